@@ -0,0 +1,227 @@
+# Copyright 2021 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compact storage of prediction results.
+
+A result is stored as a .npz file, i.e. a zip archive with one .npy member per
+array, readable with np.load. Nested keys are joined with '/', e.g.
+'structure_module/final_atom_positions'. Members stored without compression
+are memory-mapped by load_result, compressed members are decompressed when
+they are accessed.
+"""
+
+import json
+import os
+import struct
+from typing import Any, Dict, Iterator, Mapping, Optional, Sequence
+import zipfile
+
+import numpy as np
+
+PROFILES = ('minimal', 'confidence', 'full')
+
+# Keys stored by the 'minimal' profile, the other profiles add to them.
+_MINIMAL_KEYS = (
+    'plddt', 'ptm', 'iptm', 'ranking_confidence', 'num_recycles', 'tol',
+    'max_predicted_aligned_error', 'structure_module/final_atom_positions',
+    'structure_module/final_atom_mask',
+)
+_CONFIDENCE_KEYS = _MINIMAL_KEYS + ('predicted_aligned_error',)
+_PROFILE_KEYS = {'minimal': _MINIMAL_KEYS, 'confidence': _CONFIDENCE_KEYS}
+# Kept in their original precision when storing in float16.
+_FULL_PRECISION_PREFIXES = ('structure_module/',)
+_METADATA_MEMBER = '__metadata__.json'
+# Size of the fixed part of a zip local file header.
+_LOCAL_HEADER_SIZE = 30
+
+
+def _flatten(result: Mapping[str, Any], prefix: str = '') -> Dict[str, Any]:
+  flat = {}
+  for key, value in result.items():
+    if isinstance(value, Mapping):
+      flat.update(_flatten(value, f'{prefix}{key}/'))
+    else:
+      flat[prefix + key] = value
+  return flat
+
+
+def _unflatten(flat: Mapping[str, Any]) -> Dict[str, Any]:
+  result = {}
+  for key, value in flat.items():
+    *parents, name = key.split('/')
+    node = result
+    for parent in parents:
+      node = node.setdefault(parent, {})
+    node[name] = value
+  return result
+
+
+def _store_dtype(key: str, array: np.ndarray, float16: bool) -> np.dtype:
+  if (float16 and array.ndim and np.issubdtype(array.dtype, np.floating) and
+      not key.startswith(_FULL_PRECISION_PREFIXES)):
+    return np.dtype(np.float16)
+  return array.dtype
+
+
+def select_profile(result: Mapping[str, Any],
+                   profile: str = 'full') -> Dict[str, Any]:
+  """Returns the flattened arrays of result stored by the given profile."""
+  if profile not in PROFILES:
+    raise ValueError(f'Unknown result profile {profile}, expected one of '
+                     f'{PROFILES}.')
+  flat = _flatten(result)
+  if profile == 'full':
+    return flat
+  return {k: v for k, v in flat.items() if k in _PROFILE_KEYS[profile]}
+
+
+def write_result(path: str,
+                 result: Mapping[str, Any],
+                 profile: str = 'full',
+                 float16: bool = False,
+                 compress: bool = True) -> None:
+  """Writes a prediction result to a .npz file.
+
+  Args:
+    path: The output path, conventionally ending with .npz.
+    result: The (nested) prediction result.
+    profile: Which outputs to store. 'minimal' keeps the structure and the
+      scalar and per-residue confidences, 'confidence' adds the predicted
+      aligned error matrix and 'full' stores every output, including the
+      logits and representations.
+    float16: Whether to store floating arrays in float16, except the
+      structure.
+    compress: Whether to deflate the arrays. Uncompressed arrays can be
+      memory-mapped by load_result.
+  """
+  flat = select_profile(result, profile)
+  compression = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+  metadata = {'profile': profile, 'dtypes': {}}
+  tmp_path = f'{path}.{os.getpid()}.tmp'
+  with zipfile.ZipFile(tmp_path, 'w', compression=compression,
+                       allowZip64=True) as zf:
+    for key, value in flat.items():
+      array = np.asarray(value)
+      if array.dtype == object:
+        raise ValueError(f'Cannot store the object array {key}.')
+      dtype = _store_dtype(key, array, float16)
+      if dtype != array.dtype:
+        metadata['dtypes'][key] = array.dtype.str
+      with zf.open(key + '.npy', 'w', force_zip64=True) as f:
+        np.lib.format.write_array(f, array.astype(dtype, copy=False),
+                                  allow_pickle=False)
+    zf.writestr(_METADATA_MEMBER, json.dumps(metadata))
+  os.replace(tmp_path, path)
+
+
+class LazyResult(Mapping[str, np.ndarray]):
+  """Read-only view of a result written by write_result.
+
+  Arrays are keyed by their flattened key and read when accessed. Arrays
+  stored in float16 are returned in float16, see original_dtype.
+  """
+
+  def __init__(self, path: str, mmap: bool = True):
+    """Opens a result file.
+
+    Args:
+      path: The path of the .npz file.
+      mmap: Whether to memory-map the uncompressed arrays instead of reading
+        them.
+    """
+    self._path = path
+    self._mmap = mmap
+    self._zipfile = zipfile.ZipFile(path)
+    self._members = {
+        info.filename[:-len('.npy')]: info
+        for info in self._zipfile.infolist()
+        if info.filename.endswith('.npy')}
+    self.metadata = {'profile': 'full', 'dtypes': {}}
+    if _METADATA_MEMBER in self._zipfile.namelist():
+      self.metadata = json.loads(self._zipfile.read(_METADATA_MEMBER))
+
+  @property
+  def profile(self) -> str:
+    return self.metadata['profile']
+
+  def original_dtype(self, key: str) -> np.dtype:
+    """Returns the dtype of the array before it was stored."""
+    if key in self.metadata['dtypes']:
+      return np.dtype(self.metadata['dtypes'][key])
+    return self[key].dtype
+
+  def _data_offset(self, info: zipfile.ZipInfo) -> int:
+    """Returns the offset of the data of an uncompressed member."""
+    with open(self._path, 'rb') as f:
+      f.seek(info.header_offset)
+      header = f.read(_LOCAL_HEADER_SIZE)
+    name_length, extra_length = struct.unpack('<HH', header[26:30])
+    return (info.header_offset + _LOCAL_HEADER_SIZE + name_length +
+            extra_length)
+
+  def _read(self, info: zipfile.ZipInfo) -> np.ndarray:
+    with self._zipfile.open(info) as f:
+      return np.lib.format.read_array(f, allow_pickle=False)
+
+  def _memmap(self, info: zipfile.ZipInfo) -> np.ndarray:
+    offset = self._data_offset(info)
+    with open(self._path, 'rb') as f:
+      f.seek(offset)
+      version = np.lib.format.read_magic(f)
+      if version == (1, 0):
+        header = np.lib.format.read_array_header_1_0(f)
+      else:
+        header = np.lib.format.read_array_header_2_0(f)
+      shape, fortran_order, dtype = header
+      array_offset = f.tell()
+    if not shape or 0 in shape:
+      # Scalars and empty arrays cannot be memory-mapped.
+      return self._read(info)
+    return np.memmap(self._path, dtype=dtype, mode='r', offset=array_offset,
+                     shape=shape, order='F' if fortran_order else 'C')
+
+  def __getitem__(self, key: str) -> np.ndarray:
+    info = self._members[key]
+    if self._mmap and info.compress_type == zipfile.ZIP_STORED:
+      return self._memmap(info)
+    return self._read(info)
+
+  def __iter__(self) -> Iterator[str]:
+    return iter(self._members)
+
+  def __len__(self) -> int:
+    return len(self._members)
+
+  def to_dict(self, keys: Optional[Sequence[str]] = None) -> Dict[str, Any]:
+    """Returns the nested result, as passed to write_result.
+
+    Args:
+      keys: The flattened keys to read, all keys if not given.
+    """
+    keys = self._members if keys is None else keys
+    return _unflatten({k: np.asarray(self[k]) for k in keys})
+
+  def close(self) -> None:
+    self._zipfile.close()
+
+  def __enter__(self) -> 'LazyResult':
+    return self
+
+  def __exit__(self, *args) -> None:
+    self.close()
+
+
+def load_result(path: str, mmap: bool = True) -> LazyResult:
+  """Opens a result written by write_result, see LazyResult."""
+  return LazyResult(path, mmap=mmap)
@@ -0,0 +1,108 @@
+# Copyright 2021 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for results."""
+
+import os
+import tempfile
+
+from absl.testing import absltest
+from absl.testing import parameterized
+from alphafold.common import results
+import numpy as np
+
+
+def _make_result(num_res=7):
+  rng = np.random.default_rng(0)
+  return {
+      'plddt': rng.uniform(0, 100, num_res).astype(np.float32),
+      'ptm': np.array(0.5, dtype=np.float32),
+      'num_recycles': np.array(3, dtype=np.int32),
+      'predicted_aligned_error': rng.uniform(
+          0, 31, (num_res, num_res)).astype(np.float32),
+      'distogram': {
+          'logits': rng.normal(size=(num_res, num_res, 64)).astype(
+              np.float32),
+          'bin_edges': np.linspace(2, 22, 63, dtype=np.float32),
+      },
+      'structure_module': {
+          'final_atom_positions': rng.normal(size=(num_res, 37, 3)).astype(
+              np.float32),
+          'final_atom_mask': np.ones((num_res, 37), dtype=np.float32),
+      },
+      'empty': np.zeros((0, 3), dtype=np.float32),
+  }
+
+
+class ResultsTest(parameterized.TestCase):
+
+  @parameterized.parameters(True, False)
+  def test_round_trip(self, compress):
+    result = _make_result()
+    tmp_dir = self.enter_context(tempfile.TemporaryDirectory())
+    path = os.path.join(tmp_dir, 'result.npz')
+    results.write_result(path, result, compress=compress)
+
+    with results.load_result(path) as loaded:
+      self.assertEqual(loaded.profile, 'full')
+      self.assertEqual(
+          isinstance(loaded['distogram/logits'], np.memmap), not compress)
+      loaded_result = loaded.to_dict()
+    for key, value in results.select_profile(result).items():
+      np.testing.assert_array_equal(
+          results.select_profile(loaded_result)[key], value)
+
+    # The file stays readable with numpy.
+    with np.load(path) as npz:
+      np.testing.assert_array_equal(npz['plddt'], result['plddt'])
+
+  def test_profiles(self):
+    result = _make_result()
+    tmp_dir = self.enter_context(tempfile.TemporaryDirectory())
+    sizes = {}
+    for profile in results.PROFILES:
+      path = os.path.join(tmp_dir, f'{profile}.npz')
+      results.write_result(path, result, profile=profile)
+      sizes[profile] = os.path.getsize(path)
+      with results.load_result(path) as loaded:
+        self.assertIn('structure_module/final_atom_positions', loaded)
+        self.assertEqual(
+            'predicted_aligned_error' in loaded, profile != 'minimal')
+        self.assertEqual('distogram/logits' in loaded, profile == 'full')
+    self.assertLess(sizes['minimal'], sizes['confidence'])
+    self.assertLess(sizes['confidence'], sizes['full'])
+
+    with self.assertRaises(ValueError):
+      results.select_profile(result, 'unknown')
+
+  def test_float16(self):
+    result = _make_result()
+    tmp_dir = self.enter_context(tempfile.TemporaryDirectory())
+    path = os.path.join(tmp_dir, 'result.npz')
+    results.write_result(path, result, float16=True)
+    with results.load_result(path) as loaded:
+      self.assertEqual(loaded['distogram/logits'].dtype, np.float16)
+      self.assertEqual(loaded.original_dtype('distogram/logits'), np.float32)
+      np.testing.assert_allclose(
+          loaded['distogram/logits'], result['distogram']['logits'],
+          rtol=1e-3, atol=1e-3)
+      # The structure and the scalars keep their precision.
+      np.testing.assert_array_equal(
+          loaded['structure_module/final_atom_positions'],
+          result['structure_module']['final_atom_positions'])
+      self.assertEqual(loaded['ptm'].dtype, np.float32)
+
+
+if __name__ == '__main__':
+  absltest.main()
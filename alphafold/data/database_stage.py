@@ -0,0 +1,295 @@
+# Copyright 2021 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Staging of databases on fast local storage, shared between jobs.
+
+A database is a file (e.g. uniref90.fasta or one of its streamed chunks) or
+the common prefix of a set of files (e.g. an HHblits database). The first
+search of a database copies it into the stage directory, e.g. on a local NVMe
+drive or a ramdisk, and later searches on the same node read the local copy.
+Copies are checked against the size and modification time of the source
+files, indexed in a SQLite database and evicted least recently used first to
+stay within a capacity limit.
+
+Searches read a copy within DatabaseStage.reading, which holds a shared lock
+on the copy: copies being read are neither evicted nor replaced by a newer
+version, as the search tools open the database files lazily.
+"""
+
+import contextlib
+import fcntl
+import glob
+import hashlib
+import os
+import shutil
+import sqlite3
+import time
+from typing import Collection, Iterator, List, Optional, Sequence
+
+from absl import logging
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+  source TEXT PRIMARY KEY,
+  local_dir TEXT NOT NULL,
+  version TEXT NOT NULL,
+  size INTEGER NOT NULL,
+  last_access REAL NOT NULL
+)
+"""
+# Version of the entries of databases being copied.
+_STAGING = 'staging'
+# Attempts of reading to lock a copy evicted in the meantime.
+_MAX_READ_ATTEMPTS = 3
+
+
+def _source_files(source: str) -> List[str]:
+  """Returns the files of a database, a single file or a prefix."""
+  if os.path.isfile(source):
+    return [source]
+  return sorted(p for p in glob.glob(glob.escape(source) + '_*')
+                if os.path.isfile(p))
+
+
+def _files_version(paths: Sequence[str]) -> str:
+  stats = [(os.path.basename(p), os.stat(p)) for p in paths]
+  return ';'.join(f'{name}:{st.st_size}:{st.st_mtime_ns}'
+                  for name, st in stats)
+
+
+@contextlib.contextmanager
+def _exclusive_readers_lock(local_dir: str) -> Iterator[bool]:
+  """Yields whether no process is reading the copy in local_dir."""
+  with open(local_dir + '.readers', 'w') as readers_file:
+    try:
+      fcntl.flock(readers_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+      yield False
+      return
+    yield True
+
+
+class DatabaseStage:
+  """Copies of databases on local storage with LRU eviction."""
+
+  def __init__(self,
+               stage_dir: str,
+               max_size_bytes: Optional[int] = None,
+               sources: Optional[Collection[str]] = None):
+    """Initializes the database stage.
+
+    Args:
+      stage_dir: Directory holding the index and the database copies, on fast
+        local storage. It can be shared by the jobs running on a node.
+      max_size_bytes: If set, least recently used copies are evicted so that
+        the total size of the copies stays within this value. Databases larger
+        than this value are never staged.
+      sources: If set, only these databases and their streamed chunks
+        (<source>.<N>) are staged, other paths are resolved to themselves.
+    """
+    self._stage_dir = stage_dir
+    self._index_path = os.path.join(stage_dir, 'index.sqlite')
+    self._max_size_bytes = max_size_bytes
+    self._sources = None
+    if sources is not None:
+      self._sources = {os.path.abspath(s) for s in sources if s}
+    os.makedirs(stage_dir, exist_ok=True)
+    with self._connect() as conn:
+      conn.execute(_SCHEMA)
+
+  @contextlib.contextmanager
+  def _connect(self):
+    conn = sqlite3.connect(self._index_path, timeout=600)
+    try:
+      with conn:
+        yield conn
+    finally:
+      conn.close()
+
+  def _is_selected(self, source: str) -> bool:
+    if self._sources is None or source in self._sources:
+      return True
+    base, _, chunk = source.rpartition('.')
+    return chunk.isdigit() and base in self._sources
+
+  def _local_dir(self, source: str) -> str:
+    digest = hashlib.sha256(source.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(self._stage_dir, digest)
+
+  def _is_current(self, conn: sqlite3.Connection, source: str, version: str,
+                  files: Sequence[str]) -> bool:
+    """Returns whether the staged copy of source matches its files."""
+    row = conn.execute('SELECT version FROM entries WHERE source = ?',
+                       (source,)).fetchone()
+    if row is None or row[0] != version:
+      return False
+    local_dir = self._local_dir(source)
+    for path in files:
+      local_path = os.path.join(local_dir, os.path.basename(path))
+      if (not os.path.exists(local_path) or
+          os.path.getsize(local_path) != os.path.getsize(path)):
+        logging.warning('Dropping incomplete staged copy of %s', source)
+        conn.execute('DELETE FROM entries WHERE source = ?', (source,))
+        return False
+    return True
+
+  @contextlib.contextmanager
+  def reading(self, path: str) -> Iterator[str]:
+    """Yields the path to search for a database, staged if possible.
+
+    The staged copy is kept while the context is active. See resolve.
+
+    Args:
+      path: The path of a database file or the prefix of the database files.
+    """
+    for _ in range(_MAX_READ_ATTEMPTS):
+      resolved_path = self.resolve(path)
+      if resolved_path == path:
+        yield path
+        return
+      source = os.path.abspath(path)
+      local_dir = self._local_dir(source)
+      with open(local_dir + '.readers', 'w') as readers_file:
+        fcntl.flock(readers_file, fcntl.LOCK_SH)
+        files = _source_files(source)
+        with self._connect() as conn:
+          is_current = files and self._is_current(
+              conn, source, _files_version(files), files)
+        if is_current:
+          yield resolved_path
+          return
+      # Evicted or replaced before it was locked.
+      logging.info('Staged copy of %s changed, resolving it again.', source)
+    yield path
+
+  def resolve(self, path: str) -> str:
+    """Returns the path of the local copy of a database.
+
+    Stages the database if it has no current copy. If the database is not
+    staged, e.g. it is larger than the capacity, another process is copying
+    it or reading an outdated copy, returns path. The copy may be evicted
+    after it is returned, use reading to search it.
+
+    Args:
+      path: The path of a database file or the prefix of the database files.
+    """
+    source = os.path.abspath(path)
+    if not self._is_selected(source):
+      return path
+    files = _source_files(source)
+    if not files:
+      return path
+    version = _files_version(files)
+    local_path = os.path.join(self._local_dir(source),
+                              os.path.basename(source))
+    with self._connect() as conn:
+      if self._is_current(conn, source, version, files):
+        conn.execute('UPDATE entries SET last_access = ? WHERE source = ?',
+                     (time.time(), source))
+        return local_path
+
+    size = sum(os.path.getsize(p) for p in files)
+    if self._max_size_bytes is not None and size > self._max_size_bytes:
+      logging.warning('Not staging %s (%d bytes) larger than the stage '
+                      'capacity.', source, size)
+      return path
+    if self._stage(source, files, version, size):
+      return local_path
+    return path
+
+  def _stage(self, source: str, files: Sequence[str], version: str,
+             size: int) -> bool:
+    """Copies the files of source to the stage, returns whether it did."""
+    local_dir = self._local_dir(source)
+    with open(local_dir + '.lock', 'w') as lock_file:
+      try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except BlockingIOError:
+        logging.info('%s is being staged by another process, reading it in '
+                     'place.', source)
+        return False
+      with self._connect() as conn:
+        # Staged by another process while this one checked the index.
+        if self._is_current(conn, source, version, files):
+          return True
+      with _exclusive_readers_lock(local_dir) as is_unused:
+        if not is_unused:
+          logging.info('An outdated copy of %s is being read, reading it in '
+                       'place.', source)
+          return False
+        with self._connect() as conn:
+          conn.execute(
+              'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)',
+              (source, local_dir, _STAGING, size, time.time()))
+        shutil.rmtree(local_dir, ignore_errors=True)
+      with self._connect() as conn:
+        if self._max_size_bytes is not None:
+          self._evict(conn, keep=source)
+
+      try:
+        os.makedirs(local_dir, exist_ok=True)
+        logging.info('Staging %s (%d bytes) in %s', source, size, local_dir)
+        tic = time.time()
+        for path in files:
+          local_path = os.path.join(local_dir, os.path.basename(path))
+          tmp_path = f'{local_path}.{os.getpid()}.tmp'
+          shutil.copy2(path, tmp_path)
+          os.replace(tmp_path, local_path)
+        logging.info('Staged %s in %.3f seconds', source, time.time() - tic)
+      except OSError:
+        logging.exception('Failed to stage %s, reading it in place.', source)
+        shutil.rmtree(local_dir, ignore_errors=True)
+        with self._connect() as conn:
+          conn.execute('DELETE FROM entries WHERE source = ?', (source,))
+        return False
+
+      with self._connect() as conn:
+        conn.execute(
+            'UPDATE entries SET version = ?, last_access = ? WHERE source = ?',
+            (version, time.time(), source))
+    return True
+
+  def _evict(self, conn: sqlite3.Connection, keep: str) -> None:
+    """Removes least recently used copies until the size limit is met.
+
+    Copies in progress or being read are never evicted.
+    """
+    entries = conn.execute(
+        'SELECT source, local_dir, version, size FROM entries '
+        'ORDER BY last_access').fetchall()
+    total_size = sum(size for _, _, _, size in entries)
+    for source, local_dir, version, size in entries:
+      if total_size <= self._max_size_bytes:
+        break
+      if source == keep or version == _STAGING:
+        continue
+      with _exclusive_readers_lock(local_dir) as is_unused:
+        if not is_unused:
+          logging.info('Not evicting staged copy of %s, it is being read.',
+                       source)
+          continue
+        logging.info('Evicting staged copy of %s (%d bytes)', source, size)
+        conn.execute('DELETE FROM entries WHERE source = ?', (source,))
+        shutil.rmtree(local_dir, ignore_errors=True)
+      total_size -= size
+
+
+@contextlib.contextmanager
+def reading(stage: Optional[DatabaseStage], path: str) -> Iterator[str]:
+  """Yields the path to search for a database, staged if there is a stage."""
+  if stage is None:
+    yield path
+  else:
+    with stage.reading(path) as resolved_path:
+      yield resolved_path
@@ -0,0 +1,124 @@
+# Copyright 2021 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for database_stage."""
+import os
+import tempfile
+
+from absl.testing import absltest
+from alphafold.data import database_stage
+
+
+def _write(path, content):
+  with open(path, 'w') as f:
+    f.write(content)
+
+
+def _read(path):
+  with open(path) as f:
+    return f.read()
+
+
+class DatabaseStageTest(absltest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    tmp_dir = self.enter_context(tempfile.TemporaryDirectory())
+    self.db_dir = os.path.join(tmp_dir, 'databases')
+    os.makedirs(self.db_dir)
+    self.stage_dir = os.path.join(tmp_dir, 'stage')
+
+  def _database(self, name, size=10):
+    path = os.path.join(self.db_dir, name)
+    _write(path, name[0] * size)
+    return path
+
+  def test_resolve_stages_files_and_prefixes(self):
+    fasta = self._database('uniref90.fasta')
+    prefix = os.path.join(self.db_dir, 'bfd')
+    _write(prefix + '_a3m.ffdata', 'a3m')
+    _write(prefix + '_a3m.ffindex', 'index')
+    stage = database_stage.DatabaseStage(self.stage_dir)
+
+    staged_fasta = stage.resolve(fasta)
+    self.assertTrue(staged_fasta.startswith(self.stage_dir))
+    self.assertEqual(_read(staged_fasta), _read(fasta))
+    self.assertEqual(stage.resolve(fasta), staged_fasta)
+
+    staged_prefix = stage.resolve(prefix)
+    self.assertTrue(staged_prefix.startswith(self.stage_dir))
+    self.assertEqual(_read(staged_prefix + '_a3m.ffdata'), 'a3m')
+    self.assertEqual(_read(staged_prefix + '_a3m.ffindex'), 'index')
+
+    missing = os.path.join(self.db_dir, 'missing')
+    self.assertEqual(stage.resolve(missing), missing)
+    with database_stage.reading(None, fasta) as path:
+      self.assertEqual(path, fasta)
+
+  def test_only_selected_sources_are_staged(self):
+    mgnify = self._database('mgnify.fa')
+    uniref = self._database('uniref90.fasta')
+    chunk = self._database('uniref90.fasta.3')
+    stage = database_stage.DatabaseStage(self.stage_dir, sources=[uniref])
+
+    self.assertEqual(stage.resolve(mgnify), mgnify)
+    self.assertNotEqual(stage.resolve(uniref), uniref)
+    self.assertNotEqual(stage.resolve(chunk), chunk)
+
+  def test_version_change_stages_again(self):
+    fasta = self._database('uniref90.fasta')
+    stage = database_stage.DatabaseStage(self.stage_dir)
+    staged = stage.resolve(fasta)
+
+    _write(fasta, 'updated database')
+    self.assertEqual(stage.resolve(fasta), staged)
+    self.assertEqual(_read(staged), 'updated database')
+
+  def test_outdated_copy_being_read_is_not_replaced(self):
+    fasta = self._database('uniref90.fasta')
+    stage = database_stage.DatabaseStage(self.stage_dir)
+
+    with stage.reading(fasta) as staged:
+      _write(fasta, 'updated database')
+      self.assertEqual(stage.resolve(fasta), fasta)
+      self.assertEqual(_read(staged), 'u' * 10)
+    self.assertEqual(_read(stage.resolve(fasta)), 'updated database')
+
+  def test_eviction(self):
+    stage = database_stage.DatabaseStage(self.stage_dir, max_size_bytes=25)
+    a, b, c, d = (self._database(name) for name in ('a', 'b', 'c', 'd'))
+    staged_a = stage.resolve(a)
+    staged_b = stage.resolve(b)
+    # Least recently used first.
+    stage.resolve(a)
+
+    staged_c = stage.resolve(c)
+    self.assertTrue(os.path.exists(staged_a))
+    self.assertFalse(os.path.exists(staged_b))
+    self.assertTrue(os.path.exists(staged_c))
+
+    # Copies being read are not evicted.
+    with stage.reading(a) as path:
+      self.assertEqual(path, staged_a)
+      staged_d = stage.resolve(d)
+      self.assertTrue(os.path.exists(staged_a))
+      self.assertFalse(os.path.exists(staged_c))
+      self.assertTrue(os.path.exists(staged_d))
+
+    large = self._database('large', size=30)
+    self.assertEqual(stage.resolve(large), large)
+
+
+if __name__ == '__main__':
+  absltest.main()
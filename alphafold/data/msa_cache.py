@@ -0,0 +1,237 @@
+# Copyright 2021 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Persistent cache of MSA tool outputs shared between prediction jobs.
+
+Outputs are keyed by the query sequence, the searched databases (including a
+version derived from the size and modification time of their files) and the
+tool settings. They are copied into the cache, stored content-addressed under
+`objects/` and indexed in a SQLite database. Cached outputs are hard-linked
+into the job output directory instead of being copied, so these files are
+read-only and shared with the cache.
+"""
+
+import contextlib
+import dataclasses
+import glob
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import time
+from typing import Any, Dict, Optional, Sequence
+
+from absl import logging
+
+# Runner attributes which do not change the result of a search.
+_NON_KEY_ATTRIBUTES = frozenset(
+    {'binary_path', 'n_cpu', 'streaming_callback', 'database_path',
+     'databases', 'cpu_budget', 'database_stage'})
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+  key TEXT PRIMARY KEY,
+  sequence_hash TEXT NOT NULL,
+  databases TEXT NOT NULL,
+  database_version TEXT NOT NULL,
+  flags TEXT NOT NULL,
+  object TEXT NOT NULL,
+  size INTEGER NOT NULL,
+  last_access REAL NOT NULL
+)
+"""
+
+
+@dataclasses.dataclass(frozen=True)
+class CacheKey:
+  """Identifies the output of one MSA tool run."""
+  sequence_hash: str
+  databases: str
+  database_version: str
+  flags: str
+
+  @property
+  def digest(self) -> str:
+    payload = '\n'.join((self.sequence_hash, self.databases,
+                         self.database_version, self.flags))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def _runner_databases(msa_runner: Any) -> Sequence[str]:
+  if hasattr(msa_runner, 'databases'):
+    return list(msa_runner.databases)
+  return [msa_runner.database_path]
+
+
+def _runner_flags(msa_runner: Any) -> Dict[str, Any]:
+  return {
+      name: value for name, value in sorted(vars(msa_runner).items())
+      if name not in _NON_KEY_ATTRIBUTES and
+      isinstance(value, (bool, int, float, str, type(None)))
+  }
+
+
+def _file_digest(path: str) -> str:
+  sha = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(1 << 20), b''):
+      sha.update(block)
+  return sha.hexdigest()
+
+
+def _link_or_copy(src: str, dst: str) -> None:
+  """Hard-links src to dst, falling back to a copy across file systems."""
+  if os.path.lexists(dst):
+    os.remove(dst)
+  try:
+    os.link(src, dst)
+  except OSError:
+    shutil.copyfile(src, dst)
+
+
+class MsaCache:
+  """Content-addressed store of MSA tool outputs with LRU eviction."""
+
+  def __init__(self, cache_dir: str, max_size_bytes: Optional[int] = None):
+    """Initializes the MSA cache.
+
+    Args:
+      cache_dir: Directory holding the index and the cached outputs. It can be
+        shared between jobs and machines.
+      max_size_bytes: If set, least recently used outputs are evicted once the
+        total size of the cached outputs exceeds this value.
+    """
+    self._cache_dir = cache_dir
+    self._objects_dir = os.path.join(cache_dir, 'objects')
+    self._index_path = os.path.join(cache_dir, 'index.sqlite')
+    self._max_size_bytes = max_size_bytes
+    self._database_versions = {}
+    os.makedirs(self._objects_dir, exist_ok=True)
+    with self._connect() as conn:
+      conn.execute(_SCHEMA)
+
+  @contextlib.contextmanager
+  def _connect(self):
+    conn = sqlite3.connect(self._index_path, timeout=600)
+    try:
+      with conn:
+        yield conn
+    finally:
+      conn.close()
+
+  def _database_version(self, database_path: str) -> str:
+    """Returns a version string from the size and mtime of the database."""
+    if database_path not in self._database_versions:
+      paths = sorted(glob.glob(database_path) + glob.glob(database_path + '_*'))
+      stats = [(os.path.basename(p), os.stat(p)) for p in paths]
+      self._database_versions[database_path] = ';'.join(
+          f'{name}:{st.st_size}:{int(st.st_mtime)}' for name, st in stats)
+    return self._database_versions[database_path]
+
+  def make_key(self,
+               sequence: str,
+               msa_runner: Any,
+               msa_format: str,
+               max_sequences: Optional[int] = None) -> CacheKey:
+    """Builds the cache key of an MSA tool run.
+
+    Args:
+      sequence: The query sequence.
+      msa_runner: The tool wrapper, e.g. a jackhmmer.Jackhmmer or
+        hhblits.HHBlits instance.
+      msa_format: The output format stored, e.g. 'sto' or 'a3m'.
+      max_sequences: The maximum number of sequences kept in the output.
+
+    Returns:
+      The CacheKey of the run.
+    """
+    databases = _runner_databases(msa_runner)
+    flags = _runner_flags(msa_runner)
+    flags.update(tool=type(msa_runner).__name__, msa_format=msa_format,
+                 max_sequences=max_sequences)
+    return CacheKey(
+        sequence_hash=hashlib.sha256(
+            sequence.upper().encode('utf-8')).hexdigest(),
+        databases=json.dumps(
+            [os.path.basename(p) for p in databases]),
+        database_version=json.dumps(
+            [self._database_version(p) for p in databases]),
+        flags=json.dumps(flags, sort_keys=True))
+
+  def _object_path(self, object_name: str) -> str:
+    return os.path.join(self._objects_dir, object_name[:2], object_name)
+
+  def fetch(self, key: CacheKey, output_path: str) -> bool:
+    """Links the cached output for key to output_path.
+
+    The linked output is read-only, it must be removed rather than overwritten.
+
+    Args:
+      key: The CacheKey of the run.
+      output_path: Where the output should appear.
+
+    Returns:
+      Whether the output was found in the cache.
+    """
+    with self._connect() as conn:
+      row = conn.execute('SELECT object FROM entries WHERE key = ?',
+                         (key.digest,)).fetchone()
+      if row is None:
+        return False
+      object_path = self._object_path(row[0])
+      if not os.path.exists(object_path):
+        logging.warning('Dropping MSA cache entry with missing object %s',
+                        object_path)
+        conn.execute('DELETE FROM entries WHERE key = ?', (key.digest,))
+        return False
+      conn.execute('UPDATE entries SET last_access = ? WHERE key = ?',
+                   (time.time(), key.digest))
+    _link_or_copy(object_path, output_path)
+    return True
+
+  def store(self, key: CacheKey, path: str) -> None:
+    """Adds the output file at path to the cache under key."""
+    object_name = _file_digest(path)
+    object_path = self._object_path(object_name)
+    if not os.path.exists(object_path):
+      os.makedirs(os.path.dirname(object_path), exist_ok=True)
+      tmp_path = f'{object_path}.{os.getpid()}.tmp'
+      # A copy, as the output at path belongs to the job and stays writable.
+      shutil.copyfile(path, tmp_path)
+      # Cached objects are shared by hard links and must never be modified.
+      os.chmod(tmp_path, 0o444)
+      os.replace(tmp_path, object_path)
+    with self._connect() as conn:
+      conn.execute(
+          'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+          (key.digest, key.sequence_hash, key.databases, key.database_version,
+           key.flags, object_name, os.path.getsize(object_path), time.time()))
+      if self._max_size_bytes is not None:
+        self._evict(conn)
+
+  def _evict(self, conn: sqlite3.Connection) -> None:
+    """Removes least recently used objects until the size limit is met."""
+    objects = conn.execute(
+        'SELECT object, MAX(size), MAX(last_access) FROM entries '
+        'GROUP BY object ORDER BY MAX(last_access)').fetchall()
+    total_size = sum(size for _, size, _ in objects)
+    for object_name, size, _ in objects:
+      if total_size <= self._max_size_bytes:
+        break
+      logging.info('Evicting MSA cache object %s (%d bytes)', object_name, size)
+      conn.execute('DELETE FROM entries WHERE object = ?', (object_name,))
+      with contextlib.suppress(FileNotFoundError):
+        os.remove(self._object_path(object_name))
+      total_size -= size
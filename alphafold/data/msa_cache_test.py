@@ -0,0 +1,136 @@
+# Copyright 2021 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for msa_cache."""
+import os
+import tempfile
+
+from absl.testing import absltest
+from alphafold.data import msa_cache
+
+
+class _FakeRunner:
+  """Stands in for an MSA tool wrapper such as jackhmmer.Jackhmmer."""
+
+  def __init__(self, database_path, e_value=0.0001):
+    self.binary_path = '/usr/bin/jackhmmer'
+    self.database_path = database_path
+    self.n_cpu = 8
+    self.e_value = e_value
+
+
+def _write(path, content):
+  with open(path, 'w') as f:
+    f.write(content)
+
+
+def _read(path):
+  with open(path) as f:
+    return f.read()
+
+
+class MsaCacheTest(absltest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.tmp_dir = self.enter_context(tempfile.TemporaryDirectory())
+    self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+    self.database_path = os.path.join(self.tmp_dir, 'uniref90.fasta')
+    _write(self.database_path, '>a\nMKV\n')
+    self.runner = _FakeRunner(self.database_path)
+
+  def _output(self, name, content):
+    path = os.path.join(self.tmp_dir, name)
+    _write(path, content)
+    return path
+
+  def test_make_key(self):
+    cache = msa_cache.MsaCache(self.cache_dir)
+    key = cache.make_key('MKV', self.runner, 'sto', 10000)
+    self.assertEqual(key, cache.make_key('mkv', self.runner, 'sto', 10000))
+    self.assertEqual(
+        key.digest,
+        cache.make_key('MKV', _FakeRunner(self.database_path), 'sto',
+                       10000).digest)
+
+    other_database = os.path.join(self.tmp_dir, 'other', 'uniref90.fasta')
+    os.makedirs(os.path.dirname(other_database))
+    _write(other_database, '>a\nMKV\n')
+    os.utime(other_database, ns=(os.stat(self.database_path).st_atime_ns,
+                                 os.stat(self.database_path).st_mtime_ns))
+    # Settings which do not change the output are not part of the key.
+    runner = _FakeRunner(other_database)
+    runner.n_cpu = 2
+    self.assertEqual(key, cache.make_key('MKV', runner, 'sto', 10000))
+
+    for other_key in (cache.make_key('MKW', self.runner, 'sto', 10000),
+                      cache.make_key('MKV', self.runner, 'a3m', 10000),
+                      cache.make_key('MKV', self.runner, 'sto', None),
+                      cache.make_key('MKV', _FakeRunner(self.database_path,
+                                                        e_value=1.),
+                                     'sto', 10000)):
+      self.assertNotEqual(key.digest, other_key.digest)
+
+  def test_store_and_fetch(self):
+    cache = msa_cache.MsaCache(self.cache_dir)
+    key = cache.make_key('MKV', self.runner, 'sto', None)
+    fetched_path = os.path.join(self.tmp_dir, 'fetched.sto')
+    self.assertFalse(cache.fetch(key, fetched_path))
+    self.assertFalse(os.path.exists(fetched_path))
+
+    output_path = self._output('uniref90_hits.sto', '# STOCKHOLM 1.0\n')
+    cache.store(key, output_path)
+    # The output of the job is copied, it stays writable.
+    self.assertTrue(os.access(output_path, os.W_OK))
+    self.assertEqual(os.stat(output_path).st_nlink, 1)
+
+    self.assertTrue(cache.fetch(key, fetched_path))
+    self.assertEqual(_read(fetched_path), '# STOCKHOLM 1.0\n')
+    self.assertTrue(msa_cache.MsaCache(self.cache_dir).fetch(
+        key, os.path.join(self.tmp_dir, 'fetched_again.sto')))
+
+  def test_database_version_change_invalidates_entries(self):
+    cache = msa_cache.MsaCache(self.cache_dir)
+    key = cache.make_key('MKV', self.runner, 'sto', None)
+    cache.store(key, self._output('uniref90_hits.sto', '# STOCKHOLM 1.0\n'))
+
+    _write(self.database_path, '>a\nMKV\n>b\nMKW\n')
+    cache = msa_cache.MsaCache(self.cache_dir)
+    new_key = cache.make_key('MKV', self.runner, 'sto', None)
+    self.assertNotEqual(key.database_version, new_key.database_version)
+    self.assertFalse(
+        cache.fetch(new_key, os.path.join(self.tmp_dir, 'fetched.sto')))
+
+  def test_eviction(self):
+    cache = msa_cache.MsaCache(self.cache_dir, max_size_bytes=25)
+    keys = [cache.make_key(sequence, self.runner, 'sto', None)
+            for sequence in ('MKA', 'MKB', 'MKC')]
+    for i, key in enumerate(keys):
+      cache.store(key, self._output(f'{i}.sto', str(i) * 10))
+    fetched_path = os.path.join(self.tmp_dir, 'fetched.sto')
+
+    self.assertFalse(cache.fetch(keys[0], fetched_path))
+    self.assertTrue(cache.fetch(keys[1], fetched_path))
+    self.assertTrue(cache.fetch(keys[2], fetched_path))
+
+    # Outputs shared by several keys are stored and evicted once.
+    shared_key = cache.make_key('MKD', self.runner, 'sto', None)
+    cache.store(shared_key, self._output('shared.sto', '2' * 10))
+    self.assertTrue(cache.fetch(keys[1], fetched_path))
+    self.assertTrue(cache.fetch(shared_key, fetched_path))
+    self.assertTrue(cache.fetch(keys[2], fetched_path))
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -0,0 +1,96 @@
+# Copyright 2021 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Deduplication of the rows of MSA matrices.
+
+Rows are grouped by a 64-bit hash computed with a few vectorized operations
+per 8 bytes of row, so the cost is linear in the size of the matrix. Hash
+collisions are detected by comparing every row with the first row of its
+group, in which case the rows are grouped by their bytes instead.
+"""
+
+from typing import Tuple
+
+from absl import logging
+import numpy as np
+
+_HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+_HASH_SHIFT = np.uint64(29)
+
+
+def _row_words(rows: np.ndarray) -> np.ndarray:
+  """Returns the bytes of each row as a [num_rows, num_words] uint64 matrix."""
+  rows = np.ascontiguousarray(rows)
+  row_bytes = rows.view(np.uint8).reshape(rows.shape[0], -1)
+  padding = -row_bytes.shape[1] % 8
+  if padding:
+    row_bytes = np.pad(row_bytes, ((0, 0), (0, padding)))
+  return row_bytes.view(np.uint64)
+
+
+def hash_rows(rows: np.ndarray) -> np.ndarray:
+  """Returns a uint64 hash of each row of a [num_rows, num_columns] matrix."""
+  words = _row_words(rows)
+  hashes = np.full(words.shape[0], words.shape[1], dtype=np.uint64)
+  for column in range(words.shape[1]):
+    hashes ^= words[:, column]
+    hashes *= _HASH_MULTIPLIER
+    hashes ^= hashes >> _HASH_SHIFT
+  return hashes
+
+
+def _group_rows(rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+  """Groups identical rows.
+
+  Args:
+    rows: A [num_rows, num_columns] matrix.
+
+  Returns:
+    The index of the first row of each group, and the [num_rows] group of each
+    row.
+  """
+  _, first_rows, groups = np.unique(
+      hash_rows(rows), return_index=True, return_inverse=True)
+  groups = groups.reshape(-1)
+  if np.all(rows == rows[first_rows[groups]]):
+    return first_rows, groups
+  logging.warning('MSA row hash collision, comparing the rows by value.')
+  row_keys = np.ascontiguousarray(rows).view(
+      np.dtype((np.void, rows.dtype.itemsize * rows.shape[1])))
+  _, first_rows, groups = np.unique(
+      row_keys.reshape(-1), return_index=True, return_inverse=True)
+  return first_rows, groups.reshape(-1)
+
+
+def first_occurrences(rows: np.ndarray) -> np.ndarray:
+  """Returns a [num_rows] mask of the first occurrence of each distinct row."""
+  mask = np.zeros(rows.shape[0], dtype=bool)
+  if rows.shape[0]:
+    mask[_group_rows(rows)[0]] = True
+  return mask
+
+
+def rows_in(rows: np.ndarray, reference_rows: np.ndarray) -> np.ndarray:
+  """Returns a [num_rows] mask of the rows also in reference_rows.
+
+  Args:
+    rows: A [num_rows, num_columns] matrix.
+    reference_rows: A [num_reference_rows, num_columns] matrix, of the same
+      dtype as rows.
+  """
+  if not rows.shape[0] or not reference_rows.shape[0]:
+    return np.zeros(rows.shape[0], dtype=bool)
+  first_rows, groups = _group_rows(np.concatenate([reference_rows, rows]))
+  # The first row of a group is a reference row if the group has any.
+  return first_rows[groups[reference_rows.shape[0]:]] < reference_rows.shape[0]
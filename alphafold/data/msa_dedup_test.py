@@ -0,0 +1,99 @@
+# Copyright 2021 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for msa_dedup."""
+from unittest import mock
+
+from absl.testing import absltest
+from absl.testing import parameterized
+from alphafold.data import msa_dedup
+import numpy as np
+
+
+def _first_occurrences_with_set(rows):
+  seen = set()
+  mask = []
+  for row in rows.tolist():
+    mask.append(tuple(row) not in seen)
+    seen.add(tuple(row))
+  return np.array(mask, dtype=bool)
+
+
+def _rows_in_with_set(rows, reference_rows):
+  reference = {tuple(row) for row in reference_rows.tolist()}
+  return np.array([tuple(row) in reference for row in rows.tolist()],
+                  dtype=bool)
+
+
+def _colliding_rows(rng):
+  """Returns two distinct [1, 4] int32 rows with the same 64-bit hash.
+
+  Each step of the hash is invertible, so the second word of the second row
+  can be chosen to cancel the difference of the hashes after the first word.
+  """
+  words = rng.integers(0, 2**63, size=(2, 2), dtype=np.int64).view(np.uint64)
+  # The hash state of each row after its first word.
+  state = np.full(2, 2, dtype=np.uint64)
+  state ^= words[:, 0]
+  state *= msa_dedup._HASH_MULTIPLIER
+  state ^= state >> msa_dedup._HASH_SHIFT
+  words[1, 1] = state[0] ^ words[0, 1] ^ state[1]
+  rows = words.view(np.int32)
+  return rows[:1], rows[1:]
+
+
+class MsaDedupTest(parameterized.TestCase):
+
+  @parameterized.parameters(
+      (np.int32, 8), (np.int32, 3), (np.uint8, 5), (np.float32, 16))
+  def test_matches_set(self, dtype, num_columns):
+    rng = np.random.default_rng(num_columns)
+    # Few distinct values, so that many rows are duplicates.
+    rows = rng.integers(0, 2, size=(300, num_columns)).astype(dtype)
+    reference_rows = rng.integers(0, 2, size=(50, num_columns)).astype(dtype)
+
+    np.testing.assert_array_equal(msa_dedup.first_occurrences(rows),
+                                  _first_occurrences_with_set(rows))
+    np.testing.assert_array_equal(msa_dedup.rows_in(rows, reference_rows),
+                                  _rows_in_with_set(rows, reference_rows))
+
+  def test_empty(self):
+    rows = np.zeros((0, 4), dtype=np.int32)
+    reference_rows = np.ones((3, 4), dtype=np.int32)
+    self.assertEqual(msa_dedup.first_occurrences(rows).shape, (0,))
+    self.assertEqual(msa_dedup.rows_in(rows, reference_rows).shape, (0,))
+    np.testing.assert_array_equal(
+        msa_dedup.rows_in(reference_rows, rows), [False] * 3)
+
+  def test_hash_collision(self):
+    rng = np.random.default_rng(0)
+    first, second = _colliding_rows(rng)
+    self.assertFalse(np.array_equal(first, second))
+    self.assertEqual(msa_dedup.hash_rows(first)[0],
+                     msa_dedup.hash_rows(second)[0])
+
+    other = rng.integers(0, 100, size=(3, 4), dtype=np.int32)
+    rows = np.concatenate([first, other, second, first, other[:1], second])
+    with mock.patch.object(msa_dedup.logging, 'warning') as warning:
+      np.testing.assert_array_equal(msa_dedup.first_occurrences(rows),
+                                    _first_occurrences_with_set(rows))
+      np.testing.assert_array_equal(
+          msa_dedup.rows_in(rows, np.concatenate([first, other[1:]])),
+          _rows_in_with_set(rows, np.concatenate([first, other[1:]])))
+    # Both calls fell back to comparing the rows by value.
+    self.assertEqual(warning.call_count, 2)
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -15,12 +15,12 @@
 """Pairing logic for multimer data pipeline."""
 
 import collections
-from typing import cast, Dict, Iterable, List, Sequence
+from typing import Dict, Iterable, List, Sequence
 
 from alphafold.common import residue_constants
+from alphafold.data import msa_dedup
 from alphafold.data import pipeline
 import numpy as np
-import pandas as pd
 import scipy.linalg
 
 MSA_GAP_IDX = residue_constants.restypes_with_x_and_gap.index('-')
@@ -110,119 +110,132 @@ def pad_features(feature: np.ndarray, feature_name: str) -> np.ndarray:
   return feats_padded
 
 
-def _make_msa_df(chain_features: pipeline.FeatureDict) -> pd.DataFrame:
-  """Makes dataframe with msa features needed for msa pairing."""
-  chain_msa = chain_features['msa_all_seq']
+def _similarity_to_query(chain_msa: np.ndarray) -> np.ndarray:
+  """Returns the fraction of residues of each MSA row identical to the query."""
   query_seq = chain_msa[0]
-  per_seq_similarity = np.sum(
-      query_seq[None] == chain_msa, axis=-1) / float(len(query_seq))
-  per_seq_gap = np.sum(chain_msa == 21, axis=-1) / float(len(query_seq))
-  msa_df = pd.DataFrame({
-      'msa_species_identifiers':
-          chain_features['msa_species_identifiers_all_seq'],
-      'msa_row':
-          np.arange(len(
-              chain_features['msa_species_identifiers_all_seq'])),
-      'msa_similarity': per_seq_similarity,
-      'gap': per_seq_gap
-  })
-  return msa_df
-
-
-def _create_species_dict(msa_df: pd.DataFrame) -> Dict[bytes, pd.DataFrame]:
-  """Creates mapping from species to msa dataframe of that species."""
-  species_lookup = {}
-  for species, species_df in msa_df.groupby('msa_species_identifiers'):
-    species_lookup[cast(bytes, species)] = species_df
-  return species_lookup
-
-
-def _match_rows_by_sequence_similarity(this_species_msa_dfs: List[pd.DataFrame]
-                                       ) -> List[List[int]]:
-  """Finds MSA sequence pairings across chains based on sequence similarity.
-
-  Each chain's MSA sequences are first sorted by their sequence similarity to
-  their respective target sequence. The sequences are then paired, starting
-  from the sequences most similar to their target sequence.
+  return np.sum(query_seq[None] == chain_msa, axis=-1) / float(len(query_seq))
+
+
+def _sort_by_similarity(rows: np.ndarray,
+                        similarity: np.ndarray) -> np.ndarray:
+  """Sorts the MSA rows of a species as DataFrame.sort_values does.
+
+  Rows of equal similarity are ordered as by the default pandas sort, so that
+  pair_sequences pairs the same rows as the original pandas implementation
+  (kept in msa_pairing_test.py). That sort is NumPy's unstable quicksort, this
+  relies on its order of ties, which msa_pairing_test.py checks.
 
   Args:
-    this_species_msa_dfs: a list of dataframes containing MSA features for
-      sequences for a specific species.
+    rows: The MSA rows of the species, in increasing order.
+    similarity: The similarity of each row to the query.
 
   Returns:
-   A list of lists, each containing M indices corresponding to paired MSA rows,
-   where M is the number of chains.
+    The rows by decreasing similarity.
   """
-  all_paired_msa_rows = []
+  return rows[::-1][similarity[::-1].argsort(kind='quicksort')][::-1]
 
-  num_seqs = [len(species_df) for species_df in this_species_msa_dfs
-              if species_df is not None]
-  take_num_seqs = np.min(num_seqs)
 
-  sort_by_similarity = (
-      lambda x: x.sort_values('msa_similarity', axis=0, ascending=False))
+def _rows_by_species(species_codes: np.ndarray, similarity: np.ndarray,
+                     sort_species: np.ndarray) -> np.ndarray:
+  """Returns the MSA rows of a chain grouped by species and sorted.
 
-  for species_df in this_species_msa_dfs:
-    if species_df is not None:
-      species_df_sorted = sort_by_similarity(species_df)
-      msa_rows = species_df_sorted.msa_row.iloc[:take_num_seqs].values
-    else:
-      msa_rows = [-1] * take_num_seqs  # take the last 'padding' row
-    all_paired_msa_rows.append(msa_rows)
-  all_paired_msa_rows = list(np.array(all_paired_msa_rows).transpose())
-  return all_paired_msa_rows
+  Args:
+    species_codes: The species code of each MSA row.
+    similarity: The similarity of each MSA row to the query.
+    sort_species: A mask of the species codes whose rows are sorted by
+      decreasing similarity as in _sort_by_similarity, the rows of other
+      species are in an arbitrary order.
+
+  Returns:
+    The MSA rows, by increasing species code and then decreasing similarity.
+  """
+  order = np.lexsort((-similarity, species_codes))
+  sorted_codes = species_codes[order]
+  # Within a species the lexsort is stable, which is only the pandas order if
+  # no two rows have the same similarity. Sort the species with ties again.
+  ties = ((sorted_codes[1:] == sorted_codes[:-1]) &
+          (similarity[order[1:]] == similarity[order[:-1]]))
+  tied_species = np.unique(sorted_codes[1:][ties])
+  tied_species = tied_species[sort_species[tied_species]]
+  if tied_species.size:
+    starts = np.searchsorted(sorted_codes, tied_species, side='left')
+    ends = np.searchsorted(sorted_codes, tied_species, side='right')
+    for start, end in zip(starts, ends):
+      rows = np.sort(order[start:end])
+      order[start:end] = _sort_by_similarity(rows, similarity[rows])
+  return order
 
 
 def pair_sequences(examples: List[pipeline.FeatureDict]
                    ) -> Dict[int, np.ndarray]:
-  """Returns indices for paired MSA sequences across chains."""
+  """Returns indices for paired MSA sequences across chains.
 
-  num_examples = len(examples)
+  Rows of the same species in different chains are paired in order of their
+  similarity to the query of their chain, starting from the most similar
+  rows. All the species are processed together
+  with array operations: species are encoded as integers, the rows of each
+  chain are sorted by species and similarity, and the rows of equal rank
+  within a species are paired.
 
-  all_chain_species_dict = []
-  common_species = set()
-  for chain_features in examples:
-    msa_df = _make_msa_df(chain_features)
-    species_dict = _create_species_dict(msa_df)
-    all_chain_species_dict.append(species_dict)
-    common_species.update(set(species_dict))
-
-  common_species = sorted(common_species)
-  common_species.remove(b'')  # Remove target sequence species.
-
-  all_paired_msa_rows = [np.zeros(len(examples), int)]
-  all_paired_msa_rows_dict = {k: [] for k in range(num_examples)}
-  all_paired_msa_rows_dict[num_examples] = [np.zeros(len(examples), int)]
-
-  for species in common_species:
-    if not species:
-      continue
-    this_species_msa_dfs = []
-    species_dfs_present = 0
-    for species_dict in all_chain_species_dict:
-      if species in species_dict:
-        this_species_msa_dfs.append(species_dict[species])
-        species_dfs_present += 1
-      else:
-        this_species_msa_dfs.append(None)
-
-    # Skip species that are present in only one chain.
-    if species_dfs_present <= 1:
-      continue
-
-    if np.any(
-        np.array([len(species_df) for species_df in
-                  this_species_msa_dfs if
-                  isinstance(species_df, pd.DataFrame)]) > 600):
-      continue
-
-    paired_msa_rows = _match_rows_by_sequence_similarity(this_species_msa_dfs)
-    all_paired_msa_rows.extend(paired_msa_rows)
-    all_paired_msa_rows_dict[species_dfs_present].extend(paired_msa_rows)
-  all_paired_msa_rows_dict = {
-      num_examples: np.array(paired_msa_rows) for
-      num_examples, paired_msa_rows in all_paired_msa_rows_dict.items()
-  }
+  Args:
+    examples: The features of each chain.
+
+  Returns:
+    A mapping from the number of chains with a paired sequence to the indices
+    of the paired rows of each chain (-1 for chains without a sequence of the
+    species).
+  """
+  num_examples = len(examples)
+  # Fixed width bytes sort much faster than bytes objects, in the same order
+  # as species ids have no trailing null bytes.
+  chain_species = [
+      np.asarray(chain_features['msa_species_identifiers_all_seq'],
+                 dtype=np.bytes_)
+      for chain_features in examples]
+  species, species_codes = np.unique(
+      np.concatenate(chain_species), return_inverse=True)
+  species_codes = np.split(species_codes.reshape(-1),
+                           np.cumsum([len(s) for s in chain_species])[:-1])
+  if b'' not in set(species):
+    raise ValueError('The MSA has no target sequence species.')
+
+  counts = np.stack([np.bincount(codes, minlength=len(species))
+                     for codes in species_codes])
+  present = counts > 0
+  num_present = present.sum(axis=0)
+  # Skip the target sequence species, species that are present in only one
+  # chain and species with too many sequences.
+  is_paired = ((num_present > 1) & np.all(counts <= 600, axis=0) &
+               (species != b''))
+  paired_species = np.flatnonzero(is_paired)
+  take_num_seqs = np.where(present, counts, np.inf).min(axis=0)
+  take_num_seqs = take_num_seqs[paired_species].astype(int)
+
+  # The species and the rank within the species of each paired row.
+  pair_species = np.repeat(paired_species, take_num_seqs)
+  pair_rank = np.arange(len(pair_species)) - np.repeat(
+      np.cumsum(take_num_seqs) - take_num_seqs, take_num_seqs)
+
+  paired_rows = np.zeros((len(pair_species), num_examples), dtype=int)
+  for chain_index, chain_features in enumerate(examples):
+    rows = _rows_by_species(
+        species_codes[chain_index],
+        _similarity_to_query(chain_features['msa_all_seq']),
+        sort_species=is_paired)
+    species_starts = np.cumsum(counts[chain_index]) - counts[chain_index]
+    chain_rows = np.full(len(pair_species), -1)  # The last 'padding' row.
+    in_chain = present[chain_index, pair_species]
+    chain_rows[in_chain] = rows[species_starts[pair_species[in_chain]] +
+                                pair_rank[in_chain]]
+    paired_rows[:, chain_index] = chain_rows
+
+  pair_num_chains = num_present[pair_species]
+  all_paired_msa_rows_dict = {}
+  for num_chains in range(num_examples + 1):
+    rows = paired_rows[pair_num_chains == num_chains]
+    if num_chains == num_examples:
+      rows = np.concatenate([np.zeros((1, num_examples), dtype=int), rows])
+    all_paired_msa_rows_dict[num_chains] = rows if rows.size else np.array([])
   return all_paired_msa_rows_dict
 
 
@@ -444,14 +457,10 @@ def deduplicate_unpaired_sequences(
   msa_features = MSA_FEATURES
 
   for chain in np_chains:
-    # Convert the msa_all_seq numpy array to a tuple for hashing.
-    sequence_set = set(tuple(s) for s in chain['msa_all_seq'])
-    keep_rows = []
-    # Go through unpaired MSA seqs and remove any rows that correspond to the
-    # sequences that are already present in the paired MSA.
-    for row_num, seq in enumerate(chain['msa']):
-      if tuple(seq) not in sequence_set:
-        keep_rows.append(row_num)
+    # Remove the unpaired MSA rows that correspond to the sequences that are
+    # already present in the paired MSA.
+    keep_rows = ~msa_dedup.rows_in(
+        chain['msa'], chain['msa_all_seq'].astype(chain['msa'].dtype))
     for feature_name in feature_names:
       if feature_name in msa_features:
         chain[feature_name] = chain[feature_name][keep_rows]
@@ -0,0 +1,191 @@
+# Copyright 2021 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for msa_pairing."""
+from typing import cast, Dict, List
+
+from absl.testing import absltest
+from absl.testing import parameterized
+from alphafold.data import msa_pairing
+from alphafold.data import pipeline
+import numpy as np
+import pandas as pd
+
+
+def _make_msa_df(chain_features: pipeline.FeatureDict) -> pd.DataFrame:
+  """Makes dataframe with msa features needed for msa pairing."""
+  chain_msa = chain_features['msa_all_seq']
+  query_seq = chain_msa[0]
+  per_seq_similarity = msa_pairing._similarity_to_query(chain_msa)
+  per_seq_gap = np.sum(chain_msa == 21, axis=-1) / float(len(query_seq))
+  msa_df = pd.DataFrame({
+      'msa_species_identifiers':
+          chain_features['msa_species_identifiers_all_seq'],
+      'msa_row':
+          np.arange(len(
+              chain_features['msa_species_identifiers_all_seq'])),
+      'msa_similarity': per_seq_similarity,
+      'gap': per_seq_gap
+  })
+  return msa_df
+
+
+def _create_species_dict(msa_df: pd.DataFrame) -> Dict[bytes, pd.DataFrame]:
+  """Creates mapping from species to msa dataframe of that species."""
+  species_lookup = {}
+  for species, species_df in msa_df.groupby('msa_species_identifiers'):
+    species_lookup[cast(bytes, species)] = species_df
+  return species_lookup
+
+
+def _match_rows_by_sequence_similarity(this_species_msa_dfs: List[pd.DataFrame]
+                                       ) -> List[List[int]]:
+  """Finds MSA sequence pairings across chains based on sequence similarity.
+
+  Each chain's MSA sequences are first sorted by their sequence similarity to
+  their respective target sequence. The sequences are then paired, starting
+  from the sequences most similar to their target sequence.
+
+  Args:
+    this_species_msa_dfs: a list of dataframes containing MSA features for
+      sequences for a specific species.
+
+  Returns:
+   A list of lists, each containing M indices corresponding to paired MSA rows,
+   where M is the number of chains.
+  """
+  all_paired_msa_rows = []
+
+  num_seqs = [len(species_df) for species_df in this_species_msa_dfs
+              if species_df is not None]
+  take_num_seqs = np.min(num_seqs)
+
+  sort_by_similarity = (
+      lambda x: x.sort_values('msa_similarity', axis=0, ascending=False))
+
+  for species_df in this_species_msa_dfs:
+    if species_df is not None:
+      species_df_sorted = sort_by_similarity(species_df)
+      msa_rows = species_df_sorted.msa_row.iloc[:take_num_seqs].values
+    else:
+      msa_rows = [-1] * take_num_seqs  # take the last 'padding' row
+    all_paired_msa_rows.append(msa_rows)
+  all_paired_msa_rows = list(np.array(all_paired_msa_rows).transpose())
+  return all_paired_msa_rows
+
+
+def pair_sequences_with_dataframes(examples: List[pipeline.FeatureDict]
+                                   ) -> Dict[int, np.ndarray]:
+  """Returns indices for paired MSA sequences across chains.
+
+  The original implementation of msa_pairing.pair_sequences, with a pandas
+  DataFrame per species. Kept to check and benchmark pair_sequences against.
+  """
+
+  num_examples = len(examples)
+
+  all_chain_species_dict = []
+  common_species = set()
+  for chain_features in examples:
+    msa_df = _make_msa_df(chain_features)
+    species_dict = _create_species_dict(msa_df)
+    all_chain_species_dict.append(species_dict)
+    common_species.update(set(species_dict))
+
+  common_species = sorted(common_species)
+  common_species.remove(b'')  # Remove target sequence species.
+
+  all_paired_msa_rows = [np.zeros(len(examples), int)]
+  all_paired_msa_rows_dict = {k: [] for k in range(num_examples)}
+  all_paired_msa_rows_dict[num_examples] = [np.zeros(len(examples), int)]
+
+  for species in common_species:
+    if not species:
+      continue
+    this_species_msa_dfs = []
+    species_dfs_present = 0
+    for species_dict in all_chain_species_dict:
+      if species in species_dict:
+        this_species_msa_dfs.append(species_dict[species])
+        species_dfs_present += 1
+      else:
+        this_species_msa_dfs.append(None)
+
+    # Skip species that are present in only one chain.
+    if species_dfs_present <= 1:
+      continue
+
+    if np.any(
+        np.array([len(species_df) for species_df in
+                  this_species_msa_dfs if
+                  isinstance(species_df, pd.DataFrame)]) > 600):
+      continue
+
+    paired_msa_rows = _match_rows_by_sequence_similarity(this_species_msa_dfs)
+    all_paired_msa_rows.extend(paired_msa_rows)
+    all_paired_msa_rows_dict[species_dfs_present].extend(paired_msa_rows)
+  all_paired_msa_rows_dict = {
+      num_examples: np.array(paired_msa_rows) for
+      num_examples, paired_msa_rows in all_paired_msa_rows_dict.items()
+  }
+  return all_paired_msa_rows_dict
+
+
+def _random_chain(rng: np.random.Generator, num_seqs: int,
+                  num_species: int) -> pipeline.FeatureDict:
+  """Returns the uniprot MSA features of a random chain."""
+  # Few distinct residues, so that many rows of a species tie on similarity.
+  msa = rng.integers(0, 3, size=(num_seqs, 8), dtype=np.int32)
+  species = np.array(
+      [b'SPECIES%d' % i for i in rng.integers(0, num_species, num_seqs)],
+      dtype=np.object_)
+  species[rng.random(num_seqs) < 0.1] = b''
+  species[0] = b''  # The query.
+  return {'msa_all_seq': msa, 'msa_species_identifiers_all_seq': species}
+
+
+class PairSequencesTest(parameterized.TestCase):
+
+  @parameterized.parameters(
+      (2, 50, 5), (3, 200, 20), (4, 400, 10), (3, 1000, 1))
+  def test_matches_dataframes(self, num_chains, num_seqs, num_species):
+    rng = np.random.default_rng(num_chains * num_seqs)
+    for _ in range(5):
+      examples = [_random_chain(rng, num_seqs, num_species)
+                  for _ in range(num_chains)]
+      expected = pair_sequences_with_dataframes(examples)
+      paired = msa_pairing.pair_sequences(examples)
+
+      self.assertEqual(paired.keys(), expected.keys())
+      for num_paired_chains, rows in expected.items():
+        np.testing.assert_array_equal(paired[num_paired_chains], rows,
+                                      err_msg=str(num_paired_chains))
+
+  def test_ties_keep_the_pandas_order(self):
+    rows = np.array([3, 5, 8, 13, 21, 34, 55, 89])
+    similarity = np.array([0.5, 1., 0.5, 0.25, 0.5, 1., 0.5, 0.25])
+    df = pd.DataFrame({'msa_row': rows, 'msa_similarity': similarity})
+    np.testing.assert_array_equal(
+        msa_pairing._sort_by_similarity(rows, similarity),
+        df.sort_values('msa_similarity', axis=0, ascending=False).msa_row)
+
+  def test_requires_the_query_species(self):
+    chain = _random_chain(np.random.default_rng(0), 10, 2)
+    chain['msa_species_identifiers_all_seq'][:] = b'SPECIES0'
+    with self.assertRaisesRegex(ValueError, 'no target sequence species'):
+      msa_pairing.pair_sequences([chain, chain])
+
+
+if __name__ == '__main__':
+  absltest.main()
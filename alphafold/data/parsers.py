@@ -13,26 +13,104 @@
 # limitations under the License.
 
 """Functions for parsing various file formats."""
-import collections
 import dataclasses
-import itertools
+import functools
 import re
 import string
-from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Set
+from typing import (Dict, Iterable, Iterator, List, Optional, Sequence, Tuple,
+                    Set)
+
+from alphafold.data import msa_dedup
+import numpy as np
 
 # Internal import (7716).
 
 
 DeletionMatrix = Sequence[Sequence[int]]
 
+_GAP = ord('-')
+# Number of rows of the alignment matrix processed at once, bounding the size
+# of the intermediate arrays.
+_ROW_BLOCK_SIZE = 4096
+
+
+class AlignedSequences(Sequence[str]):
+  """The rows of a uint8 alignment matrix, decoded to strings on access."""
+
+  def __init__(self, residues: np.ndarray):
+    self.residues = residues
+
+  def __len__(self) -> int:
+    return self.residues.shape[0]
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      return AlignedSequences(self.residues[index])
+    return self.residues[index].tobytes().decode('ascii')
+
+
+class DeletionRows(Sequence[List[int]]):
+  """The rows of an int32 deletion matrix, converted to lists on access."""
+
+  def __init__(self, deletions: np.ndarray):
+    self.deletions = deletions
+
+  def __len__(self) -> int:
+    return self.deletions.shape[0]
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      return DeletionRows(self.deletions[index])
+    return self.deletions[index].tolist()
+
+
+def _encode_rows(sequences: Sequence[str]) -> np.ndarray:
+  """Returns the sequences as a uint8 matrix of ASCII codes."""
+  if not sequences:
+    return np.zeros((0, 0), dtype=np.uint8)
+  joined = ''.join(sequences).encode('ascii')
+  width = len(sequences[0])
+  if len(joined) != width * len(sequences):
+    raise ValueError('All the sequences of an MSA must have the same length.')
+  return np.frombuffer(joined, dtype=np.uint8).reshape(len(sequences), width)
+
 
 @dataclasses.dataclass(frozen=True)
 class Msa:
-  """Class representing a parsed MSA file."""
+  """Class representing a parsed MSA file.
+
+  The parsers return array-backed MSAs, whose sequences and deletion matrix
+  rows are decoded from a uint8 and an int32 matrix on access. The feature
+  builders use these `residues` and `deletions` matrices, which are computed
+  once for MSAs built from lists.
+  """
   sequences: Sequence[str]
   deletion_matrix: DeletionMatrix
   descriptions: Sequence[str]
 
+  @classmethod
+  def from_arrays(cls, residues: np.ndarray, deletion_matrix: np.ndarray,
+                  descriptions: Sequence[str]) -> 'Msa':
+    """Builds an MSA from its uint8 residue and int32 deletion matrices."""
+    return cls(sequences=AlignedSequences(residues),
+               deletion_matrix=DeletionRows(deletion_matrix),
+               descriptions=descriptions)
+
+  @functools.cached_property
+  def residues(self) -> np.ndarray:
+    """The aligned sequences as a [num_seq, num_res] uint8 matrix."""
+    if isinstance(self.sequences, AlignedSequences):
+      return self.sequences.residues
+    return _encode_rows(self.sequences)
+
+  @functools.cached_property
+  def deletions(self) -> np.ndarray:
+    """The deletion matrix as a [num_seq, num_res] int32 matrix."""
+    if isinstance(self.deletion_matrix, DeletionRows):
+      return self.deletion_matrix.deletions
+    deletions = np.asarray(self.deletion_matrix, dtype=np.int32)
+    return deletions.reshape(self.residues.shape)
+
   def __post_init__(self):
     if not (len(self.sequences) ==
             len(self.deletion_matrix) ==
@@ -94,83 +172,151 @@ def parse_fasta(fasta_string: str) -> Tuple[Sequence[str], Sequence[str]]:
   return sequences, descriptions
 
 
-def parse_stockholm(stockholm_string: str) -> Msa:
-  """Parses sequences and deletion matrix from stockholm format alignment.
+def iter_stockholm_blocks(
+    lines: Iterable[str]) -> Iterator[List[Tuple[str, str]]]:
+  """Yields the alignment blocks of an interleaved Stockholm file.
+
+  Stockholm files split long alignments into blocks, each with a segment of
+  every sequence. Reading the file block by block bounds the memory used by
+  the text to a single block.
 
   Args:
-    stockholm_string: The string contents of a stockholm file. The first
-      sequence in the file should be the query sequence.
+    lines: The lines of a Stockholm file, e.g. an open file.
 
-  Returns:
-    A tuple of:
-      * A list of sequences that have been aligned to the query. These
-        might contain duplicates.
-      * The deletion matrix for the alignment as a list of lists. The element
-        at `deletion_matrix[i][j]` is the number of residues deleted from
-        the aligned sequence i at residue position j.
-      * The names of the targets matched, including the jackhmmer subsequence
-        suffix.
+  Yields:
+    The (name, aligned segment) of each sequence of a block, in file order.
   """
-  name_to_sequence = collections.OrderedDict()
-  for line in stockholm_string.splitlines():
+  block = []
+  block_names = set()
+  for line in lines:
     line = line.strip()
-    if not line or line.startswith(('#', '//')):
+    if not line or line.startswith('//'):
+      if block:
+        yield block
+        block, block_names = [], set()
       continue
-    name, sequence = line.split()
-    if name not in name_to_sequence:
-      name_to_sequence[name] = ''
-    name_to_sequence[name] += sequence
+    if line.startswith('#'):
+      continue
+    name, aligned = line.split()
+    # A repeated name starts a new block, when blocks are not separated by
+    # blank lines.
+    if name in block_names:
+      yield block
+      block, block_names = [], set()
+    block_names.add(name)
+    block.append((name, aligned))
+  if block:
+    yield block
 
-  msa = []
-  deletion_matrix = []
 
-  query = ''
-  keep_columns = []
-  for seq_index, sequence in enumerate(name_to_sequence.values()):
-    if seq_index == 0:
-      # Gather the columns with gaps from the query
-      query = sequence
-      keep_columns = [i for i, res in enumerate(query) if res != '-']
+def _count_deletions(aligned: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+  """Counts the residues of each row in the query gap columns of a segment.
 
-    # Remove the columns with gaps in the query from all sequences.
-    aligned_sequence = ''.join([sequence[c] for c in keep_columns])
+  Args:
+    aligned: A [num_seq, width] segment of the alignment, the query first.
 
-    msa.append(aligned_sequence)
+  Returns:
+    The [num_seq, num_kept_columns] number of residues in the query gap
+    columns before each kept column (since the start of the segment), and the
+    [num_seq] number of residues after the last kept column.
+  """
+  query_gaps = aligned[0] == _GAP
+  keep_columns = np.flatnonzero(~query_gaps)
+  # Number of query gap columns before each kept column.
+  gaps_before = np.cumsum(query_gaps)[keep_columns]
+  gaps_before_previous = np.concatenate([[0], gaps_before[:-1]])
+  last_kept = gaps_before[-1] if keep_columns.size else 0
+  gap_columns = aligned[:, query_gaps]
+
+  deletions = np.zeros((aligned.shape[0], keep_columns.size), dtype=np.int32)
+  trailing = np.zeros(aligned.shape[0], dtype=np.int32)
+  for start in range(0, aligned.shape[0], _ROW_BLOCK_SIZE):
+    rows = slice(start, start + _ROW_BLOCK_SIZE)
+    deleted = np.zeros(
+        (gap_columns[rows].shape[0], gap_columns.shape[1] + 1),
+        dtype=np.int32)
+    np.cumsum(gap_columns[rows] != _GAP, axis=1, out=deleted[:, 1:])
+    deletions[rows] = deleted[:, gaps_before] - deleted[:, gaps_before_previous]
+    trailing[rows] = deleted[:, -1] - deleted[:, last_kept]
+  return deletions, trailing
+
+
+def _parse_stockholm_blocks(blocks: Iterable[List[Tuple[str, str]]],
+                            max_sequences: Optional[int] = None) -> Msa:
+  """Builds the array-backed Msa of a Stockholm alignment block by block."""
+  names = None
+  residue_segments = []
+  deletion_segments = []
+  for block in blocks:
+    if names is None:
+      names = [name for name, _ in block][:max_sequences]
+      row_index = {name: i for i, name in enumerate(names)}
+      # Residues in query gap columns not yet assigned to a kept column.
+      pending_deletions = np.zeros(len(names), dtype=np.int32)
+    segments = [''] * len(names)
+    for name, aligned in block:
+      if name in row_index:
+        segments[row_index[name]] = aligned
+    # Residues past the end of the query are not aligned to it.
+    aligned = _encode_rows([s[:len(segments[0])] for s in segments])
+    deletions, trailing = _count_deletions(aligned)
+    if deletions.shape[1]:
+      deletions[:, 0] += pending_deletions
+      pending_deletions = trailing
+    else:
+      pending_deletions += trailing
+    residue_segments.append(aligned[:, aligned[0] != _GAP])
+    deletion_segments.append(deletions)
 
-    # Count the number of deletions w.r.t. query.
-    deletion_vec = []
-    deletion_count = 0
-    for seq_res, query_res in zip(sequence, query):
-      if seq_res != '-' or query_res != '-':
-        if query_res == '-':
-          deletion_count += 1
-        else:
-          deletion_vec.append(deletion_count)
-          deletion_count = 0
-    deletion_matrix.append(deletion_vec)
+  if not names:
+    return Msa.from_arrays(np.zeros((0, 0), dtype=np.uint8),
+                           np.zeros((0, 0), dtype=np.int32), [])
+  return Msa.from_arrays(np.concatenate(residue_segments, axis=1),
+                         np.concatenate(deletion_segments, axis=1), names)
 
-  return Msa(sequences=msa,
-             deletion_matrix=deletion_matrix,
-             descriptions=list(name_to_sequence.keys()))
 
+def parse_stockholm(stockholm_string: str) -> Msa:
+  """Parses sequences and deletion matrix from stockholm format alignment.
 
-def parse_a3m(a3m_string: str) -> Msa:
-  """Parses sequences and deletion matrix from a3m format alignment.
+  Args:
+    stockholm_string: The string contents of a stockholm file. The first
+      sequence in the file should be the query sequence.
+
+  Returns:
+    An array-backed Msa of:
+      * The sequences that have been aligned to the query. These might
+        contain duplicates.
+      * The deletion matrix for the alignment. The element at
+        `deletion_matrix[i][j]` is the number of residues deleted from the
+        aligned sequence i at residue position j.
+      * The names of the targets matched, including the jackhmmer subsequence
+        suffix.
+  """
+  return _parse_stockholm_blocks(
+      iter_stockholm_blocks(stockholm_string.splitlines()))
+
+
+def read_stockholm(stockholm_msa_path: str,
+                   max_sequences: Optional[int] = None) -> Msa:
+  """Parses a Stockholm file without reading it all in memory.
+
+  Equivalent to parse_stockholm(truncate_stockholm_msa(...)), the file is read
+  a block at a time and only the parsed arrays are kept.
 
   Args:
-    a3m_string: The string contents of a a3m file. The first sequence in the
-      file should be the query sequence.
+    stockholm_msa_path: The path of a Stockholm file, the query first.
+    max_sequences: If set, only the first max_sequences sequences are parsed.
 
   Returns:
-    A tuple of:
-      * A list of sequences that have been aligned to the query. These
-        might contain duplicates.
-      * The deletion matrix for the alignment as a list of lists. The element
-        at `deletion_matrix[i][j]` is the number of residues deleted from
-        the aligned sequence i at residue position j.
-      * A list of descriptions, one per sequence, from the a3m file.
+    An array-backed Msa, see parse_stockholm.
   """
-  sequences, descriptions = parse_fasta(a3m_string)
+  with open(stockholm_msa_path) as f:
+    return _parse_stockholm_blocks(iter_stockholm_blocks(f), max_sequences)
+
+
+def _parse_a3m_rows(sequences: Sequence[str],
+                    descriptions: Sequence[str]) -> Msa:
+  """Parses a3m rows that do not have the same number of aligned columns."""
   deletion_matrix = []
   for msa_sequence in sequences:
     deletion_vec = []
@@ -191,6 +337,53 @@ def parse_a3m(a3m_string: str) -> Msa:
              descriptions=descriptions)
 
 
+def parse_a3m(a3m_string: str) -> Msa:
+  """Parses sequences and deletion matrix from a3m format alignment.
+
+  Args:
+    a3m_string: The string contents of a a3m file. The first sequence in the
+      file should be the query sequence.
+
+  Returns:
+    An array-backed Msa of:
+      * The sequences that have been aligned to the query. These might
+        contain duplicates.
+      * The deletion matrix for the alignment. The element at
+        `deletion_matrix[i][j]` is the number of residues deleted from the
+        aligned sequence i at residue position j.
+      * A list of descriptions, one per sequence, from the a3m file.
+  """
+  sequences, descriptions = parse_fasta(a3m_string)
+  if not sequences:
+    return Msa.from_arrays(np.zeros((0, 0), dtype=np.uint8),
+                           np.zeros((0, 0), dtype=np.int32), descriptions)
+
+  # Lower case residues are deletions, all the other characters are aligned.
+  flat = np.frombuffer(''.join(sequences).encode('ascii'), dtype=np.uint8)
+  is_deletion = (flat >= ord('a')) & (flat <= ord('z'))
+  row_lengths = np.array([len(s) for s in sequences])
+  row_starts = np.cumsum(row_lengths) - row_lengths
+  # Number of deletions in flat[:i].
+  deletion_counts = np.concatenate([[0], np.cumsum(is_deletion)])
+  row_num_res = row_lengths - np.diff(
+      deletion_counts[np.append(row_starts, len(flat))])
+  num_res = row_num_res[0]
+  if np.any(row_num_res != num_res):
+    return _parse_a3m_rows(sequences, descriptions)
+
+  num_seqs = len(sequences)
+  residues = flat[~is_deletion].reshape(num_seqs, num_res)
+  # The deletions before each aligned column, counted from the start of the
+  # file, minus those before the previous aligned column of the row (or
+  # before the start of the row).
+  deletions_before = deletion_counts[:-1][~is_deletion].reshape(
+      num_seqs, num_res)
+  deletion_matrix = np.diff(
+      deletions_before, axis=1, prepend=deletion_counts[row_starts][:, None])
+  return Msa.from_arrays(residues, deletion_matrix.astype(np.int32),
+                         descriptions)
+
+
 def _convert_sto_seq_to_a3m(
     query_non_gaps: Sequence[bool], sto_seq: str) -> Iterable[str]:
   for is_query_res_non_gap, sequence_res in zip(query_non_gaps, sto_seq):
@@ -297,73 +490,57 @@ def truncate_stockholm_msa(stockholm_msa_path: str, max_sequences: int) -> str:
   return ''.join(filtered_lines)
 
 
-def remove_empty_columns_from_stockholm_msa(stockholm_msa: str) -> str:
-  """Removes empty columns (dashes-only) from a Stockholm MSA."""
-  processed_lines = {}
-  unprocessed_lines = {}
-  for i, line in enumerate(stockholm_msa.splitlines()):
+def _remove_empty_columns(lines: Iterable[str]) -> Iterator[str]:
+  """Removes the empty columns of each block of Stockholm lines.
+
+  A block ends at its '#=GC RF' line, only the lines of the current block are
+  kept in memory.
+  """
+  block = []
+  for line in lines:
     if line.startswith('#=GC RF'):
-      reference_annotation_i = i
-      reference_annotation_line = line
       # Reached the end of this chunk of the alignment. Process chunk.
-      _, _, first_alignment = line.rpartition(' ')
-      mask = []
-      for j in range(len(first_alignment)):
-        for _, unprocessed_line in unprocessed_lines.items():
-          prefix, _, alignment = unprocessed_line.rpartition(' ')
-          if alignment[j] != '-':
-            mask.append(True)
-            break
-        else:  # Every row contained a hyphen - empty column.
-          mask.append(False)
-      # Add reference annotation for processing with mask.
-      unprocessed_lines[reference_annotation_i] = reference_annotation_line
-
-      if not any(mask):  # All columns were empty. Output empty lines for chunk.
-        for line_index in unprocessed_lines:
-          processed_lines[line_index] = ''
+      block.append(line)
+      alignments = [l.rpartition(' ')[2] for l in block]
+      reference_length = len(alignments[-1])
+      aligned = _encode_rows([a[:reference_length] for a in alignments[:-1]])
+      keep_columns = np.flatnonzero((aligned != _GAP).any(axis=0))
+      if not keep_columns.size:
+        # All columns were empty. Output empty lines for chunk.
+        yield from [''] * len(block)
       else:
-        for line_index, unprocessed_line in unprocessed_lines.items():
-          prefix, _, alignment = unprocessed_line.rpartition(' ')
-          masked_alignment = ''.join(itertools.compress(alignment, mask))
-          processed_lines[line_index] = f'{prefix} {masked_alignment}'
-
-      # Clear raw_alignments.
-      unprocessed_lines = {}
+        for block_line, alignment in zip(block, alignments):
+          prefix = block_line.rpartition(' ')[0]
+          encoded = np.frombuffer(alignment.encode('ascii'), dtype=np.uint8)
+          masked_alignment = encoded[keep_columns].tobytes().decode('ascii')
+          yield f'{prefix} {masked_alignment}'
+      block = []
     elif line.strip() and not line.startswith(('#', '//')):
-      unprocessed_lines[i] = line
+      block.append(line)
     else:
-      processed_lines[i] = line
-  return '\n'.join((processed_lines[i] for i in range(len(processed_lines))))
+      yield line
+  # Alignment lines without a reference annotation are left unchanged.
+  yield from block
 
 
-def deduplicate_stockholm_msa(stockholm_msa: str) -> str:
-  """Remove duplicate sequences (ignoring insertions wrt query)."""
-  sequence_dict = collections.defaultdict(str)
+def remove_empty_columns_from_stockholm_msa(stockholm_msa: str) -> str:
+  """Removes empty columns (dashes-only) from a Stockholm MSA."""
+  return '\n'.join(_remove_empty_columns(stockholm_msa.splitlines()))
 
-  # First we must extract all sequences from the MSA.
-  for line in stockholm_msa.splitlines():
-    # Only consider the alignments - ignore reference annotation, empty lines,
-    # descriptions or markup.
-    if line.strip() and not line.startswith(('#', '//')):
-      line = line.strip()
-      seqname, alignment = line.split()
-      sequence_dict[seqname] += alignment
 
-  seen_sequences = set()
-  seqnames = set()
-  # First alignment is the query.
-  query_align = next(iter(sequence_dict.values()))
-  mask = [c != '-' for c in query_align]  # Mask is False for insertions.
-  for seqname, alignment in sequence_dict.items():
-    # Apply mask to remove all insertions from the string.
-    masked_alignment = ''.join(itertools.compress(alignment, mask))
-    if masked_alignment in seen_sequences:
-      continue
-    else:
-      seen_sequences.add(masked_alignment)
-      seqnames.add(seqname)
+def unique_sequence_names(msa: Msa) -> Set[str]:
+  """Returns the names of the first copy of each sequence of a parsed MSA.
+
+  For a parsed Stockholm MSA the sequences are compared ignoring insertions
+  wrt query, as in deduplicate_stockholm_msa.
+  """
+  keep = msa_dedup.first_occurrences(msa.residues)
+  return {msa.descriptions[i] for i in np.flatnonzero(keep)}
 
+
+def deduplicate_stockholm_msa(stockholm_msa: str) -> str:
+  """Remove duplicate sequences (ignoring insertions wrt query)."""
+  seqnames = unique_sequence_names(parse_stockholm(stockholm_msa))
   filtered_lines = []
   for line in stockholm_msa.splitlines():
     if _keep_line(line, seqnames):
@@ -372,6 +549,28 @@ def deduplicate_stockholm_msa(stockholm_msa: str) -> str:
   return '\n'.join(filtered_lines) + '\n'
 
 
+def read_stockholm_for_templates(stockholm_msa_path: str,
+                                 msa: Msa) -> str:
+  """Reads the deduplicated Stockholm MSA used for template search.
+
+  Equivalent to remove_empty_columns_from_stockholm_msa(
+  deduplicate_stockholm_msa(...)) applied to the first len(msa) sequences of
+  the file, but the file is read a line at a time and only the lines of the
+  unique sequences are kept.
+
+  Args:
+    stockholm_msa_path: The path of a Stockholm file.
+    msa: The first sequences of the file, parsed by read_stockholm.
+
+  Returns:
+    The Stockholm MSA of the unique sequences of msa, without empty columns.
+  """
+  seqnames = unique_sequence_names(msa)
+  with open(stockholm_msa_path) as f:
+    lines = (line.rstrip('\n') for line in f if _keep_line(line, seqnames))
+    return '\n'.join(_remove_empty_columns(lines))
+
+
 def _get_hhr_line_regex_groups(
     regex_pattern: str, line: str) -> Sequence[Optional[str]]:
   match = re.match(regex_pattern, line)
@@ -0,0 +1,298 @@
+# Copyright 2021 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for parsers."""
+import collections
+import itertools
+import os
+import string
+import tempfile
+from unittest import mock
+
+from absl.testing import absltest
+from absl.testing import parameterized
+from alphafold.data import parsers
+import numpy as np
+
+
+# The list based parsers that the array based ones replaced, kept to check
+# them against.
+
+
+def _parse_stockholm_with_lists(stockholm_string):
+  """Returns the sequences, deletion matrix and names of a Stockholm MSA."""
+  name_to_sequence = collections.OrderedDict()
+  for line in stockholm_string.splitlines():
+    line = line.strip()
+    if not line or line.startswith(('#', '//')):
+      continue
+    name, sequence = line.split()
+    if name not in name_to_sequence:
+      name_to_sequence[name] = ''
+    name_to_sequence[name] += sequence
+
+  msa = []
+  deletion_matrix = []
+
+  query = ''
+  keep_columns = []
+  for seq_index, sequence in enumerate(name_to_sequence.values()):
+    if seq_index == 0:
+      # Gather the columns with gaps from the query
+      query = sequence
+      keep_columns = [i for i, res in enumerate(query) if res != '-']
+
+    # Remove the columns with gaps in the query from all sequences.
+    aligned_sequence = ''.join([sequence[c] for c in keep_columns])
+
+    msa.append(aligned_sequence)
+
+    # Count the number of deletions w.r.t. query.
+    deletion_vec = []
+    deletion_count = 0
+    for seq_res, query_res in zip(sequence, query):
+      if seq_res != '-' or query_res != '-':
+        if query_res == '-':
+          deletion_count += 1
+        else:
+          deletion_vec.append(deletion_count)
+          deletion_count = 0
+    deletion_matrix.append(deletion_vec)
+
+  return msa, deletion_matrix, list(name_to_sequence.keys())
+
+
+def _parse_a3m_with_lists(a3m_string):
+  """Returns the sequences, deletion matrix and descriptions of an A3M MSA."""
+  sequences, descriptions = parsers.parse_fasta(a3m_string)
+  deletion_matrix = []
+  for msa_sequence in sequences:
+    deletion_vec = []
+    deletion_count = 0
+    for j in msa_sequence:
+      if j.islower():
+        deletion_count += 1
+      else:
+        deletion_vec.append(deletion_count)
+        deletion_count = 0
+    deletion_matrix.append(deletion_vec)
+
+  # Make the MSA matrix out of aligned (deletion-free) sequences.
+  deletion_table = str.maketrans('', '', string.ascii_lowercase)
+  aligned_sequences = [s.translate(deletion_table) for s in sequences]
+  return aligned_sequences, deletion_matrix, descriptions
+
+
+def _remove_empty_columns_with_lists(stockholm_msa):
+  """Removes empty columns (dashes-only) from a Stockholm MSA."""
+  processed_lines = {}
+  unprocessed_lines = {}
+  for i, line in enumerate(stockholm_msa.splitlines()):
+    if line.startswith('#=GC RF'):
+      reference_annotation_i = i
+      reference_annotation_line = line
+      # Reached the end of this chunk of the alignment. Process chunk.
+      _, _, first_alignment = line.rpartition(' ')
+      mask = []
+      for j in range(len(first_alignment)):
+        for _, unprocessed_line in unprocessed_lines.items():
+          prefix, _, alignment = unprocessed_line.rpartition(' ')
+          if alignment[j] != '-':
+            mask.append(True)
+            break
+        else:  # Every row contained a hyphen - empty column.
+          mask.append(False)
+      # Add reference annotation for processing with mask.
+      unprocessed_lines[reference_annotation_i] = reference_annotation_line
+
+      if not any(mask):  # All columns were empty. Output empty lines for chunk.
+        for line_index in unprocessed_lines:
+          processed_lines[line_index] = ''
+      else:
+        for line_index, unprocessed_line in unprocessed_lines.items():
+          prefix, _, alignment = unprocessed_line.rpartition(' ')
+          masked_alignment = ''.join(itertools.compress(alignment, mask))
+          processed_lines[line_index] = f'{prefix} {masked_alignment}'
+
+      # Clear raw_alignments.
+      unprocessed_lines = {}
+    elif line.strip() and not line.startswith(('#', '//')):
+      unprocessed_lines[i] = line
+    else:
+      processed_lines[i] = line
+  return '\n'.join((processed_lines[i] for i in range(len(processed_lines))))
+
+
+def _deduplicate_stockholm_msa_with_lists(stockholm_msa):
+  """Remove duplicate sequences (ignoring insertions wrt query)."""
+  sequence_dict = collections.defaultdict(str)
+
+  # First we must extract all sequences from the MSA.
+  for line in stockholm_msa.splitlines():
+    # Only consider the alignments - ignore reference annotation, empty lines,
+    # descriptions or markup.
+    if line.strip() and not line.startswith(('#', '//')):
+      line = line.strip()
+      seqname, alignment = line.split()
+      sequence_dict[seqname] += alignment
+
+  seen_sequences = set()
+  seqnames = set()
+  # First alignment is the query.
+  query_align = next(iter(sequence_dict.values()))
+  mask = [c != '-' for c in query_align]  # Mask is False for insertions.
+  for seqname, alignment in sequence_dict.items():
+    # Apply mask to remove all insertions from the string.
+    masked_alignment = ''.join(itertools.compress(alignment, mask))
+    if masked_alignment in seen_sequences:
+      continue
+    else:
+      seen_sequences.add(masked_alignment)
+      seqnames.add(seqname)
+
+  filtered_lines = []
+  for line in stockholm_msa.splitlines():
+    if parsers._keep_line(line, seqnames):
+      filtered_lines.append(line)
+
+  return '\n'.join(filtered_lines) + '\n'
+
+
+def _random_stockholm(rng, num_seqs=12, num_columns=70, block_width=16):
+  """Returns a jackhmmer-like Stockholm MSA split into blocks.
+
+  The query has gaps, some of them runs across blocks, a few columns are gaps
+  in every row and some sequences only differ in the query gap columns.
+  """
+  names = [f'query/1-{num_columns}'] + [
+      f'UniRef90_{i}/{i}-{i + 50}' for i in range(1, num_seqs)]
+  query_gaps = rng.random(num_columns) < 0.3
+  query_gaps[block_width - 2:block_width + 3] = True
+  rows = []
+  for i in range(num_seqs):
+    row = rng.choice(list('ACDEFG-'), size=num_columns)
+    if i > 0 and i % 4 == 0:
+      # A duplicate of the previous row in the query columns.
+      row[~query_gaps] = rows[-1][~query_gaps]
+    rows.append(row)
+  rows[0][query_gaps] = '-'
+  rows = np.array(rows)
+  rows[:, 5] = '-'
+  rows[:, 3 * block_width:4 * block_width] = '-'
+
+  lines = ['# STOCKHOLM 1.0', '']
+  lines += [f'#=GS {name} DE Description of {name}' for name in names[1:]]
+  lines.append('')
+  for start in range(0, num_columns, block_width):
+    segments = [''.join(row[start:start + block_width]) for row in rows]
+    lines += [f'{name} {segment}' for name, segment in zip(names, segments)]
+    lines.append('#=GC RF ' + 'x' * len(segments[0]))
+    lines.append('')
+  lines.append('//')
+  return '\n'.join(lines) + '\n'
+
+
+def _random_a3m(rng, num_seqs=10, num_res=30, ragged=False):
+  """Returns an A3M MSA with lowercase insertions.
+
+  With ragged, one sequence has a different number of aligned columns.
+  """
+  lines = []
+  for i in range(num_seqs):
+    residues = []
+    for _ in range(num_res - (ragged and i == num_seqs - 1)):
+      if i and rng.random() < 0.2:
+        residues.extend(rng.choice(list('acdefg'), size=rng.integers(1, 4)))
+      residues.append(rng.choice(list('ACDEFG-')))
+    if i and rng.random() < 0.5:
+      residues.extend(rng.choice(list('acdefg'), size=2))
+    lines += [f'>seq{i} description {i}', ''.join(residues)]
+  return '\n'.join(lines) + '\n'
+
+
+class ParsersTest(parameterized.TestCase):
+
+  def assertMsaEqual(self, msa, sequences, deletion_matrix, descriptions):
+    self.assertEqual(list(msa.sequences), sequences)
+    self.assertEqual(list(msa.deletion_matrix), deletion_matrix)
+    self.assertEqual(list(msa.descriptions), descriptions)
+
+  def _write(self, contents):
+    path = os.path.join(self.enter_context(tempfile.TemporaryDirectory()),
+                        'msa.sto')
+    with open(path, 'w') as f:
+      f.write(contents)
+    return path
+
+  @parameterized.parameters(0, 1, 2)
+  def test_parse_stockholm_matches_lists(self, seed):
+    stockholm = _random_stockholm(np.random.default_rng(seed))
+    expected = _parse_stockholm_with_lists(stockholm)
+    self.assertMsaEqual(parsers.parse_stockholm(stockholm), *expected)
+    # Deletions are counted across row chunks.
+    with mock.patch.object(parsers, '_ROW_BLOCK_SIZE', 5):
+      self.assertMsaEqual(parsers.parse_stockholm(stockholm), *expected)
+
+  def test_parse_stockholm_without_blank_lines_between_blocks(self):
+    stockholm = _random_stockholm(np.random.default_rng(3))
+    self.assertMsaEqual(
+        parsers.parse_stockholm(stockholm.replace('\n\n', '\n')),
+        *_parse_stockholm_with_lists(stockholm))
+
+  @parameterized.parameters(None, 1, 5, 100)
+  def test_read_stockholm_matches_truncated_lists(self, max_sequences):
+    stockholm = _random_stockholm(np.random.default_rng(4))
+    path = self._write(stockholm)
+    msa = parsers.read_stockholm(path, max_sequences=max_sequences)
+    self.assertMsaEqual(
+        msa, *_parse_stockholm_with_lists(parsers.truncate_stockholm_msa(
+            path, max_sequences=max_sequences or 1000)))
+
+  @parameterized.parameters(1, 5, 12)
+  def test_read_stockholm_for_templates_matches_lists(self, max_sequences):
+    stockholm = _random_stockholm(np.random.default_rng(5))
+    path = self._write(stockholm)
+    msa = parsers.read_stockholm(path, max_sequences=max_sequences)
+    expected = _remove_empty_columns_with_lists(
+        _deduplicate_stockholm_msa_with_lists(
+            parsers.truncate_stockholm_msa(path, max_sequences)))
+    self.assertEqual(parsers.read_stockholm_for_templates(path, msa),
+                     expected)
+    self.assertEqual(
+        parsers.remove_empty_columns_from_stockholm_msa(
+            parsers.deduplicate_stockholm_msa(stockholm)),
+        _remove_empty_columns_with_lists(
+            _deduplicate_stockholm_msa_with_lists(stockholm)))
+
+  @parameterized.parameters(0, 1, 2)
+  def test_parse_a3m_matches_lists(self, seed):
+    a3m = _random_a3m(np.random.default_rng(seed))
+    msa = parsers.parse_a3m(a3m)
+    self.assertIsInstance(msa.sequences, parsers.AlignedSequences)
+    self.assertMsaEqual(msa, *_parse_a3m_with_lists(a3m))
+
+  def test_parse_ragged_a3m_matches_lists(self):
+    a3m = _random_a3m(np.random.default_rng(3), ragged=True)
+    msa = parsers.parse_a3m(a3m)
+    # Rows of different lengths are parsed row by row.
+    self.assertNotIsInstance(msa.sequences, parsers.AlignedSequences)
+    self.assertMsaEqual(msa, *_parse_a3m_with_lists(a3m))
+
+  def test_parse_empty_msas(self):
+    self.assertEmpty(parsers.parse_a3m(''))
+    self.assertEmpty(parsers.parse_stockholm('# STOCKHOLM 1.0\n//\n'))
+
+
+if __name__ == '__main__':
+  absltest.main()
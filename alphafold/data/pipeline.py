@@ -14,13 +14,19 @@
 
 """Functions for building the input features for the AlphaFold model."""
 
+import dataclasses
 import os
-from typing import Any, Mapping, MutableMapping, Optional, Sequence, Union
+from typing import (Any, Callable, List, Mapping, MutableMapping, Optional,
+                    Sequence, Union)
 from absl import logging
 from alphafold.common import residue_constants
+from alphafold.data import database_stage as database_stage_lib
+from alphafold.data import msa_cache
+from alphafold.data import msa_dedup
 from alphafold.data import msa_identifiers
 from alphafold.data import parsers
 from alphafold.data import templates
+from alphafold.data.tools import cpu_budget as cpu_budget_lib
 from alphafold.data.tools import hhblits
 from alphafold.data.tools import hhsearch
 from alphafold.data.tools import hmmsearch
@@ -52,34 +58,65 @@ def make_sequence_features(
   return features
 
 
-def make_msa_features(msas: Sequence[parsers.Msa]) -> FeatureDict:
-  """Constructs a feature dict of MSA features."""
+def _make_aa_to_id_table() -> np.ndarray:
+  table = np.full(256, -1, dtype=np.int32)
+  for res, res_id in residue_constants.HHBLITS_AA_TO_ID.items():
+    table[ord(res)] = res_id
+  return table
+
+
+# HHBLITS_AA_TO_ID indexed by ASCII code, -1 for unknown residues.
+_HHBLITS_AA_TO_ID_TABLE = _make_aa_to_id_table()
+
+
+def make_msa_features(msas: Sequence[parsers.Msa],
+                      msa_names: Optional[Sequence[str]] = None
+                      ) -> FeatureDict:
+  """Constructs a feature dict of MSA features.
+
+  Args:
+    msas: The MSAs, the rows of each MSA identical to a row of an earlier MSA
+      (or of the same MSA) are removed.
+    msa_names: Optional names of the MSAs, e.g. their databases, to log the
+      number of sequences each MSA contributes after deduplication.
+
+  Returns:
+    The MSA features.
+  """
   if not msas:
     raise ValueError('At least one MSA must be provided.')
-
-  int_msa = []
-  deletion_matrix = []
-  species_ids = []
-  seen_sequences = set()
   for msa_index, msa in enumerate(msas):
     if not msa:
       raise ValueError(f'MSA {msa_index} must contain at least one sequence.')
-    for sequence_index, sequence in enumerate(msa.sequences):
-      if sequence in seen_sequences:
-        continue
-      seen_sequences.add(sequence)
-      int_msa.append(
-          [residue_constants.HHBLITS_AA_TO_ID[res] for res in sequence])
-      deletion_matrix.append(msa.deletion_matrix[sequence_index])
+
+  keep = msa_dedup.first_occurrences(
+      np.concatenate([msa.residues for msa in msas]))
+  int_msas = []
+  deletion_matrices = []
+  species_ids = []
+  start = 0
+  for msa_index, msa in enumerate(msas):
+    kept_rows = np.flatnonzero(keep[start:start + len(msa)])
+    start += len(msa)
+    residues = msa.residues[kept_rows]
+    int_msa = _HHBLITS_AA_TO_ID_TABLE[residues]
+    if np.any(int_msa < 0):
+      raise KeyError(chr(residues[int_msa < 0][0]))
+    int_msas.append(int_msa)
+    deletion_matrices.append(msa.deletions[kept_rows])
+    for sequence_index in kept_rows:
       identifiers = msa_identifiers.get_identifiers(
           msa.descriptions[sequence_index])
       species_ids.append(identifiers.species_id.encode('utf-8'))
+    if msa_names is not None:
+      logging.info('%s MSA: %d of %d sequences kept after deduplication.',
+                   msa_names[msa_index], len(kept_rows), len(msa))
 
-  num_res = len(msas[0].sequences[0])
-  num_alignments = len(int_msa)
+  num_res = msas[0].residues.shape[1]
   features = {}
-  features['deletion_matrix_int'] = np.array(deletion_matrix, dtype=np.int32)
-  features['msa'] = np.array(int_msa, dtype=np.int32)
+  features['deletion_matrix_int'] = np.concatenate(deletion_matrices)
+  features['msa'] = np.concatenate(int_msas)
+  num_alignments = features['msa'].shape[0]
   features['num_alignments'] = np.array(
       [num_alignments] * num_res, dtype=np.int32)
   features['msa_species_identifiers'] = np.array(species_ids, dtype=np.object_)
@@ -88,26 +125,135 @@ def make_msa_features(msas: Sequence[parsers.Msa]) -> FeatureDict:
 
 def run_msa_tool(msa_runner, input_fasta_path: str, msa_out_path: str,
                  msa_format: str, use_precomputed_msas: bool,
-                 max_sto_sequences: Optional[int] = None
+                 max_sto_sequences: Optional[int] = None,
+                 msa_cache: Optional[msa_cache.MsaCache] = None
                  ) -> Mapping[str, Any]:
-  """Runs an MSA tool, checking if output already exists first."""
-  if not use_precomputed_msas or not os.path.exists(msa_out_path):
-    if msa_format == 'sto' and max_sto_sequences is not None:
-      result = msa_runner.query(input_fasta_path, max_sto_sequences)[0]  # pytype: disable=wrong-arg-count
+  """Runs an MSA tool, checking if output already exists first.
+
+  If an msa_cache is given, the output of a previous run with the same query
+  sequence, databases and tool settings is linked to msa_out_path instead of
+  running the tool, and new outputs are added to the cache.
+  """
+  return run_msa_tool_batch(
+      msa_runner, [input_fasta_path], [msa_out_path], msa_format,
+      use_precomputed_msas, max_sto_sequences, msa_cache)[0]
+
+
+def run_msa_tool_batch(msa_runner,
+                       input_fasta_paths: Sequence[str],
+                       msa_out_paths: Sequence[str],
+                       msa_format: str,
+                       use_precomputed_msas: bool,
+                       max_sto_sequences: Optional[int] = None,
+                       msa_cache: Optional[msa_cache.MsaCache] = None,
+                       read_output: bool = True
+                       ) -> List[Optional[Mapping[str, Any]]]:
+  """Runs an MSA tool on a batch of queries, see run_msa_tool.
+
+  The queries without a precomputed or cached output are searched with a
+  single msa_runner.query_multiple call, which reads the database once for the
+  whole batch.
+
+  Args:
+    read_output: Whether to return the outputs. Callers parsing the files at
+      msa_out_paths themselves, e.g. with parsers.read_stockholm, pass False so
+      that precomputed outputs are not read and search outputs are released
+      once written.
+
+  Returns:
+    The output of each query, or None for each query if read_output is False.
+  """
+  results = [None] * len(input_fasta_paths)
+  # Indices and cache keys of the queries to search.
+  pending = []
+  for index, (input_fasta_path, msa_out_path) in enumerate(
+      zip(input_fasta_paths, msa_out_paths)):
+    precomputed = use_precomputed_msas and os.path.exists(msa_out_path)
+    cache_key = None
+    if msa_cache is not None and not precomputed:
+      with open(input_fasta_path) as f:
+        query_sequence = parsers.parse_fasta(f.read())[0][0]
+      cache_key = msa_cache.make_key(
+          query_sequence, msa_runner, msa_format, max_sto_sequences)
+      if msa_cache.fetch(cache_key, msa_out_path):
+        logging.info('Found %s in the MSA cache', msa_out_path)
+        precomputed = True
+        cache_key = None
+    if precomputed:
+      if read_output:
+        results[index] = _read_msa_output(msa_out_path, msa_format,
+                                          max_sto_sequences)
     else:
-      result = msa_runner.query(input_fasta_path)[0]
-    with open(msa_out_path, 'w') as f:
-      f.write(result[msa_format])
-  else:
-    logging.warning('Reading MSA from file %s', msa_out_path)
+      pending.append((index, cache_key))
+
+  if pending:
+    query_paths = [input_fasta_paths[index] for index, _ in pending]
     if msa_format == 'sto' and max_sto_sequences is not None:
-      precomputed_msa = parsers.truncate_stockholm_msa(
-          msa_out_path, max_sto_sequences)
-      result = {'sto': precomputed_msa}
+      outputs = msa_runner.query_multiple(query_paths, max_sto_sequences)  # pytype: disable=wrong-arg-count
     else:
-      with open(msa_out_path, 'r') as f:
-        result = {msa_format: f.read()}
-  return result
+      outputs = msa_runner.query_multiple(query_paths)
+    for (index, cache_key), output in zip(pending, outputs):
+      result = output[0]
+      msa_out_path = msa_out_paths[index]
+      # Never write through a hard link shared with the MSA cache.
+      if os.path.lexists(msa_out_path):
+        os.remove(msa_out_path)
+      with open(msa_out_path, 'w') as f:
+        f.write(result[msa_format])
+      if cache_key is not None:
+        msa_cache.store(cache_key, msa_out_path)
+      if read_output:
+        results[index] = result
+  return results
+
+
+def _read_msa_output(msa_out_path: str, msa_format: str,
+                     max_sto_sequences: Optional[int]) -> Mapping[str, Any]:
+  logging.warning('Reading MSA from file %s', msa_out_path)
+  if msa_format == 'sto' and max_sto_sequences is not None:
+    precomputed_msa = parsers.truncate_stockholm_msa(
+        msa_out_path, max_sto_sequences)
+    return {'sto': precomputed_msa}
+  with open(msa_out_path, 'r') as f:
+    return {msa_format: f.read()}
+
+
+def submit_batch(executor: concurrent.futures.Executor,
+                 fn: Callable[[Sequence[Any]], Sequence[Any]],
+                 queries: Sequence[Any]) -> List[concurrent.futures.Future]:
+  """Submits fn(queries) to executor as one task.
+
+  Args:
+    executor: The executor.
+    fn: A function returning a result per query.
+    queries: The queries.
+
+  Returns:
+    A future per query, with its result.
+  """
+  query_futures = [concurrent.futures.Future() for _ in queries]
+
+  def set_query_results(batch_future):
+    if batch_future.cancelled():
+      for query_future in query_futures:
+        query_future.cancel()
+    elif batch_future.exception() is not None:
+      for query_future in query_futures:
+        query_future.set_exception(batch_future.exception())
+    else:
+      for query_future, result in zip(query_futures, batch_future.result()):
+        query_future.set_result(result)
+
+  executor.submit(fn, queries).add_done_callback(set_query_results)
+  return query_futures
+
+
+@dataclasses.dataclass(frozen=True)
+class SearchQuery:
+  """A sequence to search, see DataPipeline.submit_batched_searches."""
+  input_fasta_path: str
+  msa_output_dir: str
+  input_sequence: str
 
 
 class DataPipeline:
@@ -127,100 +273,191 @@ class DataPipeline:
                mgnify_max_hits: int = 501,
                uniref_max_hits: int = 10000,
                use_precomputed_msas: bool = False,
-               n_parallel_msa: int = 3):
+               n_parallel_msa: int = 3,
+               msa_cache: Optional[msa_cache.MsaCache] = None,
+               cpu_budget: Optional[cpu_budget_lib.CpuBudget] = None,
+               database_stage: Optional[
+                   database_stage_lib.DatabaseStage] = None):
     """Initializes the data pipeline."""
     self._use_small_bfd = use_small_bfd
     self.jackhmmer_uniref90_runner = jackhmmer.Jackhmmer(
         binary_path=jackhmmer_binary_path,
-        database_path=uniref90_database_path)
+        database_path=uniref90_database_path,
+        cpu_budget=cpu_budget,
+        database_stage=database_stage)
     if use_small_bfd:
       self.jackhmmer_small_bfd_runner = jackhmmer.Jackhmmer(
           binary_path=jackhmmer_binary_path,
-          database_path=small_bfd_database_path)
+          database_path=small_bfd_database_path,
+          cpu_budget=cpu_budget,
+          database_stage=database_stage)
     else:
       self.hhblits_bfd_uniref_runner = hhblits.HHBlits(
           binary_path=hhblits_binary_path,
-          databases=[bfd_database_path, uniref30_database_path])
+          databases=[bfd_database_path, uniref30_database_path],
+          cpu_budget=cpu_budget,
+          database_stage=database_stage)
     self.jackhmmer_mgnify_runner = jackhmmer.Jackhmmer(
         binary_path=jackhmmer_binary_path,
-        database_path=mgnify_database_path)
+        database_path=mgnify_database_path,
+        cpu_budget=cpu_budget,
+        database_stage=database_stage)
     self.template_searcher = template_searcher
     self.template_featurizer = template_featurizer
     self.mgnify_max_hits = mgnify_max_hits
     self.uniref_max_hits = uniref_max_hits
     self.use_precomputed_msas = use_precomputed_msas
     self.n_parallel_msa = n_parallel_msa
-
-  def jackhmmer_uniref90_and_pdb_templates_caller(self, input_fasta_path, msa_output_dir, input_sequence):
-    uniref90_out_path = os.path.join(msa_output_dir, 'uniref90_hits.sto')
-    jackhmmer_uniref90_result = run_msa_tool(
+    self.msa_cache = msa_cache
+    self.cpu_budget = cpu_budget
+    self.database_stage = database_stage
+
+  def jackhmmer_uniref90_and_pdb_templates_caller(
+      self, queries: Sequence[SearchQuery]) -> List[Any]:
+    uniref90_out_paths = [os.path.join(q.msa_output_dir, 'uniref90_hits.sto')
+                          for q in queries]
+    run_msa_tool_batch(
         msa_runner=self.jackhmmer_uniref90_runner,
-        input_fasta_path=input_fasta_path,
-        msa_out_path=uniref90_out_path,
+        input_fasta_paths=[q.input_fasta_path for q in queries],
+        msa_out_paths=uniref90_out_paths,
         msa_format='sto',
         use_precomputed_msas=self.use_precomputed_msas,
-        max_sto_sequences=self.uniref_max_hits)
-
-    msa_for_templates = jackhmmer_uniref90_result['sto']
-    msa_for_templates = parsers.deduplicate_stockholm_msa(msa_for_templates)
-    msa_for_templates = parsers.remove_empty_columns_from_stockholm_msa(
-        msa_for_templates)
-
-    if self.template_searcher.input_format == 'sto':
-      pdb_templates_result = self.template_searcher.query(msa_for_templates)
-    elif self.template_searcher.input_format == 'a3m':
-      uniref90_msa_as_a3m = parsers.convert_stockholm_to_a3m(msa_for_templates)
-      pdb_templates_result = self.template_searcher.query(uniref90_msa_as_a3m)
-    else:
-      raise ValueError('Unrecognized template input format: '
-                       f'{self.template_searcher.input_format}')
-
-    pdb_hits_out_path = os.path.join(
-        msa_output_dir, f'pdb_hits.{self.template_searcher.output_format}')
-    with open(pdb_hits_out_path, 'w') as f:
-      f.write(pdb_templates_result)
-
-    uniref90_msa = parsers.parse_stockholm(jackhmmer_uniref90_result['sto'])
-    uniref90_msa = uniref90_msa.truncate(max_seqs=self.uniref_max_hits)
-
-    pdb_template_hits = self.template_searcher.get_template_hits(
-        output_string=pdb_templates_result, input_sequence=input_sequence)
-    return uniref90_msa, pdb_template_hits
-
-  def jackhmmer_mgnify_caller(self, input_fasta_path, msa_output_dir):
-    mgnify_out_path = os.path.join(msa_output_dir, 'mgnify_hits.sto')
-    jackhmmer_mgnify_result = run_msa_tool(
+        max_sto_sequences=self.uniref_max_hits,
+        msa_cache=self.msa_cache,
+        read_output=False)
+
+    uniref90_msas = []
+    msas_for_templates = []
+    for uniref90_out_path in uniref90_out_paths:
+      uniref90_msa = parsers.read_stockholm(
+          uniref90_out_path, max_sequences=self.uniref_max_hits)
+      uniref90_msas.append(uniref90_msa)
+      msa_for_templates = parsers.read_stockholm_for_templates(
+          uniref90_out_path, uniref90_msa)
+      if self.template_searcher.input_format == 'a3m':
+        msa_for_templates = parsers.convert_stockholm_to_a3m(
+            msa_for_templates)
+      elif self.template_searcher.input_format != 'sto':
+        raise ValueError('Unrecognized template input format: '
+                         f'{self.template_searcher.input_format}')
+      msas_for_templates.append(msa_for_templates)
+    pdb_templates_results = self.template_searcher.query_multiple(
+        msas_for_templates)
+
+    outputs = []
+    for query, uniref90_msa, pdb_templates_result in zip(
+        queries, uniref90_msas, pdb_templates_results):
+      pdb_hits_out_path = os.path.join(
+          query.msa_output_dir,
+          f'pdb_hits.{self.template_searcher.output_format}')
+      with open(pdb_hits_out_path, 'w') as f:
+        f.write(pdb_templates_result)
+
+
+      pdb_template_hits = self.template_searcher.get_template_hits(
+          output_string=pdb_templates_result,
+          input_sequence=query.input_sequence)
+      outputs.append((uniref90_msa, pdb_template_hits))
+    return outputs
+
+  def jackhmmer_mgnify_caller(
+      self, queries: Sequence[SearchQuery]) -> List[parsers.Msa]:
+    mgnify_out_paths = [os.path.join(q.msa_output_dir, 'mgnify_hits.sto')
+                        for q in queries]
+    run_msa_tool_batch(
         msa_runner=self.jackhmmer_mgnify_runner,
-        input_fasta_path=input_fasta_path,
-        msa_out_path=mgnify_out_path,
+        input_fasta_paths=[q.input_fasta_path for q in queries],
+        msa_out_paths=mgnify_out_paths,
         msa_format='sto',
         use_precomputed_msas=self.use_precomputed_msas,
-        max_sto_sequences=self.mgnify_max_hits)
+        max_sto_sequences=self.mgnify_max_hits,
+        msa_cache=self.msa_cache,
+        read_output=False)
 
-    mgnify_msa = parsers.parse_stockholm(jackhmmer_mgnify_result['sto'])
-    return mgnify_msa
+    return [parsers.read_stockholm(path, max_sequences=self.mgnify_max_hits)
+            for path in mgnify_out_paths]
 
-  def hhblits_bfd_uniref_caller(self, input_fasta_path, msa_output_dir):
-    bfd_out_path = os.path.join(msa_output_dir, 'bfd_uniref_hits.a3m')
-    hhblits_bfd_uniref_result = run_msa_tool(
+  def hhblits_bfd_uniref_caller(
+      self, queries: Sequence[SearchQuery]) -> List[parsers.Msa]:
+    hhblits_bfd_uniref_results = run_msa_tool_batch(
         msa_runner=self.hhblits_bfd_uniref_runner,
-        input_fasta_path=input_fasta_path,
-        msa_out_path=bfd_out_path,
+        input_fasta_paths=[q.input_fasta_path for q in queries],
+        msa_out_paths=[os.path.join(q.msa_output_dir, 'bfd_uniref_hits.a3m')
+                       for q in queries],
         msa_format='a3m',
-        use_precomputed_msas=self.use_precomputed_msas)
-    bfd_msa = parsers.parse_a3m(hhblits_bfd_uniref_result['a3m'])
-    return bfd_msa
-
-  def jackhmmer_small_bfd_caller(self, input_fasta_path, msa_output_dir):
-    bfd_out_path = os.path.join(msa_output_dir, 'small_bfd_hits.sto')
-    jackhmmer_small_bfd_result = run_msa_tool(
+        use_precomputed_msas=self.use_precomputed_msas,
+        msa_cache=self.msa_cache)
+    return [parsers.parse_a3m(result['a3m'])
+            for result in hhblits_bfd_uniref_results]
+
+  def jackhmmer_small_bfd_caller(
+      self, queries: Sequence[SearchQuery]) -> List[parsers.Msa]:
+    small_bfd_out_paths = [
+        os.path.join(q.msa_output_dir, 'small_bfd_hits.sto') for q in queries]
+    run_msa_tool_batch(
         msa_runner=self.jackhmmer_small_bfd_runner,
-        input_fasta_path=input_fasta_path,
-        msa_out_path=bfd_out_path,
+        input_fasta_paths=[q.input_fasta_path for q in queries],
+        msa_out_paths=small_bfd_out_paths,
         msa_format='sto',
-        use_precomputed_msas=self.use_precomputed_msas)
-    bfd_msa = parsers.parse_stockholm(jackhmmer_small_bfd_result['sto'])
-    return bfd_msa
+        use_precomputed_msas=self.use_precomputed_msas,
+        msa_cache=self.msa_cache,
+        read_output=False)
+    return [parsers.read_stockholm(path) for path in small_bfd_out_paths]
+
+  def submit_batched_searches(
+      self,
+      executor: concurrent.futures.Executor,
+      queries: Sequence[SearchQuery]
+      ) -> List[List[concurrent.futures.Future]]:
+    """Submits the MSA and template searches of a batch of sequences.
+
+    Each database is searched by a single task for all the queries, reading
+    the database once for the whole batch.
+
+    Args:
+      executor: The executor running the searches, possibly shared with the
+        searches of other sequences.
+      queries: The sequences. Their FASTA files must exist until the searches
+        are done.
+
+    Returns:
+      For each query, the futures of the uniref90 and template search, of the
+      MGnify search and of the BFD search, as consumed by make_features.
+    """
+    if self._use_small_bfd:
+      bfd_caller = self.jackhmmer_small_bfd_caller
+    else:
+      bfd_caller = self.hhblits_bfd_uniref_caller
+    batch_futures = [
+        submit_batch(executor, caller, queries)
+        for caller in (self.jackhmmer_uniref90_and_pdb_templates_caller,
+                       self.jackhmmer_mgnify_caller, bfd_caller)]
+    return [list(query_futures) for query_futures in zip(*batch_futures)]
+
+  def submit_searches(
+      self,
+      executor: concurrent.futures.Executor,
+      input_fasta_path: str,
+      msa_output_dir: str,
+      input_sequence: str) -> List[concurrent.futures.Future]:
+    """Submits the MSA and template searches of a sequence to executor.
+
+    Args:
+      executor: The executor running the searches, possibly shared with the
+        searches of other sequences.
+      input_fasta_path: The path of a FASTA file with the sequence, which must
+        exist until the searches are done.
+      msa_output_dir: The directory of the MSA outputs of the sequence.
+      input_sequence: The sequence.
+
+    Returns:
+      The futures of the uniref90 and template search, of the MGnify search
+      and of the BFD search, as consumed by make_features.
+    """
+    query = SearchQuery(input_fasta_path=input_fasta_path,
+                        msa_output_dir=msa_output_dir,
+                        input_sequence=input_sequence)
+    return self.submit_batched_searches(executor, [query])[0]
 
   def process(self, input_fasta_path: str, msa_output_dir: str, stopat: int) -> FeatureDict:
     """Runs alignment tools on the input sequence and creates features."""
@@ -232,20 +469,21 @@ class DataPipeline:
           f'More than one input sequence found in {input_fasta_path}.')
     input_sequence = input_seqs[0]
     input_description = input_descs[0]
-    num_res = len(input_sequence)
-
-    futures = []
-    if self._use_small_bfd:
-      with concurrent.futures.ThreadPoolExecutor(max_workers=self.n_parallel_msa) as executor:
-        futures.append(executor.submit(self.jackhmmer_uniref90_and_pdb_templates_caller, input_fasta_path, msa_output_dir, input_sequence))
-        futures.append(executor.submit(self.jackhmmer_mgnify_caller, input_fasta_path, msa_output_dir))
-        futures.append(executor.submit(self.jackhmmer_small_bfd_caller, input_fasta_path, msa_output_dir))
-    else:
-      with concurrent.futures.ThreadPoolExecutor(max_workers=self.n_parallel_msa) as executor:
-        futures.append(executor.submit(self.jackhmmer_uniref90_and_pdb_templates_caller, input_fasta_path, msa_output_dir, input_sequence))
-        futures.append(executor.submit(self.jackhmmer_mgnify_caller, input_fasta_path, msa_output_dir))
-        futures.append(executor.submit(self.hhblits_bfd_uniref_caller, input_fasta_path, msa_output_dir))
 
+    with concurrent.futures.ThreadPoolExecutor(max_workers=self.n_parallel_msa) as executor:
+      futures = self.submit_searches(
+          executor, input_fasta_path, msa_output_dir, input_sequence)
+    return self.make_features(
+        futures, input_sequence, input_description, stopat)
+
+  def make_features(
+      self,
+      futures: Sequence[concurrent.futures.Future],
+      input_sequence: str,
+      input_description: str,
+      stopat: int) -> FeatureDict:
+    """Creates the features of a sequence from its submit_searches futures."""
+    num_res = len(input_sequence)
     uniref90_msa, pdb_template_hits = futures[0].result()
     mgnify_msa = futures[1].result()
     bfd_msa = futures[2].result()
@@ -264,7 +502,8 @@ class DataPipeline:
         description=input_description,
         num_res=num_res)
 
-    msa_features = make_msa_features((uniref90_msa, bfd_msa, mgnify_msa))
+    msa_features = make_msa_features((uniref90_msa, bfd_msa, mgnify_msa),
+                                     ('Uniref90', 'BFD', 'MGnify'))
 
     logging.info('Uniref90 MSA size: %d sequences.', len(uniref90_msa))
     logging.info('BFD MSA size: %d sequences.', len(bfd_msa))
@@ -277,3 +516,7 @@ class DataPipeline:
                    templates_result.features['template_domain_names'].shape[0])
 
     return {**sequence_features, **msa_features, **templates_result.features}
+
+  def close(self) -> None:
+    """Shuts down the worker processes of the template featurizer."""
+    self.template_featurizer.close()
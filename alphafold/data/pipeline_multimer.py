@@ -15,18 +15,20 @@
 """Functions for building the features for the AlphaFold multimer model."""
 
 import collections
+import concurrent.futures
 import contextlib
 import copy
 import dataclasses
 import json
 import os
 import tempfile
-from typing import Mapping, MutableMapping, Sequence
+from typing import Dict, List, Mapping, MutableMapping, Optional, Sequence
 
 from absl import logging
 from alphafold.common import protein
 from alphafold.common import residue_constants
 from alphafold.data import feature_processing
+from alphafold.data import msa_cache
 from alphafold.data import msa_pairing
 from alphafold.data import parsers
 from alphafold.data import pipeline
@@ -61,6 +63,13 @@ def _make_chain_id_map(*,
   return chain_id_map
 
 
+@dataclasses.dataclass(frozen=True)
+class _ChainSearches:
+  """The pending searches of one chain, see DataPipeline.process."""
+  monomer_futures: Sequence[concurrent.futures.Future]
+  all_seq_future: Optional[concurrent.futures.Future]
+
+
 @contextlib.contextmanager
 def temp_fasta_file(fasta_str: str):
   with tempfile.NamedTemporaryFile('w', suffix='.fasta') as fasta_file:
@@ -175,7 +184,9 @@ class DataPipeline:
                jackhmmer_binary_path: str,
                uniprot_database_path: str,
                max_uniprot_hits: int = 50000,
-               use_precomputed_msas: bool = False):
+               use_precomputed_msas: bool = False,
+               msa_cache: Optional[msa_cache.MsaCache] = None,
+               max_parallel_searches: Optional[int] = None):
     """Initializes the data pipeline.
 
     Args:
@@ -186,56 +197,110 @@ class DataPipeline:
         will be searched with jackhmmer and used for MSA pairing.
       max_uniprot_hits: The maximum number of hits to return from uniprot.
       use_precomputed_msas: Whether to use pre-existing MSAs; see run_alphafold.
+      msa_cache: Optional cache of MSA tool outputs shared between jobs.
+      max_parallel_searches: The maximum number of databases searched at the
+        same time, each for all the chains, n_parallel_msa of the monomer
+        pipeline by default.
     """
     self._monomer_data_pipeline = monomer_data_pipeline
     self._uniprot_msa_runner = jackhmmer.Jackhmmer(
         binary_path=jackhmmer_binary_path,
-        database_path=uniprot_database_path)
+        database_path=uniprot_database_path,
+        cpu_budget=monomer_data_pipeline.cpu_budget,
+        database_stage=monomer_data_pipeline.database_stage)
     self._max_uniprot_hits = max_uniprot_hits
     self.use_precomputed_msas = use_precomputed_msas
+    self.msa_cache = msa_cache
+    self._max_parallel_searches = (
+        max_parallel_searches or monomer_data_pipeline.n_parallel_msa)
 
-  def _process_single_chain(
+  def _submit_searches(
       self,
-      chain_id: str,
-      sequence: str,
-      description: str,
+      executor: concurrent.futures.Executor,
+      exit_stack: contextlib.ExitStack,
+      chain_id_map: Mapping[str, _FastaChain],
       msa_output_dir: str,
-      is_homomer_or_monomer: bool, stopat: int) -> pipeline.FeatureDict:
-    """Runs the monomer pipeline on a single chain."""
-    chain_fasta_str = f'>chain_{chain_id}\n{sequence}\n'
-    chain_msa_output_dir = os.path.join(msa_output_dir, chain_id)
-    if not os.path.exists(chain_msa_output_dir):
-      os.makedirs(chain_msa_output_dir)
-    with temp_fasta_file(chain_fasta_str) as chain_fasta_path:
+      is_homomer_or_monomer: bool) -> Dict[str, _ChainSearches]:
+    """Submits the searches of the unique chains to the shared executor.
+
+    Each database is searched once for all the unique chains, see
+    pipeline.DataPipeline.submit_batched_searches.
+
+    Returns:
+      The searches of each unique sequence.
+    """
+    queries = {}
+    for chain_id, fasta_chain in chain_id_map.items():
+      if fasta_chain.sequence in queries:
+        continue
+      chain_fasta_str = f'>chain_{chain_id}\n{fasta_chain.sequence}\n'
+      chain_msa_output_dir = os.path.join(msa_output_dir, chain_id)
+      if not os.path.exists(chain_msa_output_dir):
+        os.makedirs(chain_msa_output_dir)
+      # The FASTA file must outlive the searches of the chain.
+      chain_fasta_path = exit_stack.enter_context(
+          temp_fasta_file(chain_fasta_str))
       logging.info('Running monomer pipeline on chain %s: %s',
-                   chain_id, description)
-      chain_features = self._monomer_data_pipeline.process(
+                   chain_id, fasta_chain.description)
+      queries[fasta_chain.sequence] = pipeline.SearchQuery(
           input_fasta_path=chain_fasta_path,
-          msa_output_dir=chain_msa_output_dir, stopat=stopat)
-
-      # We only construct the pairing features if there are 2 or more unique
-      # sequences.
-      if not is_homomer_or_monomer:
-        all_seq_msa_features = self._all_seq_msa_features(chain_fasta_path,
-                                                          chain_msa_output_dir)
-        chain_features.update(all_seq_msa_features)
+          msa_output_dir=chain_msa_output_dir,
+          input_sequence=fasta_chain.sequence)
+
+    monomer_futures = self._monomer_data_pipeline.submit_batched_searches(
+        executor, list(queries.values()))
+    # We only construct the pairing features if there are 2 or more unique
+    # sequences.
+    all_seq_futures = [None] * len(queries)
+    if not is_homomer_or_monomer:
+      all_seq_futures = pipeline.submit_batch(
+          executor, self._all_seq_msa_features, list(queries.values()))
+    return {
+        sequence: _ChainSearches(monomer_futures=chain_monomer_futures,
+                                 all_seq_future=all_seq_future)
+        for sequence, chain_monomer_futures, all_seq_future in zip(
+            queries, monomer_futures, all_seq_futures)}
+
+  def _chain_features(
+      self,
+      searches: _ChainSearches,
+      sequence: str,
+      description: str,
+      stopat: int) -> pipeline.FeatureDict:
+    """Runs the monomer pipeline on a single chain from its searches."""
+    chain_features = self._monomer_data_pipeline.make_features(
+        searches.monomer_futures, sequence, description, stopat)
+    if searches.all_seq_future is not None:
+      chain_features.update(searches.all_seq_future.result())
     return chain_features
 
-  def _all_seq_msa_features(self, input_fasta_path, msa_output_dir):
+  def _all_seq_msa_features(
+      self, queries: Sequence[pipeline.SearchQuery]
+      ) -> List[pipeline.FeatureDict]:
     """Get MSA features for unclustered uniprot, for pairing."""
-    out_path = os.path.join(msa_output_dir, 'uniprot_hits.sto')
-    result = pipeline.run_msa_tool(
-        self._uniprot_msa_runner, input_fasta_path, out_path, 'sto',
-        self.use_precomputed_msas)
-    msa = parsers.parse_stockholm(result['sto'])
-    msa = msa.truncate(max_seqs=self._max_uniprot_hits)
-    all_seq_features = pipeline.make_msa_features([msa])
+    uniprot_out_paths = [
+        os.path.join(query.msa_output_dir, 'uniprot_hits.sto')
+        for query in queries]
+    # Truncated while Jackhmmer reads its output, which can reach several GB.
+    pipeline.run_msa_tool_batch(
+        self._uniprot_msa_runner,
+        [query.input_fasta_path for query in queries],
+        uniprot_out_paths,
+        'sto', self.use_precomputed_msas,
+        max_sto_sequences=self._max_uniprot_hits,
+        msa_cache=self.msa_cache,
+        read_output=False)
     valid_feats = msa_pairing.MSA_FEATURES + (
         'msa_species_identifiers',
     )
-    feats = {f'{k}_all_seq': v for k, v in all_seq_features.items()
-             if k in valid_feats}
-    return feats
+    all_feats = []
+    for uniprot_out_path in uniprot_out_paths:
+      msa = parsers.read_stockholm(uniprot_out_path,
+                                   max_sequences=self._max_uniprot_hits)
+      all_seq_features = pipeline.make_msa_features([msa])
+      all_feats.append({f'{k}_all_seq': v for k, v in all_seq_features.items()
+                        if k in valid_feats})
+    return all_feats
 
   def process(self,
               input_fasta_path: str,
@@ -256,22 +321,35 @@ class DataPipeline:
     all_chain_features = {}
     sequence_features = {}
     is_homomer_or_monomer = len(set(input_seqs)) == 1
-    for chain_id, fasta_chain in chain_id_map.items():
-      if fasta_chain.sequence in sequence_features:
-        all_chain_features[chain_id] = copy.deepcopy(
-            sequence_features[fasta_chain.sequence])
-        continue
-      chain_features = self._process_single_chain(
-          chain_id=chain_id,
-          sequence=fasta_chain.sequence,
-          description=fasta_chain.description,
+    # Each database, including uniprot for pairing, is searched by a single
+    # task for all the unique chains, and up to max_parallel_searches
+    # databases are searched at the same time.
+    # The FASTA files are removed once the executor is shut down.
+    with contextlib.ExitStack() as exit_stack, \
+        concurrent.futures.ThreadPoolExecutor(
+            max_workers=self._max_parallel_searches) as executor:
+      sequence_searches = self._submit_searches(
+          executor=executor,
+          exit_stack=exit_stack,
+          chain_id_map=chain_id_map,
           msa_output_dir=msa_output_dir,
-          is_homomer_or_monomer=is_homomer_or_monomer,stopat=stopat)
-
-      chain_features = convert_monomer_features(chain_features,
-                                                chain_id=chain_id)
-      all_chain_features[chain_id] = chain_features
-      sequence_features[fasta_chain.sequence] = chain_features
+          is_homomer_or_monomer=is_homomer_or_monomer)
+
+      for chain_id, fasta_chain in chain_id_map.items():
+        if fasta_chain.sequence in sequence_features:
+          all_chain_features[chain_id] = copy.deepcopy(
+              sequence_features[fasta_chain.sequence])
+          continue
+        chain_features = self._chain_features(
+            searches=sequence_searches[fasta_chain.sequence],
+            sequence=fasta_chain.sequence,
+            description=fasta_chain.description,
+            stopat=stopat)
+
+        chain_features = convert_monomer_features(chain_features,
+                                                  chain_id=chain_id)
+        all_chain_features[chain_id] = chain_features
+        sequence_features[fasta_chain.sequence] = chain_features
 
     all_chain_features = add_assembly_features(all_chain_features)
 
@@ -282,3 +360,7 @@ class DataPipeline:
     np_example = pad_msa(np_example, 512)
 
     return np_example
+
+  def close(self) -> None:
+    """Shuts down the worker processes of the monomer data pipeline."""
+    self._monomer_data_pipeline.close()
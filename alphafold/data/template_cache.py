@@ -0,0 +1,133 @@
+# Copyright 2021 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Persistent cache of template hit features shared between prediction jobs.
+
+TemplateHitFeaturizer stores the result of featurizing each hit (the template
+features, or the error and warning of the hit) under a key derived from the
+query sequence, the hit alignment, the max template date and the versions of
+the template mmCIF file and of the release dates file. Results of transient
+errors, e.g. of the alignment tool, are not cached. Results are pickled under
+`objects/` and indexed in a SQLite database, with least recently used results
+evicted above a size limit.
+"""
+
+import contextlib
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import time
+from typing import Any, Optional
+
+from absl import logging
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+  key TEXT PRIMARY KEY,
+  size INTEGER NOT NULL,
+  last_access REAL NOT NULL
+)
+"""
+# Bumped when the features computed for a hit change.
+_VERSION = 2
+
+
+def make_key(**fields: Any) -> str:
+  """Returns the cache key of a hit from JSON-serializable fields."""
+  payload = json.dumps({'version': _VERSION, **fields}, sort_keys=True)
+  return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class TemplateCache:
+  """Store of template hit results with LRU eviction."""
+
+  def __init__(self, cache_dir: str, max_size_bytes: Optional[int] = None):
+    """Initializes the template cache.
+
+    Args:
+      cache_dir: Directory holding the index and the cached results. It can be
+        shared between jobs and machines.
+      max_size_bytes: If set, least recently used results are evicted once the
+        total size of the cached results exceeds this value.
+    """
+    self._cache_dir = cache_dir
+    self._objects_dir = os.path.join(cache_dir, 'objects')
+    self._index_path = os.path.join(cache_dir, 'index.sqlite')
+    self._max_size_bytes = max_size_bytes
+    os.makedirs(self._objects_dir, exist_ok=True)
+    with self._connect() as conn:
+      conn.execute(_SCHEMA)
+
+  @contextlib.contextmanager
+  def _connect(self):
+    conn = sqlite3.connect(self._index_path, timeout=600)
+    try:
+      with conn:
+        yield conn
+    finally:
+      conn.close()
+
+  def _object_path(self, key: str) -> str:
+    return os.path.join(self._objects_dir, key[:2], key + '.pkl')
+
+  def fetch(self, key: str) -> Optional[Any]:
+    """Returns the result cached under key, None if there is none."""
+    with self._connect() as conn:
+      row = conn.execute('SELECT 1 FROM entries WHERE key = ?',
+                         (key,)).fetchone()
+      if row is None:
+        return None
+      try:
+        with open(self._object_path(key), 'rb') as f:
+          result = pickle.load(f)
+      except (OSError, EOFError, pickle.UnpicklingError):
+        logging.warning('Dropping unreadable template cache entry %s', key)
+        conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+        return None
+      conn.execute('UPDATE entries SET last_access = ? WHERE key = ?',
+                   (time.time(), key))
+    return result
+
+  def store(self, key: str, result: Any) -> None:
+    """Caches result under key."""
+    object_path = self._object_path(key)
+    os.makedirs(os.path.dirname(object_path), exist_ok=True)
+    tmp_path = f'{object_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+      pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, object_path)
+    with self._connect() as conn:
+      conn.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?)',
+                   (key, os.path.getsize(object_path), time.time()))
+      if self._max_size_bytes is not None:
+        self._evict(conn)
+
+  def _evict(self, conn: sqlite3.Connection) -> None:
+    """Removes least recently used results until the size limit is met."""
+    total_size = conn.execute(
+        'SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+    if total_size <= self._max_size_bytes:
+      return
+    entries = conn.execute(
+        'SELECT key, size FROM entries ORDER BY last_access').fetchall()
+    for key, size in entries:
+      if total_size <= self._max_size_bytes:
+        break
+      logging.debug('Evicting template cache entry %s (%d bytes)', key, size)
+      conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+      with contextlib.suppress(FileNotFoundError):
+        os.remove(self._object_path(key))
+      total_size -= size
@@ -0,0 +1,95 @@
+# Copyright 2021 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for template_cache."""
+import os
+import tempfile
+from unittest import mock
+
+from absl.testing import absltest
+from alphafold.data import template_cache
+
+
+class MakeKeyTest(absltest.TestCase):
+
+  def test_key_depends_on_fields_and_version(self):
+    key = template_cache.make_key(query_sequence='MKV', template_versions=[1])
+    self.assertEqual(
+        key, template_cache.make_key(template_versions=[1],
+                                     query_sequence='MKV'))
+    self.assertNotEqual(
+        key, template_cache.make_key(query_sequence='MKV',
+                                     template_versions=[2]))
+    self.assertNotEqual(
+        key, template_cache.make_key(query_sequence='MKV', template_versions=[1],
+                                     release_dates=None))
+    with mock.patch.object(template_cache, '_VERSION',
+                           template_cache._VERSION + 1):
+      self.assertNotEqual(
+          key, template_cache.make_key(query_sequence='MKV',
+                                       template_versions=[1]))
+
+
+class TemplateCacheTest(absltest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.cache_dir = self.enter_context(tempfile.TemporaryDirectory())
+
+  def test_store_and_fetch(self):
+    cache = template_cache.TemplateCache(self.cache_dir)
+    self.assertIsNone(cache.fetch('a' * 64))
+    cache.store('a' * 64, {'features': [1, 2, 3]})
+    self.assertEqual(cache.fetch('a' * 64), {'features': [1, 2, 3]})
+    cache.store('a' * 64, {'features': [4]})
+    self.assertEqual(cache.fetch('a' * 64), {'features': [4]})
+
+    # The cache is shared with other jobs using the same directory.
+    other_cache = template_cache.TemplateCache(self.cache_dir)
+    self.assertEqual(other_cache.fetch('a' * 64), {'features': [4]})
+
+  def test_unreadable_entry_is_dropped(self):
+    cache = template_cache.TemplateCache(self.cache_dir)
+    cache.store('b' * 64, 'result')
+    with open(cache._object_path('b' * 64), 'wb') as f:
+      f.write(b'truncated')
+    self.assertIsNone(cache.fetch('b' * 64))
+    with cache._connect() as conn:
+      self.assertEmpty(conn.execute('SELECT key FROM entries').fetchall())
+
+  def test_least_recently_used_entries_are_evicted(self):
+    sizing_cache = template_cache.TemplateCache(
+        self.enter_context(tempfile.TemporaryDirectory()))
+    sizing_cache.store('c' * 64, 'x' * 100)
+    entry_size = os.path.getsize(sizing_cache._object_path('c' * 64))
+    cache = template_cache.TemplateCache(
+        self.cache_dir, max_size_bytes=3 * entry_size)
+    timestamps = iter(range(10))
+    with mock.patch.object(template_cache.time, 'time',
+                           side_effect=lambda: next(timestamps)):
+      for key in ('c', 'd', 'e', 'f'):
+        cache.store(key * 64, 'x' * 100)
+      # Fetching d makes e the least recently used entry.
+      self.assertIsNotNone(cache.fetch('d' * 64))
+      cache.store('g' * 64, 'x' * 100)
+
+    for key in ('c', 'e'):
+      self.assertIsNone(cache.fetch(key * 64), key)
+      self.assertFalse(os.path.exists(cache._object_path(key * 64)), key)
+    for key in ('d', 'f', 'g'):
+      self.assertEqual(cache.fetch(key * 64), 'x' * 100, key)
+
+
+if __name__ == '__main__':
+  absltest.main()
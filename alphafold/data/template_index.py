@@ -0,0 +1,317 @@
+# Copyright 2021 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Persistent index of the template mmCIF directory.
+
+The index holds the PDB ids of the mmCIF files, the obsolete PDB ids and the
+release date of the entries, so that TemplateHitFeaturizer neither lists the
+mmCIF directory nor parses obsolete.dat on every run, and filters hits by
+release date before parsing their mmCIF file.
+
+The index is a SQLite database, by default template_index.sqlite next to the
+mmCIF directory (i.e. in pdb_mmcif). The file list is refreshed when the
+modification time of the mmCIF directory changes and the obsolete PDB ids when
+obsolete.dat changes. Release dates are read from the revision history of an
+mmCIF file the first time they are needed (or copied from a template store)
+and kept until the file changes.
+"""
+
+import collections.abc
+import contextlib
+import datetime
+import io
+import os
+import sqlite3
+import threading
+from typing import Any, Dict, Iterator, Optional
+
+from absl import logging
+from Bio import PDB
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+  key TEXT PRIMARY KEY,
+  value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+  pdb_id TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS release_dates (
+  pdb_id TEXT PRIMARY KEY,
+  mtime INTEGER NOT NULL,
+  size INTEGER NOT NULL,
+  release_date TEXT
+);
+CREATE TABLE IF NOT EXISTS obsolete (
+  pdb_id TEXT PRIMARY KEY,
+  replacement TEXT
+);
+"""
+_INDEX_NAME = 'template_index.sqlite'
+_REVISION_HISTORY = '_pdbx_audit_revision_history.'
+
+
+def default_index_path(mmcif_dir: str) -> str:
+  """Returns the path of the index of mmcif_dir, in its parent directory."""
+  return os.path.join(os.path.dirname(os.path.normpath(mmcif_dir)),
+                      _INDEX_NAME)
+
+
+def read_release_date(cif_path: str) -> Optional[str]:
+  """Returns the release date of an mmCIF file, without parsing all of it.
+
+  As in mmcif_parsing, the release date is the oldest revision date. Only the
+  lines of the revision history category are parsed.
+
+  Args:
+    cif_path: The path of the mmCIF file.
+
+  Returns:
+    The release date as YYYY-MM-DD, None if the file has no revision history.
+  """
+  category_lines = []
+  is_loop = False
+  previous_line = ''
+  with open(cif_path) as f:
+    for line in f:
+      if line.startswith(_REVISION_HISTORY):
+        if not category_lines:
+          is_loop = previous_line.startswith('loop_')
+        category_lines.append(line)
+      elif category_lines:
+        if line.startswith(('#', 'loop_', '_', 'data_')):
+          break
+        category_lines.append(line)
+      previous_line = line
+  if not category_lines:
+    return None
+  text = 'data_index\n' + ('loop_\n' if is_loop else '') + ''.join(
+      category_lines)
+  parsed_info = PDB.MMCIF2Dict.MMCIF2Dict(io.StringIO(text))
+  revision_dates = parsed_info.get(_REVISION_HISTORY + 'revision_date')
+  return min(revision_dates) if revision_dates else None
+
+
+def parse_obsolete(obsolete_file_path: str) -> Dict[str, Optional[str]]:
+  """Parses the data file from PDB that lists which pdb_ids are obsolete."""
+  result = {}
+  with open(obsolete_file_path) as f:
+    for line in f:
+      line = line.strip()
+      # Format:    Date      From     To
+      # 'OBSLTE    06-NOV-19 6G9Y'                - Removed, rare
+      # 'OBSLTE    31-JUL-94 116L     216L'       - Replaced, common
+      # 'OBSLTE    26-SEP-06 2H33     2JM5 2OWI'  - Replaced by multiple, rare
+      if line.startswith('OBSLTE'):
+        if len(line) > 30:
+          # Replaced by at least one structure.
+          result[line[20:24].lower()] = line[29:33].lower()
+        elif len(line) == 24:
+          # Removed.
+          result[line[20:24].lower()] = None
+  return result
+
+
+def _file_version(path: Optional[str]) -> str:
+  if not path:
+    return ''
+  stat = os.stat(path)
+  return f'{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}'
+
+
+class TemplateIndex:
+  """Index of the mmCIF files, obsolete PDB ids and release dates."""
+
+  def __init__(self,
+               mmcif_dir: str,
+               obsolete_pdbs_path: Optional[str] = None,
+               index_path: Optional[str] = None,
+               template_store: Optional[Any] = None,
+               refresh: bool = True):
+    """Opens the index, refreshing it if the mmCIF directory changed.
+
+    Args:
+      mmcif_dir: The directory of the mmCIF files, named <pdb_id>.cif.
+      obsolete_pdbs_path: An optional path to obsolete.dat.
+      index_path: The path of the index, see default_index_path if not set. If
+        it can't be written the index is kept in memory for this process.
+      template_store: An optional template_store.TemplateStore of mmcif_dir,
+        whose release dates are copied into the index when it is refreshed.
+      refresh: Whether to refresh the file list and the obsolete PDB ids. The
+        copies of the index in worker processes do not refresh it.
+    """
+    self._mmcif_dir = mmcif_dir
+    self._obsolete_pdbs_path = obsolete_pdbs_path
+    self._index_path = index_path or default_index_path(mmcif_dir)
+    self._lock = threading.Lock()
+    # Release dates looked up by this process.
+    self._release_dates = {}
+    try:
+      self._conn = self._open(self._index_path)
+      if refresh:
+        self._refresh(template_store)
+    except (OSError, sqlite3.Error) as e:
+      logging.warning('Could not use the template index %s (%s), indexing in '
+                      'memory.', self._index_path, e)
+      self._conn = self._open(':memory:')
+      if refresh:
+        self._refresh(template_store)
+    self._obsolete_pdbs = dict(
+        self._conn.execute('SELECT pdb_id, replacement FROM obsolete'))
+
+  def __getstate__(self) -> Dict[str, Any]:
+    # Pickled by path, e.g. to template featurization worker processes.
+    return {'mmcif_dir': self._mmcif_dir,
+            'obsolete_pdbs_path': self._obsolete_pdbs_path,
+            'index_path': self._index_path}
+
+  def __setstate__(self, state: Dict[str, Any]) -> None:
+    self.__init__(refresh=False, **state)
+
+  @staticmethod
+  def _open(index_path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(index_path, timeout=600, check_same_thread=False)
+    with conn:
+      conn.executescript(_SCHEMA)
+    return conn
+
+  @contextlib.contextmanager
+  def _transaction(self) -> Iterator[sqlite3.Connection]:
+    with self._lock, self._conn:
+      yield self._conn
+
+  def _meta(self, conn: sqlite3.Connection, key: str) -> Optional[str]:
+    row = conn.execute('SELECT value FROM meta WHERE key = ?',
+                       (key,)).fetchone()
+    return row[0] if row else None
+
+  def _refresh(self, template_store: Optional[Any]) -> None:
+    """Re-indexes the file list and obsolete PDB ids if they changed."""
+    dir_stat = os.stat(self._mmcif_dir)
+    dir_version = (f'{os.path.abspath(self._mmcif_dir)}:'
+                   f'{dir_stat.st_mtime_ns}')
+    obsolete_version = _file_version(self._obsolete_pdbs_path)
+    with self._transaction() as conn:
+      conn.execute('BEGIN IMMEDIATE')
+      if self._meta(conn, 'mmcif_dir') != dir_version:
+        logging.info('Indexing the mmCIF files of %s', self._mmcif_dir)
+        with os.scandir(self._mmcif_dir) as entries:
+          pdb_ids = [(entry.name[:-len('.cif')],) for entry in entries
+                     if entry.name.endswith('.cif')]
+        conn.execute('DELETE FROM files')
+        conn.executemany('INSERT INTO files VALUES (?)', pdb_ids)
+        if template_store is not None:
+          # The dates of modified files are dropped when they are looked up.
+          conn.executemany(
+              'INSERT OR IGNORE INTO release_dates VALUES (?, ?, ?, ?)',
+              template_store.indexed_release_dates())
+        conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                     ('mmcif_dir', dir_version))
+      if self._meta(conn, 'obsolete') != obsolete_version:
+        conn.execute('DELETE FROM obsolete')
+        if self._obsolete_pdbs_path:
+          logging.info('Indexing obsolete pdbs %s.', self._obsolete_pdbs_path)
+          conn.executemany(
+              'INSERT INTO obsolete VALUES (?, ?)',
+              parse_obsolete(self._obsolete_pdbs_path).items())
+        conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                     ('obsolete', obsolete_version))
+
+  @property
+  def num_files(self) -> int:
+    """The number of mmCIF files in the directory when it was indexed."""
+    with self._lock:
+      return self._conn.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+  def has_file(self, pdb_id: str) -> bool:
+    with self._lock:
+      row = self._conn.execute('SELECT 1 FROM files WHERE pdb_id = ?',
+                               (pdb_id,)).fetchone()
+    return row is not None
+
+  def obsolete_pdbs(self) -> Dict[str, Optional[str]]:
+    """Returns the mapping from obsolete PDB ids to their replacement."""
+    return self._obsolete_pdbs
+
+  def release_date(self, pdb_id: str) -> Optional[datetime.datetime]:
+    """Returns the release date of an entry, None if unknown.
+
+    The date is read from the mmCIF file if it is not in the index, or if the
+    file changed since it was indexed.
+
+    Args:
+      pdb_id: The PDB id, as named in the mmCIF directory.
+    """
+    if pdb_id in self._release_dates:
+      return self._release_dates[pdb_id]
+    cif_path = os.path.join(self._mmcif_dir, pdb_id + '.cif')
+    try:
+      stat = os.stat(cif_path)
+    except FileNotFoundError:
+      return None
+    version = (int(stat.st_mtime), stat.st_size)
+    with self._lock:
+      row = self._conn.execute(
+          'SELECT mtime, size, release_date FROM release_dates '
+          'WHERE pdb_id = ?', (pdb_id,)).fetchone()
+    if row is not None and tuple(row[:2]) == version:
+      date = row[2]
+    else:
+      date = read_release_date(cif_path)
+      try:
+        with self._transaction() as conn:
+          conn.execute(
+              'INSERT OR REPLACE INTO release_dates VALUES (?, ?, ?, ?)',
+              (pdb_id, *version, date))
+      except sqlite3.Error as e:
+        logging.warning('Could not index the release date of %s: %s',
+                        pdb_id, e)
+    release_date = None
+    if date is not None:
+      release_date = datetime.datetime.strptime(date, '%Y-%m-%d')
+    self._release_dates[pdb_id] = release_date
+    return release_date
+
+  def release_dates(self) -> 'ReleaseDates':
+    """Returns the release dates as a mapping, looked up lazily."""
+    return ReleaseDates(self)
+
+
+class ReleaseDates(collections.abc.Mapping):
+  """A mapping from PDB ids to release dates, read from a TemplateIndex.
+
+  Only the entries with a known release date are in the mapping. Iterating
+  over it yields the entries looked up so far.
+  """
+
+  def __init__(self, index: TemplateIndex):
+    self._index = index
+
+  def __getitem__(self, pdb_id: str) -> datetime.datetime:
+    release_date = self._index.release_date(pdb_id)
+    if release_date is None:
+      raise KeyError(pdb_id)
+    return release_date
+
+  def __contains__(self, pdb_id: object) -> bool:
+    return (isinstance(pdb_id, str) and
+            self._index.release_date(pdb_id) is not None)
+
+  def __iter__(self) -> Iterator[str]:
+    # pylint: disable=protected-access
+    return iter([pdb_id for pdb_id, date in
+                 list(self._index._release_dates.items()) if date is not None])
+
+  def __len__(self) -> int:
+    return sum(1 for _ in self)
@@ -0,0 +1,62 @@
+# Copyright 2021 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for template_index."""
+import os
+import tempfile
+
+from absl.testing import absltest
+from absl.testing import parameterized
+from alphafold.data import mmcif_parsing
+from alphafold.data import template_index
+
+
+def _testdata_path(pdb_id):
+  return os.path.join(absltest.get_default_test_srcdir(),
+                      f'alphafold/data/testdata/{pdb_id}.cif')
+
+
+class ReadReleaseDateTest(parameterized.TestCase):
+
+  @parameterized.named_parameters(
+      ('loop', '1gcn', True, '1977-11-28'),
+      ('single_revision', '2rbg', False, '2008-09-30'))
+  def test_matches_mmcif_parsing(self, pdb_id, is_loop, release_date):
+    cif_path = _testdata_path(pdb_id)
+    with open(cif_path) as f:
+      mmcif_string = f.read()
+    # The revision history is written as a loop or as single key-value pairs.
+    self.assertEqual(
+        'loop_\n_pdbx_audit_revision_history.' in mmcif_string, is_loop)
+    parsing_result = mmcif_parsing.parse(
+        file_id=pdb_id, mmcif_string=mmcif_string)
+
+    self.assertEqual(template_index.read_release_date(cif_path),
+                     parsing_result.mmcif_object.header['release_date'])
+    self.assertEqual(template_index.read_release_date(cif_path), release_date)
+
+  def test_no_revision_history(self):
+    tmp_dir = self.enter_context(tempfile.TemporaryDirectory())
+    cif_path = os.path.join(tmp_dir, '2rbg.cif')
+    with open(_testdata_path('2rbg')) as f:
+      lines = [line for line in f
+               if not line.startswith('_pdbx_audit_revision_history.')]
+    with open(cif_path, 'w') as f:
+      f.writelines(lines)
+
+    self.assertIsNone(template_index.read_release_date(cif_path))
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -0,0 +1,395 @@
+# Copyright 2021 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Pre-parsed store of the template mmCIF structures.
+
+The store holds what template featurization reads from an mmCIF file: the
+release date, resolution, per-chain SEQRES and atom37 positions and masks. It
+is built once from the mmCIF directory by scripts/build_template_store.py and
+lets TemplateHitFeaturizer skip parsing the mmCIF of each hit.
+
+Layout of the store directory:
+  index.sqlite: The entries and their chains, with the offsets of the chains
+    in the atom arrays.
+  positions.f32: float32 atom positions, [num_residues, 37, 3].
+  masks.u8: uint8 atom masks, [num_residues, 37].
+The atom arrays are memory-mapped and only grow, residues of re-indexed
+entries are left unused.
+"""
+
+import contextlib
+import dataclasses
+import datetime
+import glob
+import multiprocessing
+import os
+import sqlite3
+import threading
+from typing import (Any, Dict, Iterator, List, Mapping, Optional, Sequence,
+                    Tuple)
+
+from absl import logging
+from alphafold.common import residue_constants
+from alphafold.data import mmcif_parsing
+from alphafold.data import templates
+import numpy as np
+
+_INDEX = 'index.sqlite'
+_POSITIONS = 'positions.f32'
+_MASKS = 'masks.u8'
+_ATOMS = residue_constants.atom_type_num
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+  pdb_id TEXT PRIMARY KEY,
+  mtime INTEGER NOT NULL,
+  size INTEGER NOT NULL,
+  release_date TEXT,
+  resolution REAL,
+  errors TEXT
+);
+CREATE TABLE IF NOT EXISTS chains (
+  pdb_id TEXT NOT NULL,
+  chain_id TEXT NOT NULL,
+  seqres TEXT NOT NULL,
+  offset INTEGER,
+  num_res INTEGER NOT NULL,
+  error_type TEXT,
+  error TEXT,
+  PRIMARY KEY (pdb_id, chain_id)
+);
+"""
+
+# Exceptions of templates._get_atom_positions, re-raised when reading a chain
+# whose atoms could not be indexed.
+_ATOM_ERRORS = {
+    'KeyError': KeyError,
+    'MultipleChainsError': templates.MultipleChainsError,
+}
+
+
+@dataclasses.dataclass(frozen=True)
+class _ChainAtoms:
+  offset: Optional[int]
+  num_res: int
+  error_type: Optional[str]
+  error: Optional[str]
+
+
+@dataclasses.dataclass(frozen=True)
+class StoredStructure:
+  """A template structure read from the store.
+
+  It stands in for mmcif_parsing.MmcifObject in the template featurization,
+  with get_atom_positions instead of the Biopython structure.
+  """
+  file_id: str
+  header: Mapping[str, Any]
+  chain_to_seqres: Mapping[str, str]
+  _store: 'TemplateStore'
+  _chain_atoms: Mapping[str, _ChainAtoms]
+
+  def get_atom_positions(self, chain_id: str) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the atom37 positions and mask of a chain.
+
+    Args:
+      chain_id: The author chain id.
+
+    Returns:
+      The positions [num_res, 37, 3] (float64) and mask [num_res, 37] (int64),
+      as computed by templates._get_atom_positions before the distance check.
+
+    Raises:
+      KeyError, templates.MultipleChainsError: As raised when parsing the
+        chain from the mmCIF file.
+    """
+    atoms = self._chain_atoms[chain_id]
+    if atoms.offset is None:
+      raise _ATOM_ERRORS.get(atoms.error_type, KeyError)(atoms.error)
+    return self._store.read_atoms(atoms.offset, atoms.num_res)
+
+
+def _atom_arrays(mmcif_object: mmcif_parsing.MmcifObject,
+                 chain_id: str) -> Tuple[np.ndarray, np.ndarray]:
+  # The distance check is done when the template is read.
+  return templates._get_atom_positions(  # pylint: disable=protected-access
+      mmcif_object, chain_id, max_ca_ca_distance=float('inf'))
+
+
+def _parse_entry(cif_path: str) -> Dict[str, Any]:
+  """Parses one mmCIF file into the rows of the store."""
+  pdb_id = os.path.splitext(os.path.basename(cif_path))[0]
+  stat = os.stat(cif_path)
+  with open(cif_path, 'r') as f:
+    cif_string = f.read()
+  parsing_result = mmcif_parsing.parse(file_id=pdb_id, mmcif_string=cif_string)
+  entry = {
+      'pdb_id': pdb_id,
+      'mtime': int(stat.st_mtime),
+      'size': stat.st_size,
+      'release_date': None,
+      'resolution': None,
+      'errors': str(parsing_result.errors) if parsing_result.errors else None,
+      'chains': [],
+  }
+  mmcif_object = parsing_result.mmcif_object
+  if mmcif_object is None:
+    return entry
+  entry['release_date'] = mmcif_object.header.get('release_date')
+  entry['resolution'] = mmcif_object.header.get('resolution')
+  for chain_id, seqres in mmcif_object.chain_to_seqres.items():
+    chain = {'chain_id': chain_id, 'seqres': seqres, 'positions': None,
+             'mask': None, 'error_type': None, 'error': None}
+    try:
+      positions, mask = _atom_arrays(mmcif_object, chain_id)
+      chain['positions'] = positions.astype(np.float32)
+      chain['mask'] = mask.astype(np.uint8)
+    except (KeyError, templates.MultipleChainsError) as e:
+      chain['error_type'] = type(e).__name__
+      chain['error'] = str(e)
+    entry['chains'].append(chain)
+  return entry
+
+
+class TemplateStore:
+  """Reads template structures from a store built by build_store."""
+
+  def __init__(self, store_dir: str):
+    self._store_dir = store_dir
+    if not os.path.exists(os.path.join(store_dir, _INDEX)):
+      raise ValueError(f'No template store in {store_dir}.')
+    self._lock = threading.Lock()
+    self._conn = None
+    self._positions = None
+    self._masks = None
+
+  def __getstate__(self) -> Dict[str, Any]:
+    # Pickled by path, e.g. to template featurization worker processes.
+    return {'store_dir': self._store_dir}
+
+  def __setstate__(self, state: Dict[str, Any]) -> None:
+    self.__init__(state['store_dir'])
+
+  @property
+  def store_dir(self) -> str:
+    return self._store_dir
+
+  def _connection(self) -> sqlite3.Connection:
+    if self._conn is None:
+      self._conn = sqlite3.connect(
+          os.path.join(self._store_dir, _INDEX), check_same_thread=False)
+    return self._conn
+
+  def _map_atoms(self) -> None:
+    num_res = os.path.getsize(
+        os.path.join(self._store_dir, _MASKS)) // _ATOMS
+    self._positions = np.memmap(
+        os.path.join(self._store_dir, _POSITIONS), dtype=np.float32,
+        mode='r', shape=(num_res, _ATOMS, 3))
+    self._masks = np.memmap(
+        os.path.join(self._store_dir, _MASKS), dtype=np.uint8, mode='r',
+        shape=(num_res, _ATOMS))
+
+  def read_atoms(self, offset: int,
+                 num_res: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the positions and mask of num_res residues from offset."""
+    with self._lock:
+      if self._masks is None or offset + num_res > self._masks.shape[0]:
+        # The store was extended since it was mapped.
+        self._map_atoms()
+      positions = self._positions[offset:offset + num_res]
+      mask = self._masks[offset:offset + num_res]
+    return positions.astype(np.float64), mask.astype(np.int64)
+
+  def __contains__(self, pdb_id: str) -> bool:
+    with self._lock:
+      row = self._connection().execute(
+          'SELECT 1 FROM entries WHERE pdb_id = ?', (pdb_id,)).fetchone()
+    return row is not None
+
+  def get(self,
+          pdb_id: str,
+          cif_path: Optional[str] = None
+          ) -> Optional[mmcif_parsing.ParsingResult]:
+    """Returns the pre-parsed entry, None if it is not in the store.
+
+    Args:
+      pdb_id: The PDB id, as named in the mmCIF directory.
+      cif_path: The mmCIF file of the entry. If given, the entry is only
+        returned if the file has the size and modification time it had when
+        the store was built, a modified file is parsed again by the caller.
+
+    Returns:
+      A ParsingResult whose mmcif_object is a StoredStructure, or None if the
+      entry is not in the store or is stale. Its mmcif_object is None if the
+      mmCIF could not be parsed when the store was built.
+    """
+    with self._lock:
+      conn = self._connection()
+      entry = conn.execute(
+          'SELECT mtime, size, release_date, resolution, errors FROM entries '
+          'WHERE pdb_id = ?', (pdb_id,)).fetchone()
+      if entry is None:
+        return None
+      chains = conn.execute(
+          'SELECT chain_id, seqres, offset, num_res, error_type, error '
+          'FROM chains WHERE pdb_id = ? ORDER BY rowid', (pdb_id,)).fetchall()
+    mtime, size, release_date, resolution, errors = entry
+    if cif_path is not None:
+      try:
+        stat = os.stat(cif_path)
+      except OSError:
+        # Without the file, the stored entry is the only version available.
+        stat = None
+      if stat is not None and (int(stat.st_mtime), stat.st_size) != (mtime,
+                                                                      size):
+        logging.info('%s was modified since it was stored, parsing it. Run '
+                     'build_template_store.py to update the store.', cif_path)
+        return None
+    errors = {(pdb_id, ''): errors} if errors else {}
+    if not chains:
+      return mmcif_parsing.ParsingResult(mmcif_object=None, errors=errors)
+    header = {'resolution': resolution}
+    if release_date is not None:
+      header['release_date'] = release_date
+    structure = StoredStructure(
+        file_id=pdb_id,
+        header=header,
+        chain_to_seqres={chain_id: seqres
+                         for chain_id, seqres, *_ in chains},
+        _store=self,
+        _chain_atoms={
+            chain_id: _ChainAtoms(offset, num_res, error_type, error)
+            for chain_id, _, offset, num_res, error_type, error in chains})
+    return mmcif_parsing.ParsingResult(mmcif_object=structure, errors=errors)
+
+  def release_dates(self) -> Dict[str, datetime.datetime]:
+    """Returns the release dates of all the entries, by PDB id."""
+    with self._lock:
+      rows = self._connection().execute(
+          'SELECT pdb_id, release_date FROM entries '
+          'WHERE release_date IS NOT NULL').fetchall()
+    return {pdb_id: datetime.datetime.strptime(date, '%Y-%m-%d')
+            for pdb_id, date in rows}
+
+  def indexed_release_dates(self) -> List[Tuple[str, int, int, Optional[str]]]:
+    """Returns the PDB id, mtime, size and release date of all the entries."""
+    with self._lock:
+      return self._connection().execute(
+          'SELECT pdb_id, mtime, size, release_date FROM entries').fetchall()
+
+
+def _stale_paths(conn: sqlite3.Connection,
+                 cif_paths: Sequence[str]) -> List[str]:
+  """Returns the mmCIF files missing from the store or modified since."""
+  indexed = {pdb_id: (mtime, size) for pdb_id, mtime, size in conn.execute(
+      'SELECT pdb_id, mtime, size FROM entries')}
+  stale = []
+  for path in cif_paths:
+    pdb_id = os.path.splitext(os.path.basename(path))[0]
+    stat = os.stat(path)
+    if indexed.get(pdb_id) != (int(stat.st_mtime), stat.st_size):
+      stale.append(path)
+  return stale
+
+
+def _parsed_entries(paths: Sequence[str],
+                    num_workers: int) -> Iterator[Dict[str, Any]]:
+  if num_workers <= 1:
+    yield from map(_parse_entry, paths)
+    return
+  with multiprocessing.get_context('spawn').Pool(num_workers) as pool:
+    yield from pool.imap_unordered(_parse_entry, paths, chunksize=16)
+
+
+def _truncate_atoms(store_dir: str) -> int:
+  """Drops residues written after the last commit, returns the residue count.
+
+  An interrupted build can leave the two atom files with a different number of
+  residues, none of which are referenced by the index.
+  """
+  positions_path = os.path.join(store_dir, _POSITIONS)
+  masks_path = os.path.join(store_dir, _MASKS)
+  num_res = 0
+  if os.path.exists(positions_path) and os.path.exists(masks_path):
+    num_res = min(os.path.getsize(positions_path) // (_ATOMS * 3 * 4),
+                  os.path.getsize(masks_path) // _ATOMS)
+  for path, res_bytes in ((positions_path, _ATOMS * 3 * 4),
+                          (masks_path, _ATOMS)):
+    with open(path, 'ab'):
+      pass
+    os.truncate(path, num_res * res_bytes)
+  return num_res
+
+
+def build_store(mmcif_dir: str, store_dir: str, num_workers: int = 1,
+                commit_every: int = 1000) -> int:
+  """Indexes the mmCIF files of mmcif_dir into a template store.
+
+  The indexing is incremental, files already indexed with the same size and
+  modification time are skipped, so the store can be updated after syncing
+  the mmCIF mirror.
+
+  Args:
+    mmcif_dir: Directory with the mmCIF files, named <pdb_id>.cif.
+    store_dir: The store directory, created if needed.
+    num_workers: Number of processes parsing mmCIF files.
+    commit_every: Number of entries between two commits of the index, an
+      interrupted build resumes from the last commit.
+
+  Returns:
+    The number of entries indexed.
+  """
+  os.makedirs(store_dir, exist_ok=True)
+  cif_paths = sorted(glob.glob(os.path.join(mmcif_dir, '*.cif')))
+  num_indexed = 0
+  with contextlib.closing(
+      sqlite3.connect(os.path.join(store_dir, _INDEX))) as conn:
+    conn.executescript(_SCHEMA)
+    paths = _stale_paths(conn, cif_paths)
+    logging.info('Indexing %d of %d mmCIF files into %s', len(paths),
+                 len(cif_paths), store_dir)
+    offset = _truncate_atoms(store_dir)
+    with open(os.path.join(store_dir, _POSITIONS), 'ab') as positions_file, \
+        open(os.path.join(store_dir, _MASKS), 'ab') as masks_file:
+      for entry in _parsed_entries(paths, num_workers):
+        conn.execute('DELETE FROM chains WHERE pdb_id = ?', (entry['pdb_id'],))
+        conn.execute(
+            'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)',
+            (entry['pdb_id'], entry['mtime'], entry['size'],
+             entry['release_date'], entry['resolution'], entry['errors']))
+        for chain in entry['chains']:
+          chain_offset = None
+          if chain['positions'] is not None:
+            positions_file.write(chain['positions'].tobytes())
+            masks_file.write(chain['mask'].tobytes())
+            chain_offset = offset
+            offset += len(chain['seqres'])
+          conn.execute(
+              'INSERT INTO chains VALUES (?, ?, ?, ?, ?, ?, ?)',
+              (entry['pdb_id'], chain['chain_id'], chain['seqres'],
+               chain_offset, len(chain['seqres']), chain['error_type'],
+               chain['error']))
+        num_indexed += 1
+        if num_indexed % commit_every == 0:
+          # The atoms must be on disk before the index refers to them.
+          positions_file.flush()
+          masks_file.flush()
+          conn.commit()
+          logging.info('Indexed %d of %d mmCIF files', num_indexed,
+                       len(paths))
+      positions_file.flush()
+      masks_file.flush()
+      conn.commit()
+  return num_indexed
@@ -0,0 +1,112 @@
+# Copyright 2021 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for template_store."""
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from absl.testing import absltest
+from alphafold.data import mmcif_parsing
+from alphafold.data import template_store
+from alphafold.data import templates
+import numpy as np
+
+_PDB_IDS = ('1gcn', '2rbg')
+
+
+def _parse(cif_path):
+  pdb_id = os.path.splitext(os.path.basename(cif_path))[0]
+  with open(cif_path) as f:
+    return mmcif_parsing.parse(file_id=pdb_id, mmcif_string=f.read())
+
+
+class TemplateStoreTest(absltest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    tmp_dir = self.enter_context(tempfile.TemporaryDirectory())
+    self.mmcif_dir = os.path.join(tmp_dir, 'mmcif')
+    os.makedirs(self.mmcif_dir)
+    for pdb_id in _PDB_IDS:
+      shutil.copy(
+          os.path.join(absltest.get_default_test_srcdir(),
+                       f'alphafold/data/testdata/{pdb_id}.cif'),
+          self.mmcif_dir)
+    self.store_dir = os.path.join(tmp_dir, 'store')
+
+  def test_round_trip(self):
+    self.assertEqual(
+        template_store.build_store(self.mmcif_dir, self.store_dir), 2)
+    store = template_store.TemplateStore(self.store_dir)
+
+    for pdb_id in _PDB_IDS:
+      cif_path = os.path.join(self.mmcif_dir, f'{pdb_id}.cif')
+      expected = _parse(cif_path).mmcif_object
+      stored = store.get(pdb_id, cif_path=cif_path).mmcif_object
+      self.assertEqual(stored.header['release_date'],
+                       expected.header['release_date'])
+      self.assertEqual(stored.header['resolution'],
+                       expected.header['resolution'])
+      self.assertEqual(stored.chain_to_seqres, expected.chain_to_seqres)
+      for chain_id in expected.chain_to_seqres:
+        expected_atoms = templates._get_atom_positions(
+            expected, chain_id, max_ca_ca_distance=150.)
+        stored_atoms = templates._get_atom_positions(
+            stored, chain_id, max_ca_ca_distance=150.)
+        for expected_array, stored_array in zip(expected_atoms, stored_atoms):
+          self.assertEqual(stored_array.dtype, expected_array.dtype)
+          np.testing.assert_array_equal(stored_array, expected_array)
+
+  def test_stale_entry_falls_back_to_parsing(self):
+    template_store.build_store(self.mmcif_dir, self.store_dir)
+    store = template_store.TemplateStore(self.store_dir)
+    cif_path = os.path.join(self.mmcif_dir, '1gcn.cif')
+    with open(cif_path, 'a') as f:
+      f.write('#\n')
+
+    self.assertIsNone(store.get('1gcn', cif_path=cif_path))
+    self.assertIsNotNone(
+        store.get('2rbg', cif_path=os.path.join(self.mmcif_dir, '2rbg.cif')))
+    # Without the file, the stored entry is used.
+    self.assertIsNotNone(store.get('1gcn'))
+    self.assertIsNotNone(store.get('1gcn', cif_path=cif_path + '.missing'))
+
+    self.assertEqual(
+        template_store.build_store(self.mmcif_dir, self.store_dir), 1)
+    self.assertIsNotNone(store.get('1gcn', cif_path=cif_path))
+
+  def test_chain_errors_are_raised_again(self):
+    atom_arrays = template_store._atom_arrays
+
+    def fail_on_chain_b(mmcif_object, chain_id):
+      if chain_id == 'B':
+        raise templates.MultipleChainsError('Two chains B.')
+      return atom_arrays(mmcif_object, chain_id)
+
+    with mock.patch.object(template_store, '_atom_arrays',
+                           side_effect=fail_on_chain_b):
+      template_store.build_store(self.mmcif_dir, self.store_dir)
+    stored = template_store.TemplateStore(self.store_dir).get(
+        '2rbg').mmcif_object
+
+    templates._get_atom_positions(stored, 'A', max_ca_ca_distance=150.)
+    with self.assertRaisesRegex(templates.MultipleChainsError,
+                                'Two chains B.'):
+      templates._get_atom_positions(stored, 'B', max_ca_ca_distance=150.)
+
+
+if __name__ == '__main__':
+  absltest.main()
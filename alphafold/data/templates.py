@@ -14,18 +14,23 @@
 
 """Functions for getting templates and calculating template features."""
 import abc
+import collections
+import concurrent.futures
 import dataclasses
 import datetime
 import functools
-import glob
+import multiprocessing
 import os
 import re
-from typing import Any, Dict, Mapping, Optional, Sequence, Tuple
+from typing import (Any, Callable, Dict, Iterable, Iterator, Mapping,
+                    Optional, Sequence, Tuple)
 
 from absl import logging
 from alphafold.common import residue_constants
 from alphafold.data import mmcif_parsing
 from alphafold.data import parsers
+from alphafold.data import template_cache as template_cache_lib
+from alphafold.data import template_index
 from alphafold.data.tools import kalign
 import numpy as np
 
@@ -56,6 +61,10 @@ class QueryToTemplateAlignError(Error):
   """An error indicating that the query can't be aligned to the template."""
 
 
+class AlignToolError(QueryToTemplateAlignError):
+  """An error indicating that the alignment tool failed to run."""
+
+
 class CaDistanceError(Error):
   """An error indicating that a CA atom distance exceeds a threshold."""
 
@@ -129,29 +138,6 @@ def _is_after_cutoff(
     return False
 
 
-def _parse_obsolete(obsolete_file_path: str) -> Mapping[str, Optional[str]]:
-  """Parses the data file from PDB that lists which pdb_ids are obsolete."""
-  with open(obsolete_file_path) as f:
-    result = {}
-    for line in f:
-      line = line.strip()
-      # Format:    Date      From     To
-      # 'OBSLTE    06-NOV-19 6G9Y'                - Removed, rare
-      # 'OBSLTE    31-JUL-94 116L     216L'       - Replaced, common
-      # 'OBSLTE    26-SEP-06 2H33     2JM5 2OWI'  - Replaced by multiple, rare
-      if line.startswith('OBSLTE'):
-        if len(line) > 30:
-          # Replaced by at least one structure.
-          from_id = line[20:24].lower()
-          to_id = line[29:33].lower()
-          result[from_id] = to_id
-        elif len(line) == 24:
-          # Removed.
-          from_id = line[20:24].lower()
-          result[from_id] = None
-    return result
-
-
 def _parse_release_dates(path: str) -> Mapping[str, datetime.datetime]:
   """Parses release dates file, returns a mapping from PDBs to release dates."""
   if path.endswith('txt'):
@@ -337,9 +323,8 @@ def _realign_pdb_template_to_query(
       actual template found in the mmcif_object.
 
   Raises:
-    QueryToTemplateAlignError:
-    * If there was an error thrown by the alignment tool.
-    * Or if the actual template sequence differs by more than 10% from the
+    AlignToolError: If there was an error thrown by the alignment tool.
+    QueryToTemplateAlignError: If the actual template sequence differs by more than 10% from the
       old_template_sequence.
   """
   aligner = kalign.Kalign(binary_path=kalign_binary_path)
@@ -366,7 +351,7 @@ def _realign_pdb_template_to_query(
         aligner.align([old_template_sequence, new_template_sequence]))
     old_aligned_template, new_aligned_template = parsed_a3m.sequences
   except Exception as e:
-    raise QueryToTemplateAlignError(
+    raise AlignToolError(
         'Could not align old template %s to template %s (%s_%s). Error: %s' %
         (old_template_sequence, new_template_sequence, mmcif_object.file_id,
          template_chain_id, str(e)))
@@ -436,6 +421,14 @@ def _get_atom_positions(
     auth_chain_id: str,
     max_ca_ca_distance: float) -> Tuple[np.ndarray, np.ndarray]:
   """Gets atom positions and mask from a list of Biopython Residues."""
+  if not isinstance(mmcif_object, mmcif_parsing.MmcifObject):
+    # A pre-parsed structure, see template_store.StoredStructure.
+    all_positions, all_positions_mask = mmcif_object.get_atom_positions(
+        auth_chain_id)
+    _check_residue_distances(
+        all_positions, all_positions_mask, max_ca_ca_distance)
+    return all_positions, all_positions_mask
+
   num_res = len(mmcif_object.chain_to_seqres[auth_chain_id])
 
   relevant_chains = [c for c in mmcif_object.structure.get_chains()
@@ -679,6 +672,18 @@ class SingleHitResult:
   features: Optional[Mapping[str, Any]]
   error: Optional[str]
   warning: Optional[str]
+  # Whether the error may not happen again, e.g. a failure of the alignment
+  # tool. Such results are not cached.
+  transient: bool = False
+
+
+def _file_version(path: str) -> Optional[Tuple[int, int]]:
+  """Returns the modification time and size of a file, None if it is missing."""
+  try:
+    stat = os.stat(path)
+  except FileNotFoundError:
+    return None
+  return int(stat.st_mtime), stat.st_size
 
 
 @functools.lru_cache(16, typed=False)
@@ -696,7 +701,8 @@ def _process_single_hit(
     release_dates: Mapping[str, datetime.datetime],
     obsolete_pdbs: Mapping[str, Optional[str]],
     kalign_binary_path: str,
-    strict_error_check: bool = False) -> SingleHitResult:
+    strict_error_check: bool = False,
+    template_store: Optional[Any] = None) -> SingleHitResult:
   """Tries to extract template features from a single HHSearch hit."""
   # Fail hard if we can't get the PDB ID and chain name from the hit.
   hit_pdb_code, hit_chain_id = _get_pdb_id_and_chain(hit)
@@ -735,14 +741,18 @@ def _process_single_hit(
   # remove gaps (which regardless have a missing confidence score).
   template_sequence = hit.hit_sequence.replace('-', '')
 
+  parsing_result = None
   cif_path = os.path.join(mmcif_dir, hit_pdb_code + '.cif')
-  logging.debug('Reading PDB entry from %s. Query: %s, template: %s', cif_path,
-                query_sequence, template_sequence)
-  # Fail if we can't find the mmCIF file.
-  cif_string = _read_file(cif_path)
+  if template_store is not None:
+    parsing_result = template_store.get(hit_pdb_code, cif_path=cif_path)
+  if parsing_result is None:
+    logging.debug('Reading PDB entry from %s. Query: %s, template: %s',
+                  cif_path, query_sequence, template_sequence)
+    # Fail if we can't find the mmCIF file.
+    cif_string = _read_file(cif_path)
 
-  parsing_result = mmcif_parsing.parse(
-      file_id=hit_pdb_code, mmcif_string=cif_string)
+    parsing_result = mmcif_parsing.parse(
+        file_id=hit_pdb_code, mmcif_string=cif_string)
 
   if parsing_result.mmcif_object is not None:
     hit_release_date = datetime.datetime.strptime(
@@ -792,7 +802,23 @@ def _process_single_hit(
              '%s, mmCIF parsing errors: %s'
              % (hit_pdb_code, hit_chain_id, hit.sum_probs, hit.index,
                 str(e), parsing_result.errors))
-    return SingleHitResult(features=None, error=error, warning=None)
+    return SingleHitResult(features=None, error=error, warning=None,
+                           transient=isinstance(e, AlignToolError))
+
+
+# Arguments of _process_single_hit shared by all the hits processed in a
+# worker process, set once per process by _init_hit_worker.
+_HIT_WORKER_KWARGS = {}
+
+
+def _init_hit_worker(**kwargs) -> None:
+  _HIT_WORKER_KWARGS.update(kwargs)
+
+
+def _process_single_hit_in_worker(
+    query_sequence: str, hit: parsers.TemplateHit) -> SingleHitResult:
+  return _process_single_hit(
+      query_sequence=query_sequence, hit=hit, **_HIT_WORKER_KWARGS)
 
 
 @dataclasses.dataclass(frozen=True)
@@ -813,7 +839,11 @@ class TemplateHitFeaturizer(abc.ABC):
       kalign_binary_path: str,
       release_dates_path: Optional[str],
       obsolete_pdbs_path: Optional[str],
-      strict_error_check: bool = False):
+      strict_error_check: bool = False,
+      num_workers: int = 0,
+      template_store: Optional[Any] = None,
+      template_index_path: Optional[str] = None,
+      template_cache: Optional[Any] = None):
     """Initializes the Template Search.
 
     Args:
@@ -836,9 +866,27 @@ class TemplateHitFeaturizer(abc.ABC):
         * If any template has identical PDB ID to the query.
         * If any template is a duplicate of the query.
         * Any feature computation errors.
+      num_workers: The number of processes featurizing hits concurrently. If
+        0 or 1, the hits are featurized sequentially in this process. The
+        templates returned do not depend on it.
+      template_store: An optional template_store.TemplateStore with the
+        pre-parsed structures of mmcif_dir. Hits missing from it are parsed
+        from mmcif_dir.
+      template_index_path: An optional path to the template_index.TemplateIndex
+        of mmcif_dir, by default next to mmcif_dir.
+      template_cache: An optional template_cache.TemplateCache. The result of
+        each hit is looked up in it before featurizing the hit, and stored in
+        it after.
     """
     self._mmcif_dir = mmcif_dir
-    if not glob.glob(os.path.join(self._mmcif_dir, '*.cif')):
+    if os.path.isdir(self._mmcif_dir):
+      self._template_index = template_index.TemplateIndex(
+          mmcif_dir=mmcif_dir,
+          obsolete_pdbs_path=obsolete_pdbs_path,
+          index_path=template_index_path,
+          template_store=template_store)
+    if (not os.path.isdir(self._mmcif_dir) or
+        not self._template_index.num_files):
       logging.error('Could not find CIFs in %s', self._mmcif_dir)
       raise ValueError(f'Could not find CIFs in {self._mmcif_dir}')
 
@@ -851,18 +899,21 @@ class TemplateHitFeaturizer(abc.ABC):
     self._max_hits = max_hits
     self._kalign_binary_path = kalign_binary_path
     self._strict_error_check = strict_error_check
+    self._num_workers = num_workers
+    self._executor = None
+    self._template_store = template_store
+    self._template_cache = template_cache
+    self._release_dates_path = release_dates_path
 
     if release_dates_path:
       logging.info('Using precomputed release dates %s.', release_dates_path)
       self._release_dates = _parse_release_dates(release_dates_path)
     else:
-      self._release_dates = {}
+      # Looked up in the index, so that hits released after max_template_date
+      # are filtered before their mmCIF file is parsed.
+      self._release_dates = self._template_index.release_dates()
 
-    if obsolete_pdbs_path:
-      logging.info('Using precomputed obsolete pdbs %s.', obsolete_pdbs_path)
-      self._obsolete_pdbs = _parse_obsolete(obsolete_pdbs_path)
-    else:
-      self._obsolete_pdbs = {}
+    self._obsolete_pdbs = self._template_index.obsolete_pdbs()
 
   @abc.abstractmethod
   def get_templates(
@@ -871,6 +922,136 @@ class TemplateHitFeaturizer(abc.ABC):
       hits: Sequence[parsers.TemplateHit]) -> TemplateSearchResult:
     """Computes the templates for given query sequence."""
 
+  def _single_hit_kwargs(self) -> Dict[str, Any]:
+    return dict(
+        mmcif_dir=self._mmcif_dir,
+        max_template_date=self._max_template_date,
+        release_dates=self._release_dates,
+        obsolete_pdbs=self._obsolete_pdbs,
+        strict_error_check=self._strict_error_check,
+        kalign_binary_path=self._kalign_binary_path,
+        template_store=self._template_store)
+
+  def _template_version(self, pdb_code: str) -> Optional[Tuple[int, int]]:
+    return _file_version(os.path.join(self._mmcif_dir, pdb_code + '.cif'))
+
+  def _cache_key(self, query_sequence: str,
+                 hit: parsers.TemplateHit) -> str:
+    """Returns the template cache key of the result of a hit."""
+    pdb_code, _ = _get_pdb_id_and_chain(hit)
+    replacement = self._obsolete_pdbs.get(pdb_code)
+    return template_cache_lib.make_key(
+        query_sequence=query_sequence,
+        hit=dataclasses.asdict(hit),
+        max_template_date=self._max_template_date.isoformat(),
+        strict_error_check=self._strict_error_check,
+        obsolete=pdb_code in self._obsolete_pdbs,
+        release_dates=(
+            self._release_dates_path and
+            [os.path.abspath(self._release_dates_path),
+             _file_version(self._release_dates_path)]),
+        template_versions=[
+            self._template_version(code) for code in (pdb_code, replacement)
+            if code is not None])
+
+  def _cached_result(self, query_sequence: str,
+                     hit: parsers.TemplateHit
+                     ) -> Tuple[Optional[str], Optional[SingleHitResult]]:
+    """Returns the cache key and cached result of a hit, if any."""
+    if self._template_cache is None:
+      return None, None
+    key = self._cache_key(query_sequence, hit)
+    return key, self._template_cache.fetch(key)
+
+  def _store_result(self, key: Optional[str], result: SingleHitResult) -> None:
+    if key is not None and not result.transient:
+      self._template_cache.store(key, result)
+
+  def _get_executor(self) -> concurrent.futures.ProcessPoolExecutor:
+    # The worker processes are spawned rather than forked since the data
+    # pipeline runs the MSA tools from threads.
+    if self._executor is None:
+      self._executor = concurrent.futures.ProcessPoolExecutor(
+          max_workers=self._num_workers,
+          mp_context=multiprocessing.get_context('spawn'),
+          initializer=functools.partial(
+              _init_hit_worker, **self._single_hit_kwargs()))
+    return self._executor
+
+  def close(self) -> None:
+    """Shuts down the worker processes featurizing hits, if any."""
+    if self._executor is not None:
+      self._executor.shutdown(cancel_futures=True)
+      self._executor = None
+
+  def __enter__(self) -> 'TemplateHitFeaturizer':
+    return self
+
+  def __exit__(self, *args) -> None:
+    self.close()
+
+  def _process_hits(
+      self,
+      query_sequence: str,
+      hits: Iterable[parsers.TemplateHit],
+      stop: Callable[[], bool]
+  ) -> Iterator[Tuple[parsers.TemplateHit, SingleHitResult]]:
+    """Featurizes the hits, yielding the results in the order of hits.
+
+    With num_workers > 1, up to 2 * num_workers hits are featurized ahead of
+    the result being consumed. The hits still pending once stop() is true are
+    cancelled.
+
+    Args:
+      query_sequence: The query sequence.
+      hits: The hits, in the order they should be considered.
+      stop: Called before each hit, no more hits are yielded once it returns
+        True, e.g. when max_hits templates were found.
+
+    Yields:
+      Tuples of a hit and its SingleHitResult.
+    """
+    if self._num_workers <= 1:
+      for hit in hits:
+        if stop():
+          return
+        key, result = self._cached_result(query_sequence, hit)
+        if result is None:
+          result = _process_single_hit(
+              query_sequence=query_sequence, hit=hit,
+              **self._single_hit_kwargs())
+          self._store_result(key, result)
+        yield hit, result
+      return
+
+    executor = self._get_executor()
+    hits = iter(hits)
+    pending = collections.deque()
+    try:
+      while not stop():
+        for hit in hits:
+          key, result = self._cached_result(query_sequence, hit)
+          if result is None:
+            future = executor.submit(
+                _process_single_hit_in_worker, query_sequence, hit)
+          else:
+            # Cached results keep their place in the order of the hits.
+            future = concurrent.futures.Future()
+            future.set_result(result)
+            key = None
+          pending.append((hit, key, future))
+          if len(pending) >= 2 * self._num_workers:
+            break
+        if not pending:
+          return
+        hit, key, future = pending.popleft()
+        result = future.result()
+        self._store_result(key, result)
+        yield hit, result
+    finally:
+      for _, _, future in pending:
+        future.cancel()
+
 
 class HhsearchHitFeaturizer(TemplateHitFeaturizer):
   """A class for turning a3m hits from hhsearch to template features."""
@@ -890,21 +1071,10 @@ class HhsearchHitFeaturizer(TemplateHitFeaturizer):
     errors = []
     warnings = []
 
-    for hit in sorted(hits, key=lambda x: x.sum_probs, reverse=True):
-      # We got all the templates we wanted, stop processing hits.
-      if num_hits >= self._max_hits:
-        break
-
-      result = _process_single_hit(
-          query_sequence=query_sequence,
-          hit=hit,
-          mmcif_dir=self._mmcif_dir,
-          max_template_date=self._max_template_date,
-          release_dates=self._release_dates,
-          obsolete_pdbs=self._obsolete_pdbs,
-          strict_error_check=self._strict_error_check,
-          kalign_binary_path=self._kalign_binary_path)
-
+    sorted_hits = sorted(hits, key=lambda x: x.sum_probs, reverse=True)
+    # We got all the templates we wanted, stop processing hits.
+    stop = lambda: num_hits >= self._max_hits
+    for hit, result in self._process_hits(query_sequence, sorted_hits, stop):
       if result.error:
         errors.append(result.error)
 
@@ -957,21 +1127,9 @@ class HmmsearchHitFeaturizer(TemplateHitFeaturizer):
     else:
       sorted_hits = sorted(hits, key=lambda x: x.sum_probs, reverse=True)
 
-    for hit in sorted_hits:
-      # We got all the templates we wanted, stop processing hits.
-      if len(already_seen) >= self._max_hits:
-        break
-
-      result = _process_single_hit(
-          query_sequence=query_sequence,
-          hit=hit,
-          mmcif_dir=self._mmcif_dir,
-          max_template_date=self._max_template_date,
-          release_dates=self._release_dates,
-          obsolete_pdbs=self._obsolete_pdbs,
-          strict_error_check=self._strict_error_check,
-          kalign_binary_path=self._kalign_binary_path)
-
+    # We got all the templates we wanted, stop processing hits.
+    stop = lambda: len(already_seen) >= self._max_hits
+    for hit, result in self._process_hits(query_sequence, sorted_hits, stop):
       if result.error:
         errors.append(result.error)
 
@@ -0,0 +1,186 @@
+# Copyright 2021 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for templates."""
+import concurrent.futures
+import os
+import shutil
+import tempfile
+import time
+from unittest import mock
+
+from absl.testing import absltest
+from absl.testing import parameterized
+from alphafold.data import parsers
+from alphafold.data import template_cache
+from alphafold.data import templates
+import numpy as np
+
+_QUERY_SEQUENCE = 'MKVLA'
+
+
+def _hit(index):
+  return parsers.TemplateHit(
+      index=index, name=f'1gcn_A hit {index}', aligned_cols=5,
+      sum_probs=100. - index, query=_QUERY_SEQUENCE,
+      hit_sequence=_QUERY_SEQUENCE, indices_query=list(range(5)),
+      indices_hit=list(range(5)))
+
+
+def _fake_process_single_hit(query_sequence, hit, **unused_kwargs):
+  """Featurizes every third hit as invalid, later hits finish first."""
+  time.sleep(0.001 * (10 - hit.index % 10))
+  if hit.index % 3 == 2:
+    return templates.SingleHitResult(
+        features=None, error=f'error of hit {hit.index}', warning=None,
+        transient=hit.index == 5)
+  features = {
+      name: np.full((1,), hit.index).astype(dtype)
+      for name, dtype in templates.TEMPLATE_FEATURES.items()}
+  features['template_domain_names'] = f'1gcn_A_{hit.index}'.encode()
+  features['template_sequence'] = f'{query_sequence}{hit.index}'.encode()
+  return templates.SingleHitResult(
+      features=features, error=None, warning=f'warning of hit {hit.index}')
+
+
+class TemplateHitFeaturizerTest(parameterized.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    tmp_dir = self.enter_context(tempfile.TemporaryDirectory())
+    self.mmcif_dir = os.path.join(tmp_dir, 'mmcif')
+    os.makedirs(self.mmcif_dir)
+    shutil.copy(
+        os.path.join(absltest.get_default_test_srcdir(),
+                     'alphafold/data/testdata/1gcn.cif'),
+        self.mmcif_dir)
+    self.index_path = os.path.join(tmp_dir, 'template_index.sqlite')
+
+  def _featurizer(self, featurizer_cls, num_workers, max_hits=4,
+                  cache=None, release_dates_path=None,
+                  max_template_date='2100-01-01'):
+    return featurizer_cls(
+        mmcif_dir=self.mmcif_dir,
+        max_template_date=max_template_date,
+        max_hits=max_hits,
+        kalign_binary_path='kalign',
+        release_dates_path=release_dates_path,
+        obsolete_pdbs_path=None,
+        num_workers=num_workers,
+        template_index_path=self.index_path,
+        template_cache=cache)
+
+  def _get_templates(self, featurizer, hits):
+    if featurizer._num_workers > 1:
+      # Threads rather than spawned processes, which would not see the fake.
+      executor = self.enter_context(
+          concurrent.futures.ThreadPoolExecutor(featurizer._num_workers))
+      self.enter_context(mock.patch.object(
+          featurizer, '_get_executor', return_value=executor))
+    with mock.patch.object(
+        templates, '_process_single_hit',
+        side_effect=_fake_process_single_hit) as process_single_hit:
+      result = featurizer.get_templates(_QUERY_SEQUENCE, hits)
+    return result, process_single_hit.call_count
+
+  @parameterized.parameters(
+      (templates.HhsearchHitFeaturizer,), (templates.HmmsearchHitFeaturizer,))
+  def test_concurrent_hits_match_sequential(self, featurizer_cls):
+    hits = [_hit(index) for index in range(20)]
+    hits.reverse()
+    sequential, num_sequential_calls = self._get_templates(
+        self._featurizer(featurizer_cls, num_workers=0), hits)
+    # max_hits templates, skipping the invalid hits.
+    self.assertEqual(num_sequential_calls, 5)
+    np.testing.assert_array_equal(
+        sequential.features['template_sum_probs'], [[0], [1], [3], [4]])
+
+    for num_workers in (2, 3):
+      concurrent_result, num_calls = self._get_templates(
+          self._featurizer(featurizer_cls, num_workers=num_workers), hits)
+      self.assertGreaterEqual(num_calls, num_sequential_calls)
+      self.assertEqual(concurrent_result.errors, sequential.errors)
+      self.assertEqual(concurrent_result.warnings, sequential.warnings)
+      self.assertEqual(concurrent_result.features.keys(),
+                       sequential.features.keys())
+      for name, feature in sequential.features.items():
+        np.testing.assert_array_equal(concurrent_result.features[name],
+                                      feature)
+
+  @parameterized.parameters(0, 2)
+  def test_cache_skips_featurized_hits(self, num_workers):
+    cache = template_cache.TemplateCache(
+        self.enter_context(tempfile.TemporaryDirectory()))
+    hits = [_hit(index) for index in range(8)]
+    featurizer = self._featurizer(templates.HhsearchHitFeaturizer,
+                                  num_workers=num_workers, max_hits=8,
+                                  cache=cache)
+    uncached, num_calls = self._get_templates(featurizer, hits)
+    self.assertEqual(num_calls, 8)
+
+    cached, num_calls = self._get_templates(featurizer, hits)
+    # Hit 5 failed to align, it is featurized again.
+    self.assertEqual(num_calls, 1)
+    self.assertEqual(cached.errors, uncached.errors)
+    for name, feature in uncached.features.items():
+      np.testing.assert_array_equal(cached.features[name], feature)
+
+  def test_cache_key_changes_with_inputs(self):
+    featurizer = self._featurizer(templates.HhsearchHitFeaturizer,
+                                  num_workers=0)
+    hit = _hit(0)
+    key = featurizer._cache_key(_QUERY_SEQUENCE, hit)
+    self.assertEqual(featurizer._cache_key(_QUERY_SEQUENCE, hit), key)
+    self.assertNotEqual(featurizer._cache_key('MKVLAA', hit), key)
+    self.assertNotEqual(featurizer._cache_key(_QUERY_SEQUENCE, _hit(1)), key)
+    self.assertNotEqual(
+        self._featurizer(templates.HhsearchHitFeaturizer, num_workers=0,
+                         max_template_date='2000-01-01')._cache_key(
+                             _QUERY_SEQUENCE, hit), key)
+
+    # The template mmCIF file is updated.
+    cif_path = os.path.join(self.mmcif_dir, '1gcn.cif')
+    stat = os.stat(cif_path)
+    os.utime(cif_path, (stat.st_atime, stat.st_mtime + 10))
+    updated_key = featurizer._cache_key(_QUERY_SEQUENCE, hit)
+    self.assertNotEqual(updated_key, key)
+
+    # Release dates are read from a file, which is then updated.
+    release_dates_path = os.path.join(
+        self.enter_context(tempfile.TemporaryDirectory()), 'release_dates.txt')
+    with open(release_dates_path, 'w') as f:
+      f.write('1gcn: 1977-11-28\n')
+    featurizer = self._featurizer(templates.HhsearchHitFeaturizer,
+                                  num_workers=0,
+                                  release_dates_path=release_dates_path)
+    release_dates_key = featurizer._cache_key(_QUERY_SEQUENCE, hit)
+    self.assertNotEqual(release_dates_key, updated_key)
+    with open(release_dates_path, 'a') as f:
+      f.write('2rbg: 2008-09-30\n')
+    self.assertNotEqual(featurizer._cache_key(_QUERY_SEQUENCE, hit),
+                        release_dates_key)
+
+  def test_close_shuts_down_workers(self):
+    with self._featurizer(templates.HhsearchHitFeaturizer,
+                          num_workers=2) as featurizer:
+      executor = featurizer._get_executor()
+      self.assertIs(featurizer._get_executor(), executor)
+    self.assertIsNone(featurizer._executor)
+    with self.assertRaises(RuntimeError):
+      executor.submit(int)
+    featurizer.close()
+
+
+if __name__ == '__main__':
+  absltest.main()
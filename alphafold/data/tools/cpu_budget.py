@@ -0,0 +1,213 @@
+# Copyright 2021 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Shares a budget of CPU cores between concurrently running MSA tools."""
+
+import contextlib
+import glob
+import os
+import threading
+from typing import Iterator, Optional, Sequence, Tuple
+
+from absl import logging
+
+_CGROUP_V2_CPU_MAX = '/sys/fs/cgroup/cpu.max'
+_CGROUP_V1_QUOTA = '/sys/fs/cgroup/cpu/cpu.cfs_quota_us'
+_CGROUP_V1_PERIOD = '/sys/fs/cgroup/cpu/cpu.cfs_period_us'
+
+
+def _read_first_line(path: str) -> Optional[str]:
+  try:
+    with open(path) as f:
+      return f.readline().strip()
+  except OSError:
+    return None
+
+
+def _cgroup_cpu_limit() -> Optional[float]:
+  """Returns the CPU quota of the cgroup in cores, None if unlimited."""
+  cpu_max = _read_first_line(_CGROUP_V2_CPU_MAX)
+  if cpu_max:
+    quota, _, period = cpu_max.partition(' ')
+    if quota != 'max' and period:
+      return int(quota) / int(period)
+    return None
+  quota = _read_first_line(_CGROUP_V1_QUOTA)
+  period = _read_first_line(_CGROUP_V1_PERIOD)
+  if quota and period and int(quota) > 0:
+    return int(quota) / int(period)
+  return None
+
+
+def available_cpus() -> int:
+  """Returns the number of cores this process may use.
+
+  This is the number of cores in the CPU affinity mask of the process, further
+  limited by the CPU quota of its cgroup (e.g. `docker run --cpus`).
+  """
+  try:
+    num_cpus = len(os.sched_getaffinity(0))
+  except AttributeError:
+    num_cpus = os.cpu_count() or 1
+  try:
+    quota = _cgroup_cpu_limit()
+  except ValueError:
+    quota = None
+  if quota is not None:
+    num_cpus = min(num_cpus, max(1, int(quota)))
+  return num_cpus
+
+
+def database_size(database_paths: Sequence[str]) -> int:
+  """Returns the total size in bytes of the files of the databases.
+
+  Args:
+    database_paths: Paths to database files, or to the common prefix of the
+      files of a database (e.g. HHblits databases, <prefix>_a3m.ffdata etc.).
+  """
+  total = 0
+  for database_path in database_paths:
+    if os.path.isfile(database_path):
+      paths = [database_path]
+    else:
+      # Not database_path + '*', which matches the chunks db.10-19 of db.1.
+      paths = glob.glob(glob.escape(database_path) + '_*')
+    for path in paths:
+      if os.path.isfile(path):
+        total += os.path.getsize(path)
+  return total
+
+
+class CpuBudget:
+  """A budget of CPU cores shared by the MSA tools of a process.
+
+  Each search acquires a number of threads when it starts and returns them
+  when it finishes. A search gets a share of the budget proportional to the
+  size of its database relative to the other running searches. Slots of
+  max_concurrent not taken by a running search are counted as taken by a
+  search of the same size, so the first search to start does not take every
+  core. The number of threads of a running tool can't change, instead cores
+  freed by finished searches go to the searches started after them (including
+  the next chunk of a streamed database).
+  """
+
+  def __init__(self,
+               num_cpus: Optional[int] = None,
+               max_concurrent: int = 1,
+               max_cpus_per_search: Optional[int] = None):
+    """Initializes the budget.
+
+    Args:
+      num_cpus: The number of cores shared by the searches, detected from the
+        CPU affinity and cgroup of the process if not given.
+      max_concurrent: The expected number of searches running at the same
+        time, e.g. n_parallel_msa.
+      max_cpus_per_search: Optional limit of the threads of a single search.
+    """
+    self.num_cpus = num_cpus or available_cpus()
+    self.max_concurrent = max(1, max_concurrent)
+    self.max_cpus_per_search = max_cpus_per_search
+    self._condition = threading.Condition()
+    self._free_cpus = self.num_cpus
+    # Weights of the running searches, keyed by a per-search token.
+    self._running = {}
+    logging.info('Sharing %d CPUs between %d concurrent MSA searches.',
+                 self.num_cpus, self.max_concurrent)
+
+  def _share(self, weight: float) -> int:
+    idle_slots = max(0, self.max_concurrent - len(self._running) - 1)
+    total_weight = weight * (1 + idle_slots) + sum(self._running.values())
+    share = round(self.num_cpus * weight / total_weight) if total_weight else 1
+    if self.max_cpus_per_search:
+      share = min(share, self.max_cpus_per_search)
+    return max(1, min(share, self._free_cpus))
+
+  @contextlib.contextmanager
+  def acquire(self, weight: float, name: str = '') -> Iterator[int]:
+    """Reserves threads for a search, waiting until a core is free.
+
+    Args:
+      weight: The weight of the search, conventionally the database size.
+      name: The name of the search, for logging.
+
+    Yields:
+      The number of threads the search may use.
+    """
+    weight = max(float(weight), 1.)
+    token = object()
+    with self._condition:
+      self._condition.wait_for(lambda: self._free_cpus > 0)
+      num_threads = self._share(weight)
+      self._free_cpus -= num_threads
+      self._running[token] = weight
+    logging.info('Running %s with %d of %d CPUs.', name or 'search',
+                 num_threads, self.num_cpus)
+    try:
+      yield num_threads
+    finally:
+      with self._condition:
+        self._free_cpus += num_threads
+        del self._running[token]
+        self._condition.notify_all()
+
+
+@contextlib.contextmanager
+def reserve(budget: Optional[CpuBudget], default_cpus: int, weight: float,
+            name: str = '') -> Iterator[int]:
+  """Yields the threads of a search, default_cpus if there is no budget."""
+  if budget is None:
+    yield default_cpus
+  else:
+    with budget.acquire(weight, name) as num_threads:
+      yield num_threads
+
+
+def split_threads(num_threads: int, num_queries: int) -> Tuple[int, int]:
+  """Splits the threads of a batch evenly between its queries.
+
+  Args:
+    num_threads: The threads reserved for the batch.
+    num_queries: The number of queries of the batch.
+
+  Returns:
+    The number of queries run at the same time and the threads of each. With
+    fewer threads than queries, the queries run num_threads at a time.
+  """
+  num_concurrent = max(1, min(num_queries, num_threads))
+  return num_concurrent, max(1, num_threads // num_concurrent)
+
+
+@contextlib.contextmanager
+def reserve_batch(budget: Optional[CpuBudget], default_cpus: int,
+                  weight: float, num_queries: int,
+                  name: str = '') -> Iterator[Tuple[int, int]]:
+  """Reserves threads once for a batch of queries of the same database.
+
+  The queries of a batch read the database together, so they share a single
+  reservation, split evenly between them, rather than competing with each
+  other for the budget.
+
+  Args:
+    budget: The CPU budget, if any.
+    default_cpus: The threads of the batch if there is no budget.
+    weight: The weight of the batch, conventionally the database size.
+    num_queries: The number of queries of the batch.
+    name: The name of the search, for logging.
+
+  Yields:
+    The number of queries run at the same time and the threads of each, see
+    split_threads.
+  """
+  with reserve(budget, default_cpus, weight, name) as num_threads:
+    yield split_threads(num_threads, num_queries)
@@ -0,0 +1,165 @@
+# Copyright 2021 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for cpu_budget."""
+import contextlib
+import os
+import tempfile
+import threading
+from unittest import mock
+
+from absl.testing import absltest
+from alphafold.data.tools import cpu_budget
+
+
+class CgroupTest(absltest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.tmp_dir = self.enter_context(tempfile.TemporaryDirectory())
+
+  def _cgroup(self, cpu_max=None, quota=None, period=None):
+    """Points the cgroup files of cpu_budget to files with these contents."""
+    paths = {}
+    for name, content in (('_CGROUP_V2_CPU_MAX', cpu_max),
+                          ('_CGROUP_V1_QUOTA', quota),
+                          ('_CGROUP_V1_PERIOD', period)):
+      paths[name] = os.path.join(self.tmp_dir, name)
+      if content is not None:
+        with open(paths[name], 'w') as f:
+          f.write(content + '\n')
+    return mock.patch.multiple(cpu_budget, **paths)
+
+  def test_cgroup_v2(self):
+    with self._cgroup(cpu_max='250000 100000'):
+      self.assertEqual(cpu_budget._cgroup_cpu_limit(), 2.5)
+    with self._cgroup(cpu_max='max 100000', quota='100000', period='100000'):
+      self.assertIsNone(cpu_budget._cgroup_cpu_limit())
+
+  def test_cgroup_v1(self):
+    with self._cgroup(quota='150000', period='100000'):
+      self.assertEqual(cpu_budget._cgroup_cpu_limit(), 1.5)
+    with self._cgroup(quota='-1', period='100000'):
+      self.assertIsNone(cpu_budget._cgroup_cpu_limit())
+    with self._cgroup():
+      self.assertIsNone(cpu_budget._cgroup_cpu_limit())
+
+  def test_available_cpus(self):
+    with mock.patch.object(os, 'sched_getaffinity', return_value={0, 1, 2, 3}):
+      with self._cgroup():
+        self.assertEqual(cpu_budget.available_cpus(), 4)
+      with self._cgroup(cpu_max='250000 100000'):
+        self.assertEqual(cpu_budget.available_cpus(), 2)
+      with self._cgroup(cpu_max='50000 100000'):
+        self.assertEqual(cpu_budget.available_cpus(), 1)
+      with self._cgroup(cpu_max='800000 100000'):
+        self.assertEqual(cpu_budget.available_cpus(), 4)
+      with self._cgroup(cpu_max='invalid 100000'):
+        self.assertEqual(cpu_budget.available_cpus(), 4)
+
+
+class DatabaseSizeTest(absltest.TestCase):
+
+  def test_database_size(self):
+    tmp_dir = self.enter_context(tempfile.TemporaryDirectory())
+    for name, size in (('uniref90.fasta.1', 10), ('uniref90.fasta.10', 100),
+                       ('uniref90.fasta.11', 1000), ('bfd_a3m.ffdata', 1),
+                       ('bfd_a3m.ffindex', 2), ('bfd_hhm.ffdata', 4),
+                       ('bfdx_a3m.ffdata', 8)):
+      with open(os.path.join(tmp_dir, name), 'w') as f:
+        f.write('x' * size)
+
+    chunk = os.path.join(tmp_dir, 'uniref90.fasta.1')
+    prefix = os.path.join(tmp_dir, 'bfd')
+    self.assertEqual(cpu_budget.database_size([chunk]), 10)
+    self.assertEqual(cpu_budget.database_size([prefix]), 7)
+    self.assertEqual(cpu_budget.database_size([chunk, prefix]), 17)
+    self.assertEqual(
+        cpu_budget.database_size([os.path.join(tmp_dir, 'missing')]), 0)
+
+
+class CpuBudgetTest(absltest.TestCase):
+
+  def test_share(self):
+    budget = cpu_budget.CpuBudget(num_cpus=8, max_concurrent=2)
+    # The idle slot counts as a search of the same weight.
+    self.assertEqual(budget._share(1.), 4)
+    budget._running[object()] = 3.
+    self.assertEqual(budget._share(1.), 2)
+    budget._free_cpus = 1
+    self.assertEqual(budget._share(1.), 1)
+
+    budget = cpu_budget.CpuBudget(num_cpus=8, max_concurrent=1,
+                                  max_cpus_per_search=6)
+    self.assertEqual(budget._share(1.), 6)
+    budget._running[object()] = 1000.
+    self.assertEqual(budget._share(1.), 1)
+
+  def test_acquire(self):
+    budget = cpu_budget.CpuBudget(num_cpus=8, max_concurrent=2)
+    with budget.acquire(100) as first:
+      self.assertEqual(first, 4)
+      with budget.acquire(300) as second:
+        self.assertEqual(second, 4)
+        self.assertEqual(budget._free_cpus, 0)
+      self.assertEqual(budget._free_cpus, 4)
+    self.assertEqual(budget._free_cpus, 8)
+    self.assertEmpty(budget._running)
+
+  def test_acquire_waits_for_a_free_cpu(self):
+    budget = cpu_budget.CpuBudget(num_cpus=1)
+    acquired = threading.Event()
+
+    def search():
+      with budget.acquire(1) as num_threads:
+        self.assertEqual(num_threads, 1)
+        acquired.set()
+
+    with budget.acquire(1):
+      thread = threading.Thread(target=search)
+      thread.start()
+      self.assertFalse(acquired.wait(0.1))
+    thread.join(10)
+    self.assertTrue(acquired.is_set())
+    self.assertEqual(budget._free_cpus, 1)
+
+  def test_split_threads(self):
+    self.assertEqual(cpu_budget.split_threads(21, 6), (6, 3))
+    self.assertEqual(cpu_budget.split_threads(8, 1), (1, 8))
+    self.assertEqual(cpu_budget.split_threads(4, 6), (4, 1))
+    self.assertEqual(cpu_budget.split_threads(1, 0), (1, 1))
+
+  def test_batches_share_one_reservation(self):
+    budget = cpu_budget.CpuBudget(num_cpus=64, max_concurrent=3)
+    with contextlib.ExitStack() as stack:
+      # Three databases searched at the same time, each for 6 queries.
+      shares = [
+          stack.enter_context(cpu_budget.reserve_batch(
+              budget, default_cpus=8, weight=100, num_queries=6))
+          for _ in range(3)]
+      self.assertEqual(shares, [(6, 3), (6, 3), (6, 3)])
+      self.assertLen(budget._running, 3)
+    self.assertEqual(budget._free_cpus, 64)
+
+    with cpu_budget.reserve_batch(None, default_cpus=8, weight=1,
+                                  num_queries=3) as share:
+      self.assertEqual(share, (3, 2))
+
+  def test_reserve_without_budget(self):
+    with cpu_budget.reserve(None, default_cpus=3, weight=1) as num_threads:
+      self.assertEqual(num_threads, 3)
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -14,12 +14,15 @@
 
 """Library to run HHblits from Python."""
 
+import contextlib
 import glob
 import os
 import subprocess
 from typing import Any, List, Mapping, Optional, Sequence
 
 from absl import logging
+from alphafold.data import database_stage as database_stage_lib
+from alphafold.data.tools import cpu_budget as cpu_budget_lib
 from alphafold.data.tools import utils
 # Internal import (7716).
 
@@ -45,7 +48,10 @@ class HHBlits:
                all_seqs: bool = False,
                alt: Optional[int] = None,
                p: int = _HHBLITS_DEFAULT_P,
-               z: int = _HHBLITS_DEFAULT_Z):
+               z: int = _HHBLITS_DEFAULT_Z,
+               cpu_budget: Optional[cpu_budget_lib.CpuBudget] = None,
+               database_stage: Optional[
+                   database_stage_lib.DatabaseStage] = None):
     """Initializes the Python HHblits wrapper.
 
     Args:
@@ -53,7 +59,8 @@ class HHBlits:
       databases: A sequence of HHblits database paths. This should be the
         common prefix for the database files (i.e. up to but not including
         _hhm.ffindex etc.)
-      n_cpu: The number of CPUs to give HHblits.
+      n_cpu: The number of CPUs to give HHblits if there is no cpu_budget,
+        split between the queries of a batch.
       n_iter: The number of HHblits iterations.
       e_value: The E-value, see HHblits docs for more details.
       maxseq: The maximum number of rows in an input alignment. Note that this
@@ -70,6 +77,9 @@ class HHBlits:
         HHblits default: 20.
       z: Hard cap on number of hits reported in the hhr file.
         HHblits default: 500. NB: The relevant HHblits flag is -Z not -z.
+      cpu_budget: Optional CPU budget shared with the other MSA tools, which
+        decides the number of CPUs of each query.
+      database_stage: Optional stage of the databases on local storage.
 
     Raises:
       RuntimeError: If HHblits binary not found within the path.
@@ -93,20 +103,28 @@ class HHBlits:
     self.alt = alt
     self.p = p
     self.z = z
+    self.cpu_budget = cpu_budget
+    self.database_stage = database_stage
 
   def query(self, input_fasta_path: str) -> List[Mapping[str, Any]]:
     """Queries the database using HHblits."""
-    with utils.tmpdir_manager() as query_tmp_dir:
+    return self.query_multiple([input_fasta_path])[0]
+
+  def _query(self, input_fasta_path: str,
+             n_cpu: int) -> List[Mapping[str, Any]]:
+    """Queries the database using HHblits with n_cpu threads."""
+    with utils.tmpdir_manager() as query_tmp_dir, \
+        contextlib.ExitStack() as staged_databases:
       a3m_path = os.path.join(query_tmp_dir, 'output.a3m')
 
       db_cmd = []
       for db_path in self.databases:
         db_cmd.append('-d')
-        db_cmd.append(db_path)
+        db_cmd.append(staged_databases.enter_context(
+            database_stage_lib.reading(self.database_stage, db_path)))
       cmd = [
           self.binary_path,
           '-i', input_fasta_path,
-          '-cpu', str(self.n_cpu),
           '-oa3m', a3m_path,
           '-o', '/dev/null',
           '-n', str(self.n_iter),
@@ -124,6 +142,7 @@ class HHBlits:
       if self.z != _HHBLITS_DEFAULT_Z:
         cmd += ['-Z', str(self.z)]
       cmd += db_cmd
+      cmd += ['-cpu', str(n_cpu)]
 
       logging.info('Launching subprocess "%s"', ' '.join(cmd))
       process = subprocess.Popen(
@@ -153,3 +172,20 @@ class HHBlits:
         n_iter=self.n_iter,
         e_value=self.e_value)
     return [raw_output]
+
+  def query_multiple(
+      self, input_fasta_paths: Sequence[str]) -> List[List[Mapping[str, Any]]]:
+    """Queries the databases with a batch of queries, see query.
+
+    The queries are searched together, so that the databases are read about
+    once for all of them, see utils.map_concurrently. The CPUs are reserved
+    once for the batch and split evenly between its queries.
+    """
+    with cpu_budget_lib.reserve_batch(
+        self.cpu_budget, self.n_cpu,
+        weight=cpu_budget_lib.database_size(self.databases),
+        num_queries=len(input_fasta_paths),
+        name='HHblits') as (num_concurrent, n_cpu):
+      return utils.map_concurrently(
+          lambda path: self._query(path, n_cpu), input_fasta_paths,
+          max_workers=num_concurrent)
@@ -14,17 +14,23 @@
 
 """Library to run HHsearch from Python."""
 
+import contextlib
 import glob
 import os
 import subprocess
-from typing import Sequence
+from typing import List, Optional, Sequence
 
 from absl import logging
 
+from alphafold.data import database_stage as database_stage_lib
 from alphafold.data import parsers
+from alphafold.data.tools import cpu_budget as cpu_budget_lib
 from alphafold.data.tools import utils
 # Internal import (7716).
 
+# The number of threads of an HHsearch process, the default of its -cpu flag.
+_HHSEARCH_DEFAULT_CPU = 2
+
 
 class HHSearch:
   """Python wrapper of the HHsearch binary."""
@@ -33,7 +39,9 @@ class HHSearch:
                *,
                binary_path: str,
                databases: Sequence[str],
-               maxseq: int = 1_000_000):
+               maxseq: int = 1_000_000,
+               database_stage: Optional[
+                   database_stage_lib.DatabaseStage] = None):
     """Initializes the Python HHsearch wrapper.
 
     Args:
@@ -43,6 +51,7 @@ class HHSearch:
         _hhm.ffindex etc.)
       maxseq: The maximum number of rows in an input alignment. Note that this
         parameter is only supported in HHBlits version 3.1 and higher.
+      database_stage: Optional stage of the databases on local storage.
 
     Raises:
       RuntimeError: If HHsearch binary not found within the path.
@@ -50,6 +59,7 @@ class HHSearch:
     self.binary_path = binary_path
     self.databases = databases
     self.maxseq = maxseq
+    self.database_stage = database_stage
 
     for database_path in self.databases:
       if not glob.glob(database_path + '_*'):
@@ -66,7 +76,8 @@ class HHSearch:
 
   def query(self, a3m: str) -> str:
     """Queries the database using HHsearch using a given a3m."""
-    with utils.tmpdir_manager() as query_tmp_dir:
+    with utils.tmpdir_manager() as query_tmp_dir, \
+        contextlib.ExitStack() as staged_databases:
       input_path = os.path.join(query_tmp_dir, 'query.a3m')
       hhr_path = os.path.join(query_tmp_dir, 'output.hhr')
       with open(input_path, 'w') as f:
@@ -75,7 +86,8 @@ class HHSearch:
       db_cmd = []
       for db_path in self.databases:
         db_cmd.append('-d')
-        db_cmd.append(db_path)
+        db_cmd.append(staged_databases.enter_context(
+            database_stage_lib.reading(self.database_stage, db_path)))
       cmd = [self.binary_path,
              '-i', input_path,
              '-o', hhr_path,
@@ -99,6 +111,17 @@ class HHSearch:
         hhr = f.read()
     return hhr
 
+  def query_multiple(self, a3ms: Sequence[str]) -> List[str]:
+    """Queries the database with a batch of a3ms, see query.
+
+    The queries are searched together, as many at a time as the available
+    CPUs allow, so that the database is read about once for each group of
+    queries, see utils.map_concurrently.
+    """
+    max_workers = max(
+        1, cpu_budget_lib.available_cpus() // _HHSEARCH_DEFAULT_CPU)
+    return utils.map_concurrently(self.query, a3ms, max_workers=max_workers)
+
   def get_template_hits(self,
                         output_string: str,
                         input_sequence: str) -> Sequence[parsers.TemplateHit]:
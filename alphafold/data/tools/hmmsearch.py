@@ -16,10 +16,12 @@
 
 import os
 import subprocess
-from typing import Optional, Sequence
+from typing import List, Optional, Sequence
 
 from absl import logging
+from alphafold.data import database_stage as database_stage_lib
 from alphafold.data import parsers
+from alphafold.data.tools import cpu_budget as cpu_budget_lib
 from alphafold.data.tools import hmmbuild
 from alphafold.data.tools import utils
 # Internal import (7716).
@@ -33,7 +35,11 @@ class Hmmsearch(object):
                binary_path: str,
                hmmbuild_binary_path: str,
                database_path: str,
-               flags: Optional[Sequence[str]] = None):
+               flags: Optional[Sequence[str]] = None,
+               n_cpu: int = 17,
+               cpu_budget: Optional[cpu_budget_lib.CpuBudget] = None,
+               database_stage: Optional[
+                   database_stage_lib.DatabaseStage] = None):
     """Initializes the Python hmmsearch wrapper.
 
     Args:
@@ -42,6 +48,11 @@ class Hmmsearch(object):
         an hmm from an input a3m.
       database_path: The path to the hmmsearch database (FASTA format).
       flags: List of flags to be used by hmmsearch.
+      n_cpu: The number of CPUs to give hmmsearch if there is no cpu_budget,
+        split between the queries of a batch.
+      cpu_budget: Optional CPU budget shared with the other MSA tools, which
+        decides the number of CPUs of each query.
+      database_stage: Optional stage of the database on local storage.
 
     Raises:
       RuntimeError: If hmmsearch binary not found within the path.
@@ -59,6 +70,9 @@ class Hmmsearch(object):
                '--domE', '100',
                '--incdomE', '100']
     self.flags = flags
+    self.n_cpu = n_cpu
+    self.cpu_budget = cpu_budget
+    self.database_stage = database_stage
 
     if not os.path.exists(self.database_path):
       logging.error('Could not find hmmsearch database %s', database_path)
@@ -78,35 +92,63 @@ class Hmmsearch(object):
                                                       model_construction='hand')
     return self.query_with_hmm(hmm)
 
+  def query_multiple(self, msa_stos: Sequence[str]) -> List[str]:
+    """Queries the database with a batch of stockholm msas, see query.
+
+    The queries are searched together, so that the database is read about
+    once for all of them, see utils.map_concurrently. The CPUs are reserved
+    once for the batch and split evenly between its queries.
+    """
+    hmms = [
+        self.hmmbuild_runner.build_profile_from_sto(
+            msa_sto, model_construction='hand') for msa_sto in msa_stos]
+    return self._query_with_hmms(hmms)
+
   def query_with_hmm(self, hmm: str) -> str:
     """Queries the database using hmmsearch using a given hmm."""
+    return self._query_with_hmms([hmm])[0]
+
+  def _query_with_hmms(self, hmms: Sequence[str]) -> List[str]:
+    name = f'hmmsearch ({os.path.basename(self.database_path)})'
+    with cpu_budget_lib.reserve_batch(
+        self.cpu_budget, self.n_cpu,
+        weight=cpu_budget_lib.database_size([self.database_path]),
+        num_queries=len(hmms), name=name) as (num_concurrent, n_cpu):
+      return utils.map_concurrently(
+          lambda hmm: self._query_with_hmm(hmm, n_cpu), hmms,
+          max_workers=num_concurrent)
+
+  def _query_with_hmm(self, hmm: str, n_cpu: int) -> str:
+    """Queries the database using hmmsearch with n_cpu threads."""
     with utils.tmpdir_manager() as query_tmp_dir:
       hmm_input_path = os.path.join(query_tmp_dir, 'query.hmm')
       out_path = os.path.join(query_tmp_dir, 'output.sto')
       with open(hmm_input_path, 'w') as f:
         f.write(hmm)
 
-      cmd = [
-          self.binary_path,
-          '--noali',  # Don't include the alignment in stdout.
-          '--cpu', '17'
-      ]
-      # If adding flags, we have to do so before the output and input:
-      if self.flags:
-        cmd.extend(self.flags)
-      cmd.extend([
-          '-A', out_path,
-          hmm_input_path,
-          self.database_path,
-      ])
-
-      logging.info('Launching sub-process %s', cmd)
-      process = subprocess.Popen(
-          cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-      with utils.timing(
-          f'hmmsearch ({os.path.basename(self.database_path)}) query'):
-        stdout, stderr = process.communicate()
-        retcode = process.wait()
+      name = f'hmmsearch ({os.path.basename(self.database_path)})'
+      with database_stage_lib.reading(
+          self.database_stage, self.database_path) as database_path:
+        cmd = [
+            self.binary_path,
+            '--noali',  # Don't include the alignment in stdout.
+            '--cpu', str(n_cpu)
+        ]
+        # If adding flags, we have to do so before the output and input:
+        if self.flags:
+          cmd.extend(self.flags)
+        cmd.extend([
+            '-A', out_path,
+            hmm_input_path,
+            database_path,
+        ])
+
+        logging.info('Launching sub-process %s', cmd)
+        process = subprocess.Popen(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        with utils.timing(f'{name} query'):
+          stdout, stderr = process.communicate()
+          retcode = process.wait()
 
       if retcode:
         raise RuntimeError(
@@ -15,6 +15,7 @@
 """Library to run Jackhmmer from Python."""
 
 from concurrent import futures
+import contextlib
 import glob
 import os
 import subprocess
@@ -23,7 +24,9 @@ from urllib import request
 
 from absl import logging
 
+from alphafold.data import database_stage as database_stage_lib
 from alphafold.data import parsers
+from alphafold.data.tools import cpu_budget as cpu_budget_lib
 from alphafold.data.tools import utils
 # Internal import (7716).
 
@@ -46,13 +49,17 @@ class Jackhmmer:
                incdom_e: Optional[float] = None,
                dom_e: Optional[float] = None,
                num_streamed_chunks: Optional[int] = None,
-               streaming_callback: Optional[Callable[[int], None]] = None):
+               streaming_callback: Optional[Callable[[int], None]] = None,
+               cpu_budget: Optional[cpu_budget_lib.CpuBudget] = None,
+               database_stage: Optional[
+                   database_stage_lib.DatabaseStage] = None):
     """Initializes the Python Jackhmmer wrapper.
 
     Args:
       binary_path: The path to the jackhmmer executable.
       database_path: The path to the jackhmmer database (FASTA format).
-      n_cpu: The number of CPUs to give Jackhmmer.
+      n_cpu: The number of CPUs to give Jackhmmer if there is no cpu_budget,
+        split between the queries of a batch.
       n_iter: The number of Jackhmmer iterations.
       e_value: The E-value, see Jackhmmer docs for more details.
       z_value: The Z-value, see Jackhmmer docs for more details.
@@ -66,6 +73,10 @@ class Jackhmmer:
       num_streamed_chunks: Number of database chunks to stream over.
       streaming_callback: Callback function run after each chunk iteration with
         the iteration number as argument.
+      cpu_budget: Optional CPU budget shared with the other MSA tools, which
+        decides the number of CPUs of each query.
+      database_stage: Optional stage of the database (or of its streamed
+        chunks) on local storage.
     """
     self.binary_path = binary_path
     self.database_path = database_path
@@ -86,12 +97,15 @@ class Jackhmmer:
     self.dom_e = dom_e
     self.get_tblout = get_tblout
     self.streaming_callback = streaming_callback
+    self.cpu_budget = cpu_budget
+    self.database_stage = database_stage
 
   def _query_chunk(self,
                    input_fasta_path: str,
                    database_path: str,
+                   n_cpu: int,
                    max_sequences: Optional[int] = None) -> Mapping[str, Any]:
-    """Queries the database chunk using Jackhmmer."""
+    """Queries the database chunk using Jackhmmer with n_cpu threads."""
     with utils.tmpdir_manager() as query_tmp_dir:
       sto_path = os.path.join(query_tmp_dir, 'output.sto')
 
@@ -111,7 +125,6 @@ class Jackhmmer:
           '--incE', str(self.e_value),
           # Report only sequences with E-values <= x in per-sequence output.
           '-E', str(self.e_value),
-          '--cpu', str(self.n_cpu),
           '-N', str(self.n_iter)
       ]
       if self.get_tblout:
@@ -127,8 +140,8 @@ class Jackhmmer:
       if self.incdom_e is not None:
         cmd_flags.extend(['--incdomE', str(self.incdom_e)])
 
-      cmd = [self.binary_path] + cmd_flags + [input_fasta_path,
-                                              database_path]
+      cmd = [self.binary_path, '--cpu', str(n_cpu)] + cmd_flags + [
+          input_fasta_path, database_path]
 
       logging.info('Launching subprocess "%s"', ' '.join(cmd))
       process = subprocess.Popen(
@@ -174,18 +187,55 @@ class Jackhmmer:
       input_fasta_paths: Sequence[str],
       max_sequences: Optional[int] = None,
     ) -> Sequence[Sequence[Mapping[str, Any]]]:
-    """Queries the database for multiple queries using Jackhmmer."""
+    """Queries the database for multiple queries using Jackhmmer.
+
+    The queries are searched together, so that the database (or each streamed
+    chunk) is read about once for all of them, see utils.map_concurrently. The
+    CPUs are reserved once for the batch and split evenly between its queries.
+
+    Args:
+      input_fasta_paths: The paths of the query FASTA files.
+      max_sequences: The maximum number of sequences kept in each Stockholm
+        output.
+
+    Returns:
+      For each query, the outputs of each database chunk.
+    """
+    def query_all(database_path):
+      with cpu_budget_lib.reserve_batch(
+          self.cpu_budget, self.n_cpu,
+          weight=cpu_budget_lib.database_size([database_path]),
+          num_queries=len(input_fasta_paths),
+          name=f'Jackhmmer ({os.path.basename(database_path)})'
+      ) as (num_concurrent, n_cpu):
+        return utils.map_concurrently(
+            lambda path: self._query_chunk(
+                path, database_path, n_cpu, max_sequences),
+            input_fasta_paths, max_workers=num_concurrent)
+
     if self.num_streamed_chunks is None:
-      single_chunk_results = []
-      for input_fasta_path in input_fasta_paths:
-        single_chunk_results.append([self._query_chunk(
-            input_fasta_path, self.database_path, max_sequences)])
-      return single_chunk_results
+      with database_stage_lib.reading(
+          self.database_stage, self.database_path) as database_path:
+        return [[output] for output in query_all(database_path)]
 
     db_basename = os.path.basename(self.database_path)
     db_remote_chunk = lambda db_idx: f'{self.database_path}.{db_idx}'
     db_local_chunk = lambda db_idx: f'/tmp/ramdisk/{db_basename}.{db_idx}'
 
+    def fetch_chunk(db_idx):
+      """Returns the path of a local chunk and the context keeping it."""
+      remote_chunk = db_remote_chunk(db_idx)
+      # Staged chunks are kept for the next searches. Chunks that are not
+      # staged, e.g. URLs or chunks larger than the stage, are downloaded.
+      staged_chunk = contextlib.ExitStack()
+      chunk_path = staged_chunk.enter_context(
+          database_stage_lib.reading(self.database_stage, remote_chunk))
+      if chunk_path != remote_chunk:
+        return chunk_path, staged_chunk
+      staged_chunk.close()
+      request.urlretrieve(remote_chunk, db_local_chunk(db_idx))
+      return db_local_chunk(db_idx), contextlib.ExitStack()
+
     # Remove existing files to prevent OOM
     for f in glob.glob(db_local_chunk('[0-9]*')):
       try:
@@ -199,19 +249,18 @@ class Jackhmmer:
       for i in range(1, self.num_streamed_chunks + 1):
         # Copy the chunk locally
         if i == 1:
-          future = executor.submit(
-              request.urlretrieve, db_remote_chunk(i), db_local_chunk(i))
+          future = executor.submit(fetch_chunk, i)
         if i < self.num_streamed_chunks:
-          next_future = executor.submit(
-              request.urlretrieve, db_remote_chunk(i+1), db_local_chunk(i+1))
+          next_future = executor.submit(fetch_chunk, i + 1)
 
         # Run Jackhmmer with the chunk
-        future.result()
-        for fasta_index, input_fasta_path in enumerate(input_fasta_paths):
-          chunked_outputs[fasta_index].append(self._query_chunk(
-              input_fasta_path, db_local_chunk(i), max_sequences))
+        chunk_path, staged_chunk = future.result()
+        with staged_chunk:
+          for fasta_index, output in enumerate(query_all(chunk_path)):
+            chunked_outputs[fasta_index].append(output)
         # Remove the local copy of the chunk
-        os.remove(db_local_chunk(i))
+        if chunk_path == db_local_chunk(i):
+          os.remove(chunk_path)
         # Do not set next_future for the last chunk so that this works even for
         # databases with only 1 chunk.
         if i < self.num_streamed_chunks:
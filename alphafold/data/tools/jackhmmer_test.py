@@ -0,0 +1,107 @@
+# Copyright 2021 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for jackhmmer."""
+import os
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from absl.testing import absltest
+from alphafold.data.tools import cpu_budget
+from alphafold.data.tools import jackhmmer
+
+
+class _FakeJackhmmerProcess:
+  """Records the threads and the concurrency of the Jackhmmer processes."""
+
+  lock = threading.Lock()
+  running = 0
+  max_running = 0
+  num_cpus = []
+
+  def __init__(self, cmd, **unused_kwargs):
+    self._sto_path = cmd[cmd.index('-A') + 1]
+    with self.lock:
+      type(self).num_cpus.append(int(cmd[cmd.index('--cpu') + 1]))
+      type(self).running += 1
+      type(self).max_running = max(self.max_running, self.running)
+
+  def communicate(self):
+    time.sleep(0.05)
+    with open(self._sto_path, 'w') as f:
+      f.write('# STOCKHOLM 1.0\n//\n')
+    with self.lock:
+      type(self).running -= 1
+    return b'', b''
+
+  def wait(self):
+    return 0
+
+  @classmethod
+  def reset(cls):
+    cls.running = 0
+    cls.max_running = 0
+    cls.num_cpus = []
+
+
+class JackhmmerTest(absltest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.tmp_dir = self.enter_context(tempfile.TemporaryDirectory())
+    self.database_path = os.path.join(self.tmp_dir, 'uniref90.fasta')
+    with open(self.database_path, 'w') as f:
+      f.write('>a\nMKV\n')
+    self.fasta_paths = []
+    for i in range(6):
+      self.fasta_paths.append(os.path.join(self.tmp_dir, f'query{i}.fasta'))
+      with open(self.fasta_paths[-1], 'w') as f:
+        f.write(f'>query{i}\nMKV\n')
+    _FakeJackhmmerProcess.reset()
+    self.enter_context(mock.patch.object(
+        jackhmmer.subprocess, 'Popen', _FakeJackhmmerProcess))
+
+  def _runner(self, budget, n_cpu=8):
+    return jackhmmer.Jackhmmer(binary_path='jackhmmer',
+                               database_path=self.database_path,
+                               n_cpu=n_cpu, cpu_budget=budget)
+
+  def test_batch_splits_one_reservation(self):
+    budget = cpu_budget.CpuBudget(num_cpus=64, max_concurrent=3)
+    outputs = self._runner(budget).query_multiple(self.fasta_paths)
+
+    self.assertLen(outputs, 6)
+    self.assertEqual(outputs[0][0]['sto'], '# STOCKHOLM 1.0\n//\n')
+    # 21 CPUs for the batch, with two idle slots of the budget.
+    self.assertEqual(_FakeJackhmmerProcess.num_cpus, [3] * 6)
+    self.assertEqual(_FakeJackhmmerProcess.max_running, 6)
+    self.assertEqual(budget._free_cpus, 64)
+
+  def test_batch_larger_than_its_cpus(self):
+    budget = cpu_budget.CpuBudget(num_cpus=4)
+    self._runner(budget).query_multiple(self.fasta_paths)
+
+    self.assertEqual(_FakeJackhmmerProcess.num_cpus, [1] * 6)
+    self.assertEqual(_FakeJackhmmerProcess.max_running, 4)
+
+  def test_single_query_without_budget(self):
+    self._runner(None, n_cpu=8).query(self.fasta_paths[0])
+
+    self.assertEqual(_FakeJackhmmerProcess.num_cpus, [8])
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -13,10 +13,11 @@
 # limitations under the License.
 """Common utilities for data pipeline tools."""
 import contextlib
+from concurrent import futures
 import shutil
 import tempfile
 import time
-from typing import Optional
+from typing import Any, Callable, List, Optional, Sequence, TypeVar
 
 from absl import logging
 
@@ -38,3 +39,30 @@ def timing(msg: str):
   yield
   toc = time.time()
   logging.info('Finished %s in %.3f seconds', msg, toc - tic)
+
+
+_T = TypeVar('_T')
+
+
+def map_concurrently(fn: Callable[[Any], _T],
+                     items: Sequence[Any],
+                     max_workers: Optional[int] = None) -> List[_T]:
+  """Returns [fn(item) for item in items], calling fn from several threads.
+
+  Used to search a database with a batch of queries: tool processes started
+  together scan the database at about the same pace, so the reads of all but
+  the leading process are served from the page cache. The database is read
+  from disk about once per max_workers queries instead of once per query.
+
+  Args:
+    fn: The function to call.
+    items: The arguments of fn.
+    max_workers: The maximum number of concurrent calls, all of them if not
+      set. Callers running tools with several threads each pass the number of
+      queries their CPUs allow, see cpu_budget.reserve_batch.
+  """
+  num_workers = min(len(items), max_workers or len(items))
+  if num_workers <= 1:
+    return [fn(item) for item in items]
+  with futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+    return list(executor.map(fn, items))
@@ -0,0 +1,196 @@
+# Copyright 2021 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Confidence metrics computed on the device.
+
+JAX counterpart of alphafold.common.confidence as used by
+model.get_confidence_metrics. The [num_res, num_res, num_bins] predicted
+aligned error logits are processed in chunks of rows: the softmax of each
+chunk is computed once and reduced to the PAE, pTM and ipTM terms of its rows,
+so that only the reduced arrays are materialized and copied to the host.
+"""
+
+import functools
+from typing import Any, Dict, Mapping, Optional
+
+import jax
+import jax.numpy as jnp
+
+
+def _bin_centers(breaks: jax.Array) -> jax.Array:
+  """Returns the [num_bins] error bin centers, see confidence.py."""
+  step = breaks[1] - breaks[0]
+  bin_centers = breaks + step / 2
+  return jnp.concatenate([bin_centers, bin_centers[-1:] + step], axis=0)
+
+
+@jax.jit
+def compute_plddt(logits: jax.Array) -> jax.Array:
+  """Computes per-residue pLDDT from [num_res, num_bins] logits."""
+  num_bins = logits.shape[-1]
+  bin_width = 1.0 / num_bins
+  bin_centers = jnp.arange(0.5 * bin_width, 1.0, bin_width)[:num_bins]
+  probs = jax.nn.softmax(logits.astype(jnp.float32), axis=-1)
+  return jnp.sum(probs * bin_centers, axis=-1) * 100
+
+
+def _tm_d0(residue_weights: jax.Array) -> jax.Array:
+  """Returns d_0(num_res) of the TM-score, see confidence.predicted_tm_score."""
+  num_res = jnp.floor(jnp.sum(residue_weights))
+  # Clip num_res to avoid negative/undefined d0.
+  clipped_num_res = jnp.maximum(num_res, 19)
+  return 1.24 * (clipped_num_res - 15) ** (1. / 3) - 1.8
+
+
+def _per_alignment_tm(predicted_tm_term: jax.Array,
+                      pair_residue_weights: jax.Array) -> jax.Array:
+  """Returns the TM-score of aligning on each row residue, for a row chunk."""
+  normed_residue_mask = pair_residue_weights / (1e-8 + jnp.sum(
+      pair_residue_weights, axis=-1, keepdims=True))
+  return jnp.sum(predicted_tm_term * normed_residue_mask, axis=-1)
+
+
+@functools.partial(
+    jax.jit, static_argnames=('interface', 'chunk_size', 'return_probs'))
+def compute_aligned_confidence(
+    logits: jax.Array,
+    breaks: jax.Array,
+    residue_weights: jax.Array,
+    asym_id: Optional[jax.Array] = None,
+    interface: bool = False,
+    chunk_size: int = 128,
+    return_probs: bool = False) -> Dict[str, jax.Array]:
+  """Computes the PAE, pTM and optionally ipTM in chunks of rows.
+
+  Args:
+    logits: [num_res, num_res, num_bins] the logits output from
+      PredictedAlignedErrorHead.
+    breaks: [num_bins - 1] the error bin edges.
+    residue_weights: [num_res] the per residue weights to use for the
+      expectation, 0 for padding residues.
+    asym_id: [num_res] the asymmetric unit ID - the chain ID. Only needed
+      when interface=True.
+    interface: If True, the interface pTM (ipTM) is also computed.
+    chunk_size: Number of rows of logits processed at once.
+    return_probs: Whether to also return the [num_res, num_res, num_bins]
+      aligned_confidence_probs.
+
+  Returns:
+    A dict with predicted_aligned_error, max_predicted_aligned_error, ptm,
+    iptm if interface is set and aligned_confidence_probs if return_probs is
+    set.
+  """
+  num_res, _, num_bins = logits.shape
+  chunk_size = min(chunk_size, num_res)
+  num_chunks = -(-num_res // chunk_size)
+  residue_weights = residue_weights.astype(jnp.float32)
+
+  bin_centers = _bin_centers(breaks.astype(jnp.float32))
+  d0 = _tm_d0(residue_weights)
+  # TM-Score term for every bin.
+  tm_per_bin = 1. / (1 + jnp.square(bin_centers) / jnp.square(d0))
+
+  def body(chunk, outputs):
+    # The last chunk is shifted back to end at num_res, recomputing a few rows.
+    start = jnp.minimum(chunk * chunk_size, num_res - chunk_size)
+    rows = jax.lax.dynamic_slice_in_dim(logits, start, chunk_size, axis=0)
+    probs = jax.nn.softmax(rows.astype(jnp.float32), axis=-1)
+    row_weights = jax.lax.dynamic_slice_in_dim(
+        residue_weights, start, chunk_size)
+    pair_residue_weights = row_weights[:, None] * residue_weights[None, :]
+    predicted_tm_term = jnp.einsum('ijb,b->ij', probs, tm_per_bin)
+    updates = {
+        'predicted_aligned_error': jnp.einsum('ijb,b->ij', probs, bin_centers),
+        'ptm': _per_alignment_tm(predicted_tm_term, pair_residue_weights),
+    }
+    if interface:
+      row_asym_id = jax.lax.dynamic_slice_in_dim(asym_id, start, chunk_size)
+      pair_mask = row_asym_id[:, None] != asym_id[None, :]
+      updates['iptm'] = _per_alignment_tm(
+          predicted_tm_term * pair_mask, pair_residue_weights * pair_mask)
+    if return_probs:
+      updates['aligned_confidence_probs'] = probs
+    return {k: jax.lax.dynamic_update_slice_in_dim(v, updates[k], start, 0)
+            for k, v in outputs.items()}
+
+  outputs = {
+      'predicted_aligned_error': jnp.zeros((num_res, num_res), jnp.float32),
+      'ptm': jnp.zeros((num_res,), jnp.float32),
+  }
+  if interface:
+    outputs['iptm'] = jnp.zeros((num_res,), jnp.float32)
+  if return_probs:
+    outputs['aligned_confidence_probs'] = jnp.zeros(
+        (num_res, num_res, num_bins), jnp.float32)
+  outputs = jax.lax.fori_loop(0, num_chunks, body, outputs)
+
+  for name in ('ptm', 'iptm'):
+    if name in outputs:
+      per_alignment = outputs[name]
+      outputs[name] = per_alignment[
+          jnp.argmax(per_alignment * residue_weights)]
+  outputs['max_predicted_aligned_error'] = bin_centers[-1]
+  return outputs
+
+
+def get_confidence_metrics(
+    prediction_result: Mapping[str, Any],
+    multimer_mode: bool,
+    residue_weights: Optional[jax.Array] = None,
+    chunk_size: int = 128,
+    return_probs: bool = True) -> Dict[str, jax.Array]:
+  """Computes the confidence metrics of model.get_confidence_metrics.
+
+  The metrics are computed on the device holding prediction_result and are
+  returned as device arrays.
+
+  Args:
+    prediction_result: The output of the model.
+    multimer_mode: Whether the ipTM is computed and used for ranking.
+    residue_weights: Optional [num_res] weights of the residues, 0 for the
+      padding residues of the model input. The metrics of padded outputs are
+      those of the unpadded outputs, padded.
+    chunk_size: Number of rows of the PAE logits processed at once.
+    return_probs: Whether to return the aligned_confidence_probs. They are the
+      size of the PAE logits and unused by the confidence metrics.
+
+  Returns:
+    A dict with plddt and ranking_confidence, and with the PAE and pTM
+    metrics if the model has a PredictedAlignedErrorHead.
+  """
+  plddt_logits = prediction_result['predicted_lddt']['logits']
+  if residue_weights is None:
+    residue_weights = jnp.ones(plddt_logits.shape[0], jnp.float32)
+  confidence_metrics = {'plddt': compute_plddt(plddt_logits)}
+  if 'predicted_aligned_error' in prediction_result:
+    pae_outputs = prediction_result['predicted_aligned_error']
+    confidence_metrics.update(compute_aligned_confidence(
+        logits=pae_outputs['logits'],
+        breaks=pae_outputs['breaks'],
+        residue_weights=residue_weights,
+        asym_id=pae_outputs.get('asym_id') if multimer_mode else None,
+        interface=multimer_mode,
+        chunk_size=chunk_size,
+        return_probs=return_probs))
+    if multimer_mode:
+      confidence_metrics['ranking_confidence'] = (
+          0.8 * confidence_metrics['iptm'] + 0.2 * confidence_metrics['ptm'])
+
+  if not multimer_mode:
+    # Monomer models use mean pLDDT for model ranking.
+    confidence_metrics['ranking_confidence'] = (
+        jnp.sum(confidence_metrics['plddt'] * residue_weights) /
+        jnp.sum(residue_weights))
+
+  return confidence_metrics
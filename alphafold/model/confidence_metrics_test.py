@@ -0,0 +1,82 @@
+# Copyright 2021 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for confidence_metrics."""
+
+from absl.testing import absltest
+from absl.testing import parameterized
+from alphafold.model import confidence_metrics
+from alphafold.model import model
+import numpy as np
+
+
+def _prediction_result(num_res, rng):
+  return {
+      'predicted_lddt': {
+          'logits': rng.normal(size=(num_res, 50)).astype(np.float32)},
+      'predicted_aligned_error': {
+          'logits': rng.normal(size=(num_res, num_res, 64)).astype(np.float32),
+          'breaks': np.linspace(0., 31., 63, dtype=np.float32),
+          # Three chains.
+          'asym_id': np.arange(num_res) * 3 // num_res + 1,
+      },
+  }
+
+
+class ConfidenceMetricsTest(parameterized.TestCase):
+
+  @parameterized.parameters(
+      dict(multimer_mode=True, chunk_size=7),
+      dict(multimer_mode=True, chunk_size=128),
+      dict(multimer_mode=False, chunk_size=16),
+  )
+  def test_matches_numpy_metrics(self, multimer_mode, chunk_size):
+    result = _prediction_result(45, np.random.default_rng(0))
+    expected = model.get_confidence_metrics(result, multimer_mode)
+    metrics = confidence_metrics.get_confidence_metrics(
+        result, multimer_mode, chunk_size=chunk_size)
+
+    self.assertCountEqual(expected, metrics)
+    for name, value in expected.items():
+      np.testing.assert_allclose(metrics[name], value, rtol=1e-5, atol=1e-5,
+                                 err_msg=name)
+
+  def test_padding_and_dropped_probs(self):
+    rng = np.random.default_rng(1)
+    result = _prediction_result(30, rng)
+    padded = _prediction_result(40, rng)
+    padded['predicted_lddt']['logits'][:30] = (
+        result['predicted_lddt']['logits'])
+    pae = padded['predicted_aligned_error']
+    pae['logits'][:30, :30] = result['predicted_aligned_error']['logits']
+    pae['asym_id'][:30] = result['predicted_aligned_error']['asym_id']
+    pae['asym_id'][30:] = 0
+
+    expected = model.get_confidence_metrics(result, multimer_mode=True)
+    metrics = confidence_metrics.get_confidence_metrics(
+        padded, multimer_mode=True, residue_weights=np.arange(40) < 30,
+        chunk_size=8, return_probs=False)
+
+    self.assertNotIn('aligned_confidence_probs', metrics)
+    np.testing.assert_allclose(metrics['plddt'][:30], expected['plddt'],
+                               rtol=1e-5)
+    np.testing.assert_allclose(metrics['predicted_aligned_error'][:30, :30],
+                               expected['predicted_aligned_error'], rtol=1e-5)
+    for name in ('ptm', 'iptm', 'ranking_confidence'):
+      np.testing.assert_allclose(metrics[name], expected[name], rtol=1e-5,
+                                 err_msg=name)
+
+
+if __name__ == '__main__':
+  absltest.main()
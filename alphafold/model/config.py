@@ -458,7 +458,13 @@ CONFIG = ml_collections.ConfigDict({
             },
         },
         'num_recycle': 3,
-        'resample_msa_in_recycling': True
+        'resample_msa_in_recycling': True,
+        # Rows of the predicted aligned error logits processed at once when
+        # computing the confidence metrics, see confidence_metrics.py.
+        'confidence_chunk_size': 128,
+        # Whether the prediction result holds the [num_res, num_res, num_bins]
+        # aligned_confidence_probs.
+        'return_aligned_confidence_probs': True,
     },
 })
 
@@ -696,6 +702,22 @@ CONFIG_MULTIMER = ml_collections.ConfigDict({
         # difference in pairwise distances is less than the tolerance between
         # recycling steps.
         'recycle_early_stop_tolerance': 0.5,
-        'resample_msa_in_recycling': True
+        # Number of recycles between two checkpoints of the recycling carry
+        # (see RunModel.predict checkpoint_file). 0 disables recycle
+        # checkpointing.
+        'recycle_checkpoint_interval': 0,
+        'resample_msa_in_recycling': True,
+        # Rows of the predicted aligned error logits processed at once when
+        # computing the confidence metrics, see confidence_metrics.py.
+        'confidence_chunk_size': 128,
+        # Whether the prediction result holds the [num_res, num_res, num_bins]
+        # aligned_confidence_probs.
+        'return_aligned_confidence_probs': True,
+        # Inputs are padded (and masked) to the smallest bucket that fits them
+        # so that inputs of similar size share a compiled model, see
+        # RunModel.bucket_shape. Inputs larger than all buckets are not padded.
+        'num_res_buckets': (),
+        'msa_depth_buckets': (),
+        'num_template_buckets': (4,),
     }
 })
@@ -0,0 +1,240 @@
+# Copyright 2021 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Estimates of the device memory used by AlphaFold inference.
+
+The estimates are an analytical model of the largest live activations of the
+Evoformer for a given number of residues, used to decide how many models can
+run at the same time on one device. They err on the large side.
+"""
+
+from typing import Any, Callable, Mapping, Optional
+
+from absl import logging
+import jax
+import ml_collections
+import numpy as np
+
+# Parameters of a multimer model in float32, used when params are not given.
+_DEFAULT_PARAMS_BYTES = 375 * 1024**2
+# XLA workspace, cuBLAS/cuDNN handles and fragmentation.
+_FIXED_OVERHEAD_BYTES = 512 * 1024**2
+_SAFETY_FACTOR = 1.25
+# Live copies of the pair and MSA activations in an Evoformer block (residual,
+# layer norm, projections and gates of the triangle multiplication).
+_PAIR_COPIES = 8
+_MSA_COPIES = 6
+# Subbatch sizes tried by select_subbatch_size, besides num_res.
+_SUBBATCH_SIZES = (1024, 512, 256, 128, 64, 32, 16, 8, 4, 2, 1)
+
+
+def params_bytes(params: Optional[Mapping[str, Mapping[str, Any]]]) -> int:
+  """Returns the size of the model parameters in bytes."""
+  if params is None:
+    return _DEFAULT_PARAMS_BYTES
+  return sum(
+      np.asarray(leaf).nbytes for leaf in jax.tree_util.tree_leaves(params))
+
+
+def _activation_bytes(config: ml_collections.ConfigDict, num_res: int,
+                      subbatch_size: Optional[int]) -> int:
+  """Returns the estimated size of the largest live activations."""
+  gc = config.model.global_config
+  evo = config.model.embeddings_and_evoformer
+  act_bytes = 2 if gc.bfloat16 else 4
+  subbatch = min(subbatch_size or gc.subbatch_size or num_res, num_res)
+  n2 = num_res * num_res
+
+  pair = _PAIR_COPIES * n2 * evo.pair_channel * act_bytes
+  msa = _MSA_COPIES * evo.num_msa * num_res * evo.msa_channel * act_bytes
+  extra_msa = (_MSA_COPIES * evo.num_extra_msa * num_res *
+               evo.extra_msa_channel * act_bytes)
+  # Attention logits and weights are float32 and chunked over subbatch rows.
+  triangle_attention = (
+      2 * subbatch * evo.evoformer.triangle_attention_starting_node.num_head *
+      n2 * 4)
+  msa_row_attention = (
+      2 * subbatch * evo.evoformer.msa_row_attention_with_pair_bias.num_head *
+      n2 * 4)
+  outer_product = (evo.evoformer.outer_product_mean.chunk_size * num_res *
+                   evo.evoformer.outer_product_mean.num_outer_channel**2 * 4)
+  templates = 0
+  if evo.template.enabled:
+    templates = _PAIR_COPIES * n2 * evo.template.num_channels * act_bytes
+  # Distogram, PAE logits and aligned confidence probs are float32 outputs.
+  heads = 3 * n2 * 64 * 4
+  return (pair + msa + extra_msa + outer_product + templates + heads +
+          max(triangle_attention, msa_row_attention))
+
+
+def estimate_peak_memory_bytes(
+    config: ml_collections.ConfigDict,
+    num_res: int,
+    params: Optional[Mapping[str, Mapping[str, Any]]] = None,
+    subbatch_size: Optional[int] = None,
+    calibration: float = 1.0) -> int:
+  """Estimates the peak device memory of one prediction.
+
+  Args:
+    config: The model config, as returned by config.model_config.
+    num_res: The number of residues of the input.
+    params: The model parameters, if loaded.
+    subbatch_size: Overrides global_config.subbatch_size.
+    calibration: Scale of the activation estimate, see calibration_from_probe.
+
+  Returns:
+    The estimated peak memory in bytes.
+  """
+  activations = calibration * _activation_bytes(config, num_res, subbatch_size)
+  return int(_SAFETY_FACTOR * activations + params_bytes(params) +
+             _FIXED_OVERHEAD_BYTES)
+
+
+def device_memory_bytes(device: Optional[Any] = None) -> Optional[int]:
+  """Returns the memory available to JAX on device, None if unknown.
+
+  The limit already accounts for XLA_PYTHON_CLIENT_MEM_FRACTION.
+
+  Args:
+    device: A JAX device, the first local device if not given.
+  """
+  device = device or jax.local_devices()[0]
+  try:
+    stats = device.memory_stats()
+  except Exception:  # pylint: disable=broad-except
+    stats = None
+  if not stats or 'bytes_limit' not in stats:
+    return None
+  return int(stats['bytes_limit'])
+
+
+def max_concurrent_predictions(
+    config: ml_collections.ConfigDict,
+    num_res: int,
+    params: Optional[Mapping[str, Mapping[str, Any]]] = None,
+    device: Optional[Any] = None) -> int:
+  """Returns how many predictions fit on device at the same time.
+
+  Args:
+    config: The model config.
+    num_res: The number of residues of the input.
+    params: The model parameters, if loaded.
+    device: A JAX device, the first local device if not given.
+  """
+  available = device_memory_bytes(device)
+  if available is None:
+    return 1
+  peak = estimate_peak_memory_bytes(config, num_res, params)
+  logging.info('Estimated peak memory of a %d residue prediction: %.1f GiB of '
+               '%.1f GiB', num_res, peak / 1024**3, available / 1024**3)
+  if peak > available:
+    logging.warning('A %d residue prediction may not fit in device memory, '
+                    'consider a smaller subbatch_size.', num_res)
+  return max(1, available // peak)
+
+
+def select_subbatch_size(
+    config: ml_collections.ConfigDict,
+    num_res: int,
+    params: Optional[Mapping[str, Mapping[str, Any]]] = None,
+    memory_bytes: Optional[int] = None,
+    calibration: float = 1.0,
+    num_concurrent: int = 1) -> int:
+  """Returns the largest subbatch_size for which predictions fit in memory.
+
+  Larger subbatches run the chunked attention and transition layers
+  (mapping.inference_subbatch) in fewer, larger steps and are faster. The
+  number of concurrent predictions is meant to be decided first, with
+  max_concurrent_predictions, as the larger subbatch then only uses the memory
+  left to each prediction.
+
+  Args:
+    config: The model config.
+    num_res: The number of residues of the input.
+    params: The model parameters, if loaded.
+    memory_bytes: The memory available, the device memory if not given.
+    calibration: Scale of the activation estimate, see
+      calibration_from_probe.
+    num_concurrent: The number of predictions sharing memory_bytes.
+
+  Returns:
+    The subbatch size, global_config.subbatch_size if the device memory is
+    unknown.
+  """
+  if memory_bytes is None:
+    memory_bytes = device_memory_bytes()
+  if memory_bytes is None:
+    return config.model.global_config.subbatch_size
+  memory_bytes //= max(1, num_concurrent)
+  candidates = [num_res] + [s for s in _SUBBATCH_SIZES if s < num_res]
+  for subbatch_size in candidates:
+    peak = estimate_peak_memory_bytes(
+        config, num_res, params, subbatch_size=subbatch_size,
+        calibration=calibration)
+    if peak <= memory_bytes:
+      return subbatch_size
+  logging.warning('A %d residue prediction may not fit in device memory even '
+                  'with subbatch_size 1.', num_res)
+  return 1
+
+
+def probe_peak_memory_bytes(fn: Callable[..., Any], *args,
+                            **kwargs) -> Optional[int]:
+  """Compiles the jitted fn for args and returns its peak memory, if known.
+
+  The compilation is not reused by later calls of fn, this is meant as a
+  one-off calibration of estimate_peak_memory_bytes.
+
+  Args:
+    fn: A jax.jit-ed function.
+    *args: Arguments of fn.
+    **kwargs: Keyword arguments of fn.
+
+  Returns:
+    The memory of the arguments, outputs and temporaries of the compiled
+    program in bytes, or None if the backend does not report it.
+  """
+  try:
+    analysis = fn.lower(*args, **kwargs).compile().memory_analysis()
+  except (AttributeError, NotImplementedError) as e:
+    logging.warning('Memory analysis is not available: %s', e)
+    return None
+  if analysis is None:
+    return None
+  return int(analysis.argument_size_in_bytes + analysis.output_size_in_bytes +
+             analysis.temp_size_in_bytes - analysis.alias_size_in_bytes)
+
+
+def calibration_from_probe(
+    config: ml_collections.ConfigDict,
+    num_res: int,
+    measured_bytes: int,
+    params: Optional[Mapping[str, Mapping[str, Any]]] = None,
+    subbatch_size: Optional[int] = None) -> float:
+  """Returns the calibration of the estimates from a probed peak memory.
+
+  Args:
+    config: The model config the probe was compiled with.
+    num_res: The number of residues of the probed input.
+    measured_bytes: The output of probe_peak_memory_bytes.
+    params: The model parameters, if loaded.
+    subbatch_size: The subbatch size of the probe, if it overrides config.
+
+  Returns:
+    The factor to pass as calibration to select_subbatch_size.
+  """
+  # The probe includes the parameters but not the fixed overhead.
+  measured_activations = max(measured_bytes - params_bytes(params), 1)
+  return measured_activations / _activation_bytes(config, num_res,
+                                                  subbatch_size)
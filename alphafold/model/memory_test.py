@@ -0,0 +1,100 @@
+# Copyright 2021 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for memory."""
+
+from unittest import mock
+
+from absl.testing import absltest
+from alphafold.model import config
+from alphafold.model import memory
+
+
+class MemoryTest(absltest.TestCase):
+
+  def test_estimate_grows_with_num_res_and_subbatch(self):
+    model_config = config.model_config('model_1_multimer_v3')
+    small = memory.estimate_peak_memory_bytes(model_config, 200)
+    large = memory.estimate_peak_memory_bytes(model_config, 1000)
+    self.assertLess(small, large)
+
+    model_config.model.global_config.subbatch_size = 512
+    self.assertLess(
+        large, memory.estimate_peak_memory_bytes(model_config, 1000))
+
+  def test_max_concurrent_predictions(self):
+    model_config = config.model_config('model_1_multimer_v3')
+    peak = memory.estimate_peak_memory_bytes(model_config, 300)
+    with mock.patch.object(memory, 'device_memory_bytes',
+                           return_value=3 * peak + 1):
+      self.assertEqual(
+          memory.max_concurrent_predictions(model_config, 300), 3)
+    with mock.patch.object(memory, 'device_memory_bytes', return_value=1):
+      self.assertEqual(
+          memory.max_concurrent_predictions(model_config, 300), 1)
+    with mock.patch.object(memory, 'device_memory_bytes', return_value=None):
+      self.assertEqual(
+          memory.max_concurrent_predictions(model_config, 300), 1)
+
+  def test_select_subbatch_size(self):
+    model_config = config.model_config('model_1_multimer_v3')
+    num_res = 2000
+    large_memory = memory.estimate_peak_memory_bytes(
+        model_config, num_res, subbatch_size=num_res)
+    self.assertEqual(
+        memory.select_subbatch_size(model_config, num_res,
+                                    memory_bytes=large_memory), num_res)
+
+    small_memory = memory.estimate_peak_memory_bytes(
+        model_config, num_res, subbatch_size=64)
+    self.assertEqual(
+        memory.select_subbatch_size(model_config, num_res,
+                                    memory_bytes=small_memory), 64)
+    self.assertEqual(
+        memory.select_subbatch_size(model_config, num_res,
+                                    memory_bytes=small_memory,
+                                    calibration=2.), 1)
+
+    with mock.patch.object(memory, 'device_memory_bytes', return_value=None):
+      self.assertEqual(
+          memory.select_subbatch_size(model_config, num_res),
+          model_config.model.global_config.subbatch_size)
+
+  def test_subbatch_size_keeps_concurrent_predictions(self):
+    model_config = config.model_config('model_1_multimer_v3')
+    num_res = 400
+    peak = memory.estimate_peak_memory_bytes(model_config, num_res)
+    with mock.patch.object(memory, 'device_memory_bytes',
+                           return_value=3 * peak + 1):
+      num_concurrent = memory.max_concurrent_predictions(model_config, num_res)
+      self.assertEqual(num_concurrent, 3)
+      # A subbatch_size filling the whole device leaves room for one model.
+      alone = memory.select_subbatch_size(model_config, num_res)
+      self.assertEqual(
+          (3 * peak + 1) // memory.estimate_peak_memory_bytes(
+              model_config, num_res, subbatch_size=alone), 1)
+
+      subbatch_size = memory.select_subbatch_size(
+          model_config, num_res, num_concurrent=num_concurrent)
+      self.assertGreaterEqual(
+          subbatch_size, model_config.model.global_config.subbatch_size)
+      self.assertLess(subbatch_size, alone)
+      model_config.model.global_config.subbatch_size = subbatch_size
+      self.assertEqual(
+          memory.max_concurrent_predictions(model_config, num_res),
+          num_concurrent)
+
+
+if __name__ == '__main__':
+  absltest.main()
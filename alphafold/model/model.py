@@ -13,11 +13,22 @@
 # limitations under the License.
 
 """Code for constructing the model."""
-from typing import Any, Mapping, Optional, Union
+import concurrent.futures
+import contextlib
+import copy
+import functools
+import hashlib
+import itertools
+import os
+import pickle
+import threading
+from typing import Any, Callable, List, Mapping, Optional, Sequence, Tuple, Union
 
 from absl import logging
 from alphafold.common import confidence
+from alphafold.model import confidence_metrics
 from alphafold.model import features
+from alphafold.model import memory
 from alphafold.model import modules
 from alphafold.model import modules_multimer
 import haiku as hk
@@ -61,26 +72,194 @@ def get_confidence_metrics(
   return confidence_metrics
 
 
-class RunModel:
-  """Container for JAX model."""
+def _checkpoint_fingerprint(feat: features.FeatureDict, model_name: str,
+                            random_seed: int) -> Mapping[str, Any]:
+  """Identifies the prediction a recycle checkpoint belongs to.
 
-  def __init__(self,
-               config: ml_collections.ConfigDict,
-               params: Optional[Mapping[str, Mapping[str, jax.Array]]] = None):
-    self.config = config
-    self.params = params
-    self.multimer_mode = config.model.global_config.multimer_mode
+  Args:
+    feat: The processed features of the prediction, before padding.
+    model_name: The name of the prediction, e.g. model_1_multimer_v3_pred_0.
+    random_seed: The random seed of the prediction.
 
-    if self.multimer_mode:
-      def _forward_fn(batch, prev):
-        model = modules_multimer.AlphaFold(self.config.model)
+  Returns:
+    A dict that is equal for two predictions iff they can share a checkpoint.
+  """
+  fingerprint = {'model_name': model_name, 'random_seed': int(random_seed)}
+  for name in ('aatype', 'asym_id', 'msa'):
+    if name in feat:
+      value = np.ascontiguousarray(feat[name])
+      fingerprint[name] = (value.shape, str(value.dtype),
+                           hashlib.sha256(value.tobytes()).hexdigest())
+  return fingerprint
+
+
+def _write_checkpoint(checkpoint_file: str, state: Mapping[str, Any]) -> None:
+  """Atomically pickles a recycle checkpoint to checkpoint_file."""
+  os.makedirs(os.path.dirname(checkpoint_file) or '.', exist_ok=True)
+  tmp_path = checkpoint_file + '.tmp'
+  with open(tmp_path, 'wb') as f:
+    pickle.dump(state, f, protocol=4)
+  os.replace(tmp_path, checkpoint_file)
+  logging.info('Saved recycle %d checkpoint to %s',
+               state['num_recycles'], checkpoint_file)
+
+
+class _CheckpointWriter:
+  """Writes the newest recycle checkpoint of a prediction in the background.
+
+  At most one state per checkpoint file waits for the host writer: a state
+  queued before the previous one was written replaces it, so that a slow disk
+  does not pile up copies of the recycling carry in host memory.
+  """
+
+  def __init__(self, checkpoint_file: str):
+    self._checkpoint_file = checkpoint_file
+    self._lock = threading.Lock()
+    self._state = None
+
+  def put(self, state: Mapping[str, Any]
+          ) -> Optional[concurrent.futures.Future]:
+    """Queues state, returns the future of the write if one was submitted."""
+    with self._lock:
+      queued = self._state is not None
+      self._state = state
+    if queued:
+      return None
+    return _get_host_writer().submit(self._write)
+
+  def _write(self) -> None:
+    with self._lock:
+      state, self._state = self._state, None
+    _write_checkpoint(self._checkpoint_file, state)
+
+
+# Features padded along their residue axes to a shape bucket, by number of
+# leading axes before the residue axis. MSA and template features are also
+# padded along their first axis.
+_RESIDUE_FEATURES = {
+    'aatype': 0, 'residue_index': 0, 'asym_id': 0, 'entity_id': 0,
+    'sym_id': 0, 'seq_mask': 0, 'entity_mask': 0, 'deletion_mean': 0,
+    'all_atom_positions': 0, 'all_atom_mask': 0,
+    'msa': 1, 'deletion_matrix': 1, 'msa_mask': 1, 'bert_mask': 1,
+    'template_aatype': 1, 'template_all_atom_positions': 1,
+    'template_all_atom_mask': 1,
+}
+_MSA_FEATURES = ('msa', 'deletion_matrix', 'msa_mask', 'bert_mask',
+                 'cluster_bias_mask')
+_TEMPLATE_FEATURES = ('template_aatype', 'template_all_atom_positions',
+                      'template_all_atom_mask')
+# Residue axes of the multimer outputs, cropped back after padding.
+_RESIDUE_OUTPUT_AXES = {
+    ('distogram', 'logits'): (0, 1),
+    ('experimentally_resolved', 'logits'): (0,),
+    ('masked_msa', 'logits'): (1,),
+    ('predicted_aligned_error', 'logits'): (0, 1),
+    ('predicted_aligned_error', 'asym_id'): (0,),
+    ('predicted_lddt', 'logits'): (0,),
+    ('structure_module', 'final_atom_mask'): (0,),
+    ('structure_module', 'final_atom_positions'): (0,),
+    ('representations', 'msa'): (1,),
+    ('representations', 'msa_first_row'): (0,),
+    ('representations', 'pair'): (0, 1),
+    ('representations', 'single'): (0,),
+    ('representations', 'structure_module'): (0,),
+    ('plddt',): (0,),
+    ('predicted_aligned_error',): (0, 1),
+    ('aligned_confidence_probs',): (0, 1),
+}
+
+
+def _bucket_size(size: int, buckets: Sequence[int]) -> int:
+  """Returns the smallest bucket fitting size, size if there is none."""
+  fitting = [bucket for bucket in buckets if bucket >= size]
+  return min(fitting) if fitting else size
+
+
+def _pad_axis(x: np.ndarray, axis: int, size: int) -> np.ndarray:
+  if x.shape[axis] >= size:
+    return x
+  pad_width = [(0, 0)] * x.ndim
+  pad_width[axis] = (0, size - x.shape[axis])
+  return np.pad(x, pad_width)
+
+
+def _crop_axes(x: jax.Array, axes: Sequence[int], size: int) -> jax.Array:
+  index = [slice(None)] * x.ndim
+  for axis in axes:
+    index[axis] = slice(0, size)
+  return x[tuple(index)]
+
+
+def enable_compilation_cache(cache_dir: str) -> None:
+  """Persists compiled XLA programs in cache_dir, shared across processes."""
+  os.makedirs(cache_dir, exist_ok=True)
+  try:
+    jax.config.update('jax_compilation_cache_dir', cache_dir)
+  except AttributeError:
+    # Older JAX releases only have the experimental API.
+    from jax.experimental.compilation_cache import compilation_cache  # pylint: disable=g-import-not-at-top
+    compilation_cache.initialize_cache(cache_dir)
+  logging.info('Using XLA compilation cache in %s', cache_dir)
+
+
+def _process_recycle_output(
+    recycled: Mapping[int, Mapping[str, Any]],
+    recycle_output_fn: Optional[Callable[[int, Mapping[str, Any]], None]],
+    recycle_idx: int, atom_positions: np.ndarray, atom_mask: np.ndarray,
+    plddt_logits: np.ndarray, tol: float) -> None:
+  """Builds the output dict of one recycle and hands it to recycle_output_fn."""
+  plddt = confidence.compute_plddt(plddt_logits)
+  logging.info('recycle# %d, diff plddt values: %f %f', recycle_idx, tol,
+               plddt.mean())
+  output = {
+      'structure_module': {
+          'final_atom_positions': atom_positions,
+          'final_atom_mask': atom_mask,
+      },
+      'plddt': plddt,
+      'tol_val': tol,
+  }
+  recycled[recycle_idx] = output
+  if recycle_output_fn is not None:
+    recycle_output_fn(recycle_idx, output)
+
+
+class _SharedForwardFn:
+  """jit-compiled forward function shared by RunModels with equal configs.
+
+  The multimer models model_X_multimer_v3 share their architecture and only
+  differ in their parameters, which are an argument of `apply`. Sharing the
+  jitted function means the model is traced and compiled once per input shape
+  instead of once per RunModel.
+  """
+
+  def __init__(self, config: ml_collections.ConfigDict):
+    self._lock = threading.Lock()
+    self._compiled_signatures = {}
+    self._checkpoint_callbacks = {}
+    self._recycle_output_callbacks = {}
+    self._run_ids = itertools.count(1)
+
+    if config.model.global_config.multimer_mode:
+      def _forward_fn(batch, prev=None, prev_iter=0, prev_tol=np.inf,
+                      safe_key=None, run_id=0):
+        def recycle_callback(*carry):
+          jax.debug.callback(self._on_checkpoint, run_id, *carry)
+        def recycle_output_callback(*outputs):
+          jax.debug.callback(self._on_recycle_output, run_id, *outputs)
+        model = modules_multimer.AlphaFold(config.model)
         return model(
             batch,
             is_training=False,
-            prev=prev)
+            safe_key=safe_key,
+            prev=prev,
+            prev_iter=prev_iter,
+            prev_tol=prev_tol,
+            recycle_callback=recycle_callback,
+            recycle_output_callback=recycle_output_callback)
     else:
-      def _forward_fn(batch, prev):
-        model = modules.AlphaFold(self.config.model)
+      def _forward_fn(batch, prev=None):
+        model = modules.AlphaFold(config.model)
         return model(
             batch,
             is_training=False,
@@ -92,6 +271,114 @@ class RunModel:
     self.apply = jax.jit(hk.transform(_forward_fn).apply)
     self.init = jax.jit(hk.transform(_forward_fn).init)
 
+  def _on_checkpoint(self, run_id, *carry) -> None:
+    callback = self._checkpoint_callbacks.get(int(run_id))
+    if callback is not None:
+      callback(*carry)
+
+  def _on_recycle_output(self, run_id, *outputs) -> None:
+    callback = self._recycle_output_callbacks.get(int(run_id))
+    if callback is not None:
+      callback(*outputs)
+
+  def register_callbacks(
+      self,
+      checkpoint: Optional[Callable[..., None]] = None,
+      recycle_output: Optional[Callable[..., None]] = None) -> int:
+    """Registers the host callbacks of one run.
+
+    Args:
+      checkpoint: Called with the recycling carry, see
+        modules_multimer.AlphaFold recycle_callback.
+      recycle_output: Called with the outputs of each intermediate recycle, see
+        modules_multimer.AlphaFold recycle_output_callback.
+
+    Returns:
+      The run_id to call apply with.
+    """
+    with self._lock:
+      run_id = next(self._run_ids)
+      if checkpoint is not None:
+        self._checkpoint_callbacks[run_id] = checkpoint
+      if recycle_output is not None:
+        self._recycle_output_callbacks[run_id] = recycle_output
+    return run_id
+
+  def unregister_callbacks(self, run_id: int) -> None:
+    with self._lock:
+      self._checkpoint_callbacks.pop(run_id, None)
+      self._recycle_output_callbacks.pop(run_id, None)
+
+  @contextlib.contextmanager
+  def compilation_guard(self, signature: Any):
+    """Serializes the first call for each input signature.
+
+    Concurrent predictions with a new input shape would otherwise each compile
+    the same program. Later calls with the same signature wait for the first
+    one to be dispatched, by which time the executable is in the jit cache.
+
+    Args:
+      signature: A hashable description of the input shapes.
+
+    Yields:
+      Nothing.
+    """
+    with self._lock:
+      compiled = self._compiled_signatures.get(signature)
+      is_first = compiled is None
+      if is_first:
+        compiled = self._compiled_signatures[signature] = threading.Event()
+    if not is_first:
+      compiled.wait()
+    try:
+      yield
+    finally:
+      if is_first:
+        compiled.set()
+
+
+_SHARED_FORWARD_FNS = {}
+_SHARED_FORWARD_FNS_LOCK = threading.Lock()
+
+
+def _get_shared_forward_fn(config: ml_collections.ConfigDict) -> _SharedForwardFn:
+  config_key = config.to_json_best_effort(sort_keys=True)
+  with _SHARED_FORWARD_FNS_LOCK:
+    if config_key not in _SHARED_FORWARD_FNS:
+      _SHARED_FORWARD_FNS[config_key] = _SharedForwardFn(config)
+    return _SHARED_FORWARD_FNS[config_key]
+
+
+# Writes recycle checkpoints and outputs off the device callbacks, shared by
+# all RunModels (e.g. those made by RunModel.with_subbatch_size).
+_HOST_WRITER = None
+_HOST_WRITER_LOCK = threading.Lock()
+
+
+def _get_host_writer() -> concurrent.futures.ThreadPoolExecutor:
+  global _HOST_WRITER
+  with _HOST_WRITER_LOCK:
+    if _HOST_WRITER is None:
+      # A single thread keeps the writes of each prediction in order.
+      _HOST_WRITER = concurrent.futures.ThreadPoolExecutor(
+          max_workers=1, thread_name_prefix='host_writer')
+    return _HOST_WRITER
+
+
+class RunModel:
+  """Container for JAX model."""
+
+  def __init__(self,
+               config: ml_collections.ConfigDict,
+               params: Optional[Mapping[str, Mapping[str, jax.Array]]] = None):
+    self.config = config
+    self.params = params
+    self.multimer_mode = config.model.global_config.multimer_mode
+
+    self._forward_fn = _get_shared_forward_fn(config)
+    self.apply = self._forward_fn.apply
+    self.init = self._forward_fn.init
+
   def init_params(self, feat: features.FeatureDict, random_seed: int = 0):
     """Initializes the model parameters.
 
@@ -149,67 +436,260 @@ class RunModel:
     logging.info('Output shape was %s', shape)
     return shape
 
-  def predict(self,
-              feat: features.FeatureDict,
-              random_seed: int,
-              prev=None, prev_ckpt_iter=0) -> Mapping[str, Any]:
+  def with_subbatch_size(self, subbatch_size: int) -> 'RunModel':
+    """Returns a RunModel with the same params and another subbatch_size."""
+    if subbatch_size == self.config.model.global_config.subbatch_size:
+      return self
+    config = copy.deepcopy(self.config)
+    config.model.global_config.subbatch_size = subbatch_size
+    return RunModel(config, self.params)
+
+  def probe_peak_memory(self, feat: features.FeatureDict) -> Optional[int]:
+    """Compiles the model for feat and returns its peak memory, if known.
+
+    See memory.probe_peak_memory_bytes.
+
+    Args:
+      feat: A dictionary of NumPy feature arrays as output by
+        RunModel.process_features.
+    """
+    if self.multimer_mode:
+      feat = self._pad_to_bucket(feat)
+    self.init_params(feat)
+    feat = {k: v for k, v in feat.items() if v.dtype != 'O'}
+    return memory.probe_peak_memory_bytes(
+        self.apply, self.params, jax.random.PRNGKey(0), feat)
+
+  def bucket_shape(self, feat: features.FeatureDict) -> Tuple[int, int, int]:
+    """Returns the padded (num_res, msa depth, num templates) of feat.
+
+    Inputs with the same bucket shape share a compiled model. Only the
+    multimer model pads its inputs, monomer inputs keep their shape.
+
+    Args:
+      feat: A dictionary of NumPy feature arrays as output by
+        RunModel.process_features.
+    """
+    num_res = feat['aatype'].shape[0]
+    msa_depth = feat['msa'].shape[0] if 'msa' in feat else 0
+    num_templates = (
+        feat['template_aatype'].shape[0] if 'template_aatype' in feat else 0)
+    if not self.multimer_mode:
+      return num_res, msa_depth, num_templates
+    c = self.config.model
+    return (_bucket_size(num_res, c.get('num_res_buckets', ())),
+            _bucket_size(msa_depth, c.get('msa_depth_buckets', ())),
+            _bucket_size(num_templates, c.get('num_template_buckets', ())))
+
+  def _pad_to_bucket(self, feat: features.FeatureDict) -> features.FeatureDict:
+    """Zero-pads feat to its bucket shape, padded positions are masked out."""
+    num_res, msa_depth, num_templates = self.bucket_shape(feat)
+    feat = dict(feat)
+    for k, axis in _RESIDUE_FEATURES.items():
+      if k in feat:
+        feat[k] = _pad_axis(feat[k], axis, num_res)
+    for k in _MSA_FEATURES:
+      if k in feat:
+        feat[k] = _pad_axis(feat[k], 0, msa_depth)
+    for k in _TEMPLATE_FEATURES:
+      if k in feat:
+        feat[k] = _pad_axis(feat[k], 0, num_templates)
+    return feat
+
+  def _crop_to_num_res(self, result: Mapping[str, Any],
+                       num_res: int) -> Mapping[str, Any]:
+    """Removes the residues padded by _pad_to_bucket from the outputs."""
+    result = dict(result)
+    for path, axes in _RESIDUE_OUTPUT_AXES.items():
+      head, *name = path
+      if not name:
+        if head in result:
+          result[head] = _crop_axes(result[head], axes, num_res)
+      # The confidence metrics replace the predicted_aligned_error head by
+      # the predicted aligned error array.
+      elif (isinstance(result.get(head), Mapping) and
+            name[0] in result[head]):
+        result[head] = dict(result[head])
+        result[head][name[0]] = _crop_axes(
+            result[head][name[0]], axes, num_res)
+    return result
+
+  def _save_recycle_checkpoint(self, pending: List[concurrent.futures.Future],
+                               writer: _CheckpointWriter,
+                               fingerprint: Mapping[str, Any],
+                               num_recycles, tol, prev, key) -> None:
+    """Host callback queuing the recycling carry for writing to disk."""
+    state = {
+        'fingerprint': fingerprint,
+        'num_recycles': int(num_recycles),
+        'tol': float(tol),
+        'prev': {k: np.asarray(v) for k, v in prev.items()},
+        'key': np.asarray(key),
+    }
+    # Writing is done in the background so the device is not held up by disk.
+    future = writer.put(state)
+    if future is not None:
+      pending.append(future)
+
+  def _stream_recycle_output(
+      self, pending: List[concurrent.futures.Future],
+      recycled: Mapping[int, Mapping[str, Any]], num_res: int,
+      recycle_output_fn: Optional[Callable[[int, Mapping[str, Any]], None]],
+      recycle_idx, atom_positions, atom_mask, plddt_logits, tol) -> None:
+    """Host callback queuing the outputs of one recycle for processing."""
+    outputs = (int(recycle_idx), np.asarray(atom_positions)[:num_res],
+               np.asarray(atom_mask)[:num_res],
+               np.asarray(plddt_logits)[:num_res], float(tol))
+    pending.append(_get_host_writer().submit(
+        _process_recycle_output, recycled, recycle_output_fn, *outputs))
+
+  def load_checkpoint(
+      self,
+      feat: features.FeatureDict,
+      checkpoint_file: str,
+      model_name: str,
+      random_seed: int) -> Optional[Mapping[str, Any]]:
+    """Loads a recycle checkpoint written by RunModel.predict, if any.
+
+    Checkpoints of another input, model or random seed are ignored, see
+    _checkpoint_fingerprint.
+
+    Args:
+      feat: The processed features the checkpoint will be resumed with.
+      checkpoint_file: Path of the checkpoint.
+      model_name: The name of the prediction to resume.
+      random_seed: The random seed of the prediction to resume.
+
+    Returns:
+      The checkpoint state to pass to RunModel.predict or None if there is no
+      usable checkpoint in checkpoint_file.
+    """
+    if not os.path.exists(checkpoint_file):
+      return None
+    if not self.multimer_mode:
+      logging.warning('Recycle checkpoints are only supported for multimer '
+                      'models, ignoring %s', checkpoint_file)
+      return None
+    with open(checkpoint_file, 'rb') as f:
+      checkpoint = pickle.load(f)
+    fingerprint = _checkpoint_fingerprint(feat, model_name, random_seed)
+    if checkpoint.get('fingerprint') != fingerprint:
+      logging.warning('Ignoring checkpoint %s made for another input, model '
+                      'or random seed than %s with seed %d.',
+                      checkpoint_file, model_name, random_seed)
+      return None
+    # Checkpoints hold the recycling carry of the padded input.
+    num_res = self.bucket_shape(feat)[0]
+    if checkpoint['prev']['prev_pos'].shape[0] != num_res:
+      logging.warning('Ignoring checkpoint %s made for %d residues, the input '
+                      'is padded to %d residues.', checkpoint_file,
+                      checkpoint['prev']['prev_pos'].shape[0], num_res)
+      return None
+    logging.info('Resuming from recycle %d checkpoint %s',
+                 checkpoint['num_recycles'], checkpoint_file)
+    return checkpoint
+
+  def predict(
+      self,
+      feat: features.FeatureDict,
+      random_seed: int,
+      checkpoint: Optional[Mapping[str, Any]] = None,
+      checkpoint_file: Optional[str] = None,
+      recycle_output_fn: Optional[
+          Callable[[int, Mapping[str, Any]], None]] = None,
+      model_name: str = '',
+  ) -> Tuple[Mapping[str, Any], Tuple[Any, Any, List[Mapping[str, Any]]]]:
     """Makes a prediction by inferencing the model on the provided features.
 
+    Predictions can run concurrently from several threads; they share the
+    compiled model with every RunModel of the same config.
+
     Args:
       feat: A dictionary of NumPy feature arrays as output by
         RunModel.process_features.
       random_seed: The random seed to use when running the model. In the
         multimer model this controls the MSA sampling.
+      checkpoint: Optional checkpoint state as returned by
+        RunModel.load_checkpoint to resume the recycling loop from.
+      checkpoint_file: If set, the recycling carry of the multimer model is
+        written to this path every `recycle_checkpoint_interval` recycles.
+      recycle_output_fn: With `save_recycled`, called from a background thread
+        as `recycle_output_fn(recycle_idx, output)` as soon as each
+        intermediate recycle is computed, output holding its structure_module
+        positions and mask, plddt and tol_val.
+      model_name: The name of the prediction, stored in the checkpoints so
+        that RunModel.load_checkpoint only resumes the same prediction.
 
     Returns:
-      A dictionary of model outputs.
+      A dictionary of model outputs and a tuple of the number of recycles, the
+      final tolerance and the outputs of the intermediate recycles run by this
+      call, in recycle order.
     """
+    num_res = feat['aatype'].shape[0]
+    fingerprint = None
+    if checkpoint_file is not None:
+      fingerprint = _checkpoint_fingerprint(feat, model_name, random_seed)
+    if self.multimer_mode:
+      feat = self._pad_to_bucket(feat)
     self.init_params(feat)
     logging.info('Running predict with shape(feat) = %s',
                  tree.map_structure(lambda x: x.shape, feat))
     feat = {k: v for k, v in feat.items() if v.dtype != 'O'}
-    result, recycles = self.apply(self.params, jax.random.PRNGKey(random_seed), feat, prev=prev)
-
-    if self.checkpoint_file is not None:
-      if prev_ckpt_iter: prev_ckpt_iter += 1
-      prev_iter = prev_ckpt_iter + recycles[0]
-
-    # This block is to ensure benchmark timings are accurate. Some blocking is
-    # already happening when computing get_confidence_metrics, and this ensures
-    # all outputs are blocked on.
-    jax.tree_map(lambda x: x.block_until_ready(), result)
-    result.update(
-        get_confidence_metrics(result, multimer_mode=self.multimer_mode))
+    apply_kwargs = {}
+    if checkpoint is not None:
+      apply_kwargs.update(
+          prev=checkpoint['prev'],
+          prev_iter=checkpoint['num_recycles'],
+          prev_tol=checkpoint['tol'],
+          safe_key=checkpoint['key'])
+    pending_writes = []
+    recycled = {}
+    if self.multimer_mode:
+      callbacks = {}
+      if checkpoint_file is not None:
+        callbacks['checkpoint'] = functools.partial(
+            self._save_recycle_checkpoint, pending_writes,
+            _CheckpointWriter(checkpoint_file), fingerprint)
+      if self.config.model.save_recycled:
+        callbacks['recycle_output'] = functools.partial(
+            self._stream_recycle_output, pending_writes, recycled, num_res,
+            recycle_output_fn)
+      if callbacks:
+        apply_kwargs['run_id'] = self._forward_fn.register_callbacks(
+            **callbacks)
+    signature = (tuple(sorted((k, v.shape, str(v.dtype))
+                              for k, v in feat.items())),
+                 checkpoint is not None)
+    try:
+      with self._forward_fn.compilation_guard(signature):
+        result, (num_recycles, tol) = self.apply(
+            self.params, jax.random.PRNGKey(random_seed), feat, **apply_kwargs)
+        # Computed on the device, before cropping the padding so that inputs
+        # of a bucket share the compiled metrics.
+        residue_weights = None
+        if self.multimer_mode:
+          residue_weights = np.arange(feat['aatype'].shape[0]) < num_res
+        result = dict(result)
+        result.update(confidence_metrics.get_confidence_metrics(
+            result,
+            multimer_mode=self.multimer_mode,
+            residue_weights=residue_weights,
+            chunk_size=self.config.model.get('confidence_chunk_size', 128),
+            return_probs=self.config.model.get(
+                'return_aligned_confidence_probs', True)))
+
+      # This block is to ensure benchmark timings are accurate, it ensures all
+      # outputs are blocked on.
+      jax.tree_map(lambda x: x.block_until_ready(), result)
+    finally:
+      if 'run_id' in apply_kwargs:
+        self._forward_fn.unregister_callbacks(apply_kwargs['run_id'])
+      for future in pending_writes:
+        future.result()
+    if self.multimer_mode:
+      result = self._crop_to_num_res(result, num_res)
     logging.info('Output shape was %s',
                  tree.map_structure(lambda x: x.shape, result))
 
-    if self.config.model.save_recycled:
-      *_, recycled_info = recycles
-    # must convert jax array to np array, otherwise some interplay between
-    # jax array and the loops in the AF2Complex metric functions dramatically slow downs the calculations
-      structs = np.asarray(recycled_info['atom_positions'])
-      structs_masks = np.asarray(recycled_info['atom_mask'])
-      plddt = np.asarray(recycled_info['plddt'])
-      tol_values = np.asarray(recycled_info['tol_values'])
-      recycled_info_ = []
-
-      for i, (s, m, p, tol_val) in enumerate(zip(
-        structs, structs_masks, plddt, tol_values
-      )):
-        pl= confidence.compute_plddt(p)
-        r = {
-          "structure_module": {
-            "final_atom_positions": s,
-            "final_atom_mask": m,
-          },
-          "plddt": pl,
-          "tol_val": tol_val,
-        }
-        if i < result['num_recycles']:
-          logging.info('recycle# %d, diff plddt values: %f %f',i,tol_values[i].item(),pl.mean())
-
-        recycled_info_.append(r)
-      recycles = (*_, recycled_info_)
-      recycled_info.clear()
-
+    recycles = (num_recycles, tol, [recycled[i] for i in sorted(recycled)])
     return result, recycles
@@ -0,0 +1,184 @@
+# Copyright 2021 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for model."""
+import os
+import tempfile
+from unittest import mock
+
+from absl.testing import absltest
+from alphafold.model import config
+from alphafold.model import model
+import numpy as np
+import tree
+
+
+def _tiny_multimer_config():
+  """Returns a multimer config small enough to run on a CPU in a test."""
+  model_config = config.model_config('model_1_multimer_v3')
+  c = model_config.model
+  c.embeddings_and_evoformer.evoformer_num_block = 1
+  c.embeddings_and_evoformer.extra_msa_stack_num_block = 1
+  c.embeddings_and_evoformer.template.template_pair_stack.num_block = 1
+  c.embeddings_and_evoformer.num_msa = 4
+  c.embeddings_and_evoformer.num_extra_msa = 8
+  c.heads.structure_module.num_layer = 1
+  c.num_recycle = 3
+  c.recycle_early_stop_tolerance = -1.
+  c.save_recycled = 0
+  return model_config
+
+
+def _multimer_features(num_res=10, num_msa=12, num_templates=2):
+  """Returns random features of a dimer, as output by the data pipeline."""
+  rng = np.random.default_rng(0)
+  chain_length = num_res // 2
+  asym_id = np.repeat([1, 2], [chain_length, num_res - chain_length])
+  return {
+      'aatype': rng.integers(0, 20, num_res, dtype=np.int32),
+      'residue_index': np.concatenate(
+          [np.arange(chain_length), np.arange(num_res - chain_length)]
+      ).astype(np.int32),
+      'asym_id': asym_id.astype(np.int32),
+      'entity_id': asym_id.astype(np.int32),
+      'sym_id': np.ones(num_res, np.int32),
+      'seq_mask': np.ones(num_res, np.float32),
+      'all_atom_positions': np.zeros((num_res, 37, 3), np.float32),
+      'msa': rng.integers(0, 21, (num_msa, num_res), dtype=np.int32),
+      'deletion_matrix': np.zeros((num_msa, num_res), np.float32),
+      'msa_mask': np.ones((num_msa, num_res), np.float32),
+      'bert_mask': np.ones((num_msa, num_res), np.float32),
+      'cluster_bias_mask': np.eye(1, num_msa, dtype=np.float32)[0],
+      'template_aatype': rng.integers(
+          0, 20, (num_templates, num_res), dtype=np.int32),
+      'template_all_atom_mask': np.ones(
+          (num_templates, num_res, 37), np.float32),
+      'template_all_atom_positions': rng.normal(
+          size=(num_templates, num_res, 37, 3)).astype(np.float32),
+  }
+
+
+def _random_params(model_runner, feat):
+  """Replaces the initial parameters, whose output heads are all zeros."""
+  model_runner.init_params(feat)
+  rng = np.random.default_rng(1)
+  model_runner.params = tree.map_structure(
+      lambda p: (0.1 * rng.normal(size=p.shape)).astype(p.dtype),
+      model_runner.params)
+
+
+class RunModelTest(absltest.TestCase):
+
+  def test_padded_prediction_matches_unpadded(self):
+    feat = _multimer_features()
+    # Each recycle amplifies the float differences between the padded and
+    # unpadded reductions.
+    unpadded_config = _tiny_multimer_config()
+    unpadded_config.model.num_recycle = 1
+    unpadded_runner = model.RunModel(unpadded_config)
+    _random_params(unpadded_runner, feat)
+    padded_config = _tiny_multimer_config()
+    padded_config.model.num_recycle = 1
+    padded_config.model.num_res_buckets = (16,)
+    padded_config.model.msa_depth_buckets = (16,)
+    padded_config.model.num_template_buckets = (4,)
+    padded_runner = model.RunModel(padded_config, unpadded_runner.params)
+    self.assertEqual(padded_runner.bucket_shape(feat), (16, 16, 4))
+
+    unpadded, _ = unpadded_runner.predict(feat, random_seed=0)
+    padded, _ = padded_runner.predict(feat, random_seed=0)
+
+    for name in ('plddt', 'predicted_aligned_error', 'ptm', 'iptm'):
+      np.testing.assert_allclose(padded[name], unpadded[name],
+                                 rtol=1e-5, atol=1e-5, err_msg=name)
+    np.testing.assert_allclose(
+        padded['structure_module']['final_atom_positions'],
+        unpadded['structure_module']['final_atom_positions'],
+        rtol=1e-5, atol=1e-5)
+
+  def test_resumed_prediction_matches_uninterrupted(self):
+    feat = _multimer_features()
+    model_config = _tiny_multimer_config()
+    model_config.model.recycle_checkpoint_interval = 1
+    model_runner = model.RunModel(model_config)
+    _random_params(model_runner, feat)
+    checkpoint_file = os.path.join(
+        self.enter_context(tempfile.TemporaryDirectory()), 'checkpoint.pkl')
+    uninterrupted, (num_recycles, _, _) = model_runner.predict(
+        feat, random_seed=0)
+    self.assertEqual(num_recycles, 3)
+
+    # The prediction is killed after the checkpoint of recycle 2 is queued.
+    save_recycle_checkpoint = model_runner._save_recycle_checkpoint
+    def save_until_recycle_2(*args):
+      if args[3] <= 2:
+        save_recycle_checkpoint(*args)
+    with mock.patch.object(model_runner, '_save_recycle_checkpoint',
+                           side_effect=save_until_recycle_2):
+      model_runner.predict(feat, random_seed=0,
+                           checkpoint_file=checkpoint_file,
+                           model_name='model_1')
+
+    checkpoint = model_runner.load_checkpoint(
+        feat, checkpoint_file, model_name='model_1', random_seed=0)
+    self.assertEqual(checkpoint['num_recycles'], 2)
+    resumed, (num_recycles, _, recycled) = model_runner.predict(
+        feat, random_seed=0, checkpoint=checkpoint,
+        checkpoint_file=checkpoint_file, model_name='model_1')
+    self.assertEqual(num_recycles, 3)
+    self.assertEmpty(recycled)
+    for name in ('plddt', 'predicted_aligned_error', 'ptm', 'iptm'):
+      np.testing.assert_allclose(resumed[name], uninterrupted[name],
+                                 rtol=1e-5, atol=1e-5, err_msg=name)
+    np.testing.assert_allclose(
+        resumed['structure_module']['final_atom_positions'],
+        uninterrupted['structure_module']['final_atom_positions'],
+        rtol=1e-5, atol=1e-5)
+
+    # Checkpoints of another prediction are not resumed.
+    other_msa = dict(feat, msa=np.roll(feat['msa'], 1, axis=0))
+    for other_feat, model_name, random_seed in ((feat, 'model_2', 0),
+                                                (feat, 'model_1', 1),
+                                                (other_msa, 'model_1', 0)):
+      self.assertIsNone(model_runner.load_checkpoint(
+          other_feat, checkpoint_file, model_name, random_seed))
+
+
+class CheckpointWriterTest(absltest.TestCase):
+
+  def test_queued_state_is_replaced(self):
+    writer = model._CheckpointWriter('checkpoint.pkl')
+    written = []
+    self.enter_context(mock.patch.object(
+        model, '_write_checkpoint',
+        side_effect=lambda _, state: written.append(state)))
+    submit = self.enter_context(
+        mock.patch.object(model, '_get_host_writer')).return_value.submit
+
+    self.assertIsNotNone(writer.put({'num_recycles': 1}))
+    self.assertIsNone(writer.put({'num_recycles': 2}))
+    self.assertIsNone(writer.put({'num_recycles': 3}))
+    submit.assert_called_once_with(writer._write)
+    writer._write()
+    self.assertEqual(written, [{'num_recycles': 3}])
+
+    # A state put once the write started is written again.
+    self.assertIsNotNone(writer.put({'num_recycles': 4}))
+    self.assertEqual(submit.call_count, 2)
+    writer._write()
+    self.assertEqual(written, [{'num_recycles': 3}, {'num_recycles': 4}])
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -423,7 +423,39 @@ class AlphaFold(hk.Module):
       is_training,
       return_representations=False,
       safe_key=None,
-      prev=None):
+      prev=None,
+      prev_iter=0,
+      prev_tol=jnp.inf,
+      recycle_callback=None,
+      recycle_output_callback=None):
+    """Run the AlphaFold-Multimer model.
+
+    Arguments:
+      batch: Dictionary with inputs to the AlphaFold model.
+      is_training: Whether the system is in training or inference mode.
+      return_representations: Whether to also return the intermediate
+        representations.
+      safe_key: Optional PRNG key; drawn from Haiku if not given.
+      prev: Optional recycling inputs (prev_pos, prev_msa_first_row,
+        prev_pair) to start the recycling loop from.
+      prev_iter: Number of recycles already performed when `prev` was
+        produced, used to resume the recycling loop from a checkpoint.
+      prev_tol: Early stopping tolerance value associated with `prev`.
+      recycle_callback: Optional function called as
+        `recycle_callback(num_recycles, tol, prev, key)` every
+        `config.recycle_checkpoint_interval` recycles with the traced carry of
+        the recycling loop. It is expected to hand the values to the host with
+        jax.debug.callback, e.g. to write a checkpoint.
+      recycle_output_callback: Optional function called as
+        `recycle_output_callback(recycle_idx, final_atom_positions,
+        final_atom_mask, predicted_lddt_logits, tol)` with the traced outputs
+        of every intermediate recycle when `config.save_recycled` is set, in
+        the same way as recycle_callback.
+
+    Returns:
+      A tuple of the output of the final AlphaFoldIteration and of
+      (num_recycles, tol).
+    """
 
     c = self.config
     impl = AlphaFoldIteration(c, self.global_config)
@@ -436,27 +468,6 @@ class AlphaFold(hk.Module):
     assert isinstance(batch, dict)
     num_res = batch['aatype'].shape[0]
 
-    ### added for saving information of intermediate recycles
-    if self.config.save_recycled:
-      recycled_structs = jnp.zeros(
-        [self.config.num_recycle, num_res, residue_constants.atom_type_num, 3],
-      )
-      recycled_structs_mask = jnp.zeros(
-        [self.config.num_recycle, num_res, 37],
-      )
-      predicted_lddt_logits = jnp.zeros(
-        [self.config.num_recycle, num_res, 50],
-      )
-      tol_values = jnp.zeros([self.config.num_recycle])
-      recycled_info = {
-        "atom_positions": recycled_structs,
-        "atom_mask": recycled_structs_mask,
-        "plddt": predicted_lddt_logits,
-        "tol_values": tol_values
-      }
-    else:
-      recycled_info = {}
-
     def get_prev(ret):
       new_prev = {
           'prev_pos':
@@ -464,25 +475,21 @@ class AlphaFold(hk.Module):
           'prev_msa_first_row': ret['representations']['msa_first_row'],
           'prev_pair': ret['representations']['pair'],
       }
-      return jax.tree_map(jax.lax.stop_gradient, new_prev), recycled_info
+      return jax.tree_map(jax.lax.stop_gradient, new_prev)
+
+    # Outputs of intermediate recycles are streamed to the host as they are
+    # computed rather than accumulated on device.
+    stream_recycles = (self.config.save_recycled and
+                       recycle_output_callback is not None and
+                       not hk.running_init())
 
-    def apply_network(prev, safe_key, recycle_idx, recycled_info, tol_value):
+    def apply_network(prev, safe_key):
       recycled_batch = {**batch, **prev}
-      r = impl(
+      return impl(
           batch=recycled_batch,
           is_training=is_training,
           safe_key=safe_key)
 
-      if self.config.save_recycled:
-        recycled_info['atom_positions'] = recycled_info['atom_positions'].at[recycle_idx].set(
-          r['structure_module']['final_atom_positions'])
-        recycled_info['atom_mask'] = recycled_info['atom_mask'].at[recycle_idx].set(
-          r['structure_module']['final_atom_mask'])
-        recycled_info['plddt'] = recycled_info['plddt'].at[recycle_idx].set(
-          r['predicted_lddt']['logits'])
-        recycled_info['tol_values'] = recycled_info['tol_values'].at[recycle_idx].set(tol_value)
-      return r, recycled_info
-
     if self.config.num_recycle:
       emb_config = self.config.embeddings_and_evoformer
       if prev is None:
@@ -512,35 +519,54 @@ class AlphaFold(hk.Module):
         return jnp.sqrt(jnp.abs(a_norm[:,None] + a_norm[None,:] - 2 * a @ a.T))
 
       def recycle_body(x):
-        i, tol, _, prev, safe_key, recycled = x
+        i, tol, _, prev, safe_key = x
         safe_key1, safe_key2 = safe_key.split() if c.resample_msa_in_recycling else safe_key.duplicate()  # pylint: disable=line-too-long
-        ret, recycled = apply_network(prev=prev, safe_key=safe_key2, recycle_idx=i,
-                recycled_info=recycled, tol_value=tol)
-        prev_, recycled_ = get_prev(ret)
+        ret = apply_network(prev=prev, safe_key=safe_key2)
+        if stream_recycles:
+          recycle_output_callback(
+              i, ret['structure_module']['final_atom_positions'],
+              ret['structure_module']['final_atom_mask'],
+              ret['predicted_lddt']['logits'], tol)
+        prev_ = get_prev(ret)
         ca,ca_ = prev["prev_pos"][:,1,:], prev_["prev_pos"][:,1,:]
-        tol_ = jnp.sqrt(jnp.square(pw_dist(ca) - pw_dist(ca_)).mean())
-        return i+1, tol_, prev, prev_, safe_key1, recycled
+        # Residues padded to a shape bucket do not count.
+        mask_2d = batch['seq_mask'][:, None] * batch['seq_mask'][None, :]
+        tol_ = jnp.sqrt(utils.mask_mean(
+            mask_2d, jnp.square(pw_dist(ca) - pw_dist(ca_))))
+        if checkpoint_interval:
+          # Ship the recycle carry to the host so that the loop can be resumed
+          # from here. The key is the one the next recycle will consume.
+          jax.lax.cond(
+              (i + 1) % checkpoint_interval == 0,
+              lambda x: recycle_callback(*x),
+              lambda x: None,
+              (i + 1, tol_, prev_, safe_key1._key))  # pylint: disable=protected-access
+        return i+1, tol_, prev, prev_, safe_key1
 
       def distances(points):
         """Compute all pairwise distances for a set of points."""
         return jnp.sqrt(jnp.sum((points[:, None] - points[None, :])**2,
                                 axis=-1))
 
+      checkpoint_interval = 0
+      if recycle_callback is not None and not hk.running_init():
+        checkpoint_interval = c.get('recycle_checkpoint_interval', 0)
+
       def recycle_cond(x):
-        i, tol, prev, next_in, _, _ = x
+        i, tol, prev, next_in, _ = x
         less_than_max_recycles = (i < num_iter)
         has_exceeded_tolerance = (
             (i == 0) | (tol > c.recycle_early_stop_tolerance))
         return less_than_max_recycles & has_exceeded_tolerance
 
       if hk.running_init():
-        num_recycles, tol, _, prev, safe_key, recycled_info = recycle_body(
-            (0, jnp.inf, prev, prev, safe_key, recycled_info))
+        num_recycles, tol, _, prev, safe_key = recycle_body(
+            (0, jnp.inf, prev, prev, safe_key))
       else:
-        num_recycles, tol, _, prev, safe_key, recycled_info = hk.while_loop(
+        num_recycles, tol, _, prev, safe_key = hk.while_loop(
             recycle_cond,
             recycle_body,
-            (0, jnp.inf, prev, prev, safe_key, recycled_info))
+            (prev_iter, prev_tol, prev, prev, safe_key))
     else:
       if prev is None:
         prev = {}
@@ -549,14 +575,13 @@ class AlphaFold(hk.Module):
       (num_recycles, tol) = 0, jnp.inf
 
     # Run extra iteration.
-    ret, recycled_info = apply_network(prev=prev, safe_key=safe_key,
-        recycle_idx=num_iter, recycled_info=recycled_info, tol_value=tol)
+    ret = apply_network(prev=prev, safe_key=safe_key)
 
     if not return_representations:
       del ret['representations']
     ret['num_recycles'] = num_recycles
 
-    return ret, (num_recycles, tol, recycled_info)
+    return ret, (num_recycles, tol)
 
 
 class EmbeddingsAndEvoformer(hk.Module):
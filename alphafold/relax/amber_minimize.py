@@ -14,19 +14,19 @@
 
 """Restrained Amber Minimization of a structure."""
 
+import dataclasses
+import functools
 import io
 import time
-from typing import Collection, Optional, Sequence
+from typing import Collection, Mapping, Optional, Sequence
 
 from absl import logging
 from alphafold.common import protein
 from alphafold.common import residue_constants
-from alphafold.model import folding
 from alphafold.relax import cleanup
 from alphafold.relax import utils
-import ml_collections
+from alphafold.relax import violations as violations_lib
 import numpy as np
-import jax
 import openmm
 from openmm import unit
 from openmm import app as openmm_app
@@ -46,68 +46,228 @@ def will_restrain(atom: openmm_app.Atom, rset: str) -> bool:
     return atom.name == "CA"
 
 
-def _add_restraints(
-    system: openmm.System,
-    reference_pdb: openmm_app.PDBFile,
-    stiffness: unit.Unit,
-    rset: str,
-    exclude_residues: Sequence[int]):
-  """Adds a harmonic potential that restrains the system to a structure."""
-  assert rset in ["non_hydrogen", "c_alpha"]
+@functools.lru_cache(maxsize=None)
+def _force_field() -> openmm_app.ForceField:
+  """Returns the Amber force field, loaded once per process."""
+  return openmm_app.ForceField("amber99sb.xml")
 
-  force = openmm.CustomExternalForce(
-      "0.5 * k * ((x-x0)^2 + (y-y0)^2 + (z-z0)^2)")
-  force.addGlobalParameter("k", stiffness)
-  for p in ["x0", "y0", "z0"]:
-    force.addPerParticleParameter(p)
 
-  for i, atom in enumerate(reference_pdb.topology.atoms()):
-    if atom.residue.index in exclude_residues:
-      continue
-    if will_restrain(atom, rset):
-      force.addParticle(i, reference_pdb.positions[i])
-  logging.info("Restraining %d / %d particles.",
-               force.getNumParticles(), system.getNumParticles())
-  system.addForce(force)
+def _topology_signature(topology: openmm_app.Topology):
+  return tuple((atom.residue.chain.id, atom.residue.id, atom.residue.name,
+                atom.name) for atom in topology.atoms())
 
 
-def _openmm_minimize(
-    pdb_str: str,
-    max_iterations: int,
-    tolerance: unit.Unit,
-    stiffness: unit.Unit,
-    restraint_set: str,
-    exclude_residues: Sequence[int],
-    use_gpu: bool):
-  """Minimize energy via openmm."""
-
-  pdb_file = io.StringIO(pdb_str)
-  pdb = openmm_app.PDBFile(pdb_file)
-
-  force_field = openmm_app.ForceField("amber99sb.xml")
-  constraints = openmm_app.HBonds
-  system = force_field.createSystem(
-      pdb.topology, constraints=constraints)
-  if stiffness > 0 * ENERGY / (LENGTH**2):
-    _add_restraints(system, pdb, stiffness, restraint_set, exclude_residues)
-
-  integrator = openmm.LangevinIntegrator(0, 0.01, 0.0)
-  platform = openmm.Platform.getPlatformByName("CUDA" if use_gpu else "CPU")
-  simulation = openmm_app.Simulation(
-      pdb.topology, system, integrator, platform)
-  simulation.context.setPositions(pdb.positions)
-
-  ret = {}
-  state = simulation.context.getState(getEnergy=True, getPositions=True)
-  ret["einit"] = state.getPotentialEnergy().value_in_unit(ENERGY)
-  ret["posinit"] = state.getPositions(asNumpy=True).value_in_unit(LENGTH)
-  simulation.minimizeEnergy(maxIterations=max_iterations,
-                            tolerance=tolerance)
-  state = simulation.context.getState(getEnergy=True, getPositions=True)
-  ret["efinal"] = state.getPotentialEnergy().value_in_unit(ENERGY)
-  ret["pos"] = state.getPositions(asNumpy=True).value_in_unit(LENGTH)
-  ret["min_pdb"] = _get_pdb_string(simulation.topology, state.getPositions())
-  return ret
+class RelaxSession:
+  """OpenMM system and context reused by the iterations of a relaxation.
+
+  The system, the restraint force and the context are built for the first
+  structure and kept as long as the structures have the same atoms, which is
+  the case when the hydrogens are re-placed between iterations. The
+  restraints and positions are then updated in place. Without re-placing the
+  hydrogens, an iteration starts from the positions minimized by the previous
+  one, without going through a PDB string.
+  """
+
+  def __init__(
+      self,
+      stiffness: float,
+      restraint_set: str,
+      use_gpu: bool,
+      platform_properties: Optional[Mapping[str, str]] = None):
+    """Initializes the session.
+
+    Args:
+      stiffness: kcal/mol A**2, spring constant of the restraining potential.
+        There are no restraints if 0.
+      restraint_set: The set of atoms to restrain, see will_restrain.
+      use_gpu: Whether to run on GPU.
+      platform_properties: Optional properties of the OpenMM platform, e.g. the
+        number of CPU threads or the CUDA device index.
+    """
+    assert restraint_set in ["non_hydrogen", "c_alpha"]
+    self._stiffness = stiffness * ENERGY / (LENGTH**2)
+    self._restraint_set = restraint_set
+    self._use_gpu = use_gpu
+    self._platform_properties = dict(platform_properties or {})
+    self._signature = None
+    self._simulation = None
+    self._restraint = None
+    # (particle index, residue index) of the atoms of the restraint set.
+    self._restrainable = []
+    # Heavy atom Protein of the topology and the atoms of its positions.
+    self._template = None
+    self._template_atoms = None
+    self._topology = None
+    self._positions = None
+    self._pending_pdb_str = None
+    self._minimized = None
+
+  def set_structure(self, pdb_str: str) -> None:
+    """Starts the next minimization from the structure of a PDB string.
+
+    The structure is only parsed by the next minimization, so that errors
+    building its system are retried with the minimization.
+
+    Args:
+      pdb_str: The PDB string of the structure.
+    """
+    self._pending_pdb_str = pdb_str
+
+  def reset(self) -> None:
+    """Drops the system and context, e.g. after a failed minimization.
+
+    They are rebuilt from the current structure by the next minimization.
+    """
+    self._simulation = None
+
+  def _prepare(self) -> None:
+    """Builds the system and context of the structure to minimize if needed."""
+    if self._pending_pdb_str is not None:
+      pdb = openmm_app.PDBFile(io.StringIO(self._pending_pdb_str))
+      signature = _topology_signature(pdb.topology)
+      if signature != self._signature or self._simulation is None:
+        self._build(pdb.topology, pdb.positions)
+        self._signature = signature
+      self._positions = pdb.positions
+      self._pending_pdb_str = None
+    elif self._simulation is None:
+      self._build(self._topology, self._positions)
+
+  def _build(self, topology: openmm_app.Topology,
+             positions: unit.Quantity) -> None:
+    """Creates the system, restraint force and context of a topology."""
+    # The session is only usable once the simulation is set, at the end.
+    self._simulation = None
+    system = _force_field().createSystem(
+        topology, constraints=openmm_app.HBonds)
+    self._restraint = None
+    self._restrainable = []
+    if self._stiffness > 0 * ENERGY / (LENGTH**2):
+      # Atoms of excluded residues are switched off with `restrained`, so the
+      # exclusions can change without rebuilding the system.
+      force = openmm.CustomExternalForce(
+          "0.5 * k * restrained * ((x-x0)^2 + (y-y0)^2 + (z-z0)^2)")
+      force.addGlobalParameter("k", self._stiffness)
+      for p in ["restrained", "x0", "y0", "z0"]:
+        force.addPerParticleParameter(p)
+      for i, atom in enumerate(topology.atoms()):
+        if will_restrain(atom, self._restraint_set):
+          force.addParticle(i, [0., 0., 0., 0.])
+          self._restrainable.append((i, atom.residue.index))
+      system.addForce(force)
+      self._restraint = force
+
+    integrator = openmm.LangevinIntegrator(0, 0.01, 0.0)
+    platform = openmm.Platform.getPlatformByName(
+        "CUDA" if self._use_gpu else "CPU")
+    simulation = openmm_app.Simulation(
+        topology, system, integrator, platform, self._platform_properties)
+
+    self._template = protein.from_pdb_string(
+        _get_pdb_string(topology, positions))
+    self._template_atoms = _template_atoms(topology, self._template)
+    self._topology = topology
+    self._simulation = simulation
+
+  def _update_restraints(self, exclude_residues: Collection[int]) -> None:
+    """Restrains the atoms of the restraint set to the current positions."""
+    if self._restraint is None:
+      return
+    reference = self._positions.value_in_unit(unit.nanometer)
+    num_restrained = 0
+    for force_index, (i, residue_index) in enumerate(self._restrainable):
+      restrained = residue_index not in exclude_residues
+      num_restrained += restrained
+      self._restraint.setParticleParameters(
+          force_index, i, [float(restrained), *reference[i]])
+    self._restraint.updateParametersInContext(self._simulation.context)
+    logging.info("Restraining %d / %d particles.",
+                 num_restrained, self._simulation.system.getNumParticles())
+
+  def minimize(
+      self,
+      max_iterations: int,
+      tolerance: float,
+      exclude_residues: Collection[int]):
+    """Minimizes the energy from the current structure.
+
+    Args:
+      max_iterations: Maximum number of L-BFGS iterations, 0 for no limit.
+      tolerance: kcal/mol, the energy tolerance of L-BFGS.
+      exclude_residues: Zero-indexed residues excluded from the restraints.
+
+    Returns:
+      A dict with the initial and final energies and positions.
+    """
+    self._prepare()
+    self._update_restraints(exclude_residues)
+    context = self._simulation.context
+    context.setPositions(self._positions)
+
+    ret = {}
+    state = context.getState(getEnergy=True, getPositions=True)
+    ret["einit"] = state.getPotentialEnergy().value_in_unit(ENERGY)
+    ret["posinit"] = state.getPositions(asNumpy=True).value_in_unit(LENGTH)
+    self._simulation.minimizeEnergy(maxIterations=max_iterations,
+                                    tolerance=tolerance * ENERGY)
+    state = context.getState(getEnergy=True, getPositions=True)
+    ret["efinal"] = state.getPotentialEnergy().value_in_unit(ENERGY)
+    ret["pos"] = state.getPositions(asNumpy=True).value_in_unit(LENGTH)
+    self._positions = state.getPositions(asNumpy=True)
+    self._minimized = (self._simulation.topology, self._positions,
+                       self._template, self._template_atoms)
+    return ret
+
+  def minimized_pdb(self) -> str:
+    """Returns the PDB string of the last minimized structure."""
+    topology, positions, _, _ = self._minimized
+    return _get_pdb_string(topology, positions)
+
+  def minimized_protein(self) -> protein.Protein:
+    """Returns the heavy atoms of the last minimized structure.
+
+    Equal to parsing minimized_pdb, the positions being rounded as in the PDB
+    format.
+    """
+    topology, positions, template, template_atoms = self._minimized
+    if template_atoms is None:
+      return protein.from_pdb_string(_get_pdb_string(topology, positions))
+    atom_indices, residues, atom_types = template_atoms
+    pdb_positions = np.round(np.asarray(
+        positions.value_in_unit(LENGTH))[atom_indices], 3).astype(np.float32)
+    atom_positions = np.zeros_like(template.atom_positions)
+    atom_positions[residues, atom_types] = pdb_positions
+    return dataclasses.replace(template, atom_positions=atom_positions)
+
+
+def _template_atoms(topology: openmm_app.Topology, template: protein.Protein):
+  """Maps the heavy atoms of a topology to the positions of its Protein.
+
+  Args:
+    topology: The topology of a structure.
+    template: The Protein parsed from the structure.
+
+  Returns:
+    The indices of the heavy atoms in the topology and their residue and
+    atom type in template, None if the topology doesn't map to the template.
+  """
+  atom_indices, residues, atom_types = [], [], []
+  residue = -1
+  for topology_residue in topology.residues():
+    atoms = [(atom.index, residue_constants.atom_order[atom.name])
+             for atom in topology_residue.atoms()
+             if atom.name in residue_constants.atom_order]
+    if not atoms:
+      continue
+    residue += 1
+    for atom_index, atom_type in atoms:
+      atom_indices.append(atom_index)
+      residues.append(residue)
+      atom_types.append(atom_type)
+  if (residue + 1 != template.aatype.shape[0] or
+      template.atom_mask.sum() != len(atom_indices)):
+    return None
+  return (np.array(atom_indices), np.array(residues), np.array(atom_types))
 
 
 def _get_pdb_string(topology: openmm_app.Topology, positions: unit.Quantity):
@@ -337,14 +497,13 @@ def find_violations(prot_np: protein.Protein):
   batch["seq_mask"] = np.ones_like(batch["aatype"], np.float32)
   batch = make_atom14_positions(batch)
 
-  violations = folding.find_structural_violations(
+  violations = violations_lib.find_structural_violations(
       batch=batch,
       atom14_pred_positions=batch["atom14_gt_positions"],
-      config=ml_collections.ConfigDict(
-          {"violation_tolerance_factor": 12,  # Taken from model config.
-           "clash_overlap_tolerance": 1.5,  # Taken from model config.
-          }))
-  violation_metrics = folding.compute_violation_metrics(
+      violation_tolerance_factor=12,  # Taken from model config.
+      clash_overlap_tolerance=1.5,  # Taken from model config.
+  )
+  violation_metrics = violations_lib.compute_violation_metrics(
       batch=batch,
       atom14_pred_positions=batch["atom14_gt_positions"],
       violations=violations,
@@ -367,26 +526,19 @@ def get_violation_metrics(prot: protein.Protein):
 
 def _run_one_iteration(
     *,
-    pdb_string: str,
+    session: RelaxSession,
     max_iterations: int,
     tolerance: float,
-    stiffness: float,
-    restraint_set: str,
     max_attempts: int,
-    use_gpu: bool,
     exclude_residues: Optional[Collection[int]] = None):
   """Runs the minimization pipeline.
 
   Args:
-    pdb_string: A pdb string.
+    session: The RelaxSession holding the structure to minimize.
     max_iterations: An `int` specifying the maximum number of L-BFGS iterations.
     A value of 0 specifies no limit.
     tolerance: kcal/mol, the energy tolerance of L-BFGS.
-    stiffness: kcal/mol A**2, spring constant of heavy atom restraining
-      potential.
-    restraint_set: The set of atoms to restrain.
     max_attempts: The maximum number of minimization attempts.
-    use_gpu: Whether to run on GPU.
     exclude_residues: An optional list of zero-indexed residues to exclude from
         restraints.
 
@@ -395,10 +547,6 @@ def _run_one_iteration(
   """
   exclude_residues = exclude_residues or []
 
-  # Assign physical dimensions.
-  tolerance = tolerance * ENERGY
-  stiffness = stiffness * ENERGY / (LENGTH**2)
-
   start = time.time()
   minimized = False
   attempts = 0
@@ -407,15 +555,14 @@ def _run_one_iteration(
     try:
       logging.info("Minimizing protein, attempt %d of %d.",
                    attempts, max_attempts)
-      ret = _openmm_minimize(
-          pdb_string, max_iterations=max_iterations,
-          tolerance=tolerance, stiffness=stiffness,
-          restraint_set=restraint_set,
-          exclude_residues=exclude_residues,
-          use_gpu=use_gpu)
+      ret = session.minimize(
+          max_iterations=max_iterations, tolerance=tolerance,
+          exclude_residues=exclude_residues)
       minimized = True
     except Exception as e:  # pylint: disable=broad-except
       logging.info(e)
+      # Rebuilt by the next attempt.
+      session.reset()
   if not minimized:
     raise ValueError(f"Minimization failed after {max_attempts} attempts.")
   ret["opt_time"] = time.time() - start
@@ -434,7 +581,8 @@ def run_pipeline(
     restraint_set: str = "non_hydrogen",
     max_attempts: int = 100,
     checks: bool = True,
-    exclude_residues: Optional[Sequence[int]] = None):
+    exclude_residues: Optional[Sequence[int]] = None,
+    platform_properties: Optional[Mapping[str, str]] = None):
   """Run iterative amber relax.
 
   Successive relax iterations are performed until all violations have been
@@ -457,6 +605,8 @@ def run_pipeline(
     checks: Whether to perform cleaning checks.
     exclude_residues: An optional list of zero-indexed residues to exclude from
         restraints.
+    platform_properties: Optional properties of the OpenMM platform, e.g. the
+        number of CPU threads or the CUDA device index.
 
   Returns:
     out: A dictionary of output values.
@@ -465,7 +615,9 @@ def run_pipeline(
   # `protein.to_pdb` will strip any poorly-defined residues so we need to
   # perform this check before `clean_protein`.
   _check_residues_are_well_defined(prot)
-  pdb_string = clean_protein(prot, checks=checks)
+  session = RelaxSession(stiffness, restraint_set, use_gpu,
+                         platform_properties)
+  session.set_structure(clean_protein(prot, checks=checks))
 
   exclude_residues = exclude_residues or []
   exclude_residues = set(exclude_residues)
@@ -474,22 +626,16 @@ def run_pipeline(
 
   while violations > 0 and iteration < max_outer_iterations:
     ret = _run_one_iteration(
-        pdb_string=pdb_string,
+        session=session,
         exclude_residues=exclude_residues,
         max_iterations=max_iterations,
         tolerance=tolerance,
-        stiffness=stiffness,
-        restraint_set=restraint_set,
-        max_attempts=max_attempts,
-        use_gpu=use_gpu)
-    prot = protein.from_pdb_string(ret["min_pdb"])
+        max_attempts=max_attempts)
+    prot = session.minimized_protein()
+    # Otherwise the next iteration starts from the minimized positions.
     if place_hydrogens_every_iteration:
-      pdb_string = clean_protein(prot, checks=True)
-    else:
-      pdb_string = ret["min_pdb"]
-    # Calculation of violations can cause CUDA errors for some JAX versions.
-    with jax.default_device(jax.local_devices(backend="cpu")[0]):
-      ret.update(get_violation_metrics(prot))
+      session.set_structure(clean_protein(prot, checks=True))
+    ret.update(get_violation_metrics(prot))
     ret.update({
         "num_exclusions": len(exclude_residues),
         "iteration": iteration,
@@ -502,4 +648,5 @@ def run_pipeline(
                  ret["einit"], ret["efinal"], ret["opt_time"],
                  ret["num_residue_violations"], ret["num_exclusions"])
     iteration += 1
+  ret["min_pdb"] = session.minimized_pdb()
   return ret
@@ -14,11 +14,13 @@
 
 """Tests for amber_minimize."""
 import os
+from unittest import mock
 
 from absl.testing import absltest
 from alphafold.common import protein
 from alphafold.relax import amber_minimize
 import numpy as np
+from openmm import unit
 # Internal import (7716).
 
 _USE_GPU = False
@@ -129,5 +131,137 @@ class AmberMinimizeTest(absltest.TestCase):
         expected_per_atom_violations)
 
 
+class RelaxSessionTest(absltest.TestCase):
+  """Tests of RelaxSession which do not depend on the minimizer converging."""
+
+  def setUp(self):
+    super().setUp()
+    prot = _load_test_protein(
+        'alphafold/relax/testdata/multiple_disulfides_target.pdb')
+    self.session = amber_minimize.RelaxSession(
+        stiffness=10., restraint_set='non_hydrogen', use_gpu=_USE_GPU)
+    self.session.set_structure(amber_minimize.clean_protein(prot))
+    self.session._prepare()
+    self.context = self.session._simulation.context
+
+  def _restraint_energy(self, positions):
+    self.context.setPositions(positions)
+    return self.context.getState(getEnergy=True, groups={1}).getPotentialEnergy(
+    ).value_in_unit(unit.kilojoule_per_mole)
+
+  def test_minimized_protein_matches_minimized_pdb(self):
+    rng = np.random.default_rng(0)
+
+    def perturb(**unused_kwargs):
+      # Stands in for the minimizer, moves the atoms off the PDB grid.
+      positions = self.context.getState(getPositions=True).getPositions(
+          asNumpy=True).value_in_unit(unit.nanometer)
+      self.context.setPositions(
+          (positions + rng.normal(scale=0.01, size=positions.shape)) *
+          unit.nanometer)
+
+    with mock.patch.object(self.session._simulation, 'minimizeEnergy',
+                           side_effect=perturb):
+      for _ in range(2):
+        self.session.minimize(
+            max_iterations=0, tolerance=2.39, exclude_residues=[])
+        expected = protein.from_pdb_string(self.session.minimized_pdb())
+        actual = self.session.minimized_protein()
+        for field in ('atom_positions', 'atom_mask', 'aatype',
+                      'residue_index', 'chain_index', 'b_factors'):
+          np.testing.assert_array_equal(getattr(actual, field),
+                                        getattr(expected, field), err_msg=field)
+
+  def test_restraints_match_excluded_residues(self):
+    # The energy of the restraints alone.
+    self.session._restraint.setForceGroup(1)
+    self.context.reinitialize()
+    topology = self.session._simulation.topology
+    positions = self.session._positions.value_in_unit(unit.nanometer)
+    shift = 0.05
+    shifted = (positions + np.array([shift, 0., 0.])) * unit.nanometer
+    # kJ/mol/nm**2, from 10 kcal/mol/A**2.
+    stiffness = 10. * 4.184 * 100.
+
+    for exclude_residues in ({0, 3, 42}, set(), {0, 3, 42}, {5}):
+      self.session._update_restraints(exclude_residues)
+      # Non-hydrogen atoms outside of the excluded residues.
+      expected = {
+          atom.index for atom in topology.atoms()
+          if atom.residue.index not in exclude_residues and
+          amber_minimize.will_restrain(atom, 'non_hydrogen')}
+      restrained = set()
+      restraint = self.session._restraint
+      for force_index in range(restraint.getNumParticles()):
+        i, (is_restrained, *reference) = restraint.getParticleParameters(
+            force_index)
+        if is_restrained:
+          restrained.add(i)
+          np.testing.assert_allclose(reference, positions[i])
+      self.assertEqual(restrained, expected)
+
+      self.assertAlmostEqual(
+          self._restraint_energy(self.session._positions), 0., places=3)
+      expected_energy = 0.5 * stiffness * shift**2 * len(expected)
+      self.assertAlmostEqual(self._restraint_energy(shifted), expected_energy,
+                             delta=1e-4 * expected_energy)
+
+
+class RunOneIterationTest(absltest.TestCase):
+  """Tests of the minimization retries, with a minimizer that does nothing."""
+
+  def setUp(self):
+    super().setUp()
+    prot = _load_test_protein(
+        'alphafold/relax/testdata/multiple_disulfides_target.pdb')
+    self.session = amber_minimize.RelaxSession(
+        stiffness=10., restraint_set='non_hydrogen', use_gpu=_USE_GPU)
+    self.session.set_structure(amber_minimize.clean_protein(prot))
+    self.minimize_energy = self.enter_context(mock.patch.object(
+        amber_minimize.openmm_app.Simulation, 'minimizeEnergy'))
+
+  def _run_one_iteration(self, max_attempts=3):
+    return amber_minimize._run_one_iteration(
+        session=self.session, max_iterations=0, tolerance=2.39,
+        max_attempts=max_attempts)
+
+  def test_failed_minimization_is_rebuilt(self):
+    simulations = []
+    def fail_first_attempt(**unused_kwargs):
+      simulations.append(self.session._simulation)
+      if len(simulations) == 1:
+        raise RuntimeError('Particle coordinate is NaN.')
+    self.minimize_energy.side_effect = fail_first_attempt
+
+    ret = self._run_one_iteration()
+    self.assertEqual(ret['min_attempts'], 2)
+    self.assertLen(simulations, 2)
+    self.assertIsNot(simulations[0], simulations[1])
+
+  def test_failed_build_is_retried(self):
+    build = self.session._build
+    num_builds = []
+    def fail_first_build(*args):
+      num_builds.append(1)
+      if len(num_builds) == 1:
+        raise RuntimeError('No CPU platform.')
+      build(*args)
+
+    with mock.patch.object(self.session, '_build',
+                           side_effect=fail_first_build):
+      ret = self._run_one_iteration()
+    self.assertEqual(ret['min_attempts'], 2)
+    self.assertLen(num_builds, 2)
+    self.minimize_energy.assert_called_once()
+
+  def test_raises_after_max_attempts(self):
+    self.minimize_energy.side_effect = RuntimeError(
+        'Particle coordinate is NaN.')
+    with self.assertRaisesRegex(ValueError,
+                                'Minimization failed after 3 attempts.'):
+      self._run_one_iteration()
+    self.assertEqual(self.minimize_energy.call_count, 3)
+
+
 if __name__ == '__main__':
   absltest.main()
@@ -13,7 +13,8 @@
 # limitations under the License.
 
 """Amber relaxation."""
-from typing import Any, Dict, Sequence, Tuple
+import copy
+from typing import Any, Dict, Mapping, Optional, Sequence, Tuple
 from alphafold.common import protein
 from alphafold.relax import amber_minimize
 from alphafold.relax import utils
@@ -30,7 +31,8 @@ class AmberRelaxation(object):
                stiffness: float,
                exclude_residues: Sequence[int],
                max_outer_iterations: int,
-               use_gpu: bool):
+               use_gpu: bool,
+               platform_properties: Optional[Mapping[str, str]] = None):
     """Initialize Amber Relaxer.
 
     Args:
@@ -46,6 +48,8 @@ class AmberRelaxation(object):
        as soon as there are no violations, hence in most cases this causes no
        slowdown. In the worst case we do 20 outer iterations.
       use_gpu: Whether to run on GPU.
+      platform_properties: Optional properties of the OpenMM platform, e.g.
+        {'Threads': '4'} on CPU or {'DeviceIndex': '1'} on GPU.
     """
 
     self._max_iterations = max_iterations
@@ -54,6 +58,18 @@ class AmberRelaxation(object):
     self._exclude_residues = exclude_residues
     self._max_outer_iterations = max_outer_iterations
     self._use_gpu = use_gpu
+    self._platform_properties = dict(platform_properties or {})
+
+  @property
+  def use_gpu(self) -> bool:
+    return self._use_gpu
+
+  def with_platform_properties(
+      self, platform_properties: Mapping[str, str]) -> 'AmberRelaxation':
+    """Returns an AmberRelaxation running with other platform properties."""
+    relaxer = copy.copy(self)
+    relaxer._platform_properties = dict(platform_properties)  # pylint: disable=protected-access
+    return relaxer
 
   def process(self, *,
               prot: protein.Protein
@@ -64,7 +80,8 @@ class AmberRelaxation(object):
         tolerance=self._tolerance, stiffness=self._stiffness,
         exclude_residues=self._exclude_residues,
         max_outer_iterations=self._max_outer_iterations,
-        use_gpu=self._use_gpu)
+        use_gpu=self._use_gpu,
+        platform_properties=self._platform_properties)
     min_pos = out['pos']
     start_pos = out['posinit']
     rmsd = np.sqrt(np.sum((start_pos - min_pos)**2) / start_pos.shape[0])
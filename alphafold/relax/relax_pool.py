@@ -0,0 +1,139 @@
+# Copyright 2021 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Concurrent Amber relaxation of several structures.
+
+Each worker process relaxes one structure at a time with its own OpenMM
+platform properties: on CPU the cores are split between the workers, on GPU
+the workers are spread over the given CUDA devices.
+"""
+
+import concurrent.futures
+import multiprocessing
+import os
+import time
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple
+
+from absl import logging
+from alphafold.common import protein
+from alphafold.data.tools import cpu_budget
+from alphafold.relax import relax
+
+# (relaxed PDB, debug data, violations, relax time in seconds).
+RelaxResult = Tuple[str, Dict[str, Any], Sequence[float], float]
+
+# The relaxer of a worker process, set by _init_worker.
+_WORKER_RELAXER = None
+
+
+def _init_worker(relaxer: relax.AmberRelaxation, slots: Any) -> None:
+  global _WORKER_RELAXER
+  platform_properties = slots.get()
+  logging.info('Relax worker %d uses the OpenMM platform properties %s',
+               os.getpid(), platform_properties)
+  _WORKER_RELAXER = relaxer.with_platform_properties(platform_properties)
+
+
+def _relax(relaxer: relax.AmberRelaxation,
+           prot: protein.Protein) -> RelaxResult:
+  t_0 = time.time()
+  relaxed_pdb, debug_data, violations = relaxer.process(prot=prot)
+  return relaxed_pdb, debug_data, violations, time.time() - t_0
+
+
+def _relax_in_worker(prot: protein.Protein) -> RelaxResult:
+  return _relax(_WORKER_RELAXER, prot)
+
+
+def worker_platform_properties(
+    num_workers: int,
+    use_gpu: bool,
+    gpu_devices: Optional[Sequence[str]] = None,
+    num_cpus: Optional[int] = None) -> List[Mapping[str, str]]:
+  """Returns the OpenMM platform properties of each worker.
+
+  Args:
+    num_workers: The number of worker processes.
+    use_gpu: Whether the workers relax on GPU.
+    gpu_devices: The CUDA device indices the GPU workers are spread over,
+      round-robin. If not set, all the workers use the default device.
+    num_cpus: The number of CPUs split between the CPU workers, by default
+      those available to this process (see cpu_budget.available_cpus).
+  """
+  if use_gpu:
+    if not gpu_devices:
+      return [{} for _ in range(num_workers)]
+    return [{'DeviceIndex': str(gpu_devices[i % len(gpu_devices)])}
+            for i in range(num_workers)]
+  num_threads = max(1, (num_cpus or cpu_budget.available_cpus()) // num_workers)
+  return [{'Threads': str(num_threads)} for _ in range(num_workers)]
+
+
+class RelaxPool:
+  """Relaxes structures concurrently in worker processes.
+
+  Structures are relaxed in the order they are submitted, each as soon as a
+  worker is free, so relaxation can overlap with the inference of the
+  remaining models.
+  """
+
+  def __init__(self,
+               relaxer: relax.AmberRelaxation,
+               num_workers: int = 0,
+               gpu_devices: Optional[Sequence[str]] = None):
+    """Initializes the pool.
+
+    Args:
+      relaxer: The AmberRelaxation run by the workers.
+      num_workers: The number of worker processes. If 0, structures are relaxed
+        synchronously in submit, with relaxer as is.
+      gpu_devices: With a GPU relaxer, the CUDA device indices the workers are
+        spread over.
+    """
+    self._relaxer = relaxer
+    self._executor = None
+    if num_workers:
+      mp_context = multiprocessing.get_context('spawn')
+      slots = mp_context.Queue()
+      for platform_properties in worker_platform_properties(
+          num_workers, relaxer.use_gpu, gpu_devices,
+          num_cpus=cpu_budget.available_cpus()):
+        slots.put(platform_properties)
+      self._executor = concurrent.futures.ProcessPoolExecutor(
+          max_workers=num_workers,
+          mp_context=mp_context,
+          initializer=_init_worker,
+          initargs=(relaxer, slots))
+      logging.info('Relaxing with %d worker processes', num_workers)
+
+  def submit(self, prot: protein.Protein) -> concurrent.futures.Future:
+    """Schedules the relaxation of prot.
+
+    Args:
+      prot: The structure to relax.
+
+    Returns:
+      A future of the relaxed PDB, the debug data and the per-residue
+      violations returned by AmberRelaxation.process, and of the relax time
+      in seconds.
+    """
+    if self._executor is None:
+      future = concurrent.futures.Future()
+      future.set_result(_relax(self._relaxer, prot))
+      return future
+    return self._executor.submit(_relax_in_worker, prot)
+
+  def shutdown(self) -> None:
+    if self._executor is not None:
+      self._executor.shutdown()
@@ -0,0 +1,123 @@
+# Copyright 2021 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for relax_pool."""
+import queue
+from unittest import mock
+
+from absl.testing import absltest
+from alphafold.data.tools import cpu_budget
+from alphafold.relax import relax_pool
+
+
+class _FakeRelaxer:
+  """Records the structures it relaxes and its platform properties."""
+
+  def __init__(self, use_gpu=False, platform_properties=None):
+    self.use_gpu = use_gpu
+    self.platform_properties = platform_properties
+    self.processed = []
+
+  def process(self, *, prot):
+    self.processed.append(prot)
+    return f'relaxed {prot}', {'attempts': 1}, [0.]
+
+  def with_platform_properties(self, platform_properties):
+    return _FakeRelaxer(self.use_gpu, platform_properties)
+
+
+class WorkerPlatformPropertiesTest(absltest.TestCase):
+
+  def test_cpu_workers_split_the_cpus(self):
+    self.assertEqual(
+        relax_pool.worker_platform_properties(3, use_gpu=False, num_cpus=8),
+        [{'Threads': '2'}] * 3)
+    # Every worker gets at least one thread.
+    self.assertEqual(
+        relax_pool.worker_platform_properties(4, use_gpu=False, num_cpus=2),
+        [{'Threads': '1'}] * 4)
+    # GPU devices are ignored on CPU.
+    self.assertEqual(
+        relax_pool.worker_platform_properties(
+            1, use_gpu=False, gpu_devices=['0'], num_cpus=4),
+        [{'Threads': '4'}])
+
+  def test_cpu_workers_default_to_available_cpus(self):
+    with mock.patch.object(cpu_budget, 'available_cpus', return_value=6):
+      self.assertEqual(
+          relax_pool.worker_platform_properties(2, use_gpu=False),
+          [{'Threads': '3'}] * 2)
+
+  def test_gpu_workers_round_robin(self):
+    self.assertEqual(
+        relax_pool.worker_platform_properties(
+            5, use_gpu=True, gpu_devices=['0', '1'], num_cpus=8),
+        [{'DeviceIndex': '0'}, {'DeviceIndex': '1'}, {'DeviceIndex': '0'},
+         {'DeviceIndex': '1'}, {'DeviceIndex': '0'}])
+    self.assertEqual(
+        relax_pool.worker_platform_properties(2, use_gpu=True), [{}, {}])
+
+  def test_init_worker_takes_one_slot(self):
+    slots = queue.Queue()
+    slots.put({'DeviceIndex': '1'})
+    slots.put({'DeviceIndex': '0'})
+    with mock.patch.object(relax_pool, '_WORKER_RELAXER', None):
+      relax_pool._init_worker(_FakeRelaxer(use_gpu=True), slots)
+      self.assertEqual(relax_pool._WORKER_RELAXER.platform_properties,
+                       {'DeviceIndex': '1'})
+      self.assertEqual(relax_pool._relax_in_worker('prot')[0], 'relaxed prot')
+    self.assertEqual(slots.get_nowait(), {'DeviceIndex': '0'})
+
+
+class RelaxPoolTest(absltest.TestCase):
+
+  def test_without_workers_relaxes_in_submit(self):
+    relaxer = _FakeRelaxer()
+    pool = relax_pool.RelaxPool(relaxer, num_workers=0)
+    future = pool.submit('prot 1')
+
+    self.assertTrue(future.done())
+    self.assertEqual(relaxer.processed, ['prot 1'])
+    relaxed_pdb, debug_data, violations, relax_time = future.result()
+    self.assertEqual(relaxed_pdb, 'relaxed prot 1')
+    self.assertEqual(debug_data, {'attempts': 1})
+    self.assertEqual(violations, [0.])
+    self.assertGreaterEqual(relax_time, 0.)
+    pool.submit('prot 2')
+    self.assertEqual(relaxer.processed, ['prot 1', 'prot 2'])
+    pool.shutdown()
+
+  def test_workers_get_their_platform_properties(self):
+    relaxer = _FakeRelaxer(use_gpu=True)
+    with mock.patch.object(relax_pool.concurrent.futures,
+                           'ProcessPoolExecutor') as executor_cls:
+      pool = relax_pool.RelaxPool(relaxer, num_workers=3,
+                                  gpu_devices=['0', '1'])
+      pool.submit('prot')
+      pool.shutdown()
+
+    kwargs = executor_cls.call_args.kwargs
+    self.assertEqual(kwargs['max_workers'], 3)
+    initializer_relaxer, slots = kwargs['initargs']
+    self.assertIs(initializer_relaxer, relaxer)
+    self.assertEqual([slots.get(timeout=10) for _ in range(3)],
+                     [{'DeviceIndex': '0'}, {'DeviceIndex': '1'},
+                      {'DeviceIndex': '0'}])
+    executor_cls.return_value.submit.assert_called_once_with(
+        relax_pool._relax_in_worker, 'prot')
+    executor_cls.return_value.shutdown.assert_called_once()
+
+
+if __name__ == '__main__':
+  absltest.main()
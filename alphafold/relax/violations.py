@@ -0,0 +1,440 @@
+# Copyright 2021 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Structural violation checks in NumPy.
+
+NumPy counterparts of folding.find_structural_violations and
+folding.compute_violation_metrics, used between the iterations of the Amber
+relaxation. The between residue clashes are found by hashing the atoms into a
+grid of cells as large as the longest clash distance, so only the atoms of
+neighbouring cells are compared instead of all the pairs of atoms.
+"""
+
+import functools
+import itertools
+from typing import Dict, Tuple
+
+from alphafold.common import residue_constants
+import numpy as np
+
+_CYS_SG_INDEX = residue_constants.restype_name_to_atom14_names['CYS'].index(
+    'SG')
+
+
+def _relu(x: np.ndarray) -> np.ndarray:
+  return np.maximum(x, 0.)
+
+
+def _norm(x: np.ndarray, eps: float) -> np.ndarray:
+  return np.sqrt(eps + np.sum(np.square(x), axis=-1))
+
+
+def extreme_ca_ca_distance_violations(
+    pred_atom_positions: np.ndarray,  # (N, 37(14), 3)
+    pred_atom_mask: np.ndarray,  # (N, 37(14))
+    residue_index: np.ndarray,  # (N)
+    max_angstrom_tolerance=1.5
+    ) -> np.ndarray:
+  """Fraction of consecutive CA-CA pairs too far apart, see all_atom.py."""
+  this_ca_pos = pred_atom_positions[:-1, 1, :]
+  this_ca_mask = pred_atom_mask[:-1, 1]
+  next_ca_pos = pred_atom_positions[1:, 1, :]
+  next_ca_mask = pred_atom_mask[1:, 1]
+  has_no_gap_mask = (residue_index[1:] - residue_index[:-1]) == 1
+  ca_ca_distance = _norm(this_ca_pos - next_ca_pos, 1e-6)
+  violations = (ca_ca_distance -
+                residue_constants.ca_ca) > max_angstrom_tolerance
+  mask = this_ca_mask * next_ca_mask * has_no_gap_mask
+  return np.sum(mask * violations) / (np.sum(mask) + 1e-10)
+
+
+def between_residue_bond_loss(
+    pred_atom_positions: np.ndarray,  # (N, 37(14), 3)
+    pred_atom_mask: np.ndarray,  # (N, 37(14))
+    residue_index: np.ndarray,  # (N)
+    aatype: np.ndarray,  # (N)
+    tolerance_factor_soft=12.0,
+    tolerance_factor_hard=12.0
+) -> Dict[str, np.ndarray]:
+  """Violations of the peptide bond geometry, see all_atom.py."""
+  this_ca_pos = pred_atom_positions[:-1, 1, :]
+  this_ca_mask = pred_atom_mask[:-1, 1]
+  this_c_pos = pred_atom_positions[:-1, 2, :]
+  this_c_mask = pred_atom_mask[:-1, 2]
+  next_n_pos = pred_atom_positions[1:, 0, :]
+  next_n_mask = pred_atom_mask[1:, 0]
+  next_ca_pos = pred_atom_positions[1:, 1, :]
+  next_ca_mask = pred_atom_mask[1:, 1]
+  has_no_gap_mask = (residue_index[1:] - residue_index[:-1]) == 1
+
+  # The C-N bond to proline has slightly different length because of the ring.
+  next_is_proline = aatype[1:] == residue_constants.resname_to_idx['PRO']
+  gt_length = np.where(next_is_proline,
+                       residue_constants.between_res_bond_length_c_n[1],
+                       residue_constants.between_res_bond_length_c_n[0])
+  gt_stddev = np.where(
+      next_is_proline,
+      residue_constants.between_res_bond_length_stddev_c_n[1],
+      residue_constants.between_res_bond_length_stddev_c_n[0])
+  c_n_bond_length = _norm(this_c_pos - next_n_pos, 1e-6)
+  c_n_bond_length_error = np.sqrt(1e-6 + np.square(c_n_bond_length - gt_length))
+  c_n_loss_per_residue = _relu(
+      c_n_bond_length_error - tolerance_factor_soft * gt_stddev)
+  mask = this_c_mask * next_n_mask * has_no_gap_mask
+  c_n_loss = np.sum(mask * c_n_loss_per_residue) / (np.sum(mask) + 1e-6)
+  c_n_violation_mask = mask * (
+      c_n_bond_length_error > (tolerance_factor_hard * gt_stddev))
+
+  ca_c_bond_length = _norm(this_ca_pos - this_c_pos, 1e-6)
+  n_ca_bond_length = _norm(next_n_pos - next_ca_pos, 1e-6)
+  c_ca_unit_vec = (this_ca_pos - this_c_pos) / ca_c_bond_length[:, None]
+  c_n_unit_vec = (next_n_pos - this_c_pos) / c_n_bond_length[:, None]
+  n_ca_unit_vec = (next_ca_pos - next_n_pos) / n_ca_bond_length[:, None]
+
+  ca_c_n_cos_angle = np.sum(c_ca_unit_vec * c_n_unit_vec, axis=-1)
+  gt_angle = residue_constants.between_res_cos_angles_ca_c_n[0]
+  gt_stddev = residue_constants.between_res_bond_length_stddev_c_n[0]
+  ca_c_n_cos_angle_error = np.sqrt(
+      1e-6 + np.square(ca_c_n_cos_angle - gt_angle))
+  ca_c_n_loss_per_residue = _relu(
+      ca_c_n_cos_angle_error - tolerance_factor_soft * gt_stddev)
+  mask = this_ca_mask * this_c_mask * next_n_mask * has_no_gap_mask
+  ca_c_n_loss = np.sum(mask * ca_c_n_loss_per_residue) / (np.sum(mask) + 1e-6)
+  ca_c_n_violation_mask = mask * (ca_c_n_cos_angle_error >
+                                  (tolerance_factor_hard * gt_stddev))
+
+  c_n_ca_cos_angle = np.sum((-c_n_unit_vec) * n_ca_unit_vec, axis=-1)
+  gt_angle = residue_constants.between_res_cos_angles_c_n_ca[0]
+  gt_stddev = residue_constants.between_res_cos_angles_c_n_ca[1]
+  c_n_ca_cos_angle_error = np.sqrt(
+      1e-6 + np.square(c_n_ca_cos_angle - gt_angle))
+  c_n_ca_loss_per_residue = _relu(
+      c_n_ca_cos_angle_error - tolerance_factor_soft * gt_stddev)
+  mask = this_c_mask * next_n_mask * next_ca_mask * has_no_gap_mask
+  c_n_ca_loss = np.sum(mask * c_n_ca_loss_per_residue) / (np.sum(mask) + 1e-6)
+  c_n_ca_violation_mask = mask * (
+      c_n_ca_cos_angle_error > (tolerance_factor_hard * gt_stddev))
+
+  # The loss and violations are shared by both neighbouring residues.
+  per_residue_loss_sum = (c_n_loss_per_residue +
+                          ca_c_n_loss_per_residue +
+                          c_n_ca_loss_per_residue)
+  per_residue_loss_sum = 0.5 * (np.pad(per_residue_loss_sum, [[0, 1]]) +
+                                np.pad(per_residue_loss_sum, [[1, 0]]))
+  violation_mask = np.max(np.stack([c_n_violation_mask,
+                                    ca_c_n_violation_mask,
+                                    c_n_ca_violation_mask]), axis=0)
+  violation_mask = np.maximum(np.pad(violation_mask, [[0, 1]]),
+                              np.pad(violation_mask, [[1, 0]]))
+
+  return {'c_n_loss_mean': c_n_loss,
+          'ca_c_n_loss_mean': ca_c_n_loss,
+          'c_n_ca_loss_mean': c_n_ca_loss,
+          'per_residue_loss_sum': per_residue_loss_sum,
+          'per_residue_violation_mask': violation_mask}
+
+
+def close_pairs(positions: np.ndarray,
+                cutoff: float) -> Tuple[np.ndarray, np.ndarray]:
+  """Finds the pairs of points closer than cutoff.
+
+  The points are hashed into cubic cells of side cutoff, so each point is only
+  compared with the points of its cell and of the 26 neighbouring cells.
+
+  Args:
+    positions: [num_points, 3] the positions of the points.
+    cutoff: The distance below which points are paired.
+
+  Returns:
+    The indices i and j of the pairs, with i < j.
+  """
+  if positions.shape[0] < 2 or cutoff <= 0:
+    return np.zeros(0, np.int64), np.zeros(0, np.int64)
+  cells = np.floor(positions / cutoff).astype(np.int64)
+  # A margin of one cell so the neighbours of all cells have valid keys.
+  cells -= cells.min(axis=0) - 1
+  dims = cells.max(axis=0) + 2
+  keys = (cells[:, 0] * dims[1] + cells[:, 1]) * dims[2] + cells[:, 2]
+  order = np.argsort(keys, kind='stable')
+  cell_keys, cell_starts, cell_sizes = np.unique(
+      keys[order], return_index=True, return_counts=True)
+
+  pairs_i, pairs_j = [], []
+  for dx, dy, dz in itertools.product((-1, 0, 1), repeat=3):
+    neighbour_keys = keys + (dx * dims[1] + dy) * dims[2] + dz
+    cell = np.minimum(np.searchsorted(cell_keys, neighbour_keys),
+                      len(cell_keys) - 1)
+    points = np.flatnonzero(cell_keys[cell] == neighbour_keys)
+    sizes = cell_sizes[cell[points]]
+    # Pair each point with every point of its neighbour cell.
+    offsets = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes,
+                                                 sizes)
+    i = np.repeat(points, sizes)
+    j = order[np.repeat(cell_starts[cell[points]], sizes) + offsets]
+    keep = i < j
+    i, j = i[keep], j[keep]
+    keep = np.sum(np.square(positions[i] - positions[j]), axis=-1) < cutoff**2
+    pairs_i.append(i[keep])
+    pairs_j.append(j[keep])
+  return np.concatenate(pairs_i), np.concatenate(pairs_j)
+
+
+def _num_ordered_pairs(residue_index: np.ndarray, counts: np.ndarray) -> float:
+  """Sum of counts[a] * counts[b] over residues a, b with index[a] < index[b]."""
+  values, inverse = np.unique(residue_index, return_inverse=True)
+  totals = np.bincount(inverse.reshape(-1), weights=counts,
+                       minlength=len(values))
+  greater = np.cumsum(totals[::-1])[::-1] - totals
+  return float(np.sum(totals * greater))
+
+
+def _num_clash_candidates(atom14_atom_exists: np.ndarray,
+                          residue_index: np.ndarray) -> float:
+  """Number of atom pairs checked for clashes by all_atom.py."""
+  exists = atom14_atom_exists > 0
+  num_pairs = _num_ordered_pairs(residue_index, exists.sum(axis=-1))
+  # Disulfide bridges (the SG slot in any residue) are not clashes.
+  num_pairs -= _num_ordered_pairs(residue_index, exists[:, _CYS_SG_INDEX])
+  # Neither are backbone C--N bonds between subsequent residues.
+  n_values, n_counts = np.unique(residue_index[exists[:, 0]],
+                                 return_counts=True)
+  next_index = residue_index[exists[:, 2]] + 1
+  found = np.minimum(np.searchsorted(n_values, next_index),
+                     max(len(n_values) - 1, 0))
+  if len(n_values):
+    num_pairs -= float(np.sum(np.where(n_values[found] == next_index,
+                                       n_counts[found], 0)))
+  return num_pairs
+
+
+def between_residue_clash_loss(
+    atom14_pred_positions: np.ndarray,  # (N, 14, 3)
+    atom14_atom_exists: np.ndarray,  # (N, 14)
+    atom14_atom_radius: np.ndarray,  # (N, 14)
+    residue_index: np.ndarray,  # (N)
+    overlap_tolerance_soft=1.5,
+    overlap_tolerance_hard=1.5
+) -> Dict[str, np.ndarray]:
+  """Steric clashes between residues, see all_atom.py.
+
+  Only the pairs of atoms closer than the largest clash distance are compared,
+  which are found with close_pairs.
+
+  Args:
+    atom14_pred_positions: Predicted positions of atoms in
+      global prediction frame
+    atom14_atom_exists: Mask denoting whether atom at positions exists for given
+      amino acid type
+    atom14_atom_radius: Van der Waals radius for each atom.
+    residue_index: Residue index for given amino acid.
+    overlap_tolerance_soft: Soft tolerance factor.
+    overlap_tolerance_hard: Hard tolerance factor.
+
+  Returns:
+    Dict containing:
+      * 'mean_loss': average clash loss
+      * 'per_atom_loss_sum': sum of all clash losses per atom, shape (N, 14)
+      * 'per_atom_clash_mask': mask whether atom clashes with any other atom
+          shape (N, 14)
+  """
+  residues, atoms = np.nonzero(atom14_atom_exists)
+  positions = atom14_pred_positions[residues, atoms]
+  radius = atom14_atom_radius[residues, atoms]
+  per_atom_loss_sum = np.zeros(atom14_atom_exists.shape)
+  per_atom_clash_mask = np.zeros(atom14_atom_exists.shape)
+  if not len(radius):
+    return {'mean_loss': 0., 'per_atom_loss_sum': per_atom_loss_sum,
+            'per_atom_clash_mask': per_atom_clash_mask}
+
+  cutoff = 2 * radius.max() - min(overlap_tolerance_soft,
+                                  overlap_tolerance_hard)
+  i, j = close_pairs(positions, cutoff)
+  # Each pair is counted once, from the residue with the lower index.
+  swap = residue_index[residues[i]] > residue_index[residues[j]]
+  i, j = np.where(swap, j, i), np.where(swap, i, j)
+  this_index = residue_index[residues[i]]
+  other_index = residue_index[residues[j]]
+  c_n_bond = ((this_index + 1 == other_index) &
+              (atoms[i] == 2) & (atoms[j] == 0))
+  disulfide_bond = (atoms[i] == _CYS_SG_INDEX) & (atoms[j] == _CYS_SG_INDEX)
+  keep = (this_index < other_index) & ~c_n_bond & ~disulfide_bond
+  i, j = i[keep], j[keep]
+
+  dists = _norm(positions[i] - positions[j], 1e-10)
+  dists_lower_bound = radius[i] + radius[j]
+  dists_to_low_error = _relu(dists_lower_bound - overlap_tolerance_soft - dists)
+  clash = dists < (dists_lower_bound - overlap_tolerance_hard)
+
+  mean_loss = np.sum(dists_to_low_error) / (
+      1e-6 + _num_clash_candidates(atom14_atom_exists, residue_index))
+  for pair_atoms in (i, j):
+    np.add.at(per_atom_loss_sum, (residues[pair_atoms], atoms[pair_atoms]),
+              dists_to_low_error)
+    per_atom_clash_mask[residues[pair_atoms[clash]],
+                        atoms[pair_atoms[clash]]] = 1.
+  return {'mean_loss': mean_loss,
+          'per_atom_loss_sum': per_atom_loss_sum,
+          'per_atom_clash_mask': per_atom_clash_mask}
+
+
+def within_residue_violations(
+    atom14_pred_positions: np.ndarray,  # (N, 14, 3)
+    atom14_atom_exists: np.ndarray,  # (N, 14)
+    atom14_dists_lower_bound: np.ndarray,  # (N, 14, 14)
+    atom14_dists_upper_bound: np.ndarray,  # (N, 14, 14)
+) -> Dict[str, np.ndarray]:
+  """Steric violations within residues, see all_atom.py."""
+  dists_masks = (1. - np.eye(14, 14)[None])
+  dists_masks = dists_masks * (atom14_atom_exists[:, :, None] *
+                               atom14_atom_exists[:, None, :])
+  dists = _norm(atom14_pred_positions[:, :, None, :] -
+                atom14_pred_positions[:, None, :, :], 1e-10)
+
+  dists_to_low_error = _relu(atom14_dists_lower_bound - dists)
+  dists_to_high_error = _relu(dists - atom14_dists_upper_bound)
+  loss = dists_masks * (dists_to_low_error + dists_to_high_error)
+  per_atom_loss_sum = np.sum(loss, axis=1) + np.sum(loss, axis=2)
+
+  violations = dists_masks * ((dists < atom14_dists_lower_bound) |
+                              (dists > atom14_dists_upper_bound))
+  per_atom_violations = np.maximum(np.max(violations, axis=1),
+                                   np.max(violations, axis=2))
+  return {'per_atom_loss_sum': per_atom_loss_sum,
+          'per_atom_violations': per_atom_violations}
+
+
+@functools.lru_cache(maxsize=None)
+def _atom14_dists_bounds(
+    clash_overlap_tolerance: float,
+    violation_tolerance_factor: float) -> Dict[str, np.ndarray]:
+  return residue_constants.make_atom14_dists_bounds(
+      overlap_tolerance=clash_overlap_tolerance,
+      bond_length_tolerance_factor=violation_tolerance_factor)
+
+
+def find_structural_violations(
+    batch: Dict[str, np.ndarray],
+    atom14_pred_positions: np.ndarray,  # (N, 14, 3)
+    violation_tolerance_factor: float = 12.,
+    clash_overlap_tolerance: float = 1.5):
+  """Computes several checks for structural violations.
+
+  Args:
+    batch: The atom14 features of the structure, see
+      amber_minimize.make_atom14_positions.
+    atom14_pred_positions: The atom14 positions to check.
+    violation_tolerance_factor: Tolerance of the bond lengths and angles, in
+      standard deviations of their PDB distributions.
+    clash_overlap_tolerance: Tolerated overlap of the van der Waals radii of
+      two atoms, in Angstroms.
+
+  Returns:
+    The violations, as returned by folding.find_structural_violations.
+  """
+  connection_violations = between_residue_bond_loss(
+      pred_atom_positions=atom14_pred_positions,
+      pred_atom_mask=batch['atom14_atom_exists'].astype(np.float32),
+      residue_index=batch['residue_index'].astype(np.float32),
+      aatype=batch['aatype'],
+      tolerance_factor_soft=violation_tolerance_factor,
+      tolerance_factor_hard=violation_tolerance_factor)
+
+  # The first letter of the atom name is the element type.
+  atomtype_radius = np.array([
+      residue_constants.van_der_waals_radius[name[0]]
+      for name in residue_constants.atom_types
+  ])
+  atom14_atom_radius = batch['atom14_atom_exists'] * atomtype_radius[
+      batch['residx_atom14_to_atom37']]
+  between_residue_clashes = between_residue_clash_loss(
+      atom14_pred_positions=atom14_pred_positions,
+      atom14_atom_exists=batch['atom14_atom_exists'],
+      atom14_atom_radius=atom14_atom_radius,
+      residue_index=batch['residue_index'],
+      overlap_tolerance_soft=clash_overlap_tolerance,
+      overlap_tolerance_hard=clash_overlap_tolerance)
+
+  restype_atom14_bounds = _atom14_dists_bounds(clash_overlap_tolerance,
+                                               violation_tolerance_factor)
+  within_residue = within_residue_violations(
+      atom14_pred_positions=atom14_pred_positions,
+      atom14_atom_exists=batch['atom14_atom_exists'],
+      atom14_dists_lower_bound=restype_atom14_bounds['lower_bound'][
+          batch['aatype']],
+      atom14_dists_upper_bound=restype_atom14_bounds['upper_bound'][
+          batch['aatype']])
+
+  per_residue_violations_mask = np.max(np.stack([
+      connection_violations['per_residue_violation_mask'],
+      np.max(between_residue_clashes['per_atom_clash_mask'], axis=-1),
+      np.max(within_residue['per_atom_violations'], axis=-1)]), axis=0)
+
+  return {
+      'between_residues': {
+          'bonds_c_n_loss_mean':
+              connection_violations['c_n_loss_mean'],
+          'angles_ca_c_n_loss_mean':
+              connection_violations['ca_c_n_loss_mean'],
+          'angles_c_n_ca_loss_mean':
+              connection_violations['c_n_ca_loss_mean'],
+          'connections_per_residue_loss_sum':
+              connection_violations['per_residue_loss_sum'],
+          'connections_per_residue_violation_mask':
+              connection_violations['per_residue_violation_mask'],
+          'clashes_mean_loss':
+              between_residue_clashes['mean_loss'],
+          'clashes_per_atom_loss_sum':
+              between_residue_clashes['per_atom_loss_sum'],
+          'clashes_per_atom_clash_mask':
+              between_residue_clashes['per_atom_clash_mask'],
+      },
+      'within_residues': {
+          'per_atom_loss_sum':
+              within_residue['per_atom_loss_sum'],
+          'per_atom_violations':
+              within_residue['per_atom_violations'],
+      },
+      'total_per_residue_violations_mask':
+          per_residue_violations_mask,
+  }
+
+
+def compute_violation_metrics(
+    batch: Dict[str, np.ndarray],
+    atom14_pred_positions: np.ndarray,  # (N, 14, 3)
+    violations: Dict[str, np.ndarray],
+    ) -> Dict[str, np.ndarray]:
+  """Computes the metrics of folding.compute_violation_metrics."""
+
+  def mask_mean(mask, value):
+    return np.sum(mask * value) / (np.sum(mask) + 1e-10)
+
+  ret = {}
+  ret['violations_extreme_ca_ca_distance'] = extreme_ca_ca_distance_violations(
+      pred_atom_positions=atom14_pred_positions,
+      pred_atom_mask=batch['atom14_atom_exists'].astype(np.float32),
+      residue_index=batch['residue_index'].astype(np.float32))
+  ret['violations_between_residue_bond'] = mask_mean(
+      batch['seq_mask'],
+      violations['between_residues']['connections_per_residue_violation_mask'])
+  ret['violations_between_residue_clash'] = mask_mean(
+      batch['seq_mask'],
+      np.max(violations['between_residues']['clashes_per_atom_clash_mask'],
+             axis=-1))
+  ret['violations_within_residue'] = mask_mean(
+      batch['seq_mask'],
+      np.max(violations['within_residues']['per_atom_violations'], axis=-1))
+  ret['violations_per_residue'] = mask_mean(
+      batch['seq_mask'], violations['total_per_residue_violations_mask'])
+  return ret
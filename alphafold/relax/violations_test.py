@@ -0,0 +1,89 @@
+# Copyright 2021 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for violations."""
+import os
+
+from absl.testing import absltest
+from absl.testing import parameterized
+from alphafold.common import protein
+from alphafold.common import residue_constants
+from alphafold.model import all_atom
+from alphafold.relax import amber_minimize
+from alphafold.relax import violations
+import numpy as np
+
+
+def _load_atom14_batch(data_path):
+  pdb_path = os.path.join(absltest.get_default_test_srcdir(), data_path)
+  with open(pdb_path, 'r') as f:
+    prot = protein.from_pdb_string(f.read())
+  return amber_minimize.make_atom14_positions({
+      'aatype': prot.aatype,
+      'all_atom_positions': prot.atom_positions.astype(np.float32),
+      'all_atom_mask': prot.atom_mask.astype(np.float32),
+      'residue_index': prot.residue_index,
+  })
+
+
+class ViolationsTest(parameterized.TestCase):
+
+  def test_close_pairs(self):
+    positions = np.random.default_rng(0).uniform(0., 20., size=(300, 3))
+    i, j = violations.close_pairs(positions, cutoff=2.5)
+
+    dists = np.linalg.norm(positions[:, None] - positions[None], axis=-1)
+    expected_i, expected_j = np.nonzero(np.triu(dists < 2.5, k=1))
+    self.assertCountEqual(zip(i.tolist(), j.tolist()),
+                          zip(expected_i.tolist(), expected_j.tolist()))
+
+  @parameterized.parameters(
+      dict(data_path='alphafold/relax/testdata/multiple_disulfides_target.pdb',
+           noise=0.),
+      dict(data_path='alphafold/relax/testdata/with_violations.pdb', noise=0.),
+      dict(data_path='alphafold/relax/testdata/with_violations.pdb', noise=0.8),
+  )
+  def test_between_residue_losses_match_jax(self, data_path, noise):
+    batch = _load_atom14_batch(data_path)
+    rng = np.random.default_rng(0)
+    positions = (batch['atom14_gt_positions'] + noise * rng.normal(
+        size=batch['atom14_gt_positions'].shape)).astype(np.float32)
+    exists = batch['atom14_atom_exists']
+    atomtype_radius = np.array([
+        residue_constants.van_der_waals_radius[name[0]]
+        for name in residue_constants.atom_types
+    ])
+    radius = exists * atomtype_radius[batch['residx_atom14_to_atom37']]
+
+    expected = all_atom.between_residue_clash_loss(
+        positions, exists, radius, batch['residue_index'])
+    clashes = violations.between_residue_clash_loss(
+        positions, exists, radius, batch['residue_index'])
+    for name, value in expected.items():
+      np.testing.assert_allclose(clashes[name], value, rtol=1e-4, atol=1e-5,
+                                 err_msg=name)
+
+    expected = all_atom.between_residue_bond_loss(
+        positions, exists.astype(np.float32),
+        batch['residue_index'].astype(np.float32), batch['aatype'])
+    bonds = violations.between_residue_bond_loss(
+        positions, exists.astype(np.float32),
+        batch['residue_index'].astype(np.float32), batch['aatype'])
+    for name, value in expected.items():
+      np.testing.assert_allclose(bonds[name], value, rtol=1e-4, atol=1e-5,
+                                 err_msg=name)
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -13,8 +13,12 @@
 # limitations under the License.
 
 """Full AlphaFold protein structure prediction script."""
+import collections
+import concurrent.futures
 import enum
+import functools
 import json
+import multiprocessing
 import os
 import pathlib
 import pickle
@@ -22,24 +26,31 @@ import random
 import shutil
 import sys
 import time
-from typing import Any, Dict, Union
+from typing import Any, Callable, Dict, Optional, Union
 
 from absl import app
 from absl import flags
 from absl import logging
 from alphafold.common import confidence
 from alphafold.common import protein
+from alphafold.common import results
 from alphafold.common import residue_constants
+from alphafold.data import database_stage
+from alphafold.data import msa_cache
 from alphafold.data import pipeline
 from alphafold.data import pipeline_multimer
+from alphafold.data import template_cache
+from alphafold.data import template_store
 from alphafold.data import templates
-from alphafold.data import parsers
+from alphafold.data.tools import cpu_budget
 from alphafold.data.tools import hhsearch
 from alphafold.data.tools import hmmsearch
 from alphafold.model import config
 from alphafold.model import data
+from alphafold.model import memory
 from alphafold.model import model
 from alphafold.relax import relax
+from alphafold.relax import relax_pool as relax_pool_lib
 import jax.numpy as jnp
 import numpy as np
 import gnuplotlib
@@ -143,16 +154,122 @@ flags.DEFINE_boolean('use_gpu_relax', None, 'Whether to relax on GPU. '
                      'Relax on GPU can be much faster than CPU, so it is '
                      'recommended to enable if possible. GPUs must be available'
                      ' if this setting is enabled.')
-flags.DEFINE_integer('n_parallel_msa', 3, 'Number of parallel runs of MSA tools.')
+flags.DEFINE_integer('relax_workers', 1, 'Number of worker processes relaxing '
+                     'models concurrently. With --models_to_relax=all each '
+                     'model is relaxed as soon as it is predicted, while the '
+                     'next models run. On CPU the cores are split between the '
+                     'workers. If 0, models are relaxed one after another in '
+                     'this process.', lower_bound=0)
+flags.DEFINE_list('relax_gpu_devices', [], 'CUDA device indices the GPU relax '
+                  'workers are spread over. Empty to use the default device.')
+flags.DEFINE_integer('n_parallel_msa', 3, 'Number of parallel runs of MSA '
+                     'tools. For multimers this is shared by the searches of '
+                     'all the chains, including the uniprot searches used '
+                     'for pairing.')
+flags.DEFINE_integer('msa_cpus', None, 'Number of CPUs shared by the MSA '
+                     'tools, in proportion to the size of their database. '
+                     'Detected from the CPU affinity and cgroup CPU quota of '
+                     'the process if not set.', lower_bound=1)
+flags.DEFINE_string('template_store_dir', None, 'Path to a template store '
+                    'built from --template_mmcif_dir by '
+                    'scripts/build_template_store.py. Templates found in it '
+                    'are read without parsing their mmCIF file.')
+flags.DEFINE_string('template_index_path', None, 'Path to the index of the '
+                    'template mmCIF files, release dates and obsolete PDBs, '
+                    'persisted between runs. Defaults to '
+                    'template_index.sqlite next to --template_mmcif_dir.')
+flags.DEFINE_integer('template_workers', 4, 'Number of processes reading '
+                     'and aligning template hits concurrently. If 0, the '
+                     'hits are processed sequentially.', lower_bound=0)
+flags.DEFINE_string('msa_cache_dir', None, 'Path to a directory used as a '
+                    'persistent cache of MSA tool outputs shared between jobs. '
+                    'Outputs are keyed by query sequence, database version and '
+                    'tool settings and are hard-linked into the msas '
+                    'directory of each job.')
+flags.DEFINE_float('msa_cache_max_size_gb', None, 'If set, least recently used '
+                   'entries of the MSA cache are evicted above this size.')
+flags.DEFINE_string('template_cache_dir', None, 'Path to a directory used as '
+                    'a persistent cache of template features shared between '
+                    'jobs, keyed by query sequence, template hit alignment '
+                    'and max template date.')
+flags.DEFINE_float('template_cache_max_size_gb', None, 'If set, least recently '
+                   'used entries of the template cache are evicted above this '
+                   'size.')
+flags.DEFINE_string('database_stage_dir', None, 'Path to a directory on fast '
+                    'local storage (e.g. NVMe or a ramdisk) where the '
+                    'databases listed by --staged_databases are copied when '
+                    'first searched, and read from by later searches and jobs '
+                    'on the same node.')
+flags.DEFINE_float('database_stage_max_size_gb', None, 'If set, least '
+                   'recently used database copies are evicted above this '
+                   'size, and larger databases are not staged.')
+flags.DEFINE_list('staged_databases',
+                  ['uniref90', 'mgnify', 'small_bfd', 'uniprot', 'pdb_seqres',
+                   'pdb70'],
+                  'Databases copied to --database_stage_dir, named as the '
+                  '<name>_database_path flags.')
 flags.DEFINE_integer('save_recycled', 2, '0 - no recycle info saving, 1 - print '
                    'metrics of intermediate recycles, 2 - additionally saving pdb structures '
                    'of all recycles, 3 - additionally save all results in pickle '
                     'dictionaries of each recycling iteration.', lower_bound=0, upper_bound=3)
 flags.DEFINE_string('checkpoint_tag', 'checkpoint', 'Enable checkpoint and use the tag to name '
                     'files to restart the recycle modeling later.')
+flags.DEFINE_integer('recycle_checkpoint_interval', 5, 'Number of recycles '
+                     'between two recycle checkpoints when --checkpoint_tag is '
+                     'set. An interrupted prediction resumes from the last '
+                     'checkpoint instead of recycle 0, if it is run with the '
+                     'same features and --random_seed.', lower_bound=1)
 flags.DEFINE_integer('stopat', 6, 'which model to use and when to stop. Allows parallel inference with the 5 models. 0=MSA-only, 1=model_1_multimer_v3, 2=model_2, 3=model_3, 4=model_4, 5=model_5, 6=all models and final part (ranking, etc), 7=only final part (ranking, etc)')
-flags.DEFINE_boolean('adapt_subbatch', True, 'Whether to choose a better subbatch_size '
-                     ' than the 4 by default.')
+flags.DEFINE_integer('max_concurrent_models', 0, 'Maximum number of models '
+                     'run at the same time on the device. All models are run '
+                     'in this process and models sharing a config share their '
+                     'compiled program. If 0, the number is derived from an '
+                     'estimate of the peak memory of a prediction and the '
+                     'device memory (see XLA_PYTHON_CLIENT_MEM_FRACTION).',
+                     lower_bound=0)
+flags.DEFINE_list('num_res_buckets', ['128', '192', '256', '320', '384', '448',
+                                       '512', '640', '768', '896', '1024',
+                                       '1280', '1536', '1792', '2048', '2560',
+                                       '3072', '3584', '4096', '5120'],
+                  'Multimer inputs are padded to the smallest of these '
+                  'numbers of residues that fits them, so that inputs of '
+                  'similar length reuse the same compiled model. Empty to '
+                  'disable padding.')
+flags.DEFINE_list('msa_depth_buckets', ['512', '1024', '2048', '4096', '8192'],
+                  'Multimer MSAs are padded to the smallest of these depths '
+                  'that fits them. Empty to disable padding.')
+flags.DEFINE_string('compilation_cache_dir', None, 'Path to a directory '
+                    'storing the compiled models across runs, so that inputs '
+                    'falling in an already compiled shape bucket skip the '
+                    'compilation.')
+flags.DEFINE_boolean('adapt_subbatch', True, 'Whether to choose for each input '
+                     'the largest subbatch_size whose estimated peak memory '
+                     'fits in the device memory, instead of the 4 by default.')
+flags.DEFINE_boolean('calibrate_subbatch', False, 'Whether to calibrate the '
+                     'memory estimate used by --adapt_subbatch by compiling '
+                     'the model once for each input and reading the memory '
+                     'reported by XLA. This adds one compilation per input.')
+flags.DEFINE_integer('output_workers', 2, 'Number of worker processes writing '
+                     'the outputs of the models (PAE plots, mmCIF files) '
+                     'while the next models run. If 0, the outputs are '
+                     'written before the next model is collected.',
+                     lower_bound=0)
+flags.DEFINE_enum('result_format', 'npz', ['npz', 'pkl'], 'Format of the '
+                  'result_<model>.* files. npz stores one array per member '
+                  'and can be read lazily with '
+                  'alphafold.common.results.load_result, pkl is the full '
+                  'pickled prediction result.')
+flags.DEFINE_enum('result_profile', 'confidence', list(results.PROFILES),
+                  'Outputs stored in the npz result files. minimal: '
+                  'structure and per-residue and global confidences, '
+                  'confidence: adds the predicted aligned error matrix, '
+                  'full: every output including logits and representations.')
+flags.DEFINE_boolean('result_float16', False, 'Whether to store the arrays '
+                     'of the npz result files in float16, except the '
+                     'structure.')
+flags.DEFINE_boolean('result_compress', True, 'Whether to compress the npz '
+                     'result files. Uncompressed arrays are memory-mapped '
+                     'when loaded.')
 flags.DEFINE_integer('max_n_recycles', 20, 'Maximum number of recycles')
 flags.DEFINE_float('recycle_early_stop_tolerance', 0.5, 'RMSD threshold for early recycle stop')
 
@@ -243,6 +360,329 @@ def _save_pae_json_file(
     f.write(pae_json)
 
 
+def _save_recycled_pdb(
+    feature_dict: Dict[str, Any],
+    recycle_out_dir: str,
+    model_name: str,
+    multimer_mode: bool,
+    rec_idx: int,
+    rec_dict: Dict[str, Any],
+) -> None:
+  """Writes the structure of an intermediate recycle, see RunModel.predict."""
+  # Set the b-factors to the per-residue plddt
+  final_atom_mask = rec_dict['structure_module']['final_atom_mask']
+  b_factors = rec_dict['plddt'][:, None] * final_atom_mask
+  unrelaxed_protein = protein.from_prediction(
+      feature_dict,
+      rec_dict,
+      b_factors=b_factors,
+      remove_leading_feature_dimension=not multimer_mode)
+  unrelaxed_recycle_pdb_path = os.path.join(
+      recycle_out_dir, f'{model_name}_recycled_{rec_idx:02d}.pdb')
+  with open(unrelaxed_recycle_pdb_path, 'w') as f:
+    f.write(protein.to_pdb(unrelaxed_protein))
+
+
+def _save_pae_png_file(
+    pae: np.ndarray, max_pae: float, output_dir: str, model_name: str
+) -> None:
+  """Plots the PAE matrix of a model to a PNG file."""
+  pae_output_path = os.path.join(output_dir, f'unrelaxed_{model_name}_pae.png')
+  figPAE = plt.figure()
+  figPAE.set_facecolor('white')
+  plt.imshow(pae, vmin=0., vmax=max_pae)
+  plt.colorbar(fraction=0.46, pad=0.04)
+  plt.title('Predicted Aligned Error')
+  plt.xlabel('Scored residue')
+  plt.ylabel('Aligned residue')
+  plt.savefig(pae_output_path, dpi=300, bbox_inches='tight')
+  plt.close(figPAE)
+
+
+def _result_path(output_dir: str, model_name: str) -> str:
+  return os.path.join(
+      output_dir, f'result_{model_name}.{FLAGS.result_format}')
+
+
+def _has_result(output_dir: str, model_name: str) -> bool:
+  """Returns whether a result file of the model exists, in any format."""
+  return any(
+      os.path.exists(os.path.join(output_dir, f'result_{model_name}.{ext}'))
+      for ext in ('npz', 'pkl'))
+
+
+def _save_result_file(
+    np_prediction_result: Dict[str, Any], result_output_path: str
+) -> None:
+  """Writes the prediction result in the format of --result_format."""
+  if FLAGS.result_format == 'pkl':
+    with open(result_output_path, 'wb') as f:
+      pickle.dump(np_prediction_result, f, protocol=4)
+  else:
+    results.write_result(
+        result_output_path,
+        np_prediction_result,
+        profile=FLAGS.result_profile,
+        float16=FLAGS.result_float16,
+        compress=FLAGS.result_compress)
+
+
+def _save_model_outputs(
+    np_prediction_result: Dict[str, Any],
+    ranking_confidence: float,
+    unrelaxed_protein: protein.Protein,
+    output_dir: str,
+    model_name: str,
+    checkpoint_file: Optional[str],
+) -> str:
+  """Writes the json, PDB, result and checkpoint files of a model.
+
+  The result file is written last, a model with a result file is skipped
+  when the prediction is restarted.
+
+  Args:
+    np_prediction_result: The prediction result with numpy arrays.
+    ranking_confidence: The ranking confidence of the model.
+    unrelaxed_protein: The unrelaxed structure of the model.
+    output_dir: The output directory of the target.
+    model_name: The name of the prediction.
+    checkpoint_file: The recycle checkpoint of the model, removed once the
+      result is written.
+
+  Returns:
+    The unrelaxed structure in PDB format.
+  """
+  _save_confidence_json_file(
+      np_prediction_result['plddt'], output_dir, model_name)
+  if (
+      'predicted_aligned_error' in np_prediction_result
+      and 'max_predicted_aligned_error' in np_prediction_result
+  ):
+    _save_pae_json_file(
+        np_prediction_result['predicted_aligned_error'],
+        float(np_prediction_result['max_predicted_aligned_error']),
+        output_dir, model_name)
+
+  unrelaxed_pdb = protein.to_pdb(unrelaxed_protein)
+  unrelaxed_pdb_path = os.path.join(output_dir, f'unrelaxed_{model_name}.pdb')
+  with open(unrelaxed_pdb_path, 'w') as f:
+    f.write(unrelaxed_pdb)
+  # save checkpoints
+  unrelaxed_proteins_checkpoint_path = os.path.join(
+      output_dir, f'unrelaxed_proteins_{model_name}_checkpoint.pkl')
+  ranking_confidences_checkpoint_path = os.path.join(
+      output_dir, f'ranking_confidences_{model_name}_checkpoint.pkl')
+  with open(unrelaxed_proteins_checkpoint_path, 'wb') as f:
+    pickle.dump(unrelaxed_protein, f, protocol=4)
+  with open(ranking_confidences_checkpoint_path, 'wb') as f:
+    pickle.dump(ranking_confidence, f, protocol=4)
+
+  # Save the model outputs.
+  _save_result_file(
+      np_prediction_result, _result_path(output_dir, model_name))
+  # The recycle checkpoint is superseded by the result file.
+  if checkpoint_file and os.path.exists(checkpoint_file):
+    os.remove(checkpoint_file)
+  return unrelaxed_pdb
+
+
+class _OutputStage:
+  """Writes the outputs of the models in the background of the inference.
+
+  Plotting and mmCIF formatting hold the GIL and run in worker processes,
+  file writes run in a thread. At most max_pending jobs are in flight, submit
+  waits for the oldest one beyond that so that results waiting to be written
+  do not pile up in host memory.
+  """
+
+  def __init__(self, num_workers: int, max_pending: Optional[int] = None):
+    """Initializes the output stage.
+
+    Args:
+      num_workers: The number of worker processes. If 0, the jobs are run
+        synchronously in submit.
+      max_pending: The maximum number of jobs in flight, 4 per worker by
+        default.
+    """
+    self._processes = None
+    self._threads = None
+    if num_workers:
+      self._processes = concurrent.futures.ProcessPoolExecutor(
+          max_workers=num_workers,
+          mp_context=multiprocessing.get_context('spawn'))
+      self._threads = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    self._max_pending = max_pending or 4 * max(num_workers, 1)
+    self._pending = collections.deque()
+
+  def submit(self, fn: Callable[..., Any], *args, in_process: bool = False,
+             **kwargs) -> concurrent.futures.Future:
+    """Schedules fn(*args, **kwargs), in a worker process if in_process."""
+    if self._threads is None:
+      future = concurrent.futures.Future()
+      future.set_result(fn(*args, **kwargs))
+      return future
+    while len(self._pending) >= self._max_pending:
+      self._pending.popleft().result()
+    executor = self._processes if in_process else self._threads
+    future = executor.submit(fn, *args, **kwargs)
+    self._pending.append(future)
+    return future
+
+  def join(self) -> None:
+    """Waits for all the submitted jobs, raising the first error."""
+    while self._pending:
+      self._pending.popleft().result()
+
+  def shutdown(self) -> None:
+    self.join()
+    if self._threads is not None:
+      self._threads.shutdown()
+      self._processes.shutdown()
+
+
+def _run_model(
+    model_name: str,
+    model_runner: model.RunModel,
+    feature_dict: Dict[str, Any],
+    output_dir: str,
+    fasta_name: str,
+    model_random_seed: int,
+    benchmark: bool,
+) -> Dict[str, Any]:
+  """Runs the inference of one model, resuming from its recycle checkpoint.
+
+  This is called from the model scheduler threads of predict_structure and
+  must not write any output besides the recycle checkpoint and the
+  intermediate recycles.
+
+  Args:
+    model_name: The name of the prediction, e.g. model_1_multimer_v3_pred_0.
+    model_runner: The RunModel of the prediction.
+    feature_dict: The features output by the data pipeline.
+    output_dir: The output directory of the target.
+    fasta_name: The name of the target, used for logging.
+    model_random_seed: The random seed of the prediction.
+    benchmark: Whether to run the prediction a second time for timing.
+
+  Returns:
+    A dict with the processed features, the prediction result, the recycling
+    info returned by RunModel.predict, the checkpoint file and the timings.
+    With --save_recycled > 1 the intermediate recycles are written to the
+    recycled directory while the model runs.
+  """
+  logging.info('Running model %s on %s', model_name, fasta_name)
+  timings = {}
+  checkpoint_file = None
+  if FLAGS.checkpoint_tag:
+    checkpoint_dir = os.path.join(output_dir, 'checkpoint')
+    checkpoint_file = os.path.join(
+        checkpoint_dir, model_name + '_' + FLAGS.checkpoint_tag + '.pkl')
+  t_0 = time.time()
+  processed_feature_dict = model_runner.process_features(
+      feature_dict, random_seed=model_random_seed)
+  timings[f'process_features_{model_name}'] = time.time() - t_0
+
+  # Resume the recycling loop if a previous run was interrupted.
+  prev_ckpt = None
+  if checkpoint_file:
+    prev_ckpt = model_runner.load_checkpoint(
+        processed_feature_dict, checkpoint_file, model_name,
+        model_random_seed)
+
+  # Intermediate recycles are written as they are computed.
+  recycle_output_fn = None
+  if FLAGS.save_recycled > 1:
+    recycle_out_dir = os.path.join(output_dir, 'recycled')
+    os.makedirs(recycle_out_dir, exist_ok=True)
+    recycle_output_fn = functools.partial(
+        _save_recycled_pdb, feature_dict, recycle_out_dir, model_name,
+        model_runner.multimer_mode)
+
+  t_0 = time.time()
+  prediction_result, recycles = model_runner.predict(
+      processed_feature_dict, random_seed=model_random_seed,
+      checkpoint=prev_ckpt, checkpoint_file=checkpoint_file,
+      recycle_output_fn=recycle_output_fn, model_name=model_name)
+  t_diff = time.time() - t_0
+  timings[f'predict_and_compile_{model_name}'] = t_diff
+  logging.info(
+      'Total JAX model %s on %s predict time (includes compilation time, see --benchmark): %.1fs',
+      model_name, fasta_name, t_diff)
+
+  if benchmark:
+    t_0 = time.time()
+    model_runner.predict(processed_feature_dict,
+                         random_seed=model_random_seed)
+    t_diff = time.time() - t_0
+    timings[f'predict_benchmark_{model_name}'] = t_diff
+    logging.info(
+        'Total JAX model %s on %s predict time (excludes compilation time): %.1fs',
+        model_name, fasta_name, t_diff)
+    # The compilation is shared by all the inputs of the same bucket shape.
+    bucket = 'x'.join(
+        str(d) for d in model_runner.bucket_shape(processed_feature_dict))
+    compile_time = max(
+        0., timings[f'predict_and_compile_{model_name}'] - t_diff)
+    timings[f'compile_bucket_{bucket}_{model_name}'] = compile_time
+    timings[f'run_bucket_{bucket}_{model_name}'] = t_diff
+    logging.info('Model %s bucket %s (num_res x msa depth x templates): '
+                 'compile %.1fs, run %.1fs', model_name, bucket, compile_time,
+                 t_diff)
+
+  return {
+      'processed_feature_dict': processed_feature_dict,
+      'prediction_result': prediction_result,
+      'recycles': recycles,
+      'checkpoint_file': checkpoint_file,
+      'timings': timings,
+  }
+
+
+def _adapt_subbatch_size(
+    model_runners: Dict[str, model.RunModel],
+    feature_dict: Dict[str, Any],
+    num_concurrent: int,
+) -> Dict[str, model.RunModel]:
+  """Picks the largest subbatch_size fitting in device memory for an input.
+
+  Args:
+    model_runners: The RunModels by prediction name.
+    feature_dict: The features output by the data pipeline for the input.
+    num_concurrent: The number of predictions run at the same time, which
+      share the device memory.
+
+  Returns:
+    The RunModels with the selected subbatch_size, by prediction name.
+  """
+  calibration = None
+  adapted = {}
+  adapted_runners = {}
+  for model_name, model_runner in model_runners.items():
+    # Predictions of the same model share their RunModel.
+    if id(model_runner) not in adapted:
+      num_res = model_runner.bucket_shape(feature_dict)[0]
+      if FLAGS.calibrate_subbatch and calibration is None:
+        probe_runner = model_runner.with_subbatch_size(
+            memory.select_subbatch_size(
+                model_runner.config, num_res, model_runner.params,
+                num_concurrent=num_concurrent))
+        measured = probe_runner.probe_peak_memory(
+            probe_runner.process_features(feature_dict, random_seed=0))
+        calibration = 1.
+        if measured is not None:
+          calibration = memory.calibration_from_probe(
+              probe_runner.config, num_res, measured, probe_runner.params)
+        logging.info('Calibrated the memory estimate by %.2f', calibration)
+      subbatch_size = memory.select_subbatch_size(
+          model_runner.config, num_res, model_runner.params,
+          calibration=calibration or 1., num_concurrent=num_concurrent)
+      logging.info('Using subbatch_size %d for %s', subbatch_size, model_name)
+      adapted[id(model_runner)] = model_runner.with_subbatch_size(
+          subbatch_size)
+    adapted_runners[model_name] = adapted[id(model_runner)]
+  return adapted_runners
+
+
 def predict_structure(
     fasta_path: str,
     fasta_name: str,
@@ -254,8 +694,14 @@ def predict_structure(
     random_seed: int,
     models_to_relax: ModelsToRelax,
     model_type: str,
+    output_stage: Optional[_OutputStage] = None,
+    relax_pool: Optional[relax_pool_lib.RelaxPool] = None,
 ):
   """Predicts structure using AlphaFold for the given sequence."""
+  if output_stage is None:
+    output_stage = _OutputStage(num_workers=0)
+  if relax_pool is None:
+    relax_pool = relax_pool_lib.RelaxPool(amber_relaxer)
   logging.info('Predicting %s', fasta_name)
   timings = {}
   output_dir = os.path.join(output_dir_base, fasta_name)
@@ -311,138 +757,105 @@ def predict_structure(
   relaxed_pdbs = {}
   relax_metrics = {}
   ranking_confidences = {}
+  unrelaxed_pdb_futures = {}
+  relax_futures = {}
+  # All the models are relaxed, there is no need to wait for the ranking.
+  relax_on_prediction = (
+      models_to_relax == ModelsToRelax.ALL and FLAGS.stopat >= 6)
   prediction_result = None
   # Run the models.
   num_models = len(model_runners)
+  model_random_seeds = {
+      model_name: model_index + random_seed * num_models
+      for model_index, model_name in enumerate(model_runners)}
+  pending_models = [
+      model_name for model_name in model_runners
+      if FLAGS.stopat != 7 and not _has_result(output_dir, model_name)]
+  model_futures = {}
+  if pending_models:
+    max_workers = FLAGS.max_concurrent_models
+    if not max_workers:
+      # Models 4 and 5 use a deeper extra MSA, plan for the largest model.
+      # Concurrency is planned with the default subbatch_size, the adapted
+      # subbatch_size then fits in the memory left to each prediction.
+      max_workers = min(
+          memory.max_concurrent_predictions(
+              model_runners[model_name].config,
+              model_runners[model_name].bucket_shape(feature_dict)[0],
+              model_runners[model_name].params)
+          for model_name in pending_models)
+    if benchmark:
+      # Concurrent predictions would distort the timings.
+      max_workers = 1
+    max_workers = min(max_workers, len(pending_models))
+    if FLAGS.adapt_subbatch:
+      model_runners = _adapt_subbatch_size(model_runners, feature_dict,
+                                           max_workers)
+    logging.info('Running %d models with %d concurrent predictions',
+                 len(pending_models), max_workers)
+    model_executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=max_workers)
+    for model_name in pending_models:
+      model_futures[model_name] = model_executor.submit(
+          _run_model, model_name, model_runners[model_name], feature_dict,
+          output_dir, fasta_name, model_random_seeds[model_name], benchmark)
+    model_executor.shutdown(wait=False)
+
   for model_index, (model_name, model_runner) in enumerate(model_runners.items()):
     unrelaxed_pdb_path = os.path.join(output_dir, f'unrelaxed_{model_name}.pdb')
     unrelaxed_proteins_checkpoint_path = os.path.join(output_dir, f'unrelaxed_proteins_{model_name}_checkpoint.pkl')
     ranking_confidences_checkpoint_path = os.path.join(output_dir, f'ranking_confidences_{model_name}_checkpoint.pkl')
-    if not os.path.exists(os.path.join(output_dir, f'result_{model_name}.pkl')) and FLAGS.stopat != 7:
-      logging.info('Running model %s on %s', model_name, fasta_name)
-      prev_ckpt = None; prev_ckpt_iter = 0
-      model_runner.checkpoint_file = None
-      if FLAGS.checkpoint_tag:
-        checkpoint_dir  = os.path.join(output_dir, 'checkpoint')
-        model_runner.checkpoint_file = os.path.join(checkpoint_dir, model_name + '_' + FLAGS.checkpoint_tag + ".pkl")
-      t_0 = time.time()
-      model_random_seed = model_index + random_seed * num_models
-      processed_feature_dict = model_runner.process_features(
-          feature_dict, random_seed=model_random_seed)
-      timings[f'process_features_{model_name}'] = time.time() - t_0
-
-      t_0 = time.time()
-      prediction_result, (tot_recycle, tol_value, recycled) = model_runner.predict(processed_feature_dict,
-                                                 random_seed=model_random_seed, prev=prev_ckpt,
-                                                 prev_ckpt_iter=prev_ckpt_iter )
-      tot_recycle += prev_ckpt_iter
-
-      t_diff = time.time() - t_0
-      timings[f'predict_and_compile_{model_name}'] = t_diff
-      logging.info(
-          'Total JAX model %s on %s predict time (includes compilation time, see --benchmark): %.1fs',
-          model_name, fasta_name, t_diff)
-
-      if benchmark:
-        t_0 = time.time()
-        model_runner.predict(processed_feature_dict,
-                             random_seed=model_random_seed)
-        t_diff = time.time() - t_0
-        timings[f'predict_benchmark_{model_name}'] = t_diff
-        logging.info(
-            'Total JAX model %s on %s predict time (excludes compilation time): %.1fs',
-            model_name, fasta_name, t_diff)
-
-      # output info of intermeidate recycles and save the coordinates
-      if FLAGS.save_recycled:
-        recycle_out_dir = os.path.join(output_dir, "recycled")
-        if FLAGS.save_recycled > 1 and not os.path.exists(recycle_out_dir):
-          try:
-            os.mkdir(recycle_out_dir)
-          except FileExistsError:  # this could happen when multiple runs are working on the same target simultaneously
-            print(f"Warning: tried to create an existing {recycle_out_dir}, ignored")
-
-        for rec_idx, rec_dict in enumerate(recycled):
-          if prev_ckpt_iter: rec_idx += prev_ckpt_iter
-          if rec_idx < tot_recycle:
-            if FLAGS.save_recycled > 1:
-              # Set the b-factors to the per-residue plddt
-              final_atom_mask = rec_dict['structure_module']['final_atom_mask']
-              b_factors = rec_dict['plddt'][:, None] * final_atom_mask
-
-              unrelaxed_protein = protein.from_prediction(feature_dict,
-                                    rec_dict,
-                                    b_factors=b_factors,
-                                    remove_leading_feature_dimension=not model_runner.multimer_mode,
-                                    )
-
-              unrelaxed_recycle_pdb_path = os.path.join(recycle_out_dir, f"{model_name}_recycled_{rec_idx:02d}.pdb")
-              with open(unrelaxed_recycle_pdb_path, 'w') as f:
-                f.write(protein.to_pdb(unrelaxed_protein))
-
-      plddt = prediction_result['plddt']
-      _save_confidence_json_file(plddt, output_dir, model_name)
-      ranking_confidences[model_name] = prediction_result['ranking_confidence']
-
-      if (
-          'predicted_aligned_error' in prediction_result
-          and 'max_predicted_aligned_error' in prediction_result
-      ):
-        pae = prediction_result['predicted_aligned_error']
-        max_pae = prediction_result['max_predicted_aligned_error']
-        _save_pae_json_file(pae, float(max_pae), output_dir, model_name)
+    if model_name in model_futures:
+      # Outputs are written in model order as the predictions complete.
+      run = model_futures.pop(model_name).result()
+      timings.update(run['timings'])
+      processed_feature_dict = run['processed_feature_dict']
+      prediction_result = run['prediction_result']
+      checkpoint_file = run['checkpoint_file']
 
       # Remove jax dependency from results.
       np_prediction_result = _jnp_to_np(dict(prediction_result))
-
-      pae_outputs = {'protein': (np_prediction_result['predicted_aligned_error'], prediction_result['max_predicted_aligned_error'])}
-      pae, max_pae = list(pae_outputs.values())[0]
-      pae_output_path = os.path.join(output_dir, f'unrelaxed_{model_name}_pae.png')
-      figPAE = plt.figure()
-      figPAE.set_facecolor('white')
-      plt.imshow(pae, vmin=0., vmax=max_pae)
-      plt.colorbar(fraction=0.46, pad=0.04)
-      plt.title('Predicted Aligned Error')
-      plt.xlabel('Scored residue')
-      plt.ylabel('Aligned residue')
-      plt.savefig(pae_output_path, dpi=300, bbox_inches='tight')
+      plddt = np_prediction_result['plddt']
+      ranking_confidences[model_name] = float(
+          np_prediction_result['ranking_confidence'])
       logging.info('num_recycles: %d', np_prediction_result['num_recycles'].item() )
       logging.info('Predicted template modeling score (ptm): %f', np_prediction_result['ptm'].item() )
       if np_prediction_result['iptm'].item() != 0:
         logging.info('Multimer interface ptm (iptm): %f', np_prediction_result['iptm'].item() )
         logging.info('Multimer combined score (0.8*iptm+0.2*ptm): %f', 0.8*np_prediction_result['iptm'].item()+0.2*np_prediction_result['ptm'].item() )
 
-      # Save the model outputs.
-      result_output_path = os.path.join(output_dir, f'result_{model_name}.pkl')
-      with open(result_output_path, 'wb') as f:
-        pickle.dump(np_prediction_result, f, protocol=4)
-
       # Add the predicted LDDT in the b-factor column.
       # Note that higher predicted LDDT value means higher model confidence.
       plddt_b_factors = np.repeat(
           plddt[:, None], residue_constants.atom_type_num, axis=-1)
       unrelaxed_protein = protein.from_prediction(
           features=processed_feature_dict,
-          result=prediction_result,
+          result=np_prediction_result,
           b_factors=plddt_b_factors,
           remove_leading_feature_dimension=not model_runner.multimer_mode)
-      _save_mmcif_file(
+      unrelaxed_proteins[model_name] = unrelaxed_protein
+      if relax_on_prediction:
+        relax_futures[model_name] = relax_pool.submit(unrelaxed_protein)
+
+      # The outputs are written while the next models are collected.
+      if 'predicted_aligned_error' in np_prediction_result:
+        output_stage.submit(
+            _save_pae_png_file,
+            np_prediction_result['predicted_aligned_error'],
+            float(np_prediction_result['max_predicted_aligned_error']),
+            output_dir, model_name, in_process=True)
+      output_stage.submit(
+          _save_mmcif_file,
           prot=unrelaxed_protein,
           output_dir=output_dir,
           model_name=f'unrelaxed_{model_name}',
           file_id=str(model_index),
           model_type=model_type,
-      )
-      unrelaxed_proteins[model_name] = unrelaxed_protein
-      unrelaxed_pdbs[model_name] = protein.to_pdb(unrelaxed_protein)
-      #unrelaxed_pdb_path = os.path.join(output_dir, f'unrelaxed_{model_name}.pdb')
-      with open(unrelaxed_pdb_path, 'w') as f:
-        f.write(unrelaxed_pdbs[model_name])
-      # save checkpoints
-      with open(unrelaxed_proteins_checkpoint_path, 'wb') as f:
-        pickle.dump(unrelaxed_proteins[model_name], f, protocol=4)
-      with open(ranking_confidences_checkpoint_path, 'wb') as f:
-        pickle.dump(ranking_confidences[model_name], f, protocol=4)
+          in_process=True)
+      unrelaxed_pdb_futures[model_name] = output_stage.submit(
+          _save_model_outputs, np_prediction_result,
+          ranking_confidences[model_name], unrelaxed_protein, output_dir,
+          model_name, checkpoint_file)
     else:
       # read checkpoints
       if os.path.exists(unrelaxed_pdb_path):
@@ -455,6 +868,11 @@ def predict_structure(
         with open(ranking_confidences_checkpoint_path, 'rb') as f:
           ranking_confidences[model_name] = pickle.load(f)
 
+  # All the unrelaxed outputs must be on disk before ranking.
+  output_stage.join()
+  for model_name, unrelaxed_pdb_future in unrelaxed_pdb_futures.items():
+    unrelaxed_pdbs[model_name] = unrelaxed_pdb_future.result()
+
   if FLAGS.stopat < 6:
     raise app.UsageError('Interrupting because stopat < 6', 0)
   label = None
@@ -486,14 +904,18 @@ def predict_structure(
     to_relax = []
 
   for model_name in to_relax:
-    t_0 = time.time()
-    relaxed_pdb_str, _, violations = amber_relaxer.process(
-        prot=unrelaxed_proteins[model_name])
+    if model_name not in relax_futures:
+      relax_futures[model_name] = relax_pool.submit(
+          unrelaxed_proteins[model_name])
+
+  for model_name in to_relax:
+    relaxed_pdb_str, _, violations, relax_time = (
+        relax_futures[model_name].result())
     relax_metrics[model_name] = {
         'remaining_violations': violations,
         'remaining_violations_count': sum(violations)
     }
-    timings[f'relax_{model_name}'] = time.time() - t_0
+    timings[f'relax_{model_name}'] = relax_time
 
     relaxed_pdbs[model_name] = relaxed_pdb_str
 
@@ -601,29 +1023,77 @@ def main(argv):
   if len(fasta_names) != len(set(fasta_names)):
     raise ValueError('All FASTA paths must have a unique basename.')
 
+  structure_store = None
+  if FLAGS.template_store_dir:
+    structure_store = template_store.TemplateStore(FLAGS.template_store_dir)
+
+  shared_template_cache = None
+  if FLAGS.template_cache_dir:
+    max_size_bytes = None
+    if FLAGS.template_cache_max_size_gb is not None:
+      max_size_bytes = int(FLAGS.template_cache_max_size_gb * 1024**3)
+    shared_template_cache = template_cache.TemplateCache(
+        cache_dir=FLAGS.template_cache_dir, max_size_bytes=max_size_bytes)
+
+  msa_cpu_budget = cpu_budget.CpuBudget(
+      num_cpus=FLAGS.msa_cpus, max_concurrent=FLAGS.n_parallel_msa)
+
+  msa_database_stage = None
+  if FLAGS.database_stage_dir:
+    for name in FLAGS.staged_databases:
+      if f'{name}_database_path' not in FLAGS:
+        raise ValueError(f'Unknown database {name} in --staged_databases.')
+    max_size_bytes = None
+    if FLAGS.database_stage_max_size_gb is not None:
+      max_size_bytes = int(FLAGS.database_stage_max_size_gb * 1024**3)
+    msa_database_stage = database_stage.DatabaseStage(
+        stage_dir=FLAGS.database_stage_dir,
+        max_size_bytes=max_size_bytes,
+        sources=[FLAGS[f'{name}_database_path'].value
+                 for name in FLAGS.staged_databases])
+
   if run_multimer_system:
     template_searcher = hmmsearch.Hmmsearch(
         binary_path=FLAGS.hmmsearch_binary_path,
         hmmbuild_binary_path=FLAGS.hmmbuild_binary_path,
-        database_path=FLAGS.pdb_seqres_database_path)
+        database_path=FLAGS.pdb_seqres_database_path,
+        cpu_budget=msa_cpu_budget,
+        database_stage=msa_database_stage)
     template_featurizer = templates.HmmsearchHitFeaturizer(
         mmcif_dir=FLAGS.template_mmcif_dir,
         max_template_date=FLAGS.max_template_date,
         max_hits=MAX_TEMPLATE_HITS,
         kalign_binary_path=FLAGS.kalign_binary_path,
         release_dates_path=None,
-        obsolete_pdbs_path=FLAGS.obsolete_pdbs_path)
+        obsolete_pdbs_path=FLAGS.obsolete_pdbs_path,
+        num_workers=FLAGS.template_workers,
+        template_store=structure_store,
+        template_index_path=FLAGS.template_index_path,
+        template_cache=shared_template_cache)
   else:
     template_searcher = hhsearch.HHSearch(
         binary_path=FLAGS.hhsearch_binary_path,
-        databases=[FLAGS.pdb70_database_path])
+        databases=[FLAGS.pdb70_database_path],
+        database_stage=msa_database_stage)
     template_featurizer = templates.HhsearchHitFeaturizer(
         mmcif_dir=FLAGS.template_mmcif_dir,
         max_template_date=FLAGS.max_template_date,
         max_hits=MAX_TEMPLATE_HITS,
         kalign_binary_path=FLAGS.kalign_binary_path,
         release_dates_path=None,
-        obsolete_pdbs_path=FLAGS.obsolete_pdbs_path)
+        obsolete_pdbs_path=FLAGS.obsolete_pdbs_path,
+        num_workers=FLAGS.template_workers,
+        template_store=structure_store,
+        template_index_path=FLAGS.template_index_path,
+        template_cache=shared_template_cache)
+
+  shared_msa_cache = None
+  if FLAGS.msa_cache_dir:
+    max_size_bytes = None
+    if FLAGS.msa_cache_max_size_gb is not None:
+      max_size_bytes = int(FLAGS.msa_cache_max_size_gb * 1024**3)
+    shared_msa_cache = msa_cache.MsaCache(
+        cache_dir=FLAGS.msa_cache_dir, max_size_bytes=max_size_bytes)
 
   monomer_data_pipeline = pipeline.DataPipeline(
       jackhmmer_binary_path=FLAGS.jackhmmer_binary_path,
@@ -637,7 +1107,10 @@ def main(argv):
       template_featurizer=template_featurizer,
       use_small_bfd=use_small_bfd,
       use_precomputed_msas=FLAGS.use_precomputed_msas,
-      n_parallel_msa=FLAGS.n_parallel_msa)
+      n_parallel_msa=FLAGS.n_parallel_msa,
+      msa_cache=shared_msa_cache,
+      cpu_budget=msa_cpu_budget,
+      database_stage=msa_database_stage)
 
   if run_multimer_system:
     num_predictions_per_model = FLAGS.num_multimer_predictions_per_model
@@ -645,11 +1118,15 @@ def main(argv):
         monomer_data_pipeline=monomer_data_pipeline,
         jackhmmer_binary_path=FLAGS.jackhmmer_binary_path,
         uniprot_database_path=FLAGS.uniprot_database_path,
-        use_precomputed_msas=FLAGS.use_precomputed_msas)
+        use_precomputed_msas=FLAGS.use_precomputed_msas,
+        msa_cache=shared_msa_cache)
   else:
     num_predictions_per_model = 1
     data_pipeline = monomer_data_pipeline
 
+  if FLAGS.compilation_cache_dir:
+    model.enable_compilation_cache(FLAGS.compilation_cache_dir)
+
   model_runners = {}
   model_names = config.MODEL_PRESETS[FLAGS.model_preset]
   if FLAGS.stopat == 1:
@@ -668,42 +1145,8 @@ def main(argv):
   logging.info('Config file Early stop tol %f', config.CONFIG_MULTIMER['model']['recycle_early_stop_tolerance'])
   logging.info('Using stopat option = %d', FLAGS.stopat)
 
-  adaptative_subbatch_size = 4
-  if FLAGS.adapt_subbatch:
-    max_num_res = 0
-    # Get max legnth of the sequences.
-    for i, fasta_path in enumerate(FLAGS.fasta_paths):
-      fasta_name = fasta_names[i]
-      with open(fasta_path) as f:
-        input_fasta_str = f.read()
-        input_seqs, _ = parsers.parse_fasta(input_fasta_str)
-        num_res = 0
-        for j in range(len(input_seqs)):
-          num_res += len(input_seqs[j])
-        if num_res > max_num_res:
-            max_num_res = num_res
-    if max_num_res < 512:
-      adaptative_subbatch_size = max_num_res
-    elif max_num_res >= 4500:
-      adaptative_subbatch_size = 1
-    elif max_num_res >= 4000:
-      adaptative_subbatch_size = 4
-    elif max_num_res >= 3000:
-      adaptative_subbatch_size = 32
-    elif max_num_res >= 2000:
-      adaptative_subbatch_size = 64
-    elif max_num_res >= 1500:
-      adaptative_subbatch_size = 128
-    elif max_num_res > 1000:
-      adaptative_subbatch_size = 256
-    elif max_num_res >= 512:
-      adaptative_subbatch_size = 512
-
-  logging.info('Adaptative subbatch size %d', adaptative_subbatch_size)
-
   for model_name in model_names:
     model_config = config.model_config(model_name)
-    model_config['model']['global_config']['subbatch_size'] = adaptative_subbatch_size
     model_config['model']['num_recycle'] = FLAGS.max_n_recycles
     model_config['model']['recycle_early_stop_tolerance'] = FLAGS.recycle_early_stop_tolerance
     logging.info('Using num_recycle %d',model_config['model']['num_recycle'])
@@ -713,6 +1156,17 @@ def main(argv):
     else:
       model_config.data.eval.num_ensemble = num_ensemble
     model_config.model.save_recycled = FLAGS.save_recycled
+    # The aligned confidence probabilities are as large as the PAE logits and
+    # only stored in full results.
+    model_config.model.return_aligned_confidence_probs = (
+        FLAGS.result_format == 'pkl' or FLAGS.result_profile == 'full')
+    if run_multimer_system:
+      model_config.model.num_res_buckets = tuple(
+          int(b) for b in FLAGS.num_res_buckets)
+      model_config.model.msa_depth_buckets = tuple(
+          int(b) for b in FLAGS.msa_depth_buckets)
+    if FLAGS.checkpoint_tag:
+      model_config.model.recycle_checkpoint_interval = FLAGS.recycle_checkpoint_interval
     model_params = data.get_model_haiku_params(
         model_name=model_name, data_dir=FLAGS.data_dir)
     model_runner = model.RunModel(model_config, model_params)
@@ -735,20 +1189,34 @@ def main(argv):
   logging.info('Using random seed %d for the data pipeline', random_seed)
 
   # Predict structure for each of the sequences.
-  for i, fasta_path in enumerate(FLAGS.fasta_paths):
-    fasta_name = fasta_names[i]
-    predict_structure(
-        fasta_path=fasta_path,
-        fasta_name=fasta_name,
-        output_dir_base=FLAGS.output_dir,
-        data_pipeline=data_pipeline,
-        model_runners=model_runners,
-        amber_relaxer=amber_relaxer,
-        benchmark=FLAGS.benchmark,
-        random_seed=random_seed,
-        models_to_relax=FLAGS.models_to_relax,
-        model_type=model_type,
-    )
+  output_stage = _OutputStage(num_workers=FLAGS.output_workers)
+  relax_pool = None
+  if FLAGS.models_to_relax != ModelsToRelax.NONE:
+    relax_pool = relax_pool_lib.RelaxPool(
+        amber_relaxer, num_workers=FLAGS.relax_workers,
+        gpu_devices=FLAGS.relax_gpu_devices)
+  try:
+    for i, fasta_path in enumerate(FLAGS.fasta_paths):
+      fasta_name = fasta_names[i]
+      predict_structure(
+          fasta_path=fasta_path,
+          fasta_name=fasta_name,
+          output_dir_base=FLAGS.output_dir,
+          data_pipeline=data_pipeline,
+          model_runners=model_runners,
+          amber_relaxer=amber_relaxer,
+          benchmark=FLAGS.benchmark,
+          random_seed=random_seed,
+          models_to_relax=FLAGS.models_to_relax,
+          model_type=model_type,
+          output_stage=output_stage,
+          relax_pool=relax_pool,
+      )
+  finally:
+    output_stage.shutdown()
+    if relax_pool is not None:
+      relax_pool.shutdown()
+    data_pipeline.close()
 
 
 if __name__ == '__main__':
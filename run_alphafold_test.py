@@ -105,7 +105,7 @@ class RunAlphafoldTest(parameterized.TestCase):
         'ranked_0.cif',
         'ranked_0.pdb',
         'ranking_debug.json',
-        'result_model1.pkl',
+        'result_model1.npz',
         'timings.json',
         'unrelaxed_model1.cif',
         'unrelaxed_model1.pdb',
@@ -0,0 +1,55 @@
+# Copyright 2021 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Pre-parses the template mmCIF directory into a template store.
+
+Run once after downloading (or syncing) pdb_mmcif, then pass the store to
+run_alphafold.py with --template_store_dir:
+
+  python scripts/build_template_store.py \
+    --template_mmcif_dir=<data_dir>/pdb_mmcif/mmcif_files \
+    --template_store_dir=<data_dir>/pdb_mmcif/template_store
+"""
+
+import os
+
+from absl import app
+from absl import flags
+from absl import logging
+from alphafold.data import template_store
+
+flags.DEFINE_string('template_mmcif_dir', None, 'Path to a directory with '
+                    'template mmCIF structures, each named <pdb_id>.cif')
+flags.DEFINE_string('template_store_dir', None, 'Path to the store directory, '
+                    'updated incrementally if it exists.')
+flags.DEFINE_integer('num_workers', os.cpu_count(), 'Number of processes '
+                     'parsing mmCIF files.', lower_bound=1)
+
+FLAGS = flags.FLAGS
+
+
+def main(argv):
+  if len(argv) > 1:
+    raise app.UsageError('Too many command-line arguments.')
+  num_indexed = template_store.build_store(
+      mmcif_dir=FLAGS.template_mmcif_dir,
+      store_dir=FLAGS.template_store_dir,
+      num_workers=FLAGS.num_workers)
+  logging.info('Indexed %d mmCIF files into %s', num_indexed,
+               FLAGS.template_store_dir)
+
+
+if __name__ == '__main__':
+  flags.mark_flags_as_required(['template_mmcif_dir', 'template_store_dir'])
+  app.run(main)
@@ -0,0 +1,309 @@
+# Copyright 2021 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Job queue of the web front-end and the daemon running its jobs.
+
+web.py enqueues the prediction jobs into a SQLite database and reads their
+state back from it. The daemon runs the queued jobs with a fixed number of
+workers, smallest jobs (by number of tokens) first. A queued job gains
+priority as it waits (see AGING_TOKENS_PER_HOUR), so a stream of small jobs
+cannot hold back a large one forever:
+
+  python scripts/job_queue.py --queue_db=/storage/Data/AF2jobs/jobs.sqlite \
+    --num_workers=2
+
+The jobs get their GPUs from Slurm (see .alphafold2_callee.csh), so the
+number of workers is best set to the number of GPUs Slurm can allocate to
+them.
+
+Jobs are identified by the md5 of their input, so submitting a job that is
+already queued, running or done attaches to it instead of running it again,
+unless the output of the done job is gone.
+"""
+
+import contextlib
+import dataclasses
+import json
+import os
+import sqlite3
+import subprocess
+import threading
+import time
+from typing import List, Mapping, Optional, Sequence
+
+from absl import app
+from absl import flags
+from absl import logging
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+# The number of tokens a queued job is moved ahead by for every hour it waits.
+AGING_TOKENS_PER_HOUR = 500.
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+  job_id TEXT PRIMARY KEY,
+  state TEXT NOT NULL,
+  num_tokens INTEGER NOT NULL,
+  command TEXT NOT NULL,
+  cwd TEXT NOT NULL,
+  env TEXT NOT NULL,
+  num_submissions INTEGER NOT NULL,
+  submitted REAL NOT NULL,
+  started REAL,
+  finished REAL,
+  worker TEXT,
+  returncode INTEGER
+);
+CREATE INDEX IF NOT EXISTS jobs_by_priority
+  ON jobs (state, num_tokens, submitted);
+"""
+
+
+@dataclasses.dataclass(frozen=True)
+class Job:
+  """A row of the job queue."""
+  job_id: str
+  state: str
+  num_tokens: int
+  command: List[str]
+  cwd: str
+  env: Mapping[str, str]
+  num_submissions: int
+  submitted: float
+  started: Optional[float]
+  finished: Optional[float]
+  worker: Optional[str]
+  returncode: Optional[int]
+
+  @classmethod
+  def from_row(cls, row: sqlite3.Row) -> 'Job':
+    fields = dict(row)
+    fields['command'] = json.loads(fields['command'])
+    fields['env'] = json.loads(fields['env'])
+    return cls(**fields)
+
+
+class JobQueue:
+  """SQLite-backed queue of jobs, shared by the web app and the daemon."""
+
+  def __init__(self, db_path: str,
+               aging_tokens_per_hour: float = AGING_TOKENS_PER_HOUR):
+    """Opens the queue, creating its database if needed.
+
+    Args:
+      db_path: The path to the SQLite database.
+      aging_tokens_per_hour: The number of tokens a queued job is moved ahead
+        by for every hour it waits. The web app and the daemon must agree on it.
+    """
+    self._db_path = db_path
+    self._aging = aging_tokens_per_hour / 3600.
+    conn = sqlite3.connect(db_path, timeout=600)
+    try:
+      conn.executescript(_SCHEMA)
+    finally:
+      conn.close()
+
+  @contextlib.contextmanager
+  def _connect(self, write: bool = True):
+    conn = sqlite3.connect(self._db_path, timeout=600, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    try:
+      # Writes take the lock up front, so concurrent submissions and claims
+      # serialize, reads do not block them.
+      conn.execute('BEGIN IMMEDIATE' if write else 'BEGIN DEFERRED')
+      yield conn
+      conn.execute('COMMIT')
+    except BaseException:
+      conn.execute('ROLLBACK')
+      raise
+    finally:
+      conn.close()
+
+  def submit(self,
+             job_id: str,
+             command: Sequence[str],
+             cwd: str,
+             num_tokens: int,
+             env: Optional[Mapping[str, str]] = None,
+             finished_flag: Optional[str] = None) -> Job:
+    """Enqueues a job, or attaches to the job with the same id.
+
+    Args:
+      job_id: The id of the job, the md5 of its input.
+      command: The command running the job.
+      cwd: The working directory of the command.
+      num_tokens: The number of residues of the job, which orders the queue.
+      env: Environment variables of the command, added to those of the daemon.
+      finished_flag: The file a successful job leaves behind. A succeeded job
+        without it, e.g. whose output was deleted, is queued again.
+
+    Returns:
+      The job. A queued, running or succeeded job with the same id is returned
+      as is, with one more submission, while a failed one is queued again.
+    """
+    with self._connect() as conn:
+      row = conn.execute('SELECT * FROM jobs WHERE job_id = ?',
+                         (job_id,)).fetchone()
+      output_missing = (row is not None and row['state'] == SUCCEEDED and
+                        finished_flag is not None and
+                        not os.path.exists(finished_flag))
+      if output_missing:
+        logging.info('Job %s succeeded but %s is missing, queuing it again',
+                     job_id, finished_flag)
+      if row is not None and row['state'] != FAILED and not output_missing:
+        conn.execute('UPDATE jobs SET num_submissions = num_submissions + 1 '
+                     'WHERE job_id = ?', (job_id,))
+        logging.info('Job %s is %s, attaching to it', job_id, row['state'])
+      else:
+        num_submissions = 1 if row is None else row['num_submissions'] + 1
+        conn.execute(
+            'INSERT OR REPLACE INTO jobs VALUES '
+            '(?, ?, ?, ?, ?, ?, ?, ?, NULL, NULL, NULL, NULL)',
+            (job_id, QUEUED, num_tokens, json.dumps(list(command)), cwd,
+             json.dumps(dict(env or {})), num_submissions, time.time()))
+      return Job.from_row(conn.execute('SELECT * FROM jobs WHERE job_id = ?',
+                                       (job_id,)).fetchone())
+
+  def get(self, job_id: str) -> Optional[Job]:
+    """Returns the job with the given id, None if there is none."""
+    with self._connect(write=False) as conn:
+      row = conn.execute('SELECT * FROM jobs WHERE job_id = ?',
+                         (job_id,)).fetchone()
+    return None if row is None else Job.from_row(row)
+
+  def active_jobs(self) -> List[Job]:
+    """Returns the running jobs, then the queued jobs in the order they run."""
+    with self._connect(write=False) as conn:
+      rows = conn.execute(
+          'SELECT * FROM jobs WHERE state IN (?, ?) '
+          'ORDER BY state = ?, num_tokens + ? * submitted, submitted',
+          (RUNNING, QUEUED, QUEUED, self._aging)).fetchall()
+    return [Job.from_row(row) for row in rows]
+
+  def queue_position(self, job_id: str) -> Optional[int]:
+    """Returns the number of queued jobs running before a queued job."""
+    with self._connect(write=False) as conn:
+      row = conn.execute('SELECT * FROM jobs WHERE job_id = ? AND state = ?',
+                         (job_id, QUEUED)).fetchone()
+      if row is None:
+        return None
+      # The aging is shifted by the same amount for every job, the aging of a
+      # job submitted at time 0, so that the order does not depend on the time.
+      priority = row['num_tokens'] + self._aging * row['submitted']
+      return conn.execute(
+          'SELECT COUNT(*) FROM jobs WHERE state = ? AND '
+          '(num_tokens + ? * submitted < ? OR '
+          '(num_tokens + ? * submitted = ? AND submitted < ?))',
+          (QUEUED, self._aging, priority, self._aging, priority,
+           row['submitted'])).fetchone()[0]
+
+  def claim(self, worker: str) -> Optional[Job]:
+    """Marks the next queued job as running on worker and returns it."""
+    with self._connect() as conn:
+      row = conn.execute(
+          'SELECT job_id FROM jobs WHERE state = ? '
+          'ORDER BY num_tokens + ? * submitted, submitted LIMIT 1',
+          (QUEUED, self._aging)).fetchone()
+      if row is None:
+        return None
+      conn.execute(
+          'UPDATE jobs SET state = ?, started = ?, worker = ? WHERE job_id = ?',
+          (RUNNING, time.time(), worker, row['job_id']))
+      return Job.from_row(conn.execute('SELECT * FROM jobs WHERE job_id = ?',
+                                       (row['job_id'],)).fetchone())
+
+  def finish(self, job_id: str, returncode: int) -> None:
+    """Records the exit code of a running job."""
+    with self._connect() as conn:
+      conn.execute(
+          'UPDATE jobs SET state = ?, finished = ?, returncode = ? '
+          'WHERE job_id = ?',
+          (SUCCEEDED if returncode == 0 else FAILED, time.time(), returncode,
+           job_id))
+
+  def requeue_running(self) -> int:
+    """Queues again the jobs left running by a stopped daemon."""
+    with self._connect() as conn:
+      return conn.execute(
+          'UPDATE jobs SET state = ?, started = NULL, worker = NULL '
+          'WHERE state = ?', (QUEUED, RUNNING)).rowcount
+
+
+def _run_worker(queue: JobQueue, name: str, poll_interval: float,
+                stop: threading.Event) -> None:
+  while not stop.is_set():
+    job = queue.claim(name)
+    if job is None:
+      stop.wait(poll_interval)
+      continue
+    logging.info('%s runs job %s (%d tokens)', name, job.job_id,
+                 job.num_tokens)
+    env = {**os.environ, **job.env}
+    try:
+      returncode = subprocess.call(job.command, cwd=job.cwd, env=env)
+    except OSError as e:
+      logging.exception('Could not run job %s: %s', job.job_id, e)
+      returncode = -1
+    queue.finish(job.job_id, returncode)
+    logging.info('%s finished job %s with exit code %d', name, job.job_id,
+                 returncode)
+
+
+flags.DEFINE_string('queue_db', None, 'Path to the SQLite job queue database, '
+                    'shared with web.py.')
+flags.DEFINE_integer('num_workers', 1, 'Number of jobs run concurrently, '
+                     'e.g. the number of GPUs Slurm allocates to the jobs.',
+                     lower_bound=1)
+flags.DEFINE_float('poll_interval', 5., 'Seconds between two checks of the '
+                   'queue by an idle worker.')
+
+FLAGS = flags.FLAGS
+
+
+def main(argv):
+  if len(argv) > 1:
+    raise app.UsageError('Too many command-line arguments.')
+
+  queue = JobQueue(FLAGS.queue_db)
+  num_requeued = queue.requeue_running()
+  if num_requeued:
+    logging.info('Queued again %d jobs left running', num_requeued)
+
+  stop = threading.Event()
+  workers = []
+  logging.info('Starting %d workers', FLAGS.num_workers)
+  for i in range(FLAGS.num_workers):
+    name = f'worker{i}'
+    worker = threading.Thread(
+        target=_run_worker, name=name,
+        args=(queue, name, FLAGS.poll_interval, stop))
+    worker.start()
+    workers.append(worker)
+  try:
+    for worker in workers:
+      worker.join()
+  except KeyboardInterrupt:
+    logging.info('Stopping after the running jobs')
+    stop.set()
+    for worker in workers:
+      worker.join()
+
+
+if __name__ == '__main__':
+  flags.mark_flags_as_required(['queue_db'])
+  app.run(main)
@@ -0,0 +1,147 @@
+# Copyright 2021 DeepMind Technologies Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for job_queue."""
+import os
+import tempfile
+import time
+from unittest import mock
+
+from absl.testing import absltest
+import job_queue
+
+
+class JobQueueTest(absltest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    tmp_dir = self.enter_context(tempfile.TemporaryDirectory())
+    self.queue = job_queue.JobQueue(os.path.join(tmp_dir, 'jobs.sqlite'))
+    self.cwd = tmp_dir
+
+  def _submit(self, job_id, num_tokens=100, command=('true',),
+              finished_flag=None):
+    return self.queue.submit(job_id, command, cwd=self.cwd,
+                             num_tokens=num_tokens, env={'IBSJOBNAME': job_id},
+                             finished_flag=finished_flag)
+
+  def test_resubmission_attaches_to_job(self):
+    job = self._submit('a')
+    self.assertEqual(job.state, job_queue.QUEUED)
+    self.assertEqual(job.num_submissions, 1)
+
+    job = self._submit('a', command=('false',))
+    self.assertEqual(job.state, job_queue.QUEUED)
+    self.assertEqual(job.num_submissions, 2)
+    self.assertEqual(job.command, ['true'])
+    self.assertLen(self.queue.active_jobs(), 1)
+
+    self.queue.claim('worker0')
+    self.assertEqual(self._submit('a').state, job_queue.RUNNING)
+    self.queue.finish('a', 0)
+    job = self._submit('a')
+    self.assertEqual(job.state, job_queue.SUCCEEDED)
+    self.assertEqual(job.num_submissions, 4)
+    self.assertIsNone(self.queue.claim('worker0'))
+
+  def test_failed_job_is_queued_again(self):
+    self._submit('a')
+    self.queue.claim('worker0')
+    self.queue.finish('a', 1)
+    job = self.queue.get('a')
+    self.assertEqual(job.state, job_queue.FAILED)
+    self.assertEqual(job.returncode, 1)
+
+    job = self._submit('a')
+    self.assertEqual(job.state, job_queue.QUEUED)
+    self.assertEqual(job.num_submissions, 2)
+    self.assertIsNone(job.returncode)
+    self.assertEqual(self.queue.claim('worker1').job_id, 'a')
+
+  def test_succeeded_job_without_output_is_queued_again(self):
+    finished_flag = os.path.join(self.cwd, 'finished.txt')
+    self._submit('a', finished_flag=finished_flag)
+    self.queue.claim('worker0')
+    with open(finished_flag, 'w') as f:
+      f.write('done\n')
+    self.queue.finish('a', 0)
+    job = self._submit('a', finished_flag=finished_flag)
+    self.assertEqual(job.state, job_queue.SUCCEEDED)
+    self.assertEqual(job.num_submissions, 2)
+
+    # The output directory was deleted, web.py recreates it.
+    os.remove(finished_flag)
+    job = self._submit('a', finished_flag=finished_flag)
+    self.assertEqual(job.state, job_queue.QUEUED)
+    self.assertEqual(job.num_submissions, 3)
+    self.assertIsNone(job.returncode)
+    self.assertEqual(self.queue.claim('worker1').job_id, 'a')
+
+  def test_claims_smallest_jobs_first(self):
+    self._submit('large', num_tokens=900)
+    self._submit('small', num_tokens=50)
+    self._submit('medium', num_tokens=300)
+    self._submit('medium_later', num_tokens=300)
+    self.assertEqual(self.queue.queue_position('small'), 0)
+    self.assertEqual(self.queue.queue_position('medium_later'), 2)
+    self.assertEqual(self.queue.queue_position('large'), 3)
+
+    claimed = [self.queue.claim('worker0').job_id for _ in range(4)]
+    self.assertEqual(claimed, ['small', 'medium', 'medium_later', 'large'])
+    self.assertIsNone(self.queue.claim('worker0'))
+    self.assertIsNone(self.queue.queue_position('small'))
+
+  def test_waiting_jobs_gain_priority(self):
+    start = time.time()
+    with mock.patch.object(time, 'time', return_value=start):
+      self._submit('large', num_tokens=2000)
+    # 3 hours later, the large job has moved 1500 tokens ahead.
+    with mock.patch.object(time, 'time', return_value=start + 3 * 3600):
+      self._submit('small', num_tokens=50)
+      self._submit('tiny', num_tokens=1)
+    # 4 hours later, by 2000 tokens.
+    with mock.patch.object(time, 'time', return_value=start + 4 * 3600):
+      self._submit('medium', num_tokens=450)
+    self.assertEqual(self.queue.queue_position('tiny'), 0)
+    self.assertEqual(self.queue.queue_position('large'), 2)
+    self.assertEqual(self.queue.queue_position('medium'), 3)
+    self.assertEqual([job.job_id for job in self.queue.active_jobs()],
+                     ['tiny', 'small', 'large', 'medium'])
+
+    claimed = [self.queue.claim('worker0').job_id for _ in range(4)]
+    self.assertEqual(claimed, ['tiny', 'small', 'large', 'medium'])
+
+    # Without aging, the large job runs last.
+    queue = job_queue.JobQueue(self.queue._db_path, aging_tokens_per_hour=0)
+    self.assertEqual(queue.requeue_running(), 4)
+    self.assertEqual([job.job_id for job in queue.active_jobs()],
+                     ['tiny', 'small', 'medium', 'large'])
+
+  def test_requeue_running(self):
+    self._submit('a')
+    self._submit('b', num_tokens=200)
+    self.queue.claim('worker0')
+    self.assertEqual(
+        [(job.job_id, job.state) for job in self.queue.active_jobs()],
+        [('a', job_queue.RUNNING), ('b', job_queue.QUEUED)])
+
+    self.assertEqual(self.queue.requeue_running(), 1)
+    job = self.queue.get('a')
+    self.assertEqual(job.state, job_queue.QUEUED)
+    self.assertIsNone(job.worker)
+    self.assertEqual(self.queue.claim('worker1').job_id, 'a')
+
+
+if __name__ == '__main__':
+  absltest.main()
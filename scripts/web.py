@@ -3,13 +3,33 @@ import os
 #import uuid
 import subprocess
 import hashlib
+import time
 from datetime import datetime
 
+import job_queue
+
 app = Bottle()
 
 # Directory where job output folders will be stored
 BASE_OUTPUT_DIR = '/storage/Data/AF2jobs'  # Change this to your desired path
 log_file = os.path.join(BASE_OUTPUT_DIR, 'AF2.log')
+# Job queue run by scripts/job_queue.py
+queue = job_queue.JobQueue(os.path.join(BASE_OUTPUT_DIR, 'jobs.sqlite'))
+
+def count_tokens(sequences):
+    return sum(len(line.strip()) for line in sequences.splitlines() if not line.startswith('>'))
+
+def queue_table():
+    rows = ''
+    for job in queue.active_jobs():
+        if job.state == job_queue.RUNNING:
+            since = 'running on {} since {}'.format(job.worker, datetime.fromtimestamp(job.started).strftime('%Y-%m-%d %H:%M:%S'))
+        else:
+            since = 'queued since {}'.format(datetime.fromtimestamp(job.submitted).strftime('%Y-%m-%d %H:%M:%S'))
+        rows += f'<tr><td>{job.job_id}</td><td>{job.num_tokens}</td><td>{since}</td></tr>\n'
+    if not rows:
+        return '<p>No job running nor queued.</p>'
+    return '<table style="width:100%"><tr><th>Job id</th><th>#tokens</th><th>State</th></tr>\n' + rows + '</table>'
 
 @app.route('/favicon.ico', name='get_favicon')
 def get_favicon():
@@ -68,11 +88,11 @@ def index():
             f.write(sequences)
 
         subprocess.call(['chmod', '664', sequences_file])
-        # Launch the subprocess asynchronously
-        my_env = os.environ.copy()
-        my_env["IBSJOBNAME"] = job_id
+        # Queue the job, or attach to the identical job already queued/running/done
+        # (a done job whose output was deleted runs again)
         command = ['/storage/Alphafold/scripts/alphafold2_caller.bin', sequences_file, '3']
-        subprocess.Popen(command, cwd=job_output_dir, env=my_env)
+        finished_flag = os.path.join(job_output_dir, 'input_'+job_id+'_full_dbs/finished.txt')
+        job = queue.submit(job_id, command, cwd=job_output_dir, num_tokens=count_tokens(sequences), env={'IBSJOBNAME': job_id}, finished_flag=finished_flag)
 
         # Return the job URL to the client
         job_url = request.urlparts.scheme + "://" + request.urlparts.netloc + app.get_url('job_results', job_id=job_id)
@@ -80,17 +100,12 @@ def index():
             f.write('<tr><td>'+str(datetime.now())+'</td><td>'+email.split("@")[0]+'</td><td>'+client_ip+'</td><td><a href="'+job_url+'">'+job_id+'</a></td><td>'+tokens_var+'</td></tr>\n')
         log_lines +='<tr><td>'+str(datetime.now())+'</td><td>'+email.split("@")[0]+'</td><td>'+client_ip+'</td><td><a href="'+job_url+'">'+job_id+'</a></td><td>'+tokens_var+'</td></tr>\n'
         return f'''
-            <h1>Your Alphafold 2 job has been submitted</h1>
+            <h1>Your Alphafold 2 job has been submitted ({job.state})</h1>
             <p>You can check the result at: <a href="{job_url}">{job_url}</a></p>
             <p>Keep the link above for future access.</p>
         '''
 
     # If GET request, display the submission form
-    # Get the output of 'squeue'
-    try:
-        squeue_output = subprocess.check_output(['squeue'], universal_newlines=True)
-    except subprocess.CalledProcessError as e:
-        squeue_output = f"Failed to retrieve squeue output: {e}"
     pagestr = '''<!DOCTYPE html>
 <html>
 <head>
@@ -261,8 +276,8 @@ SALLSSDITASVNCAKKIVSDGNGMNAWVAWRNRCKGTDVQAWIRGCRL
 </table>
     '''
     pagestr += f'''
-<h2>Current Slurm job queue:</h2>
-<pre>{squeue_output}</pre>
+<h2>Current job queue:</h2>
+{queue_table()}
 <hr/>
     '''
     pagestr += 'Your IP is: {}\n'.format(client_ip)
@@ -280,12 +295,28 @@ def job_results(job_id):
     if not os.path.exists(job_output_dir):
         return HTTPResponse('Alphafold 2 job not found.', status=404)
 
-    # Check if the job is still running
+    # Check if the job is still queued or running
+    job = queue.get(job_id)
     finished_flag = os.path.join(job_output_dir, 'input_'+job_id+'_full_dbs/finished.txt')
-    running_flag = os.path.join(BASE_OUTPUT_DIR, 'input_'+job_id+'_full_dbs/running.txt')
     failed_flag = os.path.join(job_output_dir, 'input_'+job_id+'_full_dbs/failed.txt')
 
-    if os.path.exists(finished_flag):
+    if job is not None and job.state == job_queue.QUEUED:
+        position = queue.queue_position(job_id)
+        return f'''
+            <h1>Alphafold 2 job is in the queue.</h1>
+            <p>{position} job(s) will run before it. Please refresh this page later.</p>
+            <h2>Current job queue:</h2>
+            {queue_table()}
+        '''
+    elif job is not None and job.state == job_queue.RUNNING:
+        elapsed = int(time.time() - job.started)
+        return f'''
+            <h1>Alphafold 2 job is running.</h1>
+            <p>Running on {job.worker} for {elapsed // 3600}h{elapsed // 60 % 60:02d}m. Please refresh this page later.</p>
+            <h2>Current job queue:</h2>
+            {queue_table()}
+        '''
+    elif os.path.exists(finished_flag):
         # Job is complete; display results with a link to the file browser
         browse_url = app.get_url('browse', job_id=job_id, filepath='')
         return f'''
@@ -293,7 +324,7 @@ def job_results(job_id):
             <p>You can browse the output files here:</p>
             <a href="{browse_url}">Browse output files</a>
         '''
-    elif os.path.exists(failed_flag):
+    elif os.path.exists(failed_flag) or (job is not None and job.state == job_queue.FAILED):
         # Job has failed; display error message and any available logs
         error_message = ''
         error_log_path = os.path.join(job_output_dir, 'input_'+job_id+'_full_dbs.log')
@@ -306,28 +337,6 @@ def job_results(job_id):
             <h2>Error Details:</h2>
             <pre>{error_message}</pre>
         '''
-    elif os.path.exists(running_flag):
-        # Job is still running or did not start yet
-        # Get the output of 'nvidia-smi'
-        try:
-            nvidia_smi_output = subprocess.check_output(['nvidia-smi'], universal_newlines=True)
-        except subprocess.CalledProcessError as e:
-            nvidia_smi_output = f"Failed to retrieve nvidia-smi output: {e}"
-        # Get the output of 'squeue'
-        try:
-            squeue_output = subprocess.check_output(['squeue'], universal_newlines=True)
-        except subprocess.CalledProcessError as e:
-            squeue_output = f"Failed to retrieve squeue output: {e}"
-
-        # Return the page indicating the job is still running or in the queue and display nvidia-smi/squeue output
-        return f'''
-            <h1>Alphafold 2 job is still running or is in the queue.</h1>
-            <p>Please refresh this page later.</p>
-            <h2>Current Slurm job queue:</h2>
-            <pre>{squeue_output}</pre>
-            <h2>GPU Status:</h2>
-            <pre>{nvidia_smi_output}</pre>
-        '''
     else:
         # Job failed to start
         return f'''